@@ -66,8 +66,9 @@ def calculate_reprojection_errors(
         # associate framenumbers with timestamps using 2d .h5 file
         data2d = h5_context.load_entire_table("data2d_distorted", from_2d_file=True)
         data2d_idxs = np.arange(len(data2d))
-        h5_framenumbers = data2d["frame"]
-        h5_frame_qfi = result_utils.QuickFrameIndexer(h5_framenumbers)
+        h5_frame_index = h5_context.get_row_index(
+            "data2d_distorted", from_2d_file=True
+        )
 
         if show_progress:
             string_widget = StringWidget()
@@ -118,7 +119,7 @@ def calculate_reprojection_errors(
                 if stop is not None:
                     if not framenumber <= stop:
                         continue
-                h5_2d_row_idxs = h5_frame_qfi.get_frame_idxs(framenumber)
+                h5_2d_row_idxs = h5_frame_index.get_idxs_of_equal(framenumber)
                 if len(h5_2d_row_idxs) == 0:
                     # At the start, there may be 3d data without 2d data.
                     continue
@@ -147,6 +148,9 @@ def calculate_reprojection_errors(
                 frame2d = data2d[h5_2d_row_idxs]
                 frame2d_idxs = data2d_idxs[h5_2d_row_idxs]
 
+                # project into all cameras at once
+                x2d_reproj_all = R.find2d_all(X3d, distorted=True)[:, :, 0]
+
                 obs_2d_idx = this_3d_row["obs_2d_idx"]
                 kobs_2d_data = ML_estimates_2d_idxs[int(obs_2d_idx)]
 
@@ -184,7 +188,7 @@ def calculate_reprojection_errors(
 
                     frame2d_row = frame2d[idx]
                     x2d_real = frame2d_row["x"], frame2d_row["y"]
-                    x2d_reproj = R.find2d(cam_id, X3d, distorted=True)
+                    x2d_reproj = x2d_reproj_all[R.geometry.cam_id2idx[cam_id]]
                     dist = np.sqrt(np.sum((x2d_reproj - x2d_real) ** 2))
 
                     out["camn"].append(camn)
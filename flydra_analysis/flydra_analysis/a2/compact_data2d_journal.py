@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import argparse
+import os
+import sys
+
+from flydra_core.data2d_journal import compact_journal, get_journal_dirname
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="save the 2D data journal of a MainBrain .h5 file into it "
+        "(e.g. after the MainBrain crashed while saving)"
+    )
+    parser.add_argument("file", type=str, help="the .h5 file saved by the MainBrain")
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="the journal directory (default: next to the .h5 file)",
+    )
+    parser.add_argument(
+        "--keep-journal",
+        action="store_true",
+        default=False,
+        help="do not remove the journal afterwards",
+    )
+    options = parser.parse_args()
+    journal = options.journal
+    if journal is None:
+        journal = get_journal_dirname(options.file)
+    if not os.path.isdir(journal):
+        print("no journal %r" % journal, file=sys.stderr)
+        sys.exit(1)
+    n_rows = compact_journal(journal, options.file, remove=not options.keep_journal)
+    print("%s: saved %d rows of 2D data" % (options.file, n_rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,8 @@ import flydra_analysis.analysis.result_utils
 import flydra_core.reconstruct
 import flydra_analysis.analysis.PQmath as PQmath
 from flydra_analysis.a2.tables_tools import open_file_safe
+from flydra_analysis.a2.sidecar_index import get_sidecar_index
+import flydra_analysis.a2.utils as utils
 import cgtypes  # cgkit 1.x
 
 import weakref
@@ -333,6 +335,21 @@ def _get_initial_file_info(kresults):
     return obj_ids, unique_obj_ids, is_mat_file, extra
 
 
+def _get_obj_id_row_idxs(obj_id_finder, obj_id):
+    """get the row numbers of obj_id in the table of obj_id_finder
+
+    obj_id may also be a sequence of obj_ids, in which case the rows
+    of all of them are concatenated, to be treated as one object.
+    """
+    if obj_id_finder is None:
+        # no such table
+        return numpy.zeros((0,), dtype=numpy.int64)
+    if isinstance(obj_id, int) or isinstance(obj_id, numpy.integer):
+        # obj_id is an integer, normal case
+        return obj_id_finder.get_idxs_of_equal(obj_id)
+    return numpy.concatenate([obj_id_finder.get_idxs_of_equal(oi) for oi in obj_id])
+
+
 def kalman_smooth(orig_rows, dynamic_model_name=None, frames_per_second=None):
     if StrictVersion(adskalman_version.__version__) < StrictVersion("0.3.4"):
         raise ValueError(
@@ -1537,8 +1554,7 @@ class FileContextManager:
     def read_textlog_header_2d(self):
         return flydra_analysis.analysis.result_utils.read_textlog_header(self._2d_file)
 
-    def get_pytable_node(self, table_name, from_2d_file=False, groups=None):
-        """read entire table into RAM"""
+    def _get_group(self, from_2d_file=False, groups=None):
         if groups is None:
             groups = ["root"]
         if from_2d_file:
@@ -1547,18 +1563,41 @@ class FileContextManager:
             cur_base = self._data_file
         for g in groups:
             cur_base = getattr(cur_base, g)
+        return cur_base
+
+    def get_pytable_node(self, table_name, from_2d_file=False, groups=None):
+        """read entire table into RAM"""
+        cur_base = self._get_group(from_2d_file=from_2d_file, groups=groups)
 
         if table_name == "ML_estimates_2d_idxs":
-            if not hasattr(cur_base, table_name) and hasattr(
-                cur_base, "kalman_observations_2d_idxs"
-            ):
-                # backwards compatibility
-                table_name = "kalman_observations_2d_idxs"
+            # rows are read as accessed, from the current or the old layout
+            return flydra_core.kalman.flydra_kalman_utils.read_ML_estimates_2d_idxs(
+                cur_base, load=False
+            )
 
         return getattr(cur_base, table_name)
 
-    def load_entire_table(self, *args, **kwargs):
-        table = self.get_pytable_node(*args, **kwargs)
+    def get_row_index(self, table_name, colname=None, from_2d_file=False):
+        """get the persistent RowIndex of a column of a table
+
+        See flydra_analysis.a2.sidecar_index. Returns None if there is
+        no such table.
+        """
+        if from_2d_file:
+            h5file = self._2d_file
+        else:
+            h5file = self._data_file
+        return get_sidecar_index(h5file).get(table_name, colname)
+
+    def load_entire_table(self, table_name, from_2d_file=False, groups=None):
+        if table_name == "ML_estimates_2d_idxs":
+            cur_base = self._get_group(from_2d_file=from_2d_file, groups=groups)
+            return flydra_core.kalman.flydra_kalman_utils.read_ML_estimates_2d_idxs(
+                cur_base
+            )
+        table = self.get_pytable_node(
+            table_name, from_2d_file=from_2d_file, groups=groups
+        )
         nptable = table[:]
         return nptable
 
@@ -1717,18 +1756,7 @@ class CachingAnalyzer:
         if preloaded_dict is None:
             preloaded_dict = self._load_dict(result_h5_file)
         kresults = preloaded_dict["kresults"]
-        # XXX this is slow! Should precompute indexes on file load.
-        obs_obj_ids = preloaded_dict["obs_obj_ids"]
-
-        if isinstance(obj_id, int) or isinstance(obj_id, numpy.integer):
-            # obj_id is an integer, normal case
-            idxs = numpy.nonzero(obs_obj_ids == obj_id)[0]
-        else:
-            # may specify sequence of obj_id -- concatenate data, treat as one object
-            idxs = []
-            for oi in obj_id:
-                idxs.append(numpy.nonzero(obs_obj_ids == oi)[0])
-            idxs = numpy.concatenate(idxs)
+        idxs = _get_obj_id_row_idxs(preloaded_dict["obs_obj_id_finder"], obj_id)
 
         try:
             rows = kresults.root.ML_estimates.read_coordinates(idxs)
@@ -1851,51 +1879,13 @@ class CachingAnalyzer:
             kresults = preloaded_dict["kresults"]
 
             if 1:
-                # XXX this is slow! Should precompute indexes on file load.
-                obj_ids = preloaded_dict["obj_ids"]
-                if isinstance(obj_id, int) or isinstance(obj_id, numpy.integer):
-                    # obj_id is an integer, normal case
-                    idxs = numpy.nonzero(obj_ids == obj_id)[0]
-                else:
-                    # may specify sequence of obj_id -- concatenate data, treat as one object
-                    idxs = []
-                    for oi in obj_id:
-                        idxs.append(numpy.nonzero(obj_ids == oi)[0])
-                    idxs = numpy.concatenate(idxs)
+                idxs = _get_obj_id_row_idxs(preloaded_dict["obj_id_finder"], obj_id)
                 kalman_rows = kresults.root.kalman_estimates.read_coordinates(idxs)
 
             if use_kalman_smoothing:
-                obs_obj_ids = preloaded_dict["obs_obj_ids"]
-
-                if isinstance(obj_id, int) or isinstance(obj_id, numpy.integer):
-                    # obj_id is an integer, normal case
-                    tmp_cond = obs_obj_ids == obj_id
-                    tmp_nz = numpy.nonzero(tmp_cond)
-                    del tmp_cond
-                    if len(tmp_nz):
-                        obs_idxs = tmp_nz[0]
-                    else:
-                        obs_idxs = []
-                    del tmp_nz
-                else:
-                    # may specify sequence of obj_id -- concatenate
-                    # data, treat as one object
-                    obs_idxs = []
-                    for oi in obj_id:
-                        tmp_idxes = numpy.nonzero(obs_obj_ids == oi)
-                        try:
-                            tmp_idx = tmp_idxes[0]
-                        except IndexError:
-                            raise ValueError(
-                                "obj_id %s does not exist in " "observations" % oi
-                            )
-                        obs_idxs.append(tmp_idx)
-                        del tmp_idxes, tmp_idx
-                        ## print 'oi',oi
-                        ## print 'oi',type(oi)
-                        ## print 'len(obs_idxs[-1])',len(obs_idxs[-1])
-                        ## print
-                    obs_idxs = numpy.concatenate(obs_idxs)
+                obs_idxs = _get_obj_id_row_idxs(
+                    preloaded_dict["obs_obj_id_finder"], obj_id
+                )
 
                 # Kalman observations are already always in meters, no
                 # scale factor needed
@@ -2020,6 +2010,14 @@ class CachingAnalyzer:
             return uoi
         else:
             preloaded_dict = self.loaded_h5_cache.get(data_file, None)
+            if preloaded_dict["unique_obj_ids"] is None:
+                obs_obj_id_finder = preloaded_dict["obs_obj_id_finder"]
+                if obs_obj_id_finder is None:
+                    uoi = numpy.unique([])
+                else:
+                    # the keys of the sidecar index are the unique obj_ids
+                    uoi = numpy.asarray(obs_obj_id_finder.finder.keys)
+                preloaded_dict["unique_obj_ids"] = uoi
             return preloaded_dict["unique_obj_ids"]
 
     def calculate_trajectory_metrics(
@@ -2334,20 +2332,33 @@ class CachingAnalyzer:
         self_should_close = False
         # XXX I should make my reference a weakref
 
-        obj_ids = kresults.root.kalman_estimates.read(field="obj_id")
+        # The obj_id columns are looked up in the sidecar index, which
+        # is only built if it is not saved yet.
+        sidecar_index = get_sidecar_index(kresults)
+        obj_id_finder = utils.TableFinder(
+            kresults.root.kalman_estimates,
+            "obj_id",
+            row_index=sidecar_index.get("kalman_estimates"),
+        )
         if hasattr(kresults.root, "ML_estimates"):
-            obs_obj_ids = kresults.root.ML_estimates.read(field="obj_id")
+            obs_table = kresults.root.ML_estimates
         elif hasattr(kresults.root, "kalman_observations"):
-            obs_obj_ids = kresults.root.kalman_observations.read(field="obj_id")
+            obs_table = kresults.root.kalman_observations
+        else:
+            obs_table = None
+        if obs_table is None:
+            obs_obj_id_finder = None
         else:
-            obs_obj_ids = []
-        unique_obj_ids = numpy.unique(obs_obj_ids)
+            obs_obj_id_finder = utils.TableFinder(
+                obs_table, "obj_id", row_index=sidecar_index.get(obs_table.name)
+            )
         preloaded_dict = {
             "kresults": kresults,
             "self_should_close": self_should_close,
-            "obj_ids": obj_ids,
-            "obs_obj_ids": obs_obj_ids,
-            "unique_obj_ids": unique_obj_ids,
+            "obj_id_finder": obj_id_finder,
+            "obs_table": obs_table,
+            "obs_obj_id_finder": obs_obj_id_finder,
+            "unique_obj_ids": None,  # found when first needed
         }
         self.loaded_h5_cache[result_h5_file] = preloaded_dict
         return preloaded_dict
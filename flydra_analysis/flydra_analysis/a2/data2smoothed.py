@@ -88,18 +88,9 @@ def convert(
 
             print("caching raw 2D data...", end=" ")
             sys.stdout.flush()
-            table_data2d_frames = table_data2d.read(field="frame")
-            assert numpy.max(table_data2d_frames) < 2 ** 63
-            table_data2d_frames = table_data2d_frames.astype(numpy.int64)
-            # table_data2d_frames_find = fastsearch.binarysearch.BinarySearcher( table_data2d_frames )
-            table_data2d_frames_find = utils.FastFinder(table_data2d_frames)
-            table_data2d_camns = table_data2d.read(field="camn")
-            table_data2d_timestamps = table_data2d.read(field="timestamp")
+            # uses the index of the frame column, if present
+            table_data2d_frames_find = utils.TableFinder(table_data2d, "frame")
             print("done")
-            print(
-                "(cached index of %d frame values of dtype %s)"
-                % (len(table_data2d_frames), str(table_data2d_frames.dtype))
-            )
 
             drift_estimates = h5_context.get_drift_estimates()
             camn2cam_id, cam_id2camns = h5_context.get_caminfo_dicts()
@@ -144,9 +135,6 @@ def convert(
                 raise ValueError("no 3D data, cannot convert")
             assert numpy.max(table_kobs_frame) < 2 ** 63
             table_kobs_frame = table_kobs_frame.astype(numpy.int64)
-            assert (
-                table_kobs_frame.dtype == table_data2d_frames.dtype
-            )  # otherwise very slow
 
             all_idxs = fast_obs_obj_ids.get_idx_of_equal(unique_obj_ids)
             for obj_id_enum, obj_id in enumerate(unique_obj_ids):
@@ -157,9 +145,9 @@ def convert(
                 this_camn = None
                 frame_idxs = table_data2d_frames_find.get_idxs_of_equal(framenumber)
                 if len(frame_idxs):
-                    frame_idx = frame_idxs[0]
-                    this_camn = table_data2d_camns[frame_idx]
-                    remote_timestamp = table_data2d_timestamps[frame_idx]
+                    frame_row = table_data2d.read_coordinates(frame_idxs[:1])
+                    this_camn = frame_row["camn"][0]
+                    remote_timestamp = frame_row["timestamp"][0]
 
                 if this_camn is None:
                     print(
@@ -38,23 +38,14 @@ def do_data_association_tables(src_h5, output_file, options):
     new_obs_rows = []
     new_ML_est_rows = orig_ML_est_rows[:]  # copy
     idxcol = orig_ML_est_rows["obs_2d_idx"]
+    src_2d_obs = flydra_kalman_utils.read_ML_estimates_2d_idxs(src_h5.root)
     for i in range(len(orig_ML_est_rows)):
-        idxidx2d = int(
-            idxcol[i]
-        )  # orig_ML_est_row['obs_2d_idx']) # XXX pytables fails with np.uint64?
-        idx2d = src_h5.root.ML_estimates_2d_idxs[idxidx2d]
+        idx2d = src_2d_obs[idxcol[i]]
         new_ML_est_rows["obs_2d_idx"][i] = len(new_obs_rows)
         new_obs_rows.append(idx2d)
     # Save data association information.
-    ML_estimates_2d_idxs_type = flydra_kalman_utils.ML_estimates_2d_idxs_type
-    h5_2d_obs = output_file.create_vlarray(
-        output_file.root,
-        "ML_estimates_2d_idxs",
-        ML_estimates_2d_idxs_type(),  # dtype should match with tro.observations_2d
-        "camns and idxs",
-    )
-    for camns_and_idxs in new_obs_rows:
-        h5_2d_obs.append(camns_and_idxs)
+    h5_2d_obs = flydra_kalman_utils.MLEstimates2dIdxsWriter(output_file)
+    h5_2d_obs.append_rows(new_obs_rows)
     h5_2d_obs.flush()
 
     # Save ML_estimates.
@@ -130,10 +121,10 @@ def h5_shorten(input_filename, output_filename, options):
                             continue
                     print("selectively copying", node)
                     copy_selective(h5, node, output_h5.root, options)
-                elif hasattr(node, "name") and node.name in [
-                    "ML_estimates",
-                    "ML_estimates_2d_idxs",
-                ]:
+                elif hasattr(node, "name") and (
+                    node.name == "ML_estimates"
+                    or flydra_kalman_utils.is_ML_estimates_2d_idxs_node(node.name)
+                ):
                     continue
                 else:
                     # copy everything from source to dest
@@ -15,6 +15,7 @@ import numpy as np
 import tables as PT
 from optparse import OptionParser
 import flydra_core.reconstruct as reconstruct
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 import motmot.ufmf.ufmf as ufmf
 import motmot.imops.imops as imops
 import flydra_analysis.a2.utils as utils
@@ -29,6 +30,7 @@ from . import benu
 import adskalman.adskalman
 
 from .tables_tools import clear_col, open_file_safe
+from .sidecar_index import get_sidecar_index
 
 font_size = 14
 
@@ -312,14 +314,7 @@ def doit(
     obj_ids, use_obj_ids, is_mat_file, data_file, extra = ca.initial_file_load(
         kalman_filename
     )
-    try:
-        ML_estimates_2d_idxs = data_file.root.ML_estimates_2d_idxs[:]
-    except tables.exceptions.NoSuchNodeError as err1:
-        # backwards compatibility
-        try:
-            ML_estimates_2d_idxs = data_file.root.kalman_observations_2d_idxs[:]
-        except tables.exceptions.NoSuchNodeError as err2:
-            raise err1
+    ML_estimates_2d_idxs = flydra_kalman_utils.read_ML_estimates_2d_idxs(data_file.root)
 
     if os.path.exists(output_h5_filename):
         raise RuntimeError("will not overwrite old file '%s'" % output_h5_filename)
@@ -381,8 +376,7 @@ def doit(
             # associate framenumbers with timestamps using 2d .h5 file
             data2d = h5.root.data2d_distorted[:]  # load to RAM
             data2d_idxs = np.arange(len(data2d))
-            h5_framenumbers = data2d["frame"]
-            h5_frame_qfi = result_utils.QuickFrameIndexer(h5_framenumbers)
+            h5_frame_index = get_sidecar_index(h5).get("data2d_distorted")
 
             fpc = realtime_image_analysis.FitParamsClass()  # allocate FitParamsClass
 
@@ -413,7 +407,7 @@ def doit(
                     if stop is not None:
                         if not framenumber <= stop:
                             continue
-                    h5_2d_row_idxs = h5_frame_qfi.get_frame_idxs(framenumber)
+                    h5_2d_row_idxs = h5_frame_index.get_idxs_of_equal(framenumber)
 
                     frame2d = data2d[h5_2d_row_idxs]
                     frame2d_idxs = data2d_idxs[h5_2d_row_idxs]
@@ -13,6 +13,7 @@ from optparse import OptionParser
 
 from .tables_tools import clear_col, open_file_safe
 import flydra_core.kalman.ekf as kalman_ekf
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 import flydra_analysis.analysis.PQmath as PQmath
 import flydra_core.geom as geom
 import cgtypes  # cgkit 1.x
@@ -415,7 +416,9 @@ def doit(
                 h5_framenumbers = data2d["frame"]
                 h5_frame_qfi = result_utils.QuickFrameIndexer(h5_framenumbers)
 
-                ML_estimates_2d_idxs = kh5.root.ML_estimates_2d_idxs[:]
+                ML_estimates_2d_idxs = flydra_kalman_utils.read_ML_estimates_2d_idxs(
+                    kh5.root
+                )
 
                 all_kobs_obj_ids = dest_table.read(field="obj_id")
                 all_kobs_frames = dest_table.read(field="frame")
@@ -525,23 +525,18 @@ current list of 2D points
             obs_2d_idxs = kobs.read(field="obs_2d_idx")[k_use_idxs]
             kframes = kframes[k_use_idxs]
 
-            kobs_2d = kresults.root.ML_estimates_2d_idxs
+            kobs_2d = flydra_core.kalman.flydra_kalman_utils.read_ML_estimates_2d_idxs(
+                kresults.root
+            )
             xys_by_obj_id = {}
             for obj_id, kframe, obs_2d_idx in zip(obj_ids, kframes, obs_2d_idxs):
                 if obj_only is not None:
                     if obj_id not in obj_only:
                         continue
 
-                obs_2d_idx_find = int(
-                    obs_2d_idx
-                )  # XXX grr, why can't pytables do this?
                 obj_id_save = int(obj_id)  # convert from possible numpy scalar
                 xys_by_cam_id = xys_by_obj_id.setdefault(obj_id_save, {})
-                kobs_2d_data = kobs_2d.read(
-                    start=obs_2d_idx_find, stop=obs_2d_idx_find + 1
-                )
-                assert len(kobs_2d_data) == 1
-                kobs_2d_data = kobs_2d_data[0]
+                kobs_2d_data = kobs_2d[obs_2d_idx]
                 this_camns = kobs_2d_data[0::2]
                 this_camn_idxs = kobs_2d_data[1::2]
 
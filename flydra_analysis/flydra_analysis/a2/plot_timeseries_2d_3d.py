@@ -15,6 +15,7 @@ import numpy as np
 import tables as PT
 from optparse import OptionParser
 import flydra_core.reconstruct as reconstruct
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 
 import matplotlib
 import matplotlib.ticker as ticker
@@ -323,6 +324,10 @@ def doit(
                 kalman_rows = kalman_rows[valid_cond]
                 kalman_3d_frame = kalman_3d_frame[valid_cond]
 
+            ML_estimates_2d_idxs = flydra_kalman_utils.read_ML_estimates_2d_idxs(
+                data_file.root
+            )
+
             # modified from save_movies_overlay
             for this_3d_row_enum, this_3d_row in enumerate(kalman_rows):
                 if this_3d_row_enum % 100 == 0:
@@ -338,15 +343,9 @@ def doit(
                     # no observation this frame
                     continue
                 obs_2d_idx = this_3d_row["obs_2d_idx"]
-                try:
-                    kobs_2d_data = data_file.root.ML_estimates_2d_idxs[int(obs_2d_idx)]
-                except tables.exceptions.NoSuchNodeError as err:
-                    # backwards compatibility
-                    kobs_2d_data = data_file.root.kalman_observations_2d_idxs[
-                        int(obs_2d_idx)
-                    ]
-
-                # parse VLArray
+                kobs_2d_data = ML_estimates_2d_idxs[obs_2d_idx]
+
+                # parse camns and idxs
                 this_camns = kobs_2d_data[0::2]
                 this_camn_idxs = kobs_2d_data[1::2]
 
@@ -567,15 +566,10 @@ def doit(
                 obs_2d_idxs = kobs.read(field="obs_2d_idx")[k_use_idxs]
                 kframes = kframes[k_use_idxs]
 
-                try:
-                    kobs_2d = kresults.root.ML_estimates_2d_idxs
-                except tables.exceptions.NoSuchNodeError:
-                    # backwards compatibility
-                    kobs_2d = kresults.root.kalman_observations_2d_idxs
-                # this will be slooow...
+                kobs_2d = flydra_kalman_utils.read_ML_estimates_2d_idxs(kresults.root)
                 used_cam_ids = collections.defaultdict(list)
                 for obs_2d_idx, kframe in zip(obs_2d_idxs, kframes):
-                    obs_2d_row = kobs_2d[int(obs_2d_idx)]
+                    obs_2d_row = kobs_2d[obs_2d_idx]
                     # print kframe,obs_2d_row
                     for camn in obs_2d_row[::2]:
                         try:
@@ -10,6 +10,7 @@ import scipy.misc
 import flydra_analysis.a2.ufmf_tools as ufmf_tools
 import scipy.ndimage
 import flydra_core.data_descriptions
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 from .tables_tools import open_file_safe
 import motmot.FastImage.FastImage as FastImage
 import motmot.realtime_image_analysis.realtime_image_analysis as realtime_image_analysis
@@ -142,8 +143,9 @@ def retrack_movies(
                     "data2d_distorted",
                     "kalman_estimates",
                     "ML_estimates",
-                    "ML_estimates_2d_idxs",
-                ]:
+                ] and not flydra_kalman_utils.is_ML_estimates_2d_idxs_node(
+                    input_node._v_name
+                ):
                     print("copying", input_node._v_name)
                     # copy everything from source to dest
                     input_node._f_copy(output_h5.root, recursive=True)
@@ -100,13 +100,13 @@ def retrack_reuse_data_association(
                 data2d = h5_context.get_pytable_node(
                     "data2d_distorted", from_2d_file=True
                 )
-                h5_framenumbers = data2d.cols.frame[:]
             else:
                 data2d = h5_context.load_entire_table(
                     "data2d_distorted", from_2d_file=True
                 )
-                h5_framenumbers = data2d["frame"]
-            h5_frame_qfi = result_utils.QuickFrameIndexer(h5_framenumbers)
+            h5_frame_index = h5_context.get_row_index(
+                "data2d_distorted", from_2d_file=True
+            )
 
             if show_progress:
                 string_widget = StringWidget()
@@ -142,7 +142,7 @@ def retrack_reuse_data_association(
                     if stop is not None:
                         if not framenumber <= stop:
                             continue
-                    h5_2d_row_idxs = h5_frame_qfi.get_frame_idxs(framenumber)
+                    h5_2d_row_idxs = h5_frame_index.get_idxs_of_equal(framenumber)
                     if len(h5_2d_row_idxs) == 0:
                         # At the start, there may be 3d data without 2d data.
                         continue
@@ -247,6 +247,7 @@ def retrack_reuse_data_association(
                 if tro is not None:
                     tro.kill()
                     h5saver.save_tro(tro, force_obj_id=obj_id)
+            h5saver.close()
     if show_progress_json:
         result_utils.do_json_progress(100)
 
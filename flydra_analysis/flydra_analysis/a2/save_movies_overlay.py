@@ -20,9 +20,11 @@ import numpy as np
 import tables as PT
 from optparse import OptionParser
 import flydra_core.reconstruct as reconstruct
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 import sets
 import motmot.ufmf.ufmf as ufmf
 import flydra_analysis.a2.utils as utils
+from flydra_analysis.a2.sidecar_index import get_sidecar_index
 import flydra_analysis.a2.aggdraw_coord_shifter as aggdraw_coord_shifter
 
 PLOT = "image"
@@ -51,16 +53,18 @@ def ensure_minsize_image(arr, xxx_todo_changeme, fill=0):
 class KObsRowCacher:
     def __init__(self, h5):
         self.h5 = h5
-        self.all_rows_obj_ids = h5.root.ML_estimates.read(field="obj_id")
-        self.all_rows_frames = h5.root.ML_estimates.read(field="frame")
+        self.obj_id_finder = utils.TableFinder(
+            h5.root.ML_estimates,
+            "obj_id",
+            row_index=get_sidecar_index(h5).get("ML_estimates"),
+        )
         self.cache = {}
 
     def get(self, obj_id):
         if obj_id in self.cache:
             return self.cache[obj_id]
         else:
-            cond = self.all_rows_obj_ids == obj_id
-            frames = self.all_rows_frames[cond]
+            frames = self.obj_id_finder.read_equal(obj_id, field="frame")
             try:
                 qualities = core_analysis.compute_ori_quality(self.h5, frames, obj_id)
             except Exception as err:
@@ -406,6 +410,9 @@ def doit(
         print("done loading frame information.")
 
     kobs_row_cacher = KObsRowCacher(data_file)
+    ML_estimates_2d_idxs = flydra_kalman_utils.read_ML_estimates_2d_idxs(
+        data_file.root
+    )
 
     print("start, stop", start, stop)
     if not options.no_progress:
@@ -574,9 +581,9 @@ def doit(
 
                     vert_image = R.find2d(cam_id, vert, distorted=True)
                     obs_2d_idx = this_3d_row["obs_2d_idx"]
-                    kobs_2d_data = data_file.root.ML_estimates_2d_idxs[int(obs_2d_idx)]
+                    kobs_2d_data = ML_estimates_2d_idxs[obs_2d_idx]
 
-                    # parse VLArray
+                    # parse camns and idxs
                     this_camns = kobs_2d_data[0::2]
                     this_camn_idxs = kobs_2d_data[1::2]
                     this_cam_ids = [camn2cam_id[this_camn] for this_camn in this_camns]
@@ -0,0 +1,251 @@
+"""persistent indexes of the rows of flydra HDF5 files
+
+Looking up the rows of one obj_id or frame otherwise requires reading
+the entire column. The index of a file is saved next to it as
+'<file>.flydra-idx' and is built only once. It is validated by the
+md5sum_headtail() hash and the number of rows of the indexed tables.
+
+The arrays in the index file are memory mapped, so opening it costs
+almost nothing and each lookup is a binary search.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+import json
+import os
+import struct
+import tempfile
+import warnings
+
+import numpy as np
+import tables
+
+import flydra_analysis.analysis.result_utils as result_utils
+
+__all__ = ["RowIndex", "SidecarIndex", "get_sidecar_index"]
+
+SIDECAR_SUFFIX = ".flydra-idx"
+_MAGIC = b"FLYDRAIDX1\n"
+_ALIGN = 64
+
+# the columns indexed by default, by table
+INDEXED_COLUMNS = {
+    "ML_estimates": "obj_id",
+    "kalman_observations": "obj_id",  # older files
+    "kalman_estimates": "obj_id",
+    "data2d_distorted": "frame",
+}
+
+
+class RowIndex(object):
+    """the row numbers of a table, grouped by the value of one column
+
+    keys holds the sorted unique values of the column and the rows
+    with value keys[i] are rows[offsets[i]:offsets[i+1]], in
+    increasing order.
+    """
+
+    def __init__(self, keys, offsets, rows):
+        self.keys = keys
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def from_column(cls, values):
+        values = np.asarray(values)
+        rows = np.argsort(values, kind="mergesort")
+        sorted_values = values[rows]
+        keys, starts = np.unique(sorted_values, return_index=True)
+        offsets = np.empty((len(keys) + 1,), dtype=np.int64)
+        offsets[:-1] = starts
+        offsets[-1] = len(values)
+        return cls(keys, offsets, rows.astype(np.int64))
+
+    def get_idxs_of_equal(self, testval):
+        """get the sorted row numbers with column value equal to testval"""
+        i = self.keys.searchsorted(testval)
+        if i == len(self.keys) or self.keys[i] != testval:
+            return np.zeros((0,), dtype=np.int64)
+        return np.asarray(self.rows[self.offsets[i] : self.offsets[i + 1]])
+
+    def get_idxs_in_range(self, low, high):
+        """get the sorted row numbers with column value in [low, high]"""
+        i0 = self.keys.searchsorted(low, side="left")
+        i1 = self.keys.searchsorted(high, side="right")
+        return np.sort(self.rows[self.offsets[i0] : self.offsets[i1]])
+
+
+def _write_index_file(filename, header, arrays):
+    """write the arrays with their layout in a JSON header"""
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+    header = dict(header, arrays=layout)
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    data_start = len(_MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start // _ALIGN) * _ALIGN
+
+    # write a temporary file and rename, so readers never see a
+    # partially written index
+    out_dir = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=out_dir, suffix=SIDECAR_SUFFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for name, arr in arrays.items():
+                f.seek(data_start + layout[name][2])
+                f.write(np.ascontiguousarray(arr).tostring())
+            f.truncate(data_start + offset)
+        os.rename(tmp_filename, filename)
+    except:
+        os.unlink(tmp_filename)
+        raise
+
+
+def _read_index_file(filename):
+    """read the header and memory map the arrays of an index file"""
+    with open(filename, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not an index file" % filename)
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = len(_MAGIC) + 8 + header_len
+    data_start = -(-data_start // _ALIGN) * _ALIGN
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        shape = tuple(shape)
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                filename,
+                dtype=dtype,
+                mode="r",
+                offset=data_start + offset,
+                shape=shape,
+            )
+    return header, arrays
+
+
+class SidecarIndex(object):
+    """the row indexes of an open HDF5 file, saved next to it
+
+    Indexes are built when first needed and added to the sidecar file.
+    If the sidecar file cannot be written, they are kept in memory
+    only.
+    """
+
+    def __init__(self, h5file):
+        self.h5file = h5file
+        self.filename = os.path.abspath(h5file.filename) + SIDECAR_SUFFIX
+        self.hash = result_utils.md5sum_headtail(h5file.filename)
+        self.entries = {}  # nrows of each indexed table and column
+        self.arrays = {}
+        self.row_indexes = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            header, arrays = _read_index_file(self.filename)
+        except (IOError, OSError, ValueError) as err:
+            warnings.warn("ignoring broken index file %s: %s" % (self.filename, err))
+            return
+        if header.get("hash") != self.hash:
+            # the data file changed, rebuild all indexes
+            return
+        self.entries = header["entries"]
+        self.arrays = arrays
+
+    def _save(self):
+        try:
+            _write_index_file(
+                self.filename,
+                {"hash": self.hash, "entries": self.entries},
+                self.arrays,
+            )
+        except (IOError, OSError) as err:
+            warnings.warn("could not save index file %s: %s" % (self.filename, err))
+
+    def get(self, table_name, colname=None):
+        """get the RowIndex of a column, or None if there is no such table"""
+        if colname is None:
+            colname = INDEXED_COLUMNS[table_name]
+        key = "%s/%s" % (table_name, colname)
+        if key in self.row_indexes:
+            return self.row_indexes[key]
+        try:
+            table = self.h5file.get_node(self.h5file.root, table_name)
+        except tables.NoSuchNodeError:
+            return None
+        names = [key + "/keys", key + "/offsets", key + "/rows"]
+        if self.entries.get(key) != table.nrows:
+            row_index = RowIndex.from_column(table.read(field=colname))
+            self.arrays.update(
+                zip(names, [row_index.keys, row_index.offsets, row_index.rows])
+            )
+            self.entries[key] = int(table.nrows)
+            self._save()
+        else:
+            row_index = RowIndex(*[self.arrays[name] for name in names])
+        self.row_indexes[key] = row_index
+        return row_index
+
+
+_sidecar_indexes = {}
+
+
+def get_sidecar_index(h5file):
+    """get the SidecarIndex of an open HDF5 file"""
+    key = os.path.abspath(h5file.filename)
+    sidecar_index = _sidecar_indexes.get(key, None)
+    if sidecar_index is None or not sidecar_index.h5file.isopen:
+        sidecar_index = SidecarIndex(h5file)
+        _sidecar_indexes[key] = sidecar_index
+    return sidecar_index
+
+
+def test_sidecar_index():
+    class Row(tables.IsDescription):
+        obj_id = tables.UInt32Col(pos=0)
+        frame = tables.Int64Col(pos=1)
+
+    rng = np.random.RandomState(0)
+    obj_ids = rng.randint(0, 20, size=500).astype(np.uint32)
+    frames = np.arange(500)
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "data.h5")
+    try:
+        with tables.open_file(fname, mode="w") as h5file:
+            table = h5file.create_table(h5file.root, "ML_estimates", Row)
+            table.append(np.rec.fromarrays([obj_ids, frames]))
+
+        for built in [False, True]:
+            with tables.open_file(fname, mode="r") as h5file:
+                assert os.path.exists(fname + SIDECAR_SUFFIX) == built
+                sidecar_index = SidecarIndex(h5file)
+                row_index = sidecar_index.get("ML_estimates")
+                assert isinstance(row_index.rows, np.memmap) == built
+                assert sidecar_index.get("kalman_estimates") is None
+                assert row_index.keys.tolist() == np.unique(obj_ids).tolist()
+                for obj_id in range(22):
+                    expected = np.nonzero(obj_ids == obj_id)[0]
+                    actual = row_index.get_idxs_of_equal(obj_id)
+                    assert actual.tolist() == expected.tolist()
+                expected = np.nonzero((obj_ids >= 3) & (obj_ids <= 7))[0]
+                assert row_index.get_idxs_in_range(3, 7).tolist() == expected.tolist()
+
+        # the index is rebuilt once the file changes
+        with tables.open_file(fname, mode="a") as h5file:
+            h5file.root.ML_estimates.append([(99, 500)])
+        with tables.open_file(fname, mode="r") as h5file:
+            row_index = SidecarIndex(h5file).get("ML_estimates")
+            assert row_index.get_idxs_of_equal(99).tolist() == [500]
+    finally:
+        for name in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
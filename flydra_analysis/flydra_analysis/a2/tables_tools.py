@@ -24,6 +24,15 @@ def clear_col(dest_table, colname, fill_value=np.nan):
             row.update()
 
 
+def has_csindex(table, colname):
+    """True if column colname of table has a clean, completely sorted index"""
+    if not hasattr(table, "colinstances"):
+        # not a PyTables table (e.g. a 2D data journal)
+        return False
+    index = table.colinstances[colname].index
+    return index is not None and index.is_csi and not index.dirty
+
+
 @contextlib.contextmanager
 def open_file_safe(filename, delete_on_error=False, **kwargs):
     """open a file that will be closed when it goes out of scope
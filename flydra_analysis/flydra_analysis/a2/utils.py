@@ -4,6 +4,7 @@ import time, warnings
 
 # import pyximport; pyximport.install() # requires recent Cython
 from . import fastfinder_help
+from .tables_tools import has_csindex
 
 
 class MissingValueError(Exception):
@@ -153,6 +154,62 @@ class FastFinder(object):
         return this_idxs
 
 
+class TableFinder(object):
+    """fast search of the rows of a PyTables table by value of a column
+
+    If a RowIndex (see sidecar_index) of the column is given, rows are
+    looked up in it. Else, if the column has a completely sorted index,
+    rows are looked up in the index and the column is never read in
+    full. Otherwise, the column is read once and searched with a
+    FastFinder.
+
+    Parameters
+    ----------
+    table : tables.Table
+      The table to search
+    colname : str
+      The name of the (integer) column to search
+    row_index : sidecar_index.RowIndex, optional
+      A prebuilt index of the column
+    """
+
+    def __init__(self, table, colname, row_index=None):
+        self.table = table
+        self.colname = colname
+        if row_index is not None:
+            self.finder = row_index
+        elif has_csindex(table, colname):
+            self.finder = None
+        else:
+            self.finder = FastFinder(table.read(field=colname))
+
+    def get_idxs_of_equal(self, testval):
+        """get the sorted row numbers with column value equal to testval"""
+        if self.finder is None:
+            return self.table.get_where_list(
+                "%s == testval" % self.colname,
+                condvars={"testval": int(testval)},
+                sort=True,
+            )
+        return np.sort(self.finder.get_idxs_of_equal(testval))
+
+    def get_idxs_in_range(self, low, high):
+        """get the sorted row numbers with column value in [low, high]"""
+        if self.finder is None:
+            return self.table.get_where_list(
+                "(%s >= low) & (%s <= high)" % (self.colname, self.colname),
+                condvars={"low": int(low), "high": int(high)},
+                sort=True,
+            )
+        return np.sort(self.finder.get_idxs_in_range(low, high))
+
+    def read_equal(self, testval, field=None):
+        """read the rows with column value equal to testval"""
+        return self.table.read_coordinates(
+            self.get_idxs_of_equal(testval), field=field
+        )
+
+
 def iter_contig_chunk_idxs(arr):
     if len(arr) == 0:
         return
@@ -18,6 +18,7 @@ from multicamselfcal.execute import MultiCamSelfCal
 import warnings
 
 import flydra_core.reconstruct
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 import flydra_analysis.analysis.result_utils as result_utils
 
 
@@ -111,7 +112,7 @@ def do_it(
             bad = set(mylocals["bad"])
             use_obj_ids = list(use_obj_ids.difference(bad))
         kobs = results.root.ML_estimates
-        kobs_2d = results.root.ML_estimates_2d_idxs
+        kobs_2d = flydra_kalman_utils.read_ML_estimates_2d_idxs(results.root)
 
     h5_2d_data = result_utils.get_results(h5_2d_data_filename, mode="r+")
 
@@ -182,15 +183,10 @@ def do_it(
 
                 # sys.stdout.write('  reading frame data...')
                 # sys.stdout.flush()
-                obs_2d_idx_find_next = obs_2d_idx_find + numpy.uint64(1)
-                kobs_2d_data = kobs_2d.read(
-                    start=obs_2d_idx_find, stop=obs_2d_idx_find_next
-                )
+                kobs_2d_data = kobs_2d[obs_2d_idx_find]
                 # sys.stdout.write('done\n')
                 # sys.stdout.flush()
 
-                assert len(kobs_2d_data) == 1
-                kobs_2d_data = kobs_2d_data[0]
                 this_camns = kobs_2d_data[0::2]
                 this_camn_idxs = kobs_2d_data[1::2]
 
@@ -14,6 +14,7 @@ import sys
 from optparse import OptionParser
 import pylab
 import flydra_core.reconstruct
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 import flydra_analysis.analysis.result_utils as result_utils
 import matplotlib.colors
 
@@ -183,15 +184,12 @@ def show_it(
     kframes = kframes[k_use_idxs]  # kobs.read_coordinates( k_use_idxs,
     # field='frame')
 
-    kobs_2d = kresults.root.ML_estimates_2d_idxs
+    kobs_2d = flydra_kalman_utils.read_ML_estimates_2d_idxs(kresults.root)
     xys_by_obj_id = {}
     for obj_id, kframe, obs_2d_idx in zip(obj_ids, kframes, obs_2d_idxs):
-        obs_2d_idx_find = int(obs_2d_idx)  # XXX grr, why can't pytables do this?
         obj_id_save = int(obj_id)  # convert from possible numpy scalar
         xys_by_cam_id = xys_by_obj_id.setdefault(obj_id_save, {})
-        kobs_2d_data = kobs_2d.read(start=obs_2d_idx_find, stop=obs_2d_idx_find + 1)
-        assert len(kobs_2d_data) == 1
-        kobs_2d_data = kobs_2d_data[0]
+        kobs_2d_data = kobs_2d[obs_2d_idx]
         this_camns = kobs_2d_data[0::2]
         this_camn_idxs = kobs_2d_data[1::2]
 
@@ -7,13 +7,14 @@ from numpy import nan
 from . import result_utils
 import flydra_core.reconstruct
 import flydra_core._reconstruct_utils as ru
+import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 
 
 def reconstruct_line_3ds(kresults, recon2, use_obj_id, return_fXl=False):
 
     data2d = kresults.root.data2d_distorted  # make sure we have 2d data table
     camn2cam_id, cam_id2camns = result_utils.get_caminfo_dicts(kresults)
-    kobs_2d = kresults.root.ML_estimates_2d_idxs
+    kobs_2d = flydra_kalman_utils.read_ML_estimates_2d_idxs(kresults.root)
 
     obj_ids = kresults.root.kalman_estimates.read(field="obj_id", flavor="numpy")
 
@@ -61,11 +62,7 @@ def reconstruct_line_3ds(kresults, recon2, use_obj_id, return_fXl=False):
             obs_2d_idx_find = obs_2d_idx
             kframe_find = kframe
 
-        kobs_2d_data = kobs_2d.read(start=obs_2d_idx_find, stop=obs_2d_idx_find + 1)
-
-        assert len(kobs_2d_data) == 1
-
-        kobs_2d_data = kobs_2d_data[0]
+        kobs_2d_data = kobs_2d[obs_2d_idx_find]
         this_camns = kobs_2d_data[0::2]
         this_camn_idxs = kobs_2d_data[1::2]
 
@@ -18,17 +18,22 @@ import tables as PT
 import warnings
 
 warnings.filterwarnings("ignore", category=tables.NaturalNameWarning)
-import os, sys, pprint, tempfile, shutil
-from flydra_core.kalman.flydra_tracker import Tracker
+import os, sys, pprint, tempfile, shutil, copy
+from flydra_core.kalman.flydra_tracker import Tracker, ASSOCIATION_MODES
 import flydra_core.kalman.flydra_kalman_utils as flydra_kalman_utils
 from optparse import OptionParser
 import flydra_core.kalman.dynamic_models as dynamic_models
 import collections
 import flydra_core.version
-from flydra_core.data_descriptions import TextLogDescription
+from flydra_core.data_descriptions import (
+    TextLogDescription,
+    TABLE_CHUNKSHAPES,
+    create_table_indexes,
+)
 from flydra_core.reconstruct import do_3d_operations_on_2d_point
+from flydra_core.data2d_journal import Data2dJournalReader
 import flydra_analysis.a2.utils as utils
-from flydra_analysis.a2.tables_tools import open_file_safe
+from flydra_analysis.a2.tables_tools import open_file_safe, has_csindex
 
 # Not really "observations" but ML estimates
 FilteredObservations = flydra_kalman_utils.FilteredObservations
@@ -38,7 +43,15 @@ ML_estimates_2d_idxs_type = tmp
 del tmp
 
 
-def process_frame(reconstructor, tracker, frame, frame_data, camn2cam_id, debug=0):
+def process_frame(
+    reconstructor,
+    tracker,
+    frame,
+    frame_data,
+    camn2cam_id,
+    debug=0,
+    find_best_3d=ru.hypothesis_testing_algorithm__find_best_3d,
+):
     if debug is None:
         debug = 0
     frame_data = tracker.calculate_a_posteriori_estimates(
@@ -77,7 +90,7 @@ def process_frame(reconstructor, tracker, frame, frame_data, camn2cam_id, debug=
                 this_observation_Lcoords,
                 cam_ids_used,
                 min_mean_dist,
-            ) = ru.hypothesis_testing_algorithm__find_best_3d(
+            ) = find_best_3d(
                 reconstructor,
                 found_data_dict,
                 max_err,
@@ -190,10 +203,12 @@ class KalmanSaver:
         dynamic_model=None,
         fake_timestamp=None,
         debug=False,
+        create_indexes=True,
     ):
         self.cam_id2camns = cam_id2camns
         self.min_observations_to_save = min_observations_to_save
         self.debug = debug
+        self.create_indexes = create_indexes
 
         self.kalman_saver_info_instance = flydra_kalman_utils.KalmanSaveInfo(
             name=dynamic_model_name
@@ -210,6 +225,7 @@ class KalmanSaver:
             kalman_estimates_description,
             "Kalman a posteriori estimates of tracked object",
             filters=filters,
+            chunkshape=TABLE_CHUNKSHAPES["kalman_estimates"],
         )
         self.h5_xhat.attrs.dynamic_model_name = dynamic_model_name
         self.h5_xhat.attrs.dynamic_model = dynamic_model
@@ -220,18 +236,14 @@ class KalmanSaver:
             FilteredObservations,
             "observations of tracked object",
             filters=filters,
+            chunkshape=TABLE_CHUNKSHAPES["ML_estimates"],
         )
 
-        self.h5_2d_obs_next_idx = 0
-
         # Note that ML_estimates_2d_idxs_type() should
         # match dtype with tro.observations_2d.
 
-        self.h5_2d_obs = self.h5file.create_vlarray(
-            self.h5file.root,
-            "ML_estimates_2d_idxs",
-            ML_estimates_2d_idxs_type(),
-            "camns and idxs",
+        self.h5_2d_obs = flydra_kalman_utils.MLEstimates2dIdxsWriter(
+            self.h5file, filters=filters
         )
 
         self.obj_id = 0
@@ -268,7 +280,8 @@ class KalmanSaver:
         self.all_kalman_calibration_data = []
 
     def close(self):
-        pass
+        if self.create_indexes:
+            create_table_indexes(self.h5file)
 
     def save_tro(self, tro, force_obj_id=None):
         if len(tro.observations_frames) < self.min_observations_to_save:
@@ -291,28 +304,26 @@ class KalmanSaver:
         if debugADS:
             print("2D indices: ----------------")
 
-        this_idxs = []
-        for camns_and_idxs in tro.observations_2d:
-            this_idxs.append(self.h5_2d_obs_next_idx)
-            self.h5_2d_obs.append(camns_and_idxs)
-
-            if debugADS:
-                print(" %d: %s" % (self.h5_2d_obs_next_idx, str(camns_and_idxs)))
-            self.h5_2d_obs_next_idx += 1
+        # becomes obs_2d_idx (row of MLEstimates2dIdxs)
+        this_idxs = self.h5_2d_obs.append(
+            tro.observations_2d.values, tro.observations_2d.ends
+        )
         self.h5_2d_obs.flush()
+        if debugADS:
+            for obs_2d_idx, camns_and_idxs in zip(this_idxs, tro.observations_2d):
+                print(" %d: %s" % (obs_2d_idx, str(camns_and_idxs)))
 
         if debugADS:
             print()
 
-        # becomes obs_2d_idx (index into 'ML_estimates_2d_idxs')
-        this_idxs = numpy.array(this_idxs, dtype=numpy.uint64)
-
         # save observations ####################################
-        observations_frames = numpy.array(tro.observations_frames, dtype=numpy.uint64)
+        observations_frames = numpy.asarray(
+            tro.observations_frames, dtype=numpy.uint64
+        )
         obj_id_array = numpy.empty(observations_frames.shape, dtype=numpy.uint32)
         obj_id_array.fill(save_obj_id)
-        MLE_position = numpy.array(tro.MLE_position, dtype=numpy.float32)
-        MLE_Lcoords = numpy.array(tro.MLE_Lcoords, dtype=numpy.float32)
+        MLE_position = numpy.asarray(tro.MLE_position, dtype=numpy.float32)
+        MLE_Lcoords = numpy.asarray(tro.MLE_Lcoords, dtype=numpy.float32)
         list_of_pos = [MLE_position[:, i] for i in range(MLE_position.shape[1])]
         list_of_lines = [MLE_Lcoords[:, i] for i in range(MLE_Lcoords.shape[1])]
         array_list = (
@@ -342,10 +353,10 @@ class KalmanSaver:
 
         # save xhat info (kalman estimates) ##################
 
-        frames = numpy.array(tro.frames, dtype=numpy.uint64)
-        xhat_data = numpy.array(tro.xhats, dtype=numpy.float32)
-        timestamps = numpy.array(tro.timestamps, dtype=numpy.float64)
-        P_data_full = numpy.array(tro.Ps, dtype=numpy.float32)
+        frames = numpy.asarray(tro.frames, dtype=numpy.uint64)
+        xhat_data = numpy.asarray(tro.xhats, dtype=numpy.float32)
+        timestamps = numpy.asarray(tro.timestamps, dtype=numpy.float64)
+        P_data_full = numpy.asarray(tro.Ps, dtype=numpy.float32)
 
         # don't guess after last observation
         cond = frames <= last_observation_frame
@@ -372,6 +383,384 @@ class KalmanSaver:
         self.h5_xhat.append(xhats_recarray)
         self.h5_xhat.flush()
 
+    def append_saved_from(self, h5file):
+        """append all objects saved in another kalmanized file
+
+        The obj_ids and the obs_2d_idx of the ML estimates are
+        renumbered to follow those already saved, as if the objects
+        had been passed to save_tro() in the same order.
+        """
+        obs_recarray = h5file.root.ML_estimates[:]
+        if len(obs_recarray) == 0:
+            return
+
+        obj_id_offset = self.obj_id
+        obs_2d_idx_offset = self.h5_2d_obs.nrows
+
+        xhats_recarray = h5file.root.kalman_estimates[:]
+        xhats_recarray["obj_id"] += obj_id_offset
+        self.h5_xhat.append(xhats_recarray)
+        self.h5_xhat.flush()
+
+        self.obj_id += int(obs_recarray["obj_id"].max())
+        obs_recarray["obj_id"] += obj_id_offset
+        obs_recarray["obs_2d_idx"] += obs_2d_idx_offset
+        self.h5_obs.append(obs_recarray)
+        self.h5_obs.flush()
+
+        src_2d_obs = flydra_kalman_utils.read_ML_estimates_2d_idxs(h5file.root)
+        self.h5_2d_obs.append(src_2d_obs.data, src_2d_obs.offsets[1:])
+        self.h5_2d_obs.flush()
+
+
+def undistort_2d_rows(reconstructor, data2d_recarray, camn2cam_id):
+    """undistort all 2D points and compute their 3D plane and ray
+
+    The work is done for all rows of a given camera at once. Rows
+    without a known cam_id or without a detected point are nan.
+
+    Returns (x_undistorted, y_undistorted, planes, rays), with planes
+    having shape (N,4) and rays (the Pluecker coordinates of the
+    ray from the camera center) having shape (N,6).
+    """
+    N = len(data2d_recarray)
+    x_undistorted = np.empty((N,))
+    x_undistorted.fill(np.nan)
+    y_undistorted = x_undistorted.copy()
+    planes = np.empty((N, 4))
+    planes.fill(np.nan)
+    rays = np.empty((N, 6))
+    rays.fill(np.nan)
+
+    camns = data2d_recarray["camn"]
+    x_distorted = data2d_recarray["x"]
+    y_distorted = data2d_recarray["y"]
+    helpers = reconstructor.get_reconstruct_helper_dict()
+    geometry = reconstructor.geometry
+    for camn in np.unique(camns):
+        cam_id = camn2cam_id.get(camn, None)
+        if cam_id is None or cam_id not in geometry.cam_id2idx:
+            continue
+        cond = (camns == camn) & ~np.isnan(x_distorted)
+        if not np.any(cond):
+            continue
+        helper = helpers[cam_id]
+        cam_idx = geometry.cam_id2idx[cam_id]
+        pmat_inv = geometry.pmat_inv[cam_idx]
+        camera_center = geometry.camera_center[cam_idx]
+
+        xd = x_distorted[cond]
+        yd = y_distorted[cond]
+        xu, yu = helper.undistort_many(xd, yd)
+
+        rise = np.array(data2d_recarray["slope"][cond], dtype=np.float64)
+        run = np.ones_like(rise)
+        vertical = np.isinf(rise)
+        run[vertical] = 0.0
+        rise[vertical] = np.sign(rise[vertical])
+
+        (
+            planes[cond],
+            rays[cond],
+        ) = flydra_core.reconstruct.do_3d_operations_on_2d_points(
+            helper, xu, yu, pmat_inv, camera_center, xd, yd, rise, run
+        )
+        x_undistorted[cond] = xu
+        y_undistorted[cond] = yu
+    return x_undistorted, y_undistorted, planes, rays
+
+
+def read_frames_array(data2d, start_frame=None, stop_frame=None):
+    """read the frame column of the 2D data
+
+    If the frame column has a completely sorted index, only the rows
+    from the first to the last one from start_frame to stop_frame are
+    read. Returns (first_row, frames_array), with frames_array holding
+    the frames of the rows from first_row on.
+    """
+    if (start_frame is None and stop_frame is None) or not has_csindex(
+        data2d, "frame"
+    ):
+        return 0, numpy.asarray(data2d.read(field="frame"))
+    conds = []
+    condvars = {}
+    if start_frame is not None:
+        conds.append("(frame >= start_frame)")
+        condvars["start_frame"] = int(start_frame)
+    if stop_frame is not None:
+        conds.append("(frame <= stop_frame)")
+        condvars["stop_frame"] = int(stop_frame)
+    row_idxs = data2d.get_where_list(" & ".join(conds), condvars=condvars)
+    if len(row_idxs) == 0:
+        return 0, numpy.zeros((0,), dtype=numpy.int64)
+    first_row = int(row_idxs.min())
+    stop_row = int(row_idxs.max()) + 1
+    frames_array = data2d.read(start=first_row, stop=stop_row, field="frame")
+    return first_row, numpy.asarray(frames_array)
+
+
+def iter_frame_rows(
+    data2d,
+    frames_array,
+    reconstructor,
+    camn2cam_id,
+    start_frame=None,
+    stop_frame=None,
+    do_full_kalmanization=True,
+    first_row=0,
+):
+    """iterate over the 2D data, one frame at a time
+
+    frames_array holds the frames of the rows of data2d from first_row
+    on. Yields (frame, rows) for each frame in increasing order, where
+    rows is a list of (camn, timestamp, pt_undistorted,
+    pluecker_hz_meters) tuples. pt_undistorted and pluecker_hz_meters
+    are None if no point was found (or if do_full_kalmanization is
+    False). A final (None, []) is yielded after the last frame.
+
+    The data is read in large chunks, each of which is processed in
+    bulk rather than row-by-row.
+    """
+    for row_start, row_stop in utils.iter_non_overlapping_chunk_start_stops(
+        frames_array, min_chunk_size=500000, size_increment=1000, status_fd=sys.stdout,
+    ):
+
+        print(
+            "Doing initial scan of approx frame range %d-%d."
+            % (frames_array[row_start], frames_array[row_stop - 1])
+        )
+
+        this_frames_array = frames_array[row_start:row_stop]
+        if start_frame is not None:
+            if this_frames_array.max() < start_frame:
+                continue
+        if stop_frame is not None:
+            if this_frames_array.min() > stop_frame:
+                continue
+
+        data2d_recarray = data2d.read(
+            start=first_row + row_start, stop=first_row + row_stop
+        )
+        this_frames = data2d_recarray["frame"]
+        print("Examining frames %d-%d in detail." % (this_frames[0], this_frames[-1]))
+        # a stable sort keeps the rows of each frame in file order,
+        # whichever rows are read together
+        data2d_recarray = data2d_recarray[np.argsort(this_frames, kind="mergesort")]
+        this_frames = data2d_recarray["frame"]
+
+        n_rows = len(data2d_recarray)
+        camns = data2d_recarray["camn"].tolist()
+        timestamps = data2d_recarray["timestamp"].tolist()
+
+        if do_full_kalmanization:
+            (x_undistorted, y_undistorted, planes, rays) = undistort_2d_rows(
+                reconstructor, data2d_recarray, camn2cam_id
+            )
+            found = ~np.isnan(x_undistorted)
+            line_found = ~np.isnan(planes[:, 0])
+
+            def optional_column(name):
+                if name in data2d_recarray.dtype.fields:
+                    return data2d_recarray[name].tolist()
+                return [None] * n_rows
+
+            # Keep in sync with flydra_core.data_descriptions
+            pt_undistorted_columns = zip(
+                x_undistorted.tolist(),
+                y_undistorted.tolist(),
+                data2d_recarray["area"].tolist(),
+                data2d_recarray["slope"].tolist(),
+                data2d_recarray["eccentricity"].tolist(),
+                planes[:, 0].tolist(),
+                planes[:, 1].tolist(),
+                planes[:, 2].tolist(),
+                planes[:, 3].tolist(),
+                line_found.tolist(),
+                data2d_recarray["frame_pt_idx"].tolist(),
+                optional_column("cur_val"),
+                optional_column("mean_val"),
+                optional_column("sumsqf_val"),
+            )
+            pts_undistorted = [
+                pt if is_found else None
+                for (pt, is_found) in zip(pt_undistorted_columns, found.tolist())
+            ]
+            pluecker_hz_meters = [tuple(ray) for ray in rays.tolist()]
+        else:
+            pts_undistorted = [None] * n_rows
+            pluecker_hz_meters = [None] * n_rows
+
+        # split into frames
+        unique_frames, frame_starts = np.unique(this_frames, return_index=True)
+        frame_stops = np.hstack((frame_starts[1:], [n_rows]))
+        for frame, start, stop in zip(
+            unique_frames.tolist(), frame_starts.tolist(), frame_stops.tolist()
+        ):
+            if start_frame is not None:
+                if frame < start_frame:
+                    continue
+            if stop_frame is not None:
+                if frame > stop_frame:
+                    continue
+            rows = list(
+                zip(
+                    camns[start:stop],
+                    timestamps[start:stop],
+                    pts_undistorted[start:stop],
+                    pluecker_hz_meters[start:stop],
+                )
+            )
+            yield frame, rows
+    yield None, []
+
+
+def find_independent_frame_ranges(
+    data2d,
+    frames_array,
+    camn2cam_id,
+    max_frames_skipped,
+    sync_error_threshold,
+    exclude_cam_ids=(),
+    exclude_camns=(),
+    start_frame=None,
+    stop_frame=None,
+    n_ranges=1,
+    first_row=0,
+):
+    """split the 2D data into frame ranges that can be tracked separately
+
+    A tracked object is killed at the first processed frame more than
+    max_frames_skipped frames after its last data. Thus, after such a
+    frame without any 2D points, no object can be alive and tracking
+    may start afresh. The frame ranges are cut at these frames, and
+    neighboring ranges are merged to give at most n_ranges ranges of
+    approximately equal numbers of rows.
+
+    frames_array holds the frames of the rows of data2d from first_row
+    on.
+
+    Returns (frame_ranges, max_frame_spread), where frame_ranges is a
+    list of inclusive (start, stop) frame numbers (either of which may
+    be None to mean the start or end of the data) and max_frame_spread
+    is the largest inter-camera timestamp spread of any frame.
+    """
+    use_camns = [
+        camn
+        for (camn, cam_id) in camn2cam_id.items()
+        if cam_id not in exclude_cam_ids and camn not in exclude_camns
+    ]
+    start_row = first_row
+    stop_row = first_row + len(frames_array)
+    cond = np.in1d(
+        np.asarray(data2d.read(start=start_row, stop=stop_row, field="camn")),
+        use_camns,
+    )
+    if start_frame is not None:
+        cond &= frames_array >= start_frame
+    if stop_frame is not None:
+        cond &= frames_array <= stop_frame
+    frames = frames_array[cond]
+    order = np.argsort(frames)
+    frames = frames[order]
+    x = np.asarray(data2d.read(start=start_row, stop=stop_row, field="x"))
+    x = x[cond][order]
+    timestamps = np.asarray(
+        data2d.read(start=start_row, stop=stop_row, field="timestamp")
+    )
+    timestamps = timestamps[cond][order]
+
+    if len(frames) == 0:
+        return [(start_frame, stop_frame)], -np.inf
+
+    unique_frames, frame_starts = np.unique(frames, return_index=True)
+    n_rows = np.diff(np.hstack((frame_starts, [len(frames)])))
+    spread = np.maximum.reduceat(timestamps, frame_starts) - np.minimum.reduceat(
+        timestamps, frame_starts
+    )
+    if np.any(n_rows > 1):
+        max_frame_spread = spread[n_rows > 1].max()
+    else:
+        max_frame_spread = -np.inf
+    has_data = np.logical_or.reduceat(~np.isnan(x), frame_starts)
+
+    # Find the first frame killing all objects after each frame with data.
+    data_frames = unique_frames[has_data]
+    n_prior_data_frames = np.searchsorted(data_frames, unique_frames)
+    last_data_frame = data_frames[np.maximum(n_prior_data_frames - 1, 0)]
+    is_cut = (
+        ~has_data
+        & (spread <= sync_error_threshold)  # frame is processed
+        & (n_prior_data_frames > 0)
+        & (n_prior_data_frames < len(data_frames))  # more data follows
+        & (unique_frames - last_data_frame > max_frames_skipped)
+    )
+    cut_idxs = np.nonzero(is_cut)[0]
+    cut_idxs = cut_idxs[np.unique(n_prior_data_frames[cut_idxs], return_index=True)[1]]
+
+    # Merge into n_ranges ranges of similar size.
+    rows_before_cut = np.cumsum(n_rows)[cut_idxs]
+    targets = np.arange(1, n_ranges) * (len(frames) / float(n_ranges))
+    use_cuts = np.unique(np.searchsorted(rows_before_cut, targets))
+    use_cuts = use_cuts[use_cuts < len(cut_idxs)]
+    cut_frames = unique_frames[cut_idxs[use_cuts]].tolist()
+
+    starts = [start_frame] + [frame + 1 for frame in cut_frames]
+    stops = cut_frames + [stop_frame]
+    return list(zip(starts, stops)), max_frame_spread
+
+
+_segment_kalmanize_kwargs = None
+
+
+def _init_segment_worker(kalmanize_kwargs):
+    global _segment_kalmanize_kwargs
+    _segment_kalmanize_kwargs = kalmanize_kwargs
+
+
+def _kalmanize_segment(args):
+    start_frame, stop_frame, dest_filename = args
+    kalmanize(
+        start_frame=start_frame,
+        stop_frame=stop_frame,
+        dest_filename=dest_filename,
+        **_segment_kalmanize_kwargs
+    )
+    return dest_filename
+
+
+def kalmanize_frame_ranges_in_parallel(h5saver, frame_ranges, n_jobs, kalmanize_kwargs):
+    """kalmanize independent frame ranges in a process pool
+
+    Each frame range is saved to a temporary file by a separate call
+    to kalmanize() and the results are appended in order with
+    h5saver. The worker processes inherit kalmanize_kwargs (which need
+    not be picklable) by forking.
+    """
+    import multiprocessing
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        jobs = [
+            (start, stop, os.path.join(tmpdir, "range%05d.h5" % i))
+            for i, (start, stop) in enumerate(frame_ranges)
+        ]
+        pool = multiprocessing.Pool(
+            n_jobs, initializer=_init_segment_worker, initargs=(kalmanize_kwargs,)
+        )
+        try:
+            for fname in pool.imap(_kalmanize_segment, jobs):
+                if not os.path.exists(fname):
+                    # no 2D data in range
+                    continue
+                with open_file_safe(fname, mode="r") as h5file:
+                    h5saver.append_saved_from(h5file)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
 
 def kalmanize(
     src_filename,
@@ -398,6 +787,8 @@ def kalmanize(
     if debug:
         numpy.set_printoptions(precision=3, linewidth=120, suppress=False)
 
+    find_best_3d = ru.get_hypothesis_test_engine(options.hypothesis_test_engine)
+
     if exclude_cam_ids is None:
         exclude_cam_ids = []
 
@@ -536,6 +927,7 @@ def kalmanize(
                     dynamic_model=kalman_model,
                     debug=debug,
                     fake_timestamp=options.fake_timestamp,
+                    create_indexes=not options.no_index,
                 )
 
                 tracker = Tracker(
@@ -547,6 +939,8 @@ def kalmanize(
                     disable_image_stat_gating=options.disable_image_stat_gating,
                     orientation_consensus=options.orientation_consensus,
                     fake_timestamp=options.fake_timestamp,
+                    association_mode=options.association_mode,
+                    n_workers=options.tracker_workers,
                 )
 
                 tracker.set_killed_tracker_callback(h5saver.save_tro)
@@ -555,7 +949,10 @@ def kalmanize(
                 if hasattr(results.root, "trigger_clock_info"):
                     results.root.trigger_clock_info._f_copy(h5file.root)
 
-            data2d = results.root.data2d_distorted
+            if options.data2d_journal is not None:
+                data2d = Data2dJournalReader(options.data2d_journal)
+            else:
+                data2d = results.root.data2d_distorted
 
             frame_count = 0
             last_frame = None
@@ -567,7 +964,9 @@ def kalmanize(
                 time1 = time.time()
                 if do_full_kalmanization:
                     print("loading all frame numbers...")
-                frames_array = numpy.asarray(data2d.read(field="frame"))
+                first_row, frames_array = read_frames_array(
+                    data2d, start_frame=start_frame, stop_frame=stop_frame
+                )
                 time2 = time.time()
                 if do_full_kalmanization:
                     print("done in %.1f sec" % (time2 - time1))
@@ -602,142 +1001,150 @@ def kalmanize(
 
             max_all_check_times = -np.inf
 
-            for row_start, row_stop in utils.iter_non_overlapping_chunk_start_stops(
-                frames_array,
-                min_chunk_size=500000,
-                size_increment=1000,
-                status_fd=sys.stdout,
-            ):
-
-                print(
-                    "Doing initial scan of approx frame range %d-%d."
-                    % (frames_array[row_start], frames_array[row_stop - 1])
+            if do_full_kalmanization and options.jobs > 1:
+                frame_ranges, max_all_check_times = find_independent_frame_ranges(
+                    data2d,
+                    frames_array,
+                    camn2cam_id,
+                    kalman_model["max_frames_skipped"],
+                    sync_error_threshold,
+                    exclude_cam_ids=exclude_cam_ids,
+                    exclude_camns=exclude_camns,
+                    start_frame=start_frame,
+                    stop_frame=stop_frame,
+                    n_ranges=4 * options.jobs,
+                    first_row=first_row,
                 )
-
-                this_frames_array = frames_array[row_start:row_stop]
-                if start_frame is not None:
-                    if this_frames_array.max() < start_frame:
-                        continue
-                if stop_frame is not None:
-                    if this_frames_array.min() > stop_frame:
-                        continue
-
-                data2d_recarray = data2d.read(start=row_start, stop=row_stop)
-                this_frames = data2d_recarray["frame"]
                 print(
-                    "Examining frames %d-%d in detail."
-                    % (this_frames[0], this_frames[-1])
+                    "kalmanizing %d independent frame ranges with %d jobs"
+                    % (len(frame_ranges), options.jobs)
+                )
+                segment_options = copy.copy(options)
+                segment_options.jobs = 1
+                segment_options.keep_sync_errors = True  # checked here
+                # daemonic pool processes cannot start tracker workers
+                segment_options.tracker_workers = 0
+                segment_options.no_index = True  # only the merged file
+                kalmanize_frame_ranges_in_parallel(
+                    h5saver,
+                    frame_ranges,
+                    options.jobs,
+                    dict(
+                        src_filename=src_filename,
+                        reconstructor=reconstructor,
+                        exclude_cam_ids=exclude_cam_ids,
+                        exclude_camns=exclude_camns,
+                        dynamic_model_name=dynamic_model_name,
+                        debug=debug,
+                        frames_per_second=frames_per_second,
+                        area_threshold=area_threshold,
+                        min_observations_to_save=min_observations_to_save,
+                        options=segment_options,
+                    ),
+                )
+                frame_iterator = []
+            else:
+                frame_iterator = iter_frame_rows(
+                    data2d,
+                    frames_array,
+                    reconstructor,
+                    camn2cam_id,
+                    start_frame=start_frame,
+                    stop_frame=stop_frame,
+                    do_full_kalmanization=do_full_kalmanization,
+                    first_row=first_row,
                 )
-                this_row_idxs = np.argsort(this_frames)
-                for ii in range(len(this_row_idxs) + 1):
-
-                    if ii >= len(this_row_idxs):
-                        finish_frame = True
-                    else:
-                        finish_frame = False
-
-                        this_row_idx = this_row_idxs[ii]
-
-                        row = data2d_recarray[this_row_idx]
-
-                        new_frame = row["frame"]
 
-                        if start_frame is not None:
-                            if new_frame < start_frame:
-                                continue
-                        if stop_frame is not None:
-                            if new_frame > stop_frame:
-                                continue
+            for new_frame, frame_rows in frame_iterator:
+                ########################################
+                # Data for last_frame is complete
+                if last_frame is not None:
+                    if new_frame is not None and new_frame < last_frame:
+                        print("new_frame", new_frame)
+                        print("last_frame", last_frame)
+                        raise RuntimeError(
+                            "expected continuously increasing " "frame numbers"
+                        )
 
-                        if last_frame != new_frame:
-                            if new_frame < last_frame:
-                                print("new_frame", new_frame)
-                                print("last_frame", last_frame)
-                                raise RuntimeError(
-                                    "expected continuously increasing " "frame numbers"
-                                )
-                            finish_frame = True
-
-                    if finish_frame:
-                        # new frame
-                        ########################################
-                        # Data for this frame is complete
-                        if last_frame is not None:
-
-                            this_frame_spread = 0.0
-                            if len(time_frame_all_cam_timestamps) > 1:
-                                check_times = np.array(time_frame_all_cam_timestamps)
-                                check_times -= check_times.min()
-                                this_frame_spread = check_times.max()
-                                if accum_frame_spread is not None:
-                                    accum_frame_spread.append(this_frame_spread)
-                                    accum_frame_spread_fno.append(last_frame)
-
-                                    accum_frame_all_timestamps.append(
-                                        time_frame_all_cam_timestamps
+                    this_frame_spread = 0.0
+                    if len(time_frame_all_cam_timestamps) > 1:
+                        check_times = np.array(time_frame_all_cam_timestamps)
+                        check_times -= check_times.min()
+                        this_frame_spread = check_times.max()
+                        if accum_frame_spread is not None:
+                            accum_frame_spread.append(this_frame_spread)
+                            accum_frame_spread_fno.append(last_frame)
+
+                            accum_frame_all_timestamps.append(
+                                time_frame_all_cam_timestamps
+                            )
+                            accum_frame_all_camns.append(time_frame_all_camns)
+
+                        max_all_check_times = max(
+                            this_frame_spread, max_all_check_times
+                        )
+                        if this_frame_spread > sync_error_threshold:
+                            if this_frame_spread == max_all_check_times:
+                                print(
+                                    "%s frame %d: sync diff: %.1f msec"
+                                    % (
+                                        os.path.split(results.filename)[-1],
+                                        last_frame,
+                                        this_frame_spread * 1000.0,
                                     )
-                                    accum_frame_all_camns.append(time_frame_all_camns)
-
-                                max_all_check_times = max(
-                                    this_frame_spread, max_all_check_times
                                 )
-                                if this_frame_spread > sync_error_threshold:
-                                    if this_frame_spread == max_all_check_times:
-                                        print(
-                                            "%s frame %d: sync diff: %.1f msec"
-                                            % (
-                                                os.path.split(results.filename)[-1],
-                                                last_frame,
-                                                this_frame_spread * 1000.0,
-                                            )
-                                        )
 
+                    if debug > 5:
+                        print()
+                        print("frame_data for frame %d" % (last_frame,))
+                        pprint.pprint(dict(frame_data))
+                        print()
+                    if do_full_kalmanization:
+                        if this_frame_spread > sync_error_threshold:
                             if debug > 5:
-                                print()
-                                print("frame_data for frame %d" % (last_frame,))
-                                pprint.pprint(dict(frame_data))
-                                print()
-                            if do_full_kalmanization:
-                                if this_frame_spread > sync_error_threshold:
-                                    if debug > 5:
-                                        print(
-                                            "frame sync error (spread %.1f msec), "
-                                            "skipping" % (this_frame_spread * 1e3,)
-                                        )
-                                        print()
-                                    warnings.warn(
-                                        "Synchronization error detected, "
-                                        "but continuing analysis without "
-                                        "potentially bad data."
-                                    )
-                                else:
-                                    process_frame(
-                                        reconstructor,
-                                        tracker,
-                                        last_frame,
-                                        frame_data,
-                                        camn2cam_id,
-                                        debug=debug,
-                                    )
-                            frame_count += 1
-                            if do_full_kalmanization and frame_count % 1000 == 0:
-                                time2 = time.time()
-                                dur = time2 - time1
-                                fps = frame_count / dur
                                 print(
-                                    "frame % 10d, kalmanization/data association speed: % 8.1f fps"
-                                    % (last_frame, fps)
+                                    "frame sync error (spread %.1f msec), "
+                                    "skipping" % (this_frame_spread * 1e3,)
                                 )
-                                time1 = time2
-                                frame_count = 0
+                                print()
+                            warnings.warn(
+                                "Synchronization error detected, "
+                                "but continuing analysis without "
+                                "potentially bad data."
+                            )
+                        else:
+                            process_frame(
+                                reconstructor,
+                                tracker,
+                                last_frame,
+                                frame_data,
+                                camn2cam_id,
+                                debug=debug,
+                                find_best_3d=find_best_3d,
+                            )
+                    frame_count += 1
+                    if do_full_kalmanization and frame_count % 1000 == 0:
+                        time2 = time.time()
+                        dur = time2 - time1
+                        fps = frame_count / dur
+                        print(
+                            "frame % 10d, kalmanization/data association speed: % 8.1f fps"
+                            % (last_frame, fps)
+                        )
+                        time1 = time2
+                        frame_count = 0
+
+                if new_frame is None:
+                    # all data done
+                    break
 
-                        ########################################
-                        frame_data = collections.defaultdict(list)
-                        time_frame_all_cam_timestamps = []  # clear values
-                        time_frame_all_camns = []  # clear values
-                        last_frame = new_frame
+                ########################################
+                frame_data = collections.defaultdict(list)
+                time_frame_all_cam_timestamps = []  # clear values
+                time_frame_all_camns = []  # clear values
+                last_frame = new_frame
 
-                    camn = row["camn"]
+                for camn, timestamp, pt_undistorted, pluecker_hz_meters in frame_rows:
                     try:
                         cam_id = camn2cam_id[camn]
                     except KeyError:
@@ -760,111 +1167,21 @@ def kalmanize(
                         # exclude this camera
                         continue
 
-                    time_frame_all_cam_timestamps.append(row["timestamp"])
-                    time_frame_all_camns.append(row["camn"])
-
-                    if do_full_kalmanization:
+                    time_frame_all_cam_timestamps.append(timestamp)
+                    time_frame_all_camns.append(camn)
 
-                        x_distorted = row["x"]
-                        if numpy.isnan(x_distorted):
-                            # drop point -- not found
-                            continue
-                        y_distorted = row["y"]
-
-                        (x_undistorted, y_undistorted) = reconstructor.undistort(
-                            cam_id, (x_distorted, y_distorted)
-                        )
-
-                        (area, slope, eccentricity, frame_pt_idx) = (
-                            row["area"],
-                            row["slope"],
-                            row["eccentricity"],
-                            row["frame_pt_idx"],
-                        )
-
-                        if "cur_val" in row.dtype.fields:
-                            cur_val = row["cur_val"]
-                        else:
-                            cur_val = None
-                        if "mean_val" in row.dtype.fields:
-                            mean_val = row["mean_val"]
-                        else:
-                            mean_val = None
-                        if "sumsqf_val" in row.dtype.fields:
-                            sumsqf_val = row["sumsqf_val"]
-                        else:
-                            sumsqf_val = None
-
-                        # FIXME: cache this stuff?
-                        pmat_inv = reconstructor.get_pmat_inv(cam_id)
-                        camera_center = reconstructor.get_camera_center(cam_id)
-                        camera_center = numpy.hstack((camera_center[:, 0], [1]))
-                        camera_center_meters = reconstructor.get_camera_center(cam_id)
-                        camera_center_meters = numpy.hstack(
-                            (camera_center_meters[:, 0], [1])
-                        )
-                        helper = reconstructor.get_reconstruct_helper_dict()[cam_id]
-                        rise = slope
-                        run = 1.0
-                        if np.isinf(rise):
-                            if rise > 0:
-                                rise = 1.0
-                                run = 0.0
-                            else:
-                                rise = -1.0
-                                run = 0.0
-
-                        (
-                            p1,
-                            p2,
-                            p3,
-                            p4,
-                            ray0,
-                            ray1,
-                            ray2,
-                            ray3,
-                            ray4,
-                            ray5,
-                        ) = do_3d_operations_on_2d_point(
-                            helper,
-                            x_undistorted,
-                            y_undistorted,
-                            pmat_inv,
-                            camera_center,
-                            x_distorted,
-                            y_distorted,
-                            rise,
-                            run,
-                        )
-                        line_found = not numpy.isnan(p1)
-                        pluecker_hz_meters = (ray0, ray1, ray2, ray3, ray4, ray5)
-
-                        # Keep in sync with kalmanize.py and data_descriptions.py
-                        pt_undistorted = (
-                            x_undistorted,
-                            y_undistorted,
-                            area,
-                            slope,
-                            eccentricity,
-                            p1,
-                            p2,
-                            p3,
-                            p4,
-                            line_found,
-                            frame_pt_idx,
-                            cur_val,
-                            mean_val,
-                            sumsqf_val,
-                        )
+                    if pt_undistorted is None:
+                        # drop point -- not found (or not kalmanizing)
+                        continue
 
-                        projected_line_meters = geom.line_from_HZline(
-                            pluecker_hz_meters
-                        )
+                    projected_line_meters = geom.line_from_HZline(pluecker_hz_meters)
 
-                        frame_data[camn].append((pt_undistorted, projected_line_meters))
+                    frame_data[camn].append((pt_undistorted, projected_line_meters))
 
             if do_full_kalmanization:
                 tracker.kill_all_trackers()  # done tracking
+                tracker.close()
+                h5saver.close()
 
         if not do_full_kalmanization:
             os.unlink(dest_filename)
@@ -1103,6 +1420,66 @@ def get_parser():
         help="disable gating the data based on image statistics",
         default=False,
     )
+
+    parser.add_option(
+        "--jobs",
+        type="int",
+        default=1,
+        help=(
+            "number of processes used to kalmanize independent frame ranges "
+            "(separated by gaps without data) in parallel"
+        ),
+    )
+
+    parser.add_option(
+        "--hypothesis-test-engine",
+        type="choice",
+        choices=sorted(ru.HYPOTHESIS_TEST_ENGINES.keys()),
+        default="loop",
+        help=(
+            "implementation of the hypothesis test used to find new objects "
+            "('vectorized' solves all camera combinations at once)"
+        ),
+    )
+
+    parser.add_option(
+        "--association-mode",
+        type="choice",
+        choices=list(ASSOCIATION_MODES),
+        default="greedy",
+        help=(
+            "how 2D points are associated with tracked objects ('hungarian' "
+            "assigns points by minimum total cost and updates each object once)"
+        ),
+    )
+
+    parser.add_option(
+        "--tracker-workers",
+        type="int",
+        default=0,
+        help=(
+            "number of processes holding the tracked objects, which are "
+            "updated in parallel (0 updates them in this process)"
+        ),
+    )
+
+    parser.add_option(
+        "--no-index",
+        action="store_true",
+        default=False,
+        help="do not index the obj_id and frame columns of the saved tables",
+    )
+
+    parser.add_option(
+        "--data2d-journal",
+        type="string",
+        default=None,
+        help=(
+            "read the 2D data from this journal directory instead of FILE "
+            "(e.g. when the MainBrain did not compact it into FILE)"
+        ),
+        metavar="JOURNAL",
+    )
     return parser
 
 
@@ -10,6 +10,7 @@ Info2D = flydra_core.data_descriptions.Info2D
 Info2DCol_description = tables.Description(Info2D().columns)._v_nested_descr
 CamSyncInfo = flydra_core.data_descriptions.CamSyncInfo
 TextLogDescription = flydra_core.data_descriptions.TextLogDescription
+TABLE_CHUNKSHAPES = flydra_core.data_descriptions.TABLE_CHUNKSHAPES
 
 
 def startup_message(h5textlog, fps):
@@ -73,7 +74,13 @@ def save_data(fname, data2d, reconstructor, fps, eccentricity):
             cam_info_row["cam_id"] = cam_id
             cam_info_row.append()
 
-        h5data2d = ct(root, "data2d_distorted", Info2D, "2d data")
+        h5data2d = ct(
+            root,
+            "data2d_distorted",
+            Info2D,
+            "2d data",
+            chunkshape=TABLE_CHUNKSHAPES["data2d_distorted"],
+        )
         detection = h5data2d.row
 
         frame_pt_idx = 0
@@ -105,3 +112,4 @@ def save_data(fname, data2d, reconstructor, fps, eccentricity):
                 detection.append()
 
         h5data2d.flush()
+        flydra_core.data_descriptions.create_table_indexes(h5file)
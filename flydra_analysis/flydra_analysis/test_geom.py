@@ -177,6 +177,7 @@ class TestNonlinearDistortion:
             ##            yield (self.tst_undistort_mesh, xys, helper_args)
             yield (self.tst_undistort_orig, xys, helper_args)
             yield (self.tst_roundtrip, xys, helper_args)
+            yield (self.tst_many, xys, helper_args)
 
     def _distort(self, helper_args, xy):
         fc1, fc2, cc1, cc2, k1, k2, p1, p2 = helper_args
@@ -226,6 +227,35 @@ class TestNonlinearDistortion:
             assert numpy.allclose(xy, redistorted_xy)
 
 
+    def tst_many(self, xys, helper_args):
+        helper = reconstruct_utils.ReconstructHelper(*helper_args)
+        x, y = numpy.array(xys, dtype=numpy.float64).T
+
+        xu, yu = helper.undistort_many(x, y)
+        xd, yd = helper.distort_many(xu, yu)
+        for i, xy in enumerate(xys):
+            assert numpy.allclose(
+                helper.undistort(*xy), (xu[i], yu[i]), rtol=0, atol=1e-9
+            )
+            assert numpy.allclose(
+                helper.distort(xu[i], yu[i]), (xd[i], yd[i]), rtol=0, atol=1e-9
+            )
+
+        # with a convergence tolerance
+        xu, yu = helper.undistort_many(x, y, n_iterations=50, tolerance=1e-15)
+        for i, xy in enumerate(xys):
+            expected = helper.undistort(xy[0], xy[1], n_iterations=50)
+            assert numpy.allclose(expected, (xu[i], yu[i]), rtol=0, atol=1e-9)
+
+        # with a lookup table
+        lut = helper.make_undistort_lut(640, 500)
+        xu, yu = helper.undistort_many(x, y, lut=lut)
+        for i, xy in enumerate(xys):
+            assert numpy.allclose(
+                helper.undistort(*xy), (xu[i], yu[i]), rtol=0, atol=1e-9
+            )
+
+
 class TestMahalanobis(unittest.TestCase):
     def test_2d(self):
         line_2d = (
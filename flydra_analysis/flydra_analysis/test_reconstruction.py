@@ -6,15 +6,21 @@ import tempfile, os
 import pprint
 import pkg_resources
 import shutil
+import collections
 
 import numpy as np
+import tables
 
 from pymvg.camera_model import CameraModel
 from pymvg.multi_camera_system import MultiCameraSystem
 
 import flydra_core.kalman.dynamic_models
+from flydra_core.kalman.flydra_kalman_utils import (
+    MLEstimates2dIdxsWriter,
+    read_ML_estimates_2d_idxs,
+)
 import flydra_analysis.offline_data_save
-from flydra_analysis.kalmanize import kalmanize
+from flydra_analysis.kalmanize import kalmanize, get_parser
 import flydra_core.water as water
 import flydra_analysis.a2.core_analysis as core_analysis
 import flydra_core.flydra_socket as flydra_socket
@@ -227,6 +233,366 @@ def check_find3d(
     assert rowidx > 0  # make sure we did some tests
 
 
+def test_camera_geometry():
+    R = _get_cams(with_distortion=True)["reconstructor"]
+    geometry = R.geometry
+    assert len(geometry) == len(R.cam_ids)
+    for cam_id in R.cam_ids:
+        cam_idx = geometry.cam_id2idx[cam_id]
+        assert geometry.cam_ids[cam_idx] == cam_id
+        assert np.allclose(geometry.pmat[cam_idx], R.get_pmat(cam_id))
+        assert np.allclose(geometry.pmat_inv[cam_idx], R.get_pmat_inv(cam_id))
+        cc = R.get_camera_center(cam_id)[:, 0]
+        assert np.allclose(geometry.camera_center[cam_idx], np.hstack((cc, [1])))
+        helper = R.get_reconstruct_helper_dict()[cam_id]
+        assert np.allclose(geometry.distortion[cam_idx], helper.get_nlparams())
+    for arr in (geometry.pmat, geometry.pmat_inv, geometry.camera_center):
+        assert arr.flags.c_contiguous
+        assert not arr.flags.writeable
+    try:
+        geometry.pmat = None
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("geometry should be immutable")
+
+
+def test_find2d_all():
+    for with_water in [False, True]:
+        for with_distortion in [False, True]:
+            yield check_find2d_all, with_water, with_distortion
+
+
+def check_find2d_all(with_water, with_distortion):
+    D = setup_data(with_water=with_water, with_distortion=with_distortion)
+    R = D["reconstructor"]
+    X = np.array([D["x"], D["y"], D["z"]]).T
+    for distorted in [False, True]:
+        x_all = R.find2d_all(X, distorted=distorted)
+        assert x_all.shape == (len(R.cam_ids), 2, len(X))
+        for cam_idx, cam_id in enumerate(R.cam_ids):
+            expected = [R.find2d(cam_id, pt, distorted=distorted) for pt in X]
+            assert np.allclose(x_all[cam_idx], np.array(expected).T)
+
+
+def test_candidate_grid():
+    from flydra_core._flydra_tracked_object import CandidateGrid
+    import flydra_core.data_descriptions as dd
+
+    R = _get_cams(with_distortion=True)["reconstructor"]
+    rng = np.random.RandomState(42)
+    camn2cam_id = dict(enumerate(R.cam_ids))
+    radius = 15.0
+    data_dict = {}
+    for camn, cam_id in camn2cam_id.items():
+        candidate_point_list = []
+        for i in range(50):
+            pt = [0.0] * 14
+            pt[dd.PT_TUPLE_IDX_X], pt[dd.PT_TUPLE_IDX_Y] = rng.uniform(0, 200, 2)
+            candidate_point_list.append((tuple(pt), None))
+        data_dict[camn] = candidate_point_list
+    grid = CandidateGrid(R, data_dict, camn2cam_id, radius)
+    for camn, cam_id in camn2cam_id.items():
+        pts = np.array([pt[:2] for (pt, line) in data_dict[camn]])
+        xd, yd = R.get_reconstruct_helper_dict()[cam_id].distort_many(
+            pts[:, 0], pts[:, 1]
+        )
+        for i in range(20):
+            x, y = rng.uniform(0, 200, 2)
+            idxs = grid.query(camn, x, y, radius)
+            assert idxs == sorted(idxs)
+            within = np.nonzero(np.hypot(xd - x, yd - y) <= radius)[0]
+            assert set(within).issubset(idxs)
+        assert grid.query(camn, np.nan, 0.0, radius) is None
+    assert grid.query(len(camn2cam_id), 0.0, 0.0, radius) is None
+
+
+def test_undistort_many_read_only():
+    R = _get_cams(with_distortion=True)["reconstructor"]
+    helper = R.get_reconstruct_helper_dict()[R.cam_ids[0]]
+    # like the points decoded from a packet
+    x = np.linspace(10.0, 190.0, 5)
+    y = np.linspace(20.0, 180.0, 5)
+    x.flags.writeable = False
+    y.flags.writeable = False
+    xl, yl = helper.undistort_many(x, y)
+    for i in range(len(x)):
+        assert np.allclose((xl[i], yl[i]), helper.undistort(x[i], y[i]))
+    xl.flags.writeable = False
+    yl.flags.writeable = False
+    xd, yd = helper.distort_many(xl, yl)
+    assert np.allclose(xd, x) and np.allclose(yd, y)
+
+
+def test_history():
+    import pickle
+    from flydra_core._flydra_tracked_object import History, RaggedHistory
+
+    rng = np.random.RandomState(0)
+    xhats = History((6,), capacity=2)
+    expected = []
+    observations_2d = RaggedHistory(np.uint16)
+    expected_2d = []
+    for i in range(100):
+        if len(expected) and rng.uniform() < 0.3:
+            assert np.all(xhats.pop() == expected.pop())
+            assert np.all(observations_2d.pop() == expected_2d.pop())
+        else:
+            x = rng.randn(6)
+            xhats.append(x)
+            expected.append(x)
+            run = np.arange(rng.randint(0, 5) * 2, dtype=np.uint16)
+            observations_2d.append(run)
+            expected_2d.append(run)
+    assert len(xhats) == len(expected)
+    assert np.all(np.asarray(xhats) == np.array(expected))
+    assert np.all(xhats[-1] == expected[-1])
+    assert len(observations_2d) == len(expected_2d)
+    for actual, run in zip(observations_2d, expected_2d):
+        assert actual.dtype == np.uint16
+        assert actual.tolist() == run.tolist()
+
+    xhats.truncate(3)
+    assert np.all(np.asarray(xhats) == np.array(expected[:3]))
+    xhats2 = pickle.loads(pickle.dumps(xhats))
+    assert np.all(np.asarray(xhats2) == np.asarray(xhats))
+    observations_2d2 = pickle.loads(pickle.dumps(observations_2d))
+    assert [r.tolist() for r in observations_2d2] == [
+        r.tolist() for r in observations_2d
+    ]
+
+
+def test_ML_estimates_2d_idxs():
+    rows = [
+        np.arange(n_cams * 2, dtype=np.uint16) + i
+        for i, n_cams in enumerate([2, 0, 3, 1])
+    ]
+    fd, fname = tempfile.mkstemp(suffix=".h5")
+    os.close(fd)
+    try:
+        with tables.open_file(fname, mode="w") as h5file:
+            writer = MLEstimates2dIdxsWriter(h5file)
+            assert writer.append_rows(rows[:1]).tolist() == [0]
+            ends = np.cumsum([len(r) for r in rows[1:]])
+            assert writer.append(np.concatenate(rows[1:]), ends).tolist() == [1, 2, 3]
+            writer.flush()
+            # the layout of older files
+            vlarray = h5file.create_vlarray(
+                h5file.root, "old", tables.UInt16Atom(), "camns and idxs"
+            )
+            for row in rows:
+                vlarray.append(row)
+            group = h5file.create_group(h5file.root, "old_file")
+            vlarray.move(group, "ML_estimates_2d_idxs")
+
+        with tables.open_file(fname, mode="r") as h5file:
+            for where in [h5file.root, h5file.root.old_file]:
+                for load in [True, False]:
+                    idxs = read_ML_estimates_2d_idxs(where, load=load)
+                    assert len(idxs) == len(rows)
+                    for i, row in enumerate(rows):
+                        assert idxs[np.uint64(i)].tolist() == row.tolist()
+            idxs = read_ML_estimates_2d_idxs(h5file.root)
+            assert [r.tolist() for r in idxs] == [r.tolist() for r in rows]
+            data, offsets = idxs.get_range(1, 4)
+            assert offsets.tolist() == [0, 0, 6, 8]
+            assert data.tolist() == np.concatenate(rows[1:]).tolist()
+            assert data.base is not None  # a view
+    finally:
+        os.unlink(fname)
+
+
+def test_fused_ekf():
+    from flydra_core._fused_ekf import FusedEKF
+    from flydra_core._flydra_tracked_object import evaluate_pmat_jacobian
+    import flydra_core.kalman.ekf as kalman_ekf
+
+    fps = 120.0
+    D = setup_data(fps=fps)
+    R = D["reconstructor"]
+    model = flydra_core.kalman.dynamic_models.get_kalman_model(
+        name=D["dynamic_model_name"], dt=(1.0 / fps)
+    )
+    A, Q = model["A"], model["Q"]
+    cov = model["ekf_observation_covariance_pixels"]
+    x0 = np.zeros((model["ss"],))
+    x0[:3] = [0.01, 0.02, 0.03]
+    P0 = np.eye(model["ss"]) * 0.01
+    fused = FusedEKF(A, Q, cov, x0, P0)
+    expected = kalman_ekf.EKF(initial_x=x0, initial_P=P0)
+
+    # steps without data
+    xhats = np.empty((5, model["ss"]))
+    Ps = np.empty((5, model["ss"], model["ss"]))
+    fused.step_many(xhats, Ps)
+    for i in range(5):
+        xhat, P = expected.step(A, Q)
+        assert np.allclose(xhats[i], xhat)
+        assert np.allclose(Ps[i], P)
+
+    # a step with data from all cameras
+    X = np.array([0.012, 0.018, 0.031])
+    y = np.array([R.find2d(cam_id, X) + 0.5 for cam_id in R.cam_ids])
+    pmats = R.geometry.pmat[[R.geometry.cam_id2idx[cam_id] for cam_id in R.cam_ids]]
+    xhatminus, Pminus = fused.calculate_a_priori()
+    xhat, P = fused.calculate_a_posteriori(xhatminus, Pminus, pmats, y)
+    xhatminus, Pminus = expected.step1__calculate_a_priori(A, Q)
+    pmats_and_points_cov = [
+        (R.get_model_with_jacobian(cam_id), y_i, cov)
+        for cam_id, y_i in zip(R.cam_ids, y)
+    ]
+    (y, hx, C, R, missing_data) = evaluate_pmat_jacobian(
+        pmats_and_points_cov, xhatminus
+    )
+    expected_xhat, expected_P = expected.step2__calculate_a_posteriori(
+        xhatminus, Pminus, y=y, hx=hx, C=C, R=R, missing_data=missing_data
+    )
+    assert np.allclose(xhat, expected_xhat)
+    assert np.allclose(P, expected_P)
+    assert np.allclose(fused.xhat_k1, expected_xhat)
+
+
+def test_skipped_frames_closed_form():
+    from flydra_core._flydra_tracked_object import TrackedObject
+    import flydra_core._fastgeom as fastgeom
+
+    fps = 120.0
+    D = setup_data(fps=fps)
+    R = D["reconstructor"]
+    model = flydra_core.kalman.dynamic_models.get_kalman_model(
+        name=D["dynamic_model_name"], dt=(1.0 / fps)
+    )
+    A, Q = model["A"], model["Q"]
+    A_powers, Q_accumulated = flydra_core.kalman.dynamic_models.get_multistep_matrices(
+        model
+    )
+    assert len(A_powers) == model["max_frames_skipped"] + 2
+    assert np.allclose(A_powers[3], np.dot(A, np.dot(A, A)))
+
+    camn2cam_id = dict(enumerate(R.cam_ids))
+    X = np.array([0.01, 0.02, 0.03])
+    tro = TrackedObject(
+        R,
+        1,
+        0,
+        X,
+        None,
+        [],
+        [],
+        kalman_model=model,
+        save_all_data=True,
+        disable_image_stat_gating=True,
+    )
+    # step with data, then skip 5 frames, then step with data again
+    for frame in [1, 7]:
+        data_dict = {}
+        for camn, cam_id in camn2cam_id.items():
+            pt_undistorted = np.zeros((14,))
+            pt_undistorted[:2] = R.find2d(cam_id, X)
+            projected_line = fastgeom.line_from_points(
+                fastgeom.ThreeTuple(R.get_camera_center(cam_id)[:, 0]),
+                fastgeom.ThreeTuple(X),
+            )
+            data_dict[camn] = [(tuple(pt_undistorted), projected_line)]
+        tro.calculate_a_posteriori_estimate(frame, data_dict, camn2cam_id)
+    # the skipped frames are filled in before the estimates are read,
+    # also while the object is alive
+    assert np.asarray(tro.observations_frames).tolist() == [0, 1, 7]
+    assert np.asarray(tro.frames).tolist() == list(range(8))
+    xhat, P = tro.xhats[1], tro.Ps[1]
+    for frame in range(2, 7):
+        xhat = np.dot(A, xhat)
+        P = np.dot(np.dot(A, P), A.T) + Q
+        assert np.allclose(tro.xhats[frame], xhat)
+        assert np.allclose(tro.Ps[frame], P)
+    tro.kill()
+    assert np.asarray(tro.frames).tolist() == list(range(8))
+
+
+def test_failed_update_is_missed_observation():
+    from flydra_core._flydra_tracked_object import TrackedObject
+
+    fps = 120.0
+    D = setup_data(fps=fps)
+    R = D["reconstructor"]
+    model = flydra_core.kalman.dynamic_models.get_kalman_model(
+        name=D["dynamic_model_name"], dt=(1.0 / fps)
+    )
+    X = np.array([0.01, 0.02, 0.03])
+    tro = TrackedObject(
+        R,
+        1,
+        0,
+        X,
+        None,
+        [],
+        [],
+        kalman_model=model,
+        save_all_data=True,
+        disable_image_stat_gating=True,
+    )
+    xhatminus, Pminus = tro.calculate_a_priori_estimate(1)
+    cam_ids_and_points2d = [
+        (cam_id, tuple(R.find2d(cam_id, X))) for cam_id in R.cam_ids
+    ]
+    used_camns_and_idxs = [(camn, 0, 0) for camn in range(len(R.cam_ids))]
+    # an innovation covariance which is not positive definite
+    (used, obs2d_hash, Pmean) = tro.calculate_a_posteriori_from_observation(
+        1,
+        xhatminus,
+        -Pminus,
+        X,
+        None,
+        used_camns_and_idxs,
+        cam_ids_and_points2d,
+    )
+    assert used == []
+    assert obs2d_hash is None
+    assert tro.n_failed_updates == 1
+    assert tro.last_frameno_with_data == 0
+    assert np.asarray(tro.observations_frames).tolist() == [0]
+    assert np.asarray(tro.frames).tolist() == [0, 1]
+    assert np.allclose(tro.xhats[1], xhatminus)
+
+
+def test_hypothesis_test_engines():
+    import flydra_core._reconstruct_utils as ru
+
+    R = _get_cams(with_distortion=False)["reconstructor"]
+    max_err = 10.0
+    rng = np.random.RandomState(1234)
+    n_found = 0
+    for i in range(200):
+        X = np.array([0.2, 0.3, 0.1]) * rng.randn(3)
+        found_data_dict = {}
+        for cam_id in R.cam_ids:
+            if rng.uniform() < 0.2:
+                continue  # camera missing data
+            x, y = R.find2d(cam_id, X) + rng.randn(2)
+            if rng.uniform() < 0.1:
+                x += 30.0  # outlier
+            found_data_dict[cam_id] = (x, y, 1.0, 0.0, 0.0) + (np.nan,) * 4
+        results = []
+        for engine in ["loop", "vectorized"]:
+            find_best_3d = ru.get_hypothesis_test_engine(engine)
+            try:
+                results.append(find_best_3d(R, found_data_dict, max_err))
+            except ru.NoAcceptablePointFound:
+                results.append(None)
+        if results[0] is None:
+            assert results[1] is None
+            continue
+        n_found += 1
+        X0, Lcoords0, cam_ids_used0, mean_dist0 = results[0]
+        X1, Lcoords1, cam_ids_used1, mean_dist1 = results[1]
+        assert cam_ids_used0 == cam_ids_used1
+        # the same cameras give the same 3D point
+        assert np.array_equal(X0, X1)
+        # up to the summation order of the reprojection errors
+        assert abs(mean_dist0 - mean_dist1) < 1e-9
+    assert n_found > 0
+
+
 def test_offline_reconstruction():
     fps = 120.0
     for use_kalman_smoothing in [False, True]:
@@ -350,9 +716,126 @@ class FakeRemoteApi:
         pass
 
 
+class FakePublisher:
+    """keep the published messages and the threads publishing them"""
+
+    def __init__(self, *args, **kwargs):
+        self.published = []
+
+    def publish(self, msg):
+        self.published.append((msg, threading.current_thread().name))
+
+
+class FakeRosMsg(object):
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.__dict__.update(kwargs)
+
+
+class FakeFlydraError(FakeRosMsg):
+    FRAME_DATA_LOSS = 0
+    CAM_TIMESTAMPS_OFF = 1
+
+
+def _make_ros_stubs():
+    """make modules standing in for the parts of ROS used in the attic"""
+    import types
+
+    modules = {}
+
+    def add_module(name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        modules[name] = module
+        return module
+
+    class ROSInitException(Exception):
+        pass
+
+    class Time:
+        now = staticmethod(time.time)
+        from_sec = staticmethod(float)
+
+    def no_op(*args, **kwargs):
+        pass
+
+    add_module(
+        "roslib",
+        load_manifest=no_op,
+        packages=add_module("roslib.packages"),
+    )
+    add_module("rospkg")
+    add_module("rosgraph", masterapi=add_module("rosgraph.masterapi"))
+    add_module(
+        "rospy",
+        Publisher=FakePublisher,
+        Time=Time,
+        core=add_module("rospy.core", is_initialized=lambda: False),
+        exceptions=add_module("rospy.exceptions", ROSInitException=ROSInitException),
+        names=add_module("rospy.names"),
+        get_name=lambda: "/flydra_test",
+        loginfo=no_op,
+        logdebug=no_op,
+        logwarn=no_op,
+        logfatal=no_op,
+    )
+    add_module(
+        "std_msgs",
+        msg=add_module("std_msgs.msg", String=FakeRosMsg, UInt64=FakeRosMsg),
+    )
+    add_module(
+        "ros_flydra",
+        msg=add_module(
+            "ros_flydra.msg",
+            flydra_mainbrain_super_packet=FakeRosMsg,
+            flydra_mainbrain_packet=FakeRosMsg,
+            flydra_object=FakeRosMsg,
+            CameraList=FakeRosMsg,
+            FlydraError=FakeFlydraError,
+        ),
+    )
+    add_module(
+        "geometry_msgs",
+        msg=add_module("geometry_msgs.msg", Point=FakeRosMsg, Vector3=FakeRosMsg),
+    )
+    return modules
+
+
+_attic_modules = {}
+
+
+def _import_coordinate_receiver():
+    """import the coordinate receiver of the attic without ROS"""
+    import imp
+    import flydra_core
+
+    if "coordinate_receiver" in _attic_modules:
+        return _attic_modules["coordinate_receiver"]
+    attic = os.path.join(os.path.dirname(flydra_core.__file__), os.pardir, "attic")
+    stubs = _make_ros_stubs()
+    added = [name for name in stubs if name not in sys.modules]
+    for name in added:
+        sys.modules[name] = stubs[name]
+    try:
+        # (kept referenced, as unreferenced modules lose their globals)
+        _attic_modules["rosutils"] = flydra_core.rosutils = imp.load_source(
+            "flydra_core.rosutils", os.path.join(attic, "rosutils.py")
+        )
+        _attic_modules["coordinate_receiver"] = imp.load_source(
+            "coordinate_receiver", os.path.join(attic, "coordinate_receiver.py")
+        )
+    finally:
+        # the modules keep their references to the stubs
+        for name in added + ["flydra_core.rosutils", "coordinate_receiver"]:
+            sys.modules.pop(name, None)
+        del flydra_core.rosutils
+    return _attic_modules["coordinate_receiver"]
+
+
 class FakeMainBrain:
     def __init__(self, trigger_device):
         self.queue_error_ros_msgs = Queue.Queue()
+        self.error_ros_msgs_pub = FakePublisher()
         self.trigger_device = trigger_device
         self.remote_api = FakeRemoteApi()
         self.counts = {}
@@ -362,6 +845,438 @@ class FakeMainBrain:
         return False
 
 
+def _check_kalmanize_same_output(
+    D,
+    data2d_fname,
+    option_args_a,
+    option_args_b,
+    between_runs=None,
+    check=None,
+    **kwargs
+):
+    """check that kalmanize gives the same 3D data with both option_args
+
+    between_runs is called after the first run. check is called with
+    the open results of both runs for further tests. kwargs are passed
+    to kalmanize().
+    """
+    data3d_fnames = []
+    try:
+        for option_args in [option_args_a, option_args_b]:
+            if len(data3d_fnames) and between_runs is not None:
+                between_runs()
+            (options, args) = get_parser().parse_args(option_args)
+            options.fake_timestamp = 123.0
+            data3d_fname = tempfile.mktemp(suffix="-data3d.h5")
+            data3d_fnames.append(data3d_fname)
+            kalmanize(
+                data2d_fname,
+                dest_filename=data3d_fname,
+                dynamic_model_name=D["dynamic_model_name"],
+                reconstructor=D["reconstructor"],
+                options=options,
+                **kwargs
+            )
+
+        with tables.open_file(data3d_fnames[0], mode="r") as result_a:
+            with tables.open_file(data3d_fnames[1], mode="r") as result_b:
+                for name in ["kalman_estimates", "ML_estimates"]:
+                    expected = getattr(result_a.root, name)[:]
+                    actual = getattr(result_b.root, name)[:]
+                    assert len(expected) > 0
+                    assert expected.tostring() == actual.tostring()
+                expected = read_ML_estimates_2d_idxs(result_a.root)
+                actual = read_ML_estimates_2d_idxs(result_b.root)
+                assert [r.tolist() for r in expected] == [r.tolist() for r in actual]
+                if check is not None:
+                    check(result_a, result_b)
+    finally:
+        for fname in data3d_fnames:
+            try:
+                os.unlink(fname)
+            except OSError as err:
+                # file does not exist?
+                pass
+
+
+def test_parallel_kalmanize():
+    fps = 120.0
+    D = setup_data(fps=fps)
+    # repeat the trajectory with gaps of missing data in between
+    for cam_id, pos in D["data2d"]["2d_pos_by_cam_ids"].items():
+        pos = np.vstack([pos] * 3)
+        pos[100:130] = np.nan
+        pos[200:205] = np.nan
+        pos[260:300] = np.nan
+        D["data2d"]["2d_pos_by_cam_ids"][cam_id] = pos
+        D["data2d"]["2d_slope_by_cam_ids"][cam_id] = np.zeros((len(pos),))
+    D["data2d"]["t"] = np.arange(len(pos)) / fps
+
+    data2d_fname = tempfile.mktemp(suffix="-data2d.h5")
+    try:
+        flydra_analysis.offline_data_save.save_data(
+            fname=data2d_fname,
+            data2d=D["data2d"],
+            fps=fps,
+            reconstructor=D["reconstructor"],
+            eccentricity=D["eccentricity"],
+        )
+        _check_kalmanize_same_output(D, data2d_fname, ["--jobs", "1"], ["--jobs", "3"])
+    finally:
+        try:
+            os.unlink(data2d_fname)
+        except OSError as err:
+            # file does not exist?
+            pass
+
+
+def _save_swarm_data(fname, reconstructor, fps, n_objects, n_frames, seed=3):
+    """save 2D data of several objects flying at once to fname"""
+    from flydra_core.data_descriptions import Info2D, CamSyncInfo, TextLogDescription
+
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_frames) / fps
+    X = []
+    for i in range(n_objects):
+        center = rng.uniform(-0.15, 0.15, 3)
+        amplitude = rng.uniform(0.05, 0.1, 3)
+        omega = rng.uniform(1.0, 4.0, 3)
+        phase = rng.uniform(0.0, 2 * np.pi, 3)
+        X.append(center + amplitude * np.sin(omega * t[:, np.newaxis] + phase))
+
+    with tables.open_file(fname, mode="w") as h5file:
+        reconstructor.save_to_h5file(h5file)
+        h5textlog = h5file.create_table(
+            h5file.root, "textlog", TextLogDescription, "text log"
+        )
+        flydra_analysis.offline_data_save.startup_message(h5textlog=h5textlog, fps=fps)
+        h5cam_info = h5file.create_table(h5file.root, "cam_info", CamSyncInfo)
+        for camn, cam_id in enumerate(reconstructor.cam_ids):
+            h5cam_info.row["camn"] = camn
+            h5cam_info.row["cam_id"] = cam_id
+            h5cam_info.row.append()
+        h5data2d = h5file.create_table(h5file.root, "data2d_distorted", Info2D)
+        detection = h5data2d.row
+        x2d_all = [
+            reconstructor.find2d_all(X[i], distorted=True) for i in range(n_objects)
+        ]
+        for frame in range(n_frames):
+            for camn in range(len(reconstructor.cam_ids)):
+                for i in range(n_objects):
+                    x, y = x2d_all[i][camn, :, frame] + rng.randn(2) * 0.3
+                    detection["camn"] = camn
+                    detection["frame"] = frame
+                    detection["timestamp"] = t[frame]
+                    detection["cam_received_timestamp"] = t[frame]
+                    detection["x"] = x
+                    detection["y"] = y
+                    detection["area"] = 1
+                    detection["slope"] = 0.0
+                    detection["eccentricity"] = 0.0
+                    detection["frame_pt_idx"] = i
+                    detection["cur_val"] = 123
+                    detection["mean_val"] = 1.2345
+                    detection["sumsqf_val"] = 1.2345
+                    detection.append()
+
+
+def check_association_mode(association_mode, n_objects=6, n_frames=120):
+    fps = 120.0
+    D = setup_data(fps=fps)
+    data2d_fname = tempfile.mktemp(suffix="-data2d.h5")
+    data3d_fname = tempfile.mktemp(suffix="-data3d.h5")
+    try:
+        _save_swarm_data(data2d_fname, D["reconstructor"], fps, n_objects, n_frames)
+        (options, args) = get_parser().parse_args(
+            ["--association-mode", association_mode]
+        )
+        options.fake_timestamp = 123.0
+        t_start = time.time()
+        kalmanize(
+            data2d_fname,
+            dest_filename=data3d_fname,
+            dynamic_model_name=D["dynamic_model_name"],
+            reconstructor=D["reconstructor"],
+            options=options,
+        )
+        duration = time.time() - t_start
+
+        with tables.open_file(data3d_fname, mode="r") as h5file:
+            ML_estimates = h5file.root.ML_estimates[:]
+            idxs = read_ML_estimates_2d_idxs(h5file.root)
+            n_obj_ids = len(np.unique(ML_estimates["obj_id"]))
+            # count 2D points used by more than one object in a frame
+            used = collections.Counter()
+            for row in ML_estimates:
+                camns_and_idxs = idxs[int(row["obs_2d_idx"])]
+                for camn, idx in zip(camns_and_idxs[0::2], camns_and_idxs[1::2]):
+                    used[(row["frame"], camn, idx)] += 1
+            n_shared = sum(1 for count in used.values() if count > 1)
+    finally:
+        for fname in [data2d_fname, data3d_fname]:
+            try:
+                os.unlink(fname)
+            except OSError as err:
+                # file does not exist?
+                pass
+    return dict(
+        association_mode=association_mode,
+        n_objects=n_objects,
+        n_obj_ids=n_obj_ids,
+        n_shared_2d_points=n_shared,
+        duration=duration,
+    )
+
+
+def test_hungarian_association():
+    rd = check_association_mode("hungarian")
+    assert rd["n_shared_2d_points"] == 0
+    assert 0 < rd["n_obj_ids"] <= rd["n_objects"]
+
+
+def test_assign_by_min_cost():
+    from flydra_core.kalman.flydra_tracker import _assign_by_min_cost
+
+    inf = np.inf
+    # Greedy association lets object 0 take its best point 0, leaving
+    # object 1 with point 1 (total cost 11) or, if it may not use point
+    # 1, with nothing. The minimum cost assignment swaps the points.
+    cost = np.array([[1.0, 2.0], [1.5, 10.0]])
+    assert sorted(_assign_by_min_cost(cost)) == [(0, 1), (1, 0)]
+    cost = np.array([[1.0, 2.0, inf], [1.0, inf, inf], [inf, inf, inf]])
+    assert sorted(_assign_by_min_cost(cost)) == [(0, 1), (1, 0)]
+    # more objects than points
+    cost = np.array([[3.0], [1.0], [2.0]])
+    assert _assign_by_min_cost(cost) == [(1, 0)]
+    assert _assign_by_min_cost(np.array([[inf, inf]])) == []
+
+
+def benchmark_association_modes(n_objects=15, n_frames=240):
+    """compare the association modes (run with --association-modes)"""
+    for association_mode in ["greedy", "hungarian"]:
+        rd = check_association_mode(
+            association_mode, n_objects=n_objects, n_frames=n_frames
+        )
+        pprint.pprint(rd)
+
+
+def test_tracker_workers():
+    fps = 120.0
+    D = setup_data(fps=fps)
+    data2d_fname = tempfile.mktemp(suffix="-data2d.h5")
+    try:
+        _save_swarm_data(data2d_fname, D["reconstructor"], fps, 4, 60)
+        _check_kalmanize_same_output(
+            D, data2d_fname, ["--tracker-workers", "0"], ["--tracker-workers", "2"]
+        )
+    finally:
+        try:
+            os.unlink(data2d_fname)
+        except OSError as err:
+            # file does not exist?
+            pass
+
+
+def test_table_indexes():
+    from flydra_core.data_descriptions import create_table_indexes
+    from flydra_analysis.a2.tables_tools import has_csindex
+    from flydra_analysis.a2.utils import TableFinder
+
+    def check_indexes(unindexed, indexed):
+        for name in ["kalman_estimates", "ML_estimates"]:
+            table = getattr(indexed.root, name)
+            actual = table[:]
+            assert has_csindex(table, "obj_id")
+            assert has_csindex(table, "frame")
+            finder = TableFinder(table, "obj_id")
+            assert finder.finder is None
+            for obj_id in np.unique(actual["obj_id"]):
+                expected_idxs = np.nonzero(actual["obj_id"] == obj_id)[0]
+                assert finder.get_idxs_of_equal(obj_id).tolist() == (
+                    expected_idxs.tolist()
+                )
+            unindexed_finder = TableFinder(getattr(unindexed.root, name), "frame")
+            assert (
+                TableFinder(table, "frame").get_idxs_in_range(30, 35).tolist()
+                == unindexed_finder.get_idxs_in_range(30, 35).tolist()
+            )
+
+    def index_data2d():
+        with tables.open_file(data2d_fname, mode="r+") as h5file:
+            create_table_indexes(h5file)
+            assert has_csindex(h5file.root.data2d_distorted, "frame")
+
+    fps = 120.0
+    D = setup_data(fps=fps)
+    data2d_fname = tempfile.mktemp(suffix="-data2d.h5")
+    try:
+        _save_swarm_data(data2d_fname, D["reconstructor"], fps, 4, 60)
+        # the second run reads the indexed 2D data
+        _check_kalmanize_same_output(
+            D,
+            data2d_fname,
+            [],
+            [],
+            between_runs=index_data2d,
+            check=check_indexes,
+            start_frame=20,
+            stop_frame=45,
+        )
+    finally:
+        try:
+            os.unlink(data2d_fname)
+        except OSError as err:
+            # file does not exist?
+            pass
+
+
+def test_kalmanize_data2d_journal():
+    from flydra_core.data2d_journal import Data2dJournalWriter
+
+    fps = 120.0
+    D = setup_data(fps=fps)
+    data2d_fname = tempfile.mktemp(suffix="-data2d.h5")
+    journal_dirname = tempfile.mkdtemp(suffix="-data2d-journal")
+    try:
+        _save_swarm_data(data2d_fname, D["reconstructor"], fps, 4, 60)
+        with tables.open_file(data2d_fname, mode="r") as h5file:
+            data2d = h5file.root.data2d_distorted[:]
+        journal = Data2dJournalWriter(journal_dirname, segment_max_bytes=10000)
+        for start in range(0, len(data2d), 100):
+            journal.append(data2d[start : start + 100])
+        journal.close()
+
+        _check_kalmanize_same_output(
+            D,
+            data2d_fname,
+            [],
+            ["--data2d-journal", journal_dirname],
+            start_frame=20,
+            stop_frame=45,
+        )
+    finally:
+        shutil.rmtree(journal_dirname)
+        try:
+            os.unlink(data2d_fname)
+        except OSError as err:
+            # file does not exist?
+            pass
+
+
+def test_realtime_pipeline():
+    for slow_tracking in [False, True]:
+        yield check_realtime_pipeline, slow_tracking
+
+
+def check_realtime_pipeline(slow_tracking, fps=120.0):
+    from flydra_core.coord_packets import PointPacketEncoder
+
+    coordinate_receiver = _import_coordinate_receiver()
+    D = setup_data(fps=fps, with_distortion=False)
+    R = D["reconstructor"]
+    pos2d = D["data2d"]["2d_pos_by_cam_ids"]
+    n_frames = len(D["data2d"]["t"])
+    cam_ids = R.cam_ids
+
+    time_lock = threading.Lock()
+    time_dict = {}
+    trigger_device = FakeTriggerDevice(time_lock=time_lock, time_dict=time_dict)
+    mb = FakeMainBrain(trigger_device=trigger_device)
+    coord_processor = coordinate_receiver.CoordinateProcessor(
+        mb,
+        save_profiling_data=False,
+        debug_level=threading.Event(),
+        show_sync_errors=False,
+        show_overall_latency=threading.Event(),
+        max_reconstruction_latency_sec=0.1,
+        max_N_hypothesis_test=3,
+        use_unix_domain_sockets=True,
+    )
+    for cam_id in cam_ids:
+        coord_processor.connect(cam_id)
+    coord_processor.set_reconstructor(R)
+    model = flydra_core.kalman.dynamic_models.get_kalman_model(
+        name=D["dynamic_model_name"], dt=(1.0 / fps)
+    )
+    coord_processor.set_new_tracker(model)
+    if slow_tracking:
+        tracker = coord_processor.tracker
+        calculate_a_posteriori_estimates = tracker.calculate_a_posteriori_estimates
+
+        def slow_calculate(*args, **kwargs):
+            time.sleep(0.02)
+            return calculate_a_posteriori_estimates(*args, **kwargs)
+
+        tracker.calculate_a_posteriori_estimates = slow_calculate
+
+    addrinfo = flydra_socket.make_addrinfo(**coord_processor.get_listen_address())
+    sender = flydra_socket.FlydraTransportSender(addrinfo)
+    n_packets = n_frames * len(cam_ids)
+
+    coord_processor.daemon = True
+    coord_processor.start()
+    try:
+        # frame 0 synchronizes the cameras
+        encoders = dict((cam_id, PointPacketEncoder(cam_id)) for cam_id in cam_ids)
+        for framenumber in range(n_frames):
+            timestamp = time.time()
+            with time_lock:
+                time_dict[framenumber] = timestamp
+            for cam_id in cam_ids:
+                x, y = pos2d[cam_id][framenumber]
+                pt = (x, y, 1.0, 0.0, 0.0, False, 100, 2.0, 3.0)
+                buf = encoders[cam_id].encode(
+                    timestamp, timestamp, framenumber, [pt], 0
+                )
+                sender.send(buf)
+            time.sleep(1.0 / fps)
+
+        # wait for the receive queue to empty
+        stop_time = time.time() + 10.0
+        while time.time() < stop_time:
+            receive_metrics = coord_processor.receive_queue.get_metrics()
+            if receive_metrics["n_put"] == n_packets:
+                if receive_metrics["depth"] == 0:
+                    break
+            time.sleep(0.05)
+    finally:
+        coord_processor.quit()
+    assert coord_processor.did_quit_successfully
+
+    metrics = dict(
+        (stage_metrics["name"], stage_metrics)
+        for stage_metrics in coord_processor.get_pipeline_metrics()
+    )
+    # every packet was drained from the socket, even with slow tracking
+    assert metrics["receive"]["n_put"] == n_packets
+    assert metrics["receive"]["n_dropped"] == 0
+    assert metrics["tracking"]["n_overwritten"] == 0
+    assert metrics["output"]["n_dropped"] == 0
+    assert metrics["output"]["n_errors"] == 0
+    if slow_tracking:
+        assert metrics["tracking"]["n_degraded"] > 0
+
+    # the tracked objects are published from the output stage
+    published = coord_processor.realtime_ros_packets_pub.published
+    assert set(thread_name for msg, thread_name in published) == set(["OutputStage"])
+    live_framenumbers = []
+    for super_packet, thread_name in published:
+        (packet,) = super_packet.args[0]
+        for obj in packet.objects:
+            X = np.array(obj.position.args)
+            if np.any(np.isnan(X)):
+                # the object was killed
+                continue
+            live_framenumbers.append(packet.framenumber)
+            X_expected = np.array([D[dim][packet.framenumber] for dim in "xyz"])
+            assert np.sqrt(np.sum((X - X_expected) ** 2)) < 0.01
+    # also when tracking is slow, the newest frames keep being published
+    assert len(live_framenumbers) > 1
+    assert max(live_framenumbers) >= n_frames // 2
+    if not slow_tracking:
+        assert len(live_framenumbers) > n_frames // 2
+
+
 def disabled_tst_online_reconstruction():
     # This is currently disabled because it was never updated when we switched from
     # sending ROS messages from a separate thread to directly calling publish().
@@ -613,6 +1528,9 @@ def benchmark():
 
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--association-modes"]:
+        benchmark_association_modes()
+        sys.exit(0)
     if len(sys.argv) == 2:
         kcachegrind_output_fname = sys.argv[1]
     else:
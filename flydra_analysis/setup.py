@@ -72,6 +72,7 @@ setup(
             "flydra_analysis_filter_kalman_data = flydra_analysis.analysis.flydra_analysis_filter_kalman_data:main",
             "flydra_analysis_h5_shorten = flydra_analysis.a2.h5_shorten:main",
             "flydra_analysis_check_mainbrain_h5_contiguity = flydra_analysis.a2.check_mainbrain_h5_contiguity:main",
+            "flydra_analysis_compact_data2d_journal = flydra_analysis.a2.compact_data2d_journal:main",
             "flydra_analysis_get_clock_sync = flydra_analysis.a2.get_clock_sync:main",
             "flydra_analysis_get_2D_image_latency = flydra_analysis.a2.get_2D_image_latency:main",
             "flydra_analysis_get_2D_image_latency_plot = flydra_analysis.a2.get_2D_image_latency_plot:main",
@@ -31,8 +31,6 @@ import os
 BENCHMARK = int(os.environ.get('FLYDRA_BENCHMARK',0))
 FLYDRA_BT = int(os.environ.get('FLYDRA_BT',0)) # threaded benchmark
 
-NAUGHTY_BUT_FAST = False
-
 #DISABLE_ALL_PROCESSING = True
 DISABLE_ALL_PROCESSING = False
 
@@ -92,9 +90,7 @@ import flydra_camnode.version
 import flydra_core.rosutils
 
 import flydra_core.data_descriptions
-WIRE_ORDER_CUR_VAL_IDX    = flydra_core.data_descriptions.WIRE_ORDER_CUR_VAL_IDX
-WIRE_ORDER_MEAN_VAL_IDX   = flydra_core.data_descriptions.WIRE_ORDER_MEAN_VAL_IDX
-WIRE_ORDER_SUMSQF_VAL_IDX = flydra_core.data_descriptions.WIRE_ORDER_SUMSQF_VAL_IDX
+from flydra_core.coord_packets import PointPacketEncoder, recv_pt_dtype
 
 import camnode_utils
 import motmot.FastImage.FastImage as FastImage
@@ -330,17 +326,19 @@ def pluecker_from_verts(A,B):
     L = nx.dot(A,nx.transpose(B)) - nx.dot(B,nx.transpose(A))
     return Lmatrix2Lcoords(L)
 
-class PreallocatedBuffer(object):
+class PreallocatedBuffer(camnode_utils.RefCountedBuffer):
+    """A frame buffer, shared by reference counting. Threadsafe.
+
+    The buffer returns to its pool when the last reference is released.
+    """
     def __init__(self,size,pool):
+        camnode_utils.RefCountedBuffer.__init__(self,pool)
         self._size = size
         self._buf = FastImage.FastImage8u(size)
-        self._pool = pool
     def get_size(self):
         return self._size
     def get_buf(self):
         return self._buf
-    def get_pool(self):
-        return self._pool
 
 class PreallocatedBufferPool(object):
     """One instance of this class for each camera. Threadsafe."""
@@ -368,6 +366,7 @@ class PreallocatedBufferPool(object):
                 buffer = self._allocated_pool.pop()
             else:
                 buffer = PreallocatedBuffer(self._size,self)
+            buffer._refcount = 1
             self._buffers_handed_out += 1
             self._zero_buffer_lock.clear()
             return buffer
@@ -397,7 +396,7 @@ def get_free_buffer_from_pool(pool):
         yield buf
     finally:
         if not buf._i_promise_to_return_buffer_to_the_pool:
-            pool.return_buffer(buf)
+            buf.release()
 
 class ProcessCamClass(rospy.SubscribeListener):
     def __init__(self,
@@ -459,10 +458,11 @@ class ProcessCamClass(rospy.SubscribeListener):
         if self.benchmark:
             self.coord_socket = flydra_socket.get_dummy_sender()
         else:
-            self.coord_socket = flydra_socket.FlydraTransportSender( coord_receiver_addrinfo )
+            self.coord_socket = flydra_socket.make_sender( coord_receiver_addrinfo )
         if len(cam_id) > (flydra_core.common_variables.cam_id_count-1):
             raise ValueError('cam_id %r is too long'%cam_id)
         self.cam_id = cam_id
+        self._point_packet_encoder = PointPacketEncoder(cam_id)
         self.log_message_queue = log_message_queue
 
         self.bg_frame_alpha = bg_frame_alpha
@@ -526,40 +526,36 @@ class ProcessCamClass(rospy.SubscribeListener):
     def _convert_to_wire_order(self, xpoints, hw_roi_frame, running_mean_im, sumsqf ):
         """the images passed in are already in roi coords, as are index_x and index_y.
         convert to values for sending.
+
+        Returns an array of flydra_core.coord_packets.recv_pt_dtype.
         """
-        points = []
-        hw_roi_frame = numpy.asarray( hw_roi_frame )
-        for xpt in xpoints:
-            try:
-                (x0_abs, y0_abs, area, slope, eccentricity, index_x, index_y) = xpt
-            except:
-                LOG.warn('converting xpt %s' % xpt)
-                raise
-
-            # Find values at location in image that triggered
-            # point. Cast to Python int and floats.
-            cur_val = int(hw_roi_frame[index_y,index_x])
-            mean_val = float(running_mean_im[index_y, index_x])
-            sumsqf_val = float(sumsqf[index_y, index_x])
-
-            slope_found = not numpy.isnan(slope)
-            if slope_found==False:
-                # prevent nan going across network
-                slope = 0.0
-            elif numpy.isinf(slope):
-                # prevent inf going across network
-                slope = near_inf
-
-            if numpy.isinf(eccentricity):
-                # prevent inf going across network
-                eccentricity = near_inf
-
-            # see flydra_core.common_variables.recv_pt_fmt struct definition:
-            pt = (x0_abs, y0_abs, area, slope, eccentricity,
-                  slope_found, cur_val, mean_val, sumsqf_val)
-            # WIRE_ORDER_CUR_VAL_IDX, WIRE_ORDER_MEAN_VAL_IDX, WIRE_ORDER_SUMSQF_VAL_IDX
-            assert len(pt) == (WIRE_ORDER_SUMSQF_VAL_IDX+1)
-            points.append( pt )
+        points = numpy.zeros( (len(xpoints),), dtype=recv_pt_dtype )
+        if not len(xpoints):
+            return points
+        # columns: x0_abs, y0_abs, area, slope, eccentricity, index_x, index_y
+        xpoints = numpy.array( xpoints, dtype=numpy.float64 )
+        index_x = xpoints[:,5].astype(numpy.intp)
+        index_y = xpoints[:,6].astype(numpy.intp)
+
+        slope = xpoints[:,3]
+        slope_found = ~numpy.isnan(slope)
+        # prevent nan and inf going across network
+        slope[~slope_found] = 0.0
+        slope[numpy.isinf(slope)] = near_inf
+        eccentricity = xpoints[:,4]
+        eccentricity[numpy.isinf(eccentricity)] = near_inf
+
+        # see flydra_core.common_variables.recv_pt_fmt struct definition:
+        points['x_distorted'] = xpoints[:,0]
+        points['y_distorted'] = xpoints[:,1]
+        points['area'] = xpoints[:,2]
+        points['slope'] = slope
+        points['eccentricity'] = eccentricity
+        points['slope_found'] = slope_found
+        # Find values at location in image that triggered point.
+        points['cur_val'] = numpy.asarray( hw_roi_frame )[index_y,index_x]
+        points['mean_val'] = numpy.asarray( running_mean_im )[index_y,index_x]
+        points['sumsqf_val'] = numpy.asarray( sumsqf )[index_y,index_x]
         return points
 
     def _service_ros(self, framenumber, hw_roi_frame, chainbuf):
@@ -730,8 +726,10 @@ class ProcessCamClass(rospy.SubscribeListener):
 
         #################### done initializing images ############
 
-        incoming_raw_frames_queue = globals['incoming_raw_frames']
-        incoming_raw_frames_queue_put = incoming_raw_frames_queue.put
+        incoming_raw_frames_queue_put = globals['incoming_raw_frames'].put
+
+        latency_record = globals['latency_stats'].record
+        monotonic = camnode_utils.monotonic
 
         initial_take_bg_state = None
 
@@ -740,6 +738,8 @@ class ProcessCamClass(rospy.SubscribeListener):
             with camnode_utils.use_buffer_from_chain(self._chain) as chainbuf:
                 if chainbuf.quit_now:
                     break
+                t_start = monotonic()
+                latency_record('queue', t_start-chainbuf.grabbed_monotonic)
                 chainbuf.updated_running_mean_image = None
                 chainbuf.updated_running_sumsqf_image = None
 
@@ -795,6 +795,7 @@ class ProcessCamClass(rospy.SubscribeListener):
                 old_ts = timestamp
                 old_fn = framenumber
 
+                t0 = monotonic()
                 xpoints = self.realtime_analyzer.do_work(hw_roi_frame,
                                                          timestamp, framenumber, use_roi2,
                                                          use_cmp_isSet(),
@@ -802,18 +803,11 @@ class ProcessCamClass(rospy.SubscribeListener):
                                                          max_duration_sec=self.shortest_IFI-0.0005, # give .5 msec for other processing
                                                          return_debug_values=1,
                                                          )
+                latency_record('do_work', monotonic()-t0)
                 ## if len(xpoints)>=self.max_num_points:
                 ##     msg = 'Warning: cannot save acquire points this frame because maximum number already acheived'
                 ##     LOG.warn(msg)
                 chainbuf.processed_points = xpoints
-                if NAUGHTY_BUT_FAST:
-                    chainbuf.absdiff8u_im_full = absdiff8u_im_full
-                    chainbuf.mean8u_im_full = running_mean8u_im_full
-                    chainbuf.compareframe8u_full = compareframe8u_full
-                else:
-                    chainbuf.absdiff8u_im_full = numpy.array(absdiff8u_im_full,copy=True)
-                    chainbuf.mean8u_im_full = numpy.array(running_mean8u_im_full,copy=True)
-                    chainbuf.compareframe8u_full = numpy.array(compareframe8u_full,copy=True)
                 points = self._convert_to_wire_order( xpoints, hw_roi_frame, running_mean_im, running_sumsqf)
 
                 # allow other thread to see images
@@ -825,15 +819,11 @@ class ProcessCamClass(rospy.SubscribeListener):
                 globals['most_recent_frame_potentially_corrupt'] = (0,0), export_image # give view of image, receiver must be careful
 
                 if 1:
-                    # allow other thread to see raw image always (for saving)
-                    if incoming_raw_frames_queue.qsize() >1000:
-                        # chop off some old frames to prevent memory explosion
-                        LOG.warn('ERROR: deleting old frames to make room for new ones! (and sleeping)')
-                        for i in range(100):
-                            incoming_raw_frames_queue.get_nowait()
+                    # allow other thread to see raw image always (for
+                    # saving). Not copied, the queue holds a reference.
                     incoming_raw_frames_queue_put(
-                        (hw_roi_frame.get_8u_copy(hw_roi_frame.size), # save a copy
-                         timestamp,
+                        chainbuf,
+                        (timestamp,
                          framenumber,
                          points,
                          self.realtime_analyzer.roi,
@@ -923,6 +913,7 @@ class ProcessCamClass(rospy.SubscribeListener):
                         do_bg_maint = True
 
                 if do_bg_maint:
+                    t0 = monotonic()
                     realtime_image_analysis.do_bg_maint(
                     #print 'doing slow bg maint, frame', chainbuf.framenumber
                     #tmpresult = motmot.realtime_image_analysis.slow.do_bg_maint(
@@ -944,6 +935,7 @@ class ProcessCamClass(rospy.SubscribeListener):
                         bench=0 )
                         #debug=0)
                     #chainbuf.real_std_est= tmpresult
+                    latency_record('bg_maint', monotonic()-t0)
                     bg_changed = True
                     bg_frame_number = 0
 
@@ -974,21 +966,19 @@ class ProcessCamClass(rospy.SubscribeListener):
                     self.realtime_analyzer.clear_threshold = (
                         self.clear_threshold_shared.get_nowait() )
 
-                data = struct.pack(flydra_core.common_variables.recv_pt_header_fmt,
-                                   self.cam_id,
-                                   timestamp,cam_received_time,
-                                   framenumber,len(points),n_frames_skipped)
-                for point_tuple in points:
-                    try:
-                        data = data + struct.pack(flydra_core.common_variables.recv_pt_fmt,*point_tuple)
-                    except:
-                        LOG.warn('error-causing data: %s' % (point_tuple,))
-                        raise
+                t0 = monotonic()
+                data = self._point_packet_encoder.encode(timestamp,cam_received_time,
+                                                         framenumber,points,n_frames_skipped)
+                t1 = monotonic()
+                latency_record('pack', t1-t0)
                 if 0:
                     local_processing_time = (time.time()-cam_received_time)*1e3
                     LOG.debug('local_processing_time % 3.1f'%local_processing_time)
 
                 self.coord_socket.send(data)
+                t2 = monotonic()
+                latency_record('send', t2-t1)
+                latency_record('total', t2-chainbuf.grabbed_monotonic)
 
                 if 0 and self.new_roi.isSet():
                     with self.new_roi_data_lock:
@@ -1163,7 +1153,8 @@ class SaveCamData(object):
                     last_running_sumsqf_image = chainbuf.updated_running_sumsqf_image
 
                 if state == 'saving':
-                    raw.append( (numpy.array(chainbuf.get_buf(), copy=True),
+                    chainbuf.add_ref() # released once saved
+                    raw.append( (chainbuf,
                                  chainbuf.cam_received_time) )
                     if chainbuf.updated_running_mean_image is not None:
                         meancmp.append( (chainbuf.updated_running_mean_image,
@@ -1189,7 +1180,8 @@ class SaveCamData(object):
                         last_running_sumsqf_image = chainbuf.updated_running_sumsqf_image
 
                     if state == 'saving':
-                        raw.append( (numpy.array(chainbuf.get_buf(), copy=True),
+                        chainbuf.add_ref() # released once saved
+                        raw.append( (chainbuf,
                                      chainbuf.cam_received_time) )
                         if chainbuf.updated_running_mean_image is not None:
                             meancmp.append( (chainbuf.updated_running_mean_image,
@@ -1202,10 +1194,12 @@ class SaveCamData(object):
             #   TODO: switch to add_frames() method which doesn't acquire GIL after each frame.
             if state == 'saving':
                 for frame,timestamp in raw:
-                    raw_movie.add_frame(FastImage.asfastimage(frame),timestamp,error_if_not_fast=True)
+                    raw_movie.add_frame(frame.get_buf(),timestamp,error_if_not_fast=True)
                 for running_mean,running_sumsqf,timestamp in meancmp:
                     bg_movie.add_frame(FastImage.asfastimage(running_mean),timestamp,error_if_not_fast=True)
                     std_movie.add_frame(FastImage.asfastimage(running_sumsqf),timestamp,error_if_not_fast=True)
+            for frame,timestamp in raw:
+                frame.release()
             del raw[:]
             del meancmp[:]
 
@@ -1379,9 +1373,11 @@ class ImageSource(threading.Thread):
                  debug_acquire=False,
                  cam_id='<unassigned>',
                  quit_event=None,
-                 log_message_queue=None):
+                 log_message_queue=None,
+                 latency_stats=None):
 
         threading.Thread.__init__(self,name='ImageSource')
+        self.latency_stats = latency_stats
         self._chain = chain
         self.cam = cam
         with self.cam.lock:
@@ -1405,6 +1401,8 @@ class ImageSource(threading.Thread):
         LOG.info('ImageSource running in process %s' % os.getpid())
         buffer_pool = self.buffer_pool
         process_quit_event_isSet = self.quit_event.isSet
+        latency_stats = self.latency_stats
+        monotonic = camnode_utils.monotonic
         while not process_quit_event_isSet():
             self._block_until_ready() # no-op for realtime camera processing
             if buffer_pool.get_num_outstanding_buffers() > 100:
@@ -1424,9 +1422,13 @@ class ImageSource(threading.Thread):
 
                 _bufim = chainbuf.get_buf()
 
+                t_grab_start = monotonic()
                 try_again_condition, timestamp, framenumber = self._grab_into_buffer( _bufim )
                 if try_again_condition:
                     continue
+                chainbuf.grabbed_monotonic = t_grab_done = monotonic()
+                if latency_stats is not None:
+                    latency_stats.record('grab', t_grab_done-t_grab_start)
 
                 if self.debug_acquire:
                     stdout_write(self.cam_id)
@@ -1927,6 +1929,13 @@ class AppState(object):
 
         self.log_message_queue = Queue.Queue()
 
+        if options.latency_stats_socket:
+            self._latency_stats_sender = flydra_socket.FlydraTransportSender(
+                flydra_socket.make_addrinfo(filename=options.latency_stats_socket))
+        else:
+            self._latency_stats_sender = None
+        self._latency_summary_logged = False
+
         force_cam_ids = options.force_cam_ids
         if force_cam_ids is not None:
             force_cam_ids = force_cam_ids.split(',')
@@ -1996,7 +2005,11 @@ class AppState(object):
             globals = self.globals[cam_no] # shorthand
 
             globals['debug_acquire']=options.debug_acquire
-            globals['incoming_raw_frames']=Queue.Queue()
+            globals['incoming_raw_frames']=camnode_utils.FrameQueue(
+                options.raw_frames_queue_size,
+                policy=options.raw_frames_backpressure)
+            globals['incoming_raw_frames_n_dropped']=0
+            globals['latency_stats_last_log_time']=time.time()
             globals['raw_fmf_and_bg_fmf']=None
             globals['most_recent_frame_potentially_corrupt']=None
             globals['saved_bg_frame']=False
@@ -2066,6 +2079,8 @@ class AppState(object):
                         print 'FAILED to open camera %s'%cam.guid
                         raise
             self.cam_status[cam_no]= 'started'
+            globals['latency_stats']=camnode_utils.LatencyStats(self.all_cam_ids[cam_no])
+
             if ImageSourceModel is not None:
                 with cam.lock:
                     l,b,w,h = cam.get_frame_roi()
@@ -2077,7 +2092,8 @@ class AppState(object):
                                                 debug_acquire=options.debug_acquire,
                                                 cam_id=self.all_cam_ids[cam_no],
                                                 quit_event=globals['process_quit_event'],
-                                                log_message_queue=self.log_message_queue)
+                                                log_message_queue=self.log_message_queue,
+                                                latency_stats=globals['latency_stats'])
                 if benchmark: # should maybe be for any simulated camera in non-GUI mode?
                     image_source.register_buffer_pool( buffer_pool )
 
@@ -2397,6 +2413,13 @@ class AppState(object):
             if thread.isAlive():
                 thread.join(0.01)
 
+        if not self._latency_summary_logged:
+            self._latency_summary_logged = True
+            for globals in self.globals:
+                if 'latency_stats' in globals:
+                    latency_stats = globals['latency_stats']
+                    LOG.info(latency_stats.format_table(latency_stats.get_summary()))
+
         if self._real_quit_function is not None:
             self._real_quit_function(exit_value)
 
@@ -2485,9 +2508,12 @@ class AppState(object):
                     get_raw_frame = globals['incoming_raw_frames'].get_nowait
                     try:
                         while 1:
-                            (frame,timestamp,framenumber,points,lbrt,
+                            frame, (timestamp,framenumber,points,lbrt,
                              cam_received_time) = get_raw_frame() # this may raise Queue.Empty
-                            last_frames.append( (frame,timestamp,framenumber,points) ) # save for post-triggering
+                            # Do not keep the image, which would keep
+                            # the buffer from returning to the pool.
+                            frame.release()
+                            last_frames.append( (timestamp,framenumber,points) ) # save for post-triggering
                             while len(last_frames)>200:
                                 del last_frames[0]
 
@@ -2500,10 +2526,43 @@ class AppState(object):
                     except Queue.Empty:
                         pass
 
+                    n_dropped = globals['incoming_raw_frames'].n_dropped
+                    if n_dropped != globals['incoming_raw_frames_n_dropped']:
+                        LOG.warn('%s: %d raw frames dropped (backpressure policy %s)' % (
+                            cam_id, n_dropped - globals['incoming_raw_frames_n_dropped'],
+                            self.options.raw_frames_backpressure))
+                        globals['incoming_raw_frames_n_dropped'] = n_dropped
+
+                    self._publish_latency_stats(globals)
+
         except:
             LOG.fatal(traceback.format_exc())
             self.quit_function(1)
 
+    def _publish_latency_stats(self, globals):
+        """log and send the latency of the last interval, when due"""
+        interval = self.options.latency_log_interval
+        if not interval:
+            return
+        now = time.time()
+        if now - globals['latency_stats_last_log_time'] < interval:
+            return
+        globals['latency_stats_last_log_time'] = now
+
+        latency_stats = globals['latency_stats']
+        summary = latency_stats.get_interval_summary()
+        LOG.info(latency_stats.format_table(summary))
+        if self._latency_stats_sender is not None:
+            msg = json.dumps({'cam_id': latency_stats.cam_id,
+                              'timestamp': now,
+                              'interval': interval,
+                              'latency_msec': summary})
+            try:
+                self._latency_stats_sender.send(msg)
+            except socket.error:
+                # nobody listening
+                pass
+
     def handle_commands(self, cam_no, cmds_orig):
         cmds = cmds_orig.copy() # copy dict to prevent potential threading issues
         if cmds:
@@ -2641,7 +2700,7 @@ class AppState(object):
                     # Make sure data is pure python, (not numpy).
                     # "points" was filled by _convert_to_wire_order().
                     missing_data.append( (int(camn), int(missing_framenumber), float(timestamp),
-                                          float(camn_received_time), points) )
+                                          float(camn_received_time), points.tolist()) )
                 if len(missing_data):
                     self.main_brain.receive_missing_data(cam_id, framenumber_offset, missing_data)
 
@@ -2722,6 +2781,10 @@ def get_app_defaults():
                     num_points=20,
                     software_roi_radius=10,
                     num_buffers=50,
+                    raw_frames_queue_size=50,
+                    raw_frames_backpressure='drop-oldest',
+                    latency_log_interval=0.0,
+                    latency_stats_socket='',
                     small_save_radius=10,
                     background_frame_interval=50,
                     background_frame_alpha=1.0/50.0,
@@ -2814,6 +2877,25 @@ def parse_args(benchmark, cmdline_args):
     parser.add_option("--num-buffers", type="int",
                       help="force number of buffers [default: %default]")
 
+    parser.add_option("--raw-frames-queue-size", type="int",
+                      help=("maximum number of frames waiting for the main "
+                            "thread [default: %default]"))
+
+    parser.add_option("--raw-frames-backpressure", type="choice",
+                      choices=list(camnode_utils.FRAME_QUEUE_POLICIES),
+                      help=("what to do when the queue of frames for the main "
+                            "thread is full: block, drop-oldest or drop-newest "
+                            "[default: %default]"))
+
+    parser.add_option("--latency-log-interval", type="float",
+                      help=("every N seconds, log the latency of each processing "
+                            "stage over the last N seconds, 0 to disable "
+                            "[default: %default]"))
+
+    parser.add_option("--latency-stats-socket", type="string",
+                      help=("filename of a unix domain datagram socket to also "
+                            "send the latency statistics to, as JSON"))
+
     parser.add_option("--mask-images", type="string",
                       help="list of masks for each camera (uses OS-specific path separator, ':' for POSIX, ';' for Windows)")
 
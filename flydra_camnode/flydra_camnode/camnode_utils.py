@@ -3,6 +3,10 @@ from __future__ import division
 from __future__ import with_statement
 
 import contextlib
+import collections
+import ctypes, ctypes.util
+import math
+import time
 
 import threading, Queue
 
@@ -46,8 +50,8 @@ class ChainLink(object):
         if next is not None:
             next.fire(buf)
         else:
-            pool = buf.get_pool()
-            pool.return_buffer( buf )
+            # drop the reference of the chain
+            buf.release()
 
 @contextlib.contextmanager
 def use_buffer_from_chain(link,blocking=True):
@@ -57,3 +61,223 @@ def use_buffer_from_chain(link,blocking=True):
         yield buf
     finally:
         link.end_buf(buf)
+
+class RefCountedBuffer(object):
+    """base class of buffers shared by reference counting. Threadsafe.
+
+    The pool hands out a buffer with a reference count of 1 and gets
+    it back by return_buffer() when the last reference is released.
+    """
+    def __init__(self,pool):
+        self._pool = pool
+        self._refcount_lock = threading.Lock()
+        self._refcount = 0
+    def get_pool(self):
+        return self._pool
+    def add_ref(self):
+        with self._refcount_lock:
+            assert self._refcount > 0
+            self._refcount += 1
+    def release(self):
+        with self._refcount_lock:
+            self._refcount -= 1
+            refcount = self._refcount
+        if refcount == 0:
+            self._pool.return_buffer( self )
+
+FRAME_QUEUE_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+class FrameQueue(object):
+    """bounded queue of items holding a reference to a frame buffer
+
+    The frame buffers (see camnode.PreallocatedBuffer) are not copied,
+    instead the queue holds a reference to each until it is taken by
+    get_nowait(). The taker must release() the buffer when done.
+
+    When the queue is full, put() either blocks, drops the oldest
+    item, or drops the new item, according to policy. Dropped items
+    are counted in n_dropped. Threadsafe.
+    """
+    def __init__(self, maxsize, policy='drop-oldest'):
+        if policy not in FRAME_QUEUE_POLICIES:
+            raise ValueError('unknown policy %r'%(policy,))
+        self._maxsize = maxsize
+        self._policy = policy
+        self._cond = threading.Condition()
+        # start: vars access controlled by self._cond
+        self._items = collections.deque()
+        self.n_dropped = 0
+        #   end: vars access controlled by self._cond
+
+    def put(self, buf, item):
+        """put (buf, item) in the queue, adding a reference to buf"""
+        buf.add_ref()
+        dropped_buf = None
+        with self._cond:
+            while len(self._items) >= self._maxsize:
+                if self._policy == 'block':
+                    self._cond.wait()
+                    continue
+                self.n_dropped += 1
+                if self._policy == 'drop-oldest':
+                    dropped_buf, dropped_item = self._items.popleft()
+                else:
+                    dropped_buf = buf
+                break
+            if dropped_buf is not buf:
+                self._items.append( (buf, item) )
+        if dropped_buf is not None:
+            dropped_buf.release()
+
+    def get_nowait(self):
+        """return (buf, item), the caller owns the reference to buf"""
+        with self._cond:
+            if not len(self._items):
+                raise Queue.Empty()
+            result = self._items.popleft()
+            self._cond.notify()
+        return result
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items)
+
+# ---- latency instrumentation --------------------------------------------
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1 # on linux
+    ts = _timespec()
+    ts_ref = ctypes.byref(ts)
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ts_ref)
+        return ts.tv_sec + ts.tv_nsec*1e-9
+    return monotonic
+
+# seconds of a clock which is not affected by changes of the system time
+monotonic = _get_monotonic()
+
+_HIST_SUB_BITS = 5 # 32 sub-buckets per power of two: error < 1/16
+_HIST_HALF = 1 << (_HIST_SUB_BITS-1)
+_HIST_MAX_US = (1 << 27) - 1 # about 134 seconds, larger values are clamped
+
+def _hist_bucket(usec):
+    if usec < 2*_HIST_HALF:
+        return usec
+    shift = usec.bit_length() - _HIST_SUB_BITS
+    return 2*_HIST_HALF + (shift-1)*_HIST_HALF + ((usec >> shift) - _HIST_HALF)
+
+def _hist_bucket_value(idx):
+    """the highest value (in microseconds) falling in bucket idx"""
+    if idx < 2*_HIST_HALF:
+        return idx
+    shift = (idx - 2*_HIST_HALF)//_HIST_HALF + 1
+    mantissa = (idx - 2*_HIST_HALF)%_HIST_HALF + _HIST_HALF
+    return ((mantissa+1) << shift) - 1
+
+_HIST_N_BUCKETS = _hist_bucket(_HIST_MAX_US) + 1
+
+class LatencyHistogram(object):
+    """histogram of durations with logarithmic buckets, as in HdrHistogram
+
+    Durations are counted in microsecond buckets whose width grows
+    with the value, so each is recorded with an error of less than
+    1/16 at constant memory. There is no lock: a histogram must only
+    be recorded by one thread. Other threads can get_counts() at any
+    time, which may miss the most recent records.
+    """
+    def __init__(self):
+        self._counts = [0]*_HIST_N_BUCKETS
+
+    def record(self, seconds):
+        usec = int(seconds*1e6)
+        if usec < 0:
+            usec = 0
+        elif usec > _HIST_MAX_US:
+            usec = _HIST_MAX_US
+        self._counts[_hist_bucket(usec)] += 1
+
+    def get_counts(self):
+        return list(self._counts)
+
+def summarize_latency_counts(counts, percentiles=(50, 90, 99)):
+    """return a dict with the count, percentiles and max in msec of counts"""
+    n = sum(counts)
+    result = {'count': n, 'max': None}
+    for q in percentiles:
+        result['p%d'%q] = None
+    if n == 0:
+        return result
+    targets = sorted((int(math.ceil(n*q/100.0)) or 1, q) for q in percentiles)
+    accum = 0
+    for idx, count in enumerate(counts):
+        if not count:
+            continue
+        accum += count
+        value_msec = _hist_bucket_value(idx)*1e-3
+        while len(targets) and accum >= targets[0][0]:
+            result['p%d'%targets.pop(0)[1]] = value_msec
+        result['max'] = value_msec
+    return result
+
+LATENCY_STAGES = ('grab', 'queue', 'do_work', 'bg_maint', 'pack', 'send', 'total')
+
+class LatencyStats(object):
+    """per stage latency histograms of one camera
+
+    The stages are recorded by the threads of the camera (each stage
+    by only one thread) and summarized by another thread.
+    """
+    def __init__(self, cam_id, stages=LATENCY_STAGES):
+        self.cam_id = cam_id
+        self.stages = tuple(stages)
+        self._histograms = dict( (stage, LatencyHistogram())
+                                 for stage in self.stages )
+        self._last_counts = dict( (stage, [0]*_HIST_N_BUCKETS)
+                                  for stage in self.stages )
+
+    def record(self, stage, seconds):
+        self._histograms[stage].record(seconds)
+
+    def get_summary(self):
+        """summarize all records, by stage"""
+        return dict( (stage, summarize_latency_counts(
+            self._histograms[stage].get_counts()))
+                     for stage in self.stages )
+
+    def get_interval_summary(self):
+        """summarize the records since the last call, by stage"""
+        result = {}
+        for stage in self.stages:
+            counts = self._histograms[stage].get_counts()
+            last_counts = self._last_counts[stage]
+            result[stage] = summarize_latency_counts(
+                [c-l for c,l in zip(counts,last_counts)])
+            self._last_counts[stage] = counts
+        return result
+
+    def format_table(self, summary):
+        """format a summary as a table of milliseconds"""
+        lines = ['latency of %s (msec):'%self.cam_id,
+                 '  %-10s %9s %9s %9s %9s %9s'%('stage','count','p50','p90','p99','max')]
+        def fmt(value):
+            if value is None:
+                return '%9s'%'-'
+            return '%9.3f'%value
+        for stage in self.stages:
+            s = summary[stage]
+            lines.append('  %-10s %9d %s %s %s %s'%(
+                stage, s['count'], fmt(s['p50']), fmt(s['p90']),
+                fmt(s['p99']), fmt(s['max'])))
+        return '\n'.join(lines)
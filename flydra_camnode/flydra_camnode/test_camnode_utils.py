@@ -0,0 +1,126 @@
+#emacs, this is -*-Python-*- mode
+from __future__ import with_statement
+
+import threading
+import Queue
+
+import camnode_utils
+
+class FakePool(object):
+    def __init__(self):
+        self.returned = []
+    def get_free_buffer(self):
+        buf = camnode_utils.RefCountedBuffer(self)
+        buf._refcount = 1
+        return buf
+    def return_buffer(self, buf):
+        self.returned.append(buf)
+
+def test_refcounted_buffer():
+    pool = FakePool()
+    buf = pool.get_free_buffer()
+    buf.add_ref()
+    buf.release()
+    assert pool.returned == []
+    buf.release()
+    assert pool.returned == [buf]
+
+def check_frame_queue_drop(policy):
+    pool = FakePool()
+    q = camnode_utils.FrameQueue(2, policy=policy)
+    bufs = [pool.get_free_buffer() for i in range(3)]
+    for i,buf in enumerate(bufs):
+        q.put(buf, i)
+        # the producer releases its own reference
+        buf.release()
+    assert q.qsize() == 2
+    assert q.n_dropped == 1
+    if policy == 'drop-oldest':
+        expected = [1, 2]
+        dropped = bufs[0]
+    else:
+        expected = [0, 1]
+        dropped = bufs[2]
+    # the dropped buffer is back in the pool, the others are queued
+    assert pool.returned == [dropped]
+    items = []
+    while 1:
+        try:
+            buf, item = q.get_nowait()
+        except Queue.Empty:
+            break
+        items.append(item)
+        buf.release()
+    assert items == expected
+    assert len(pool.returned) == 3
+
+def test_frame_queue_drop():
+    for policy in ['drop-oldest', 'drop-newest']:
+        yield check_frame_queue_drop, policy
+
+def test_frame_queue_block():
+    pool = FakePool()
+    q = camnode_utils.FrameQueue(1, policy='block')
+    bufs = [pool.get_free_buffer() for i in range(2)]
+    q.put(bufs[0], 0)
+    bufs[0].release()
+    put_done = threading.Event()
+    def put_second():
+        q.put(bufs[1], 1)
+        bufs[1].release()
+        put_done.set()
+    thread = threading.Thread(target=put_second)
+    thread.start()
+    assert not put_done.wait(0.1)
+    buf, item = q.get_nowait()
+    assert item == 0
+    buf.release()
+    thread.join()
+    assert put_done.isSet()
+    assert q.get_nowait()[1] == 1
+    assert q.n_dropped == 0
+    assert pool.returned == [bufs[0]]
+
+def test_frame_queue_bad_policy():
+    try:
+        camnode_utils.FrameQueue(1, policy='drop-all')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('expected ValueError')
+
+def test_hist_bucket_round_trip():
+    values = range(1000) + [int(1.1**i) for i in range(73, 196)]
+    values.append(camnode_utils._HIST_MAX_US)
+    last_idx = -1
+    for usec in sorted(values):
+        idx = camnode_utils._hist_bucket(usec)
+        assert idx >= last_idx
+        last_idx = idx
+        assert idx < camnode_utils._HIST_N_BUCKETS
+        value = camnode_utils._hist_bucket_value(idx)
+        # the bucket value is the highest value of the bucket
+        assert value >= usec
+        assert camnode_utils._hist_bucket(value) == idx
+        assert camnode_utils._hist_bucket(value+1) == idx+1
+        # with an error of less than 1/16 (none below 32 usec)
+        if usec < 32:
+            assert value == usec
+        else:
+            assert value - usec < usec/16.0
+
+def test_summarize_latency_counts():
+    hist = camnode_utils.LatencyHistogram()
+    assert camnode_utils.summarize_latency_counts(hist.get_counts()) == {
+        'count': 0, 'max': None, 'p50': None, 'p90': None, 'p99': None}
+    # 1 to 100 msec
+    for i in range(1, 101):
+        hist.record(i*1e-3)
+    summary = camnode_utils.summarize_latency_counts(hist.get_counts())
+    assert summary['count'] == 100
+    for key, expected in [('p50', 50.0), ('p90', 90.0), ('p99', 99.0),
+                          ('max', 100.0)]:
+        assert expected <= summary[key] < expected*(1+1/16.0), (key, summary)
+    summary = camnode_utils.summarize_latency_counts(hist.get_counts(),
+                                                     percentiles=(1,))
+    assert 1.0 <= summary['p1'] < 1.0*(1+1/16.0)
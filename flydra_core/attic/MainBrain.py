@@ -22,6 +22,12 @@ import flydra_core.kalman.flydra_tracker
 
 import flydra_core.data_descriptions
 from flydra_core.coordinate_receiver import CoordinateProcessor, ATTEMPT_DATA_RECOVERY
+from flydra_core.table_writer import BatchedTableWriter, TableWriterThread
+from flydra_core.data2d_journal import (
+    Data2dJournalWriter,
+    JournalCompactor,
+    get_journal_dirname,
+)
 
 # ensure that pytables uses numpy:
 import tables
@@ -108,6 +114,7 @@ HostClockInfo = flydra_core.data_descriptions.HostClockInfo
 TriggerClockInfo = flydra_core.data_descriptions.TriggerClockInfo
 MovieInfo = flydra_core.data_descriptions.MovieInfo
 ExperimentInfo = flydra_core.data_descriptions.ExperimentInfo
+TABLE_CHUNKSHAPES = flydra_core.data_descriptions.TABLE_CHUNKSHAPES
 
 FilteredObservations = flydra_kalman_utils.FilteredObservations
 ML_estimates_2d_idxs_type = flydra_kalman_utils.ML_estimates_2d_idxs_type
@@ -249,11 +256,18 @@ class MainBrain(object):
         kalman_model="EKF mamarama, units: mm",
         max_reconstruction_latency_sec=0.06,  # 60 msec
         max_N_hypothesis_test=3,
+        hypothesis_test_engine="loop",  # or 'vectorized'
+        association_mode="greedy",  # or 'hungarian'
+        tracker_workers=0,  # > 0 holds tracked objects in worker processes
         save_data_dir="~/FLYDRA",
         save_movie_dir="~/FLYDRA_MOVIES",
         camera_calibration="",
         use_unix_domain_sockets=False,
+        use_shared_memory=False,  # for cameras on the MainBrain host only
         posix_scheduler="",  # '' means OS default, set to e.g. ['FIFO', 99] for max
+        save_data_flush_rows=20000,  # 2D data rows staged before writing
+        save_data_flush_interval_sec=0.5,
+        save_data2d_journal=False,  # crash-safe 2D data, compacted into the .h5
     )
 
     class RemoteAPI:
@@ -522,7 +536,7 @@ class MainBrain(object):
                         + point_tuple5
                         + (frame_pt_idx, cur_val, mean_val, sumsqf_val)
                     )
-            self.main_brain.queue_data2d.put(deferred_2d_data)
+            self.main_brain.data2d_writer.append_rows(deferred_2d_data)
 
         def get_and_clear_commands(self, cam_id):
             with self.cam_info_lock:
@@ -635,13 +649,25 @@ class MainBrain(object):
         self.h5movie_info = None
         self.h5exp_info = None
         self.h5textlog = None
+        self.data2d_journal = None
+        self.journal_compactor = None
         if 1:
             self.h5data3d_kalman_estimates = None
             self.h5data3d_ML_estimates = None
             self.h5_2d_obs = None
 
         # Queues of information to save
-        self.queue_data2d = Queue.Queue()
+        # (2D data is staged in place and written by the table writer thread)
+        self.data2d_writer = BatchedTableWriter(
+            "data2d_distorted",
+            Info2DCol_description,
+            capacity=self.config["save_data_flush_rows"],
+            flush_interval_sec=self.config["save_data_flush_interval_sec"],
+        )
+        self.table_writer_thread = TableWriterThread(
+            [self.data2d_writer], lock=self._service_save_data_lock
+        )
+        self.table_writer_thread.start()
         self.queue_host_clock_info = Queue.Queue()
         self.queue_trigger_clock_info = Queue.Queue()
         self.queue_data3d_best = Queue.Queue()
@@ -659,7 +685,11 @@ class MainBrain(object):
                 "max_reconstruction_latency_sec"
             ],
             max_N_hypothesis_test=self.config["max_N_hypothesis_test"],
+            hypothesis_test_engine=self.config["hypothesis_test_engine"],
+            association_mode=self.config["association_mode"],
+            tracker_workers=self.config["tracker_workers"],
             use_unix_domain_sockets=self.config["use_unix_domain_sockets"],
+            use_shared_memory=self.config["use_shared_memory"],
             posix_scheduler=self.config["posix_scheduler"],
         )
         # self.coord_processor.setDaemon(True)
@@ -1142,6 +1172,7 @@ class MainBrain(object):
 
         self.stop_saving_data()
         self.coord_processor.quit()
+        self.table_writer_thread.quit()
 
     def load_calibration(self, dirname):
         if self.is_saving_data():
@@ -1257,6 +1288,12 @@ class MainBrain(object):
         if os.path.exists(filename):
             raise RuntimeError("will not overwrite data file")
 
+        if self.journal_compactor is not None:
+            # the new .h5 file is opened without the save data lock,
+            # so wait until the last journal is compacted
+            self.journal_compactor.join()
+            self.journal_compactor = None
+
         self.h5filename = filename
 
         LOG.info("saving data to %s" % self.h5filename)
@@ -1270,8 +1307,25 @@ class MainBrain(object):
         ct = self.h5file.create_table  # shorthand
         root = self.h5file.root  # shorthand
         self.h5data2d = ct(
-            root, "data2d_distorted", Info2D, "2d data", expectedrows=expected_rows * 5
+            root,
+            "data2d_distorted",
+            Info2D,
+            "2d data",
+            expectedrows=expected_rows * 5,
+            chunkshape=TABLE_CHUNKSHAPES["data2d_distorted"],
         )
+        if self.config["save_data2d_journal"]:
+            # the empty table is replaced when the journal is compacted
+            self.data2d_journal = Data2dJournalWriter(
+                get_journal_dirname(os.path.expanduser(self.h5filename))
+            )
+        with self._service_save_data_lock:
+            # discard rows staged before saving started
+            self.data2d_writer.flush()
+            if self.data2d_journal is not None:
+                self.data2d_writer.set_table(self.data2d_journal)
+            else:
+                self.data2d_writer.set_table(self.h5data2d)
         self.h5cam_info = ct(
             root, "cam_info", CamSyncInfo, "Cam Sync Info", expectedrows=500
         )
@@ -1307,6 +1361,7 @@ class MainBrain(object):
                     self.KalmanEstimatesDescription,
                     "3d data (from Kalman filter)",
                     expectedrows=expected_rows,
+                    chunkshape=TABLE_CHUNKSHAPES["kalman_estimates"],
                 )
                 self.h5data3d_kalman_estimates.attrs.dynamic_model_name = (
                     self.dynamic_model_name
@@ -1319,14 +1374,11 @@ class MainBrain(object):
                     FilteredObservations,
                     "dynamics-free maximum liklihood estimates",
                     expectedrows=expected_rows,
+                    chunkshape=TABLE_CHUNKSHAPES["ML_estimates"],
                 )
-                self.h5_2d_obs = self.h5file.create_vlarray(
-                    self.h5file.root,
-                    "ML_estimates_2d_idxs",
-                    ML_estimates_2d_idxs_type(),  # dtype should match with tro.observations_2d
-                    "camns and idxs",
+                self.h5_2d_obs = flydra_kalman_utils.MLEstimates2dIdxsWriter(
+                    self.h5file
                 )
-                self.h5_2d_obs_next_idx = 0
 
         general_save_info = self.coord_processor.get_general_cam_info()
         for cam_id, dd in general_save_info.iteritems():
@@ -1374,8 +1426,23 @@ class MainBrain(object):
             LOG.info("entering final save data service call")
             self._service_save_data()  # we absolutely want to save
             LOG.info("entering done with final save data service call")
+            self.table_writer_thread.flush_all()
+            self.data2d_writer.set_table(None)
+            if self.data2d_journal is not None:
+                self.data2d_journal.close()
             if self.is_saving_data():
+                LOG.info("indexing h5 file")
+                flydra_core.data_descriptions.create_table_indexes(self.h5file)
                 self.h5file.close()
+                if self.data2d_journal is not None:
+                    LOG.info("compacting 2D data journal in the background")
+                    # (waits until this lock is released)
+                    self.journal_compactor = JournalCompactor(
+                        self.data2d_journal.dirname,
+                        self.h5file.filename,
+                        lock=self._service_save_data_lock,
+                    )
+                    self.journal_compactor.start()
                 self.h5file = None
                 self.h5filename = ""
                 self.pub_data_file.publish(self.h5filename)
@@ -1390,6 +1457,7 @@ class MainBrain(object):
             self.h5movie_info = None
             self.h5exp_info = None
             self.h5textlog = None
+            self.data2d_journal = None
             self.h5data3d_kalman_estimates = None
             self.h5data3d_ML_estimates = None
             self.h5_2d_obs = None
@@ -1481,24 +1549,12 @@ class MainBrain(object):
         with self._service_save_data_lock:
             self._service_save_data()
 
+    def get_save_data_counters(self):
+        """get the write throughput counters of the saved tables"""
+        return self.table_writer_thread.get_counters()
+
     def _service_save_data(self):
-        # ** 2d data **
-        #   clear queue
-        list_of_rows_of_data2d = []
-        try:
-            while True:
-                tmp = self.queue_data2d.get(0)
-                list_of_rows_of_data2d.extend(tmp)
-        except Queue.Empty:
-            pass
-        #   save
-        if self.h5data2d is not None and len(list_of_rows_of_data2d):
-            # it's much faster to convert to numpy first:
-            recarray = numpy.rec.array(
-                list_of_rows_of_data2d, dtype=Info2DCol_description
-            )
-            self.h5data2d.append(recarray)
-            self.h5data2d.flush()
+        # ** 2d data ** is saved by self.table_writer_thread
 
         # ** textlog **
         if self.h5textlog is not None:
@@ -1512,20 +1568,14 @@ class MainBrain(object):
                 pass
 
             if list_of_textlog_data:
-                textlog_row = self.h5textlog.row
-                for textlog_data in list_of_textlog_data:
-                    (
-                        mainbrain_timestamp,
-                        cam_id,
-                        host_timestamp,
-                        message,
-                    ) = textlog_data
-                    textlog_row["mainbrain_timestamp"] = mainbrain_timestamp
-                    textlog_row["cam_id"] = cam_id
-                    textlog_row["host_timestamp"] = host_timestamp
-                    textlog_row["message"] = message
-                    textlog_row.append()
-
+                textlog = numpy.empty(
+                    (len(list_of_textlog_data),), dtype=self.h5textlog.dtype
+                )
+                for i, name in enumerate(
+                    ("mainbrain_timestamp", "cam_id", "host_timestamp", "message")
+                ):
+                    textlog[name] = [row[i] for row in list_of_textlog_data]
+                self.h5textlog.append(textlog)
                 self.h5textlog.flush()
 
         if 1:
@@ -1540,6 +1590,23 @@ class MainBrain(object):
             except Queue.Empty:
                 pass
             if self.h5data3d_kalman_estimates is not None:
+                # only save data with at least N observations
+                list_of_3d_data = [
+                    data
+                    for data in list_of_3d_data
+                    if len(data[5]) >= MIN_KALMAN_OBSERVATIONS_TO_SAVE
+                ]
+
+                # save observation 2d data indexes of all objects at once
+                # becomes obs_2d_idx (row of MLEstimates2dIdxs)
+                all_observations_2d = []
+                for data in list_of_3d_data:
+                    all_observations_2d.extend(data[7])
+                all_idxs = self.h5_2d_obs.append_rows(all_observations_2d)
+
+                list_of_obs_recarrays = []
+                list_of_xhats_recarrays = []
+                idx_start = 0
                 for (
                     obj_id,
                     tro_frames,
@@ -1552,30 +1619,20 @@ class MainBrain(object):
                     obs_Lcoords,
                 ) in list_of_3d_data:
 
-                    if len(obs_frames) < MIN_KALMAN_OBSERVATIONS_TO_SAVE:
-                        # only save data with at least N observations
-                        continue
-
-                    # save observation 2d data indexes
-                    this_idxs = []
-                    for camns_and_idxs in observations_2d:
-                        this_idxs.append(self.h5_2d_obs_next_idx)
-                        self.h5_2d_obs.append(camns_and_idxs)
-                        self.h5_2d_obs_next_idx += 1
-                    self.h5_2d_obs.flush()
-
-                    this_idxs = numpy.array(
-                        this_idxs, dtype=numpy.uint64
-                    )  # becomes obs_2d_idx (index into 'ML_estimates_2d_idxs')
+                    idx_stop = idx_start + len(observations_2d)
+                    this_idxs = all_idxs[idx_start:idx_stop]
+                    idx_start = idx_stop
 
                     # save observations
-                    observations_frames = numpy.array(obs_frames, dtype=numpy.uint64)
+                    observations_frames = numpy.asarray(obs_frames, dtype=numpy.uint64)
                     obj_id_array = numpy.empty(
                         observations_frames.shape, dtype=numpy.uint32
                     )
                     obj_id_array.fill(obj_id)
-                    observations_data = numpy.array(obs_data, dtype=numpy.float32)
-                    observations_Lcoords = numpy.array(obs_Lcoords, dtype=numpy.float32)
+                    observations_data = numpy.asarray(obs_data, dtype=numpy.float32)
+                    observations_Lcoords = numpy.asarray(
+                        obs_Lcoords, dtype=numpy.float32
+                    )
                     list_of_obs = [
                         observations_data[:, i]
                         for i in range(observations_data.shape[1])
@@ -1591,15 +1648,13 @@ class MainBrain(object):
                         + list_of_lines
                     )
                     obs_recarray = numpy.rec.fromarrays(array_list, names=h5_obs_names)
-
-                    self.h5data3d_ML_estimates.append(obs_recarray)
-                    self.h5data3d_ML_estimates.flush()
+                    list_of_obs_recarrays.append(obs_recarray)
 
                     # save xhat info (kalman estimates)
-                    frames = numpy.array(tro_frames, dtype=numpy.uint64)
-                    timestamps = numpy.array(tro_timestamps, dtype=numpy.float64)
-                    xhat_data = numpy.array(tro_xhats, dtype=numpy.float32)
-                    P_data_full = numpy.array(tro_Ps, dtype=numpy.float32)
+                    frames = numpy.asarray(tro_frames, dtype=numpy.uint64)
+                    timestamps = numpy.asarray(tro_timestamps, dtype=numpy.float64)
+                    xhat_data = numpy.asarray(tro_xhats, dtype=numpy.float32)
+                    P_data_full = numpy.asarray(tro_Ps, dtype=numpy.float32)
                     obj_id_array = numpy.empty(frames.shape, dtype=numpy.uint32)
                     obj_id_array.fill(obj_id)
                     list_of_xhats = [xhat_data[:, i] for i in range(xhat_data.shape[1])]
@@ -1609,8 +1664,18 @@ class MainBrain(object):
                         [obj_id_array, frames, timestamps] + list_of_xhats + list_of_Ps,
                         names=self.h5_xhat_names,
                     )
+                    list_of_xhats_recarrays.append(xhats_recarray)
 
-                    self.h5data3d_kalman_estimates.append(xhats_recarray)
+                # a single append per table
+                if len(list_of_3d_data):
+                    self.h5_2d_obs.flush()
+                    self.h5data3d_ML_estimates.append(
+                        numpy.concatenate(list_of_obs_recarrays)
+                    )
+                    self.h5data3d_ML_estimates.flush()
+                    self.h5data3d_kalman_estimates.append(
+                        numpy.concatenate(list_of_xhats_recarrays)
+                    )
                     self.h5data3d_kalman_estimates.flush()
 
         # ** camera info **
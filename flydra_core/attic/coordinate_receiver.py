@@ -1,7 +1,6 @@
 from __future__ import with_statement, division
-import threading, time, socket, select, os, copy, struct
+import threading, time, socket, select, os, copy
 import warnings
-import collections
 import errno
 
 import flydra_core.reconstruct
@@ -11,6 +10,10 @@ import numpy as np
 from numpy import nan, inf
 from flydra_core.common_variables import near_inf
 import flydra_core.flydra_socket as flydra_socket
+from flydra_core.coord_packets import decode_point_packet
+from flydra_core.frame_assembler import FrameAssembler
+from flydra_core.realtime_pipeline import StageQueue, ReceiveStage, OutputStage
+from flydra_core.frame_scheduler import FrameScheduler, TRACK_ONLY, PREDICT_ONLY
 import Queue
 
 pytables_filt = numpy.asarray
@@ -54,6 +57,8 @@ ATTEMPT_DATA_RECOVERY = bool(int(os.environ.get("ATTEMPT_DATA_RECOVERY", "1")))
 
 IMPOSSIBLE_TIMESTAMP = -10.0
 
+INCOMPLETE_FRAME_WARN_INTERVAL = 1.0  # seconds
+
 PT_TUPLE_IDX_X = flydra_core.data_descriptions.PT_TUPLE_IDX_X
 PT_TUPLE_IDX_Y = flydra_core.data_descriptions.PT_TUPLE_IDX_Y
 PT_TUPLE_IDX_FRAME_PT_IDX = flydra_core.data_descriptions.PT_TUPLE_IDX_FRAME_PT_IDX
@@ -74,13 +79,23 @@ class CoordinateProcessor(threading.Thread):
         max_N_hypothesis_test,
         use_unix_domain_sockets,
         posix_scheduler="",
+        use_shared_memory=False,
+        hypothesis_test_engine="loop",
+        association_mode="greedy",
+        tracker_workers=0,
+        receive_queue_size=1000,
+        output_queue_size=1000,
     ):
         self.did_quit_successfully = False
         self.main_brain = main_brain
         self.debug_level = debug_level
         self.show_overall_latency = show_overall_latency
         self.max_reconstruction_latency_sec = max_reconstruction_latency_sec
+        self.frame_scheduler = FrameScheduler(max_reconstruction_latency_sec)
         self.max_N_hypothesis_test = max_N_hypothesis_test
+        self.find_best_3d = ru.get_hypothesis_test_engine(hypothesis_test_engine)
+        self.association_mode = association_mode
+        self.tracker_workers = tracker_workers
         self.posix_scheduler = posix_scheduler
 
         self._synchronized_cameras = []
@@ -128,7 +143,12 @@ class CoordinateProcessor(threading.Thread):
 
         self.to_unlink = []
 
-        if use_unix_domain_sockets:
+        if use_shared_memory:
+            # cameras on this host only
+            addrinfo = flydra_socket.make_addrinfo(
+                shm_name="flydra_coordinate_receiver." + str(os.getpid())
+            )
+        elif use_unix_domain_sockets:
             addr = "/tmp/flydra_coordinate_receiver." + str(os.getpid())
             try:
                 os.remove(addr)
@@ -141,7 +161,7 @@ class CoordinateProcessor(threading.Thread):
             addrinfo = flydra_socket.make_addrinfo(
                 host=flydra_socket.get_bind_address(), port=0
             )
-        self.listen_socket = flydra_socket.FlydraTransportReceiver(
+        self.listen_socket = flydra_socket.make_receiver(
             addrinfo, socket_timeout_seconds=0.5
         )
         self.listen_address = self.listen_socket.get_listen_addrinfo().to_dict()
@@ -164,10 +184,20 @@ class CoordinateProcessor(threading.Thread):
             "~synchronize", std_msgs.msg.String, queue_size=100
         )
 
-        self.realtime_coord_dict = {}
-        self.timestamp_check_dict = {}
-        self.realtime_kalman_coord_dict = collections.defaultdict(dict)
-        self.oldest_timestamp_by_corrected_framenumber = {}
+        self.frame_assembler = FrameAssembler(n_cams=0)
+
+        # The stages of the pipeline: the receive stage drains the
+        # socket, this thread assembles frames, tracks and fills the
+        # save queues, and the output stage publishes to ROS. (The
+        # saved data is not deferred, so none is lost when saving
+        # stops.)
+        self.receive_queue = StageQueue("receive", receive_queue_size)
+        self.output_stage = OutputStage("output", output_queue_size)
+        self._last_n_dropped = {}
+        self._last_n_degraded = 0
+        self._last_drop_check_time = time.time()
+        self._n_incomplete_frames = 0  # evicted since the last warning
+        self._last_incomplete_warn_time = 0.0
 
         threading.Thread.__init__(self, name="CoordinateProcessor")
 
@@ -227,22 +257,30 @@ class CoordinateProcessor(threading.Thread):
         self.cached_calibration_by_cam_id = {}
         if R is None:
             return
-        for cam_id in R.cam_ids:
+        geometry = R.geometry
+        for cam_idx, cam_id in enumerate(geometry.cam_ids):
             scc = R.get_SingleCameraCalibration(cam_id)
-            cc = R.get_camera_center(cam_id)[:, 0]
-            cc = np.array([cc[0], cc[1], cc[2], 1.0])
+            cc = geometry.camera_center[cam_idx]
             self.cached_calibration_by_cam_id[cam_id] = scc, cc
 
     def set_new_tracker(self, kalman_model=None):
         # called from main thread, must lock to send to realtime coord thread
         tracker = flydra_core.kalman.flydra_tracker.Tracker(
-            self.reconstructor, kalman_model=kalman_model
+            self.reconstructor,
+            kalman_model=kalman_model,
+            association_mode=self.association_mode,
+            n_workers=self.tracker_workers,
         )
         tracker.set_killed_tracker_callback(self.enqueue_finished_tracked_object)
         with self.tracker_lock:
             if self.tracker is not None:
                 self.tracker.kill_all_trackers()  # save (if necessary) all old data
+                self.tracker.close()
             self.tracker = tracker  # bind to name, replacing old tracker
+            # do not skip so many frames that tracked objects get killed
+            self.frame_scheduler.max_consecutive_skipped = max(
+                kalman_model["max_frames_skipped"] - 1, 0
+            )
             if self.save_profiling_data:
                 tracker = copy.copy(self.tracker)
                 tracker.kill_tracker_callbacks = []
@@ -283,8 +321,9 @@ class CoordinateProcessor(threading.Thread):
                 acquire_stamp=acquire_stamp,
                 objects=[this_ros_object],
             )
-            self.realtime_ros_packets_pub.publish(
-                flydra_mainbrain_super_packet([ros_packet])
+            self._put_output(
+                self.realtime_ros_packets_pub.publish,
+                flydra_mainbrain_super_packet([ros_packet]),
             )
 
         if self.debug_level.isSet():
@@ -311,6 +350,7 @@ class CoordinateProcessor(threading.Thread):
             self.last_framenumbers_delay.append(-1)  # arbitrary impossible number
             self.last_framenumbers_skip.append(-1)  # arbitrary impossible number
             self.general_save_info[cam_id] = {"absolute_cam_no": absolute_cam_no}
+            self.frame_assembler.reset(len(self.cam_ids))
 
     def disconnect(self, cam_id):
         # called from Remote-API thread on camera disconnect
@@ -322,6 +362,7 @@ class CoordinateProcessor(threading.Thread):
             del self.last_framenumbers_delay[cam_idx]
             del self.last_framenumbers_skip[cam_idx]
             del self.general_save_info[cam_id]
+            self.frame_assembler.reset(len(self.cam_ids))
 
     def quit(self):
         # called from outside of thread to quit the thread
@@ -347,13 +388,7 @@ class CoordinateProcessor(threading.Thread):
             self.synchronze_ros_msgs_pub.publish(std_msgs.msg.String(cam_id))
             LOG.info("%s (re)synchronized" % cam_id)
             # discard all previous data
-            for k in self.realtime_coord_dict.keys():
-                del self.realtime_coord_dict[k]
-                del self.timestamp_check_dict[k]
-            for k in self.realtime_kalman_coord_dict.keys():
-                del self.realtime_kalman_coord_dict[k]
-            for k in self.oldest_timestamp_by_corrected_framenumber.keys():
-                del self.oldest_timestamp_by_corrected_framenumber[k]
+            self.frame_assembler.reset()
 
         # make new absolute_cam_no to indicate new synchronization state
         self.max_absolute_cam_nos += 1
@@ -449,57 +484,116 @@ class CoordinateProcessor(threading.Thread):
             LOG.info("3D reconstruction thread running with default priority")
         LOG.info("CoordinateProcessor running on PID %d" % os.getpid())
         # self.main_brain.trigger_device.wait_for_estimate()
+
+        # the stage threads inherit the scheduling of this thread
+        receive_stage = ReceiveStage(
+            self.listen_socket, self.receive_queue, self.quit_event
+        )
+        receive_stage.start()
+        self.output_stage.start()
+
         while not self.quit_event.isSet():
             try:
-                incoming_2d_data = self.listen_socket.recv()
-            except socket.error as err:
-                if err.errno == errno.EAGAIN:
-                    # no data ready. try again (after checking if we should quit).
-                    continue
-                else:
-                    raise
-            self.process_data(incoming_2d_data)
+                incoming_2d_data = self.receive_queue.get(timeout=0.5)
+            except Queue.Empty:
+                # no data ready. try again (after checking if we should quit).
+                continue
+            # and all others already waiting, so the newest frame is
+            # known before the work is scheduled. The batch must not
+            # span more frames than the frame assembler keeps, or
+            # completed frames would be overwritten before being
+            # scheduled.
+            max_items = self.frame_assembler.capacity * max(
+                1, self.frame_assembler.n_cams
+            )
+            batch = [incoming_2d_data] + self.receive_queue.get_all_nowait(
+                max_items - 1
+            )
+            self.process_data_batch(batch)
+            self._check_pipeline_drops()
+        receive_stage.join()
         self.finish_processing()
 
+    def _put_output(self, func, value):
+        """call func(value) in the output stage"""
+        self.output_stage.put(func, value)
+
+    def get_pipeline_metrics(self):
+        """get the queue depth and drop counts of the pipeline stages"""
+        result = [self.receive_queue.get_metrics()]
+        if hasattr(self.listen_socket, "get_n_lost"):
+            # dropped by the senders
+            result[0]["n_lost"] = self.listen_socket.get_n_lost()
+        result.append(
+            {
+                "name": "tracking",
+                "n_evicted": self.frame_assembler.n_evicted,
+                "n_overwritten": self.frame_assembler.n_overwritten,
+                "n_dropped": self.frame_assembler.n_dropped,
+                # completed frames overwritten before being scheduled
+                # were not processed at all
+                "n_degraded": self.frame_scheduler.get_n_degraded()
+                + self.frame_assembler.n_overwritten,
+                "n_predict_only": self.frame_scheduler.n_frames[PREDICT_ONLY],
+                "max_backlog": self.frame_scheduler.max_backlog,
+            }
+        )
+        result.append(self.output_stage.get_metrics())
+        return result
+
+    def _check_pipeline_drops(self):
+        now = time.time()
+        if now - self._last_drop_check_time < 1.0:
+            return
+        self._last_drop_check_time = now
+        for metrics in self.get_pipeline_metrics():
+            name = metrics["name"]
+            n_dropped = metrics["n_dropped"]
+            last_n_dropped = self._last_n_dropped.get(name, 0)
+            if n_dropped != last_n_dropped:
+                LOG.warn(
+                    "%s stage dropped %d packets (queue depth %s)"
+                    % (name, n_dropped - last_n_dropped, metrics.get("depth"))
+                )
+                self._last_n_dropped[name] = n_dropped
+            n_degraded = metrics.get("n_degraded")
+            if n_degraded is not None and n_degraded != self._last_n_degraded:
+                LOG.warn(
+                    "tracking behind: %d frames not fully processed to bound latency"
+                    % (n_degraded - self._last_n_degraded)
+                )
+                self._last_n_degraded = n_degraded
+
     def finish_processing(self):
         with self.tracker_lock:
             if self.tracker is not None:
                 self.tracker.kill_all_trackers()  # save (if necessary) all old data
+                self.tracker.close()
+
+        # let the output stage finish all waiting outputs, including
+        # those of the trackers just killed
+        self.output_stage.finish()
 
         for fname in self.to_unlink:
             os.remove(fname)
+        if self.listen_socket.get_listen_addrinfo().is_shared_memory():
+            self.listen_socket.close()
 
         self.did_quit_successfully = True
 
     def process_data(self, buf_data):
+        self.process_data_batch([buf_data])
 
-        header_fmt = flydra_core.common_variables.recv_pt_header_fmt
-        header_size = struct.calcsize(header_fmt)
-        pt_fmt = flydra_core.common_variables.recv_pt_fmt
-        pt_size = struct.calcsize(pt_fmt)
-
-        no_point_tuple = (
-            nan,
-            nan,
-            nan,
-            nan,
-            nan,
-            nan,
-            nan,
-            nan,
-            nan,
-            False,
-            0,
-            0,
-            0,
-            0,
-        )
+    def process_data_batch(self, bufs):
+        """assemble the 2D data of the packets, then reconstruct completed frames"""
+        new_data_slots = set()
+        for buf_data in bufs:
+            self._parse_data(buf_data, new_data_slots)
+        self._reconstruct_frames(new_data_slots)
 
-        new_data_framenumbers = set()
+    def _parse_data(self, buf_data, new_data_slots):
 
-        deferred_2d_data = []
-        header = buf_data[:header_size]
-        assert len(header) == header_size
+        header, pt_array = decode_point_packet(buf_data)
         # this raw_timestamp is the remote camera's timestamp (?? from the driver, not the host clock??)
         (
             cam_id,
@@ -508,17 +602,13 @@ class CoordinateProcessor(threading.Thread):
             raw_framenumber,
             n_pts,
             n_frames_skipped,
-        ) = struct.unpack(header_fmt, header)
+        ) = header
 
         with self.all_data_lock:
             cam_idx = self.cam_ids.index(cam_id)
             absolute_cam_no = self.absolute_cam_nos[cam_idx]
 
             points_in_pluecker_coords_meters = []
-            points_undistorted = []
-            points_distorted = []
-
-            assert len(buf_data) == (header_size + n_pts * pt_size)
 
             predicted_framenumber = (
                 n_frames_skipped + self.last_framenumbers_skip[cam_idx] + 1
@@ -563,11 +653,17 @@ class CoordinateProcessor(threading.Thread):
                         del missing_frame_numbers
 
             self.last_framenumbers_skip[cam_idx] = raw_framenumber
-            start = header_size
             if n_pts:
                 # valid points
+                pt_rows = pt_array.tolist()
+                calibration = self.cached_calibration_by_cam_id.get(cam_id, None)
+                if calibration is not None:
+                    # undistort all points of this camera frame at once
+                    scc = calibration[0]
+                    xs_undistorted, ys_undistorted = scc.helper.undistort_many(
+                        pt_array["x_distorted"], pt_array["y_distorted"]
+                    )
                 for frame_pt_idx in range(n_pts):
-                    end = start + pt_size
                     (
                         x_distorted,
                         y_distorted,
@@ -578,7 +674,7 @@ class CoordinateProcessor(threading.Thread):
                         cur_val,
                         mean_val,
                         sumsqf_val,
-                    ) = struct.unpack(pt_fmt, buf_data[start:end])
+                    ) = pt_rows[frame_pt_idx]
                     # nan cannot get sent across network in platform-independent way
 
                     if slope == near_inf:
@@ -601,11 +697,10 @@ class CoordinateProcessor(threading.Thread):
                         run = nan
                         rise = nan
 
-                    if cam_id in self.cached_calibration_by_cam_id:
-                        scc, cc = self.cached_calibration_by_cam_id[cam_id]
-                        x_undistorted, y_undistorted = scc.helper.undistort(
-                            x_distorted, y_distorted
-                        )
+                    if calibration is not None:
+                        scc, cc = calibration
+                        x_undistorted = xs_undistorted[frame_pt_idx]
+                        y_undistorted = ys_undistorted[frame_pt_idx]
                         (
                             p1,
                             p2,
@@ -654,22 +749,6 @@ class CoordinateProcessor(threading.Thread):
                         mean_val,
                         sumsqf_val,
                     )
-                    pt_distorted = (
-                        x_distorted,
-                        y_distorted,
-                        area,
-                        slope,
-                        eccentricity,
-                        p1,
-                        p2,
-                        p3,
-                        p4,
-                        line_found,
-                        frame_pt_idx,
-                        cur_val,
-                        mean_val,
-                        sumsqf_val,
-                    )
                     if ray_valid:
                         points_in_pluecker_coords_meters.append(
                             (
@@ -679,16 +758,6 @@ class CoordinateProcessor(threading.Thread):
                                 ),
                             )
                         )
-                    points_undistorted.append(pt_undistorted)
-                    points_distorted.append(pt_distorted)
-                    start = end
-            else:
-                # no points found
-                end = start
-                # append non-point to allow correlation of
-                # timestamps with frame number
-                points_distorted.append(no_point_tuple)
-                points_undistorted.append(no_point_tuple)
 
             self._process_parsed_data(
                 cam_idx,
@@ -697,13 +766,43 @@ class CoordinateProcessor(threading.Thread):
                 n_pts,
                 cam_id,
                 raw_framenumber,
-                new_data_framenumbers,
+                new_data_slots,
                 points_in_pluecker_coords_meters,
-                points_distorted,
-                points_undistorted,
-                deferred_2d_data,
+                pt_array,
             )
 
+    def _warn_incomplete_frame(self, corrected_framenumber, arrived_mask):
+        # dont spam the console at startup (i.e. before a sync has been attemted)
+        if not self.ever_synchronized:
+            return
+        # an unsynchronized camera makes every frame incomplete, so
+        # warn at most once per INCOMPLETE_FRAME_WARN_INTERVAL
+        self._n_incomplete_frames += 1
+        now = time.time()
+        if now - self._last_incomplete_warn_time < INCOMPLETE_FRAME_WARN_INTERVAL:
+            return
+        self._last_incomplete_warn_time = now
+        n_incomplete = self._n_incomplete_frames
+        self._n_incomplete_frames = 0
+        LOG.warn(
+            "Cameras not synchronized or network dropping packets -- unmatched 2D data discarded (%d incomplete frames)"
+            % n_incomplete
+        )
+        self.main_brain.error_ros_msgs_pub.publish(
+            FlydraError(FlydraError.NOT_SYNCHRONIZED, "")
+        )
+
+        delta = [
+            self.cam_ids[i]
+            for i in self.frame_assembler.get_missing_cam_idxs(arrived_mask)
+        ]
+        if len(delta):
+            LOG.warn("a guess at missing cam_id(s): %r" % delta)
+            for d in delta:
+                self.main_brain.error_ros_msgs_pub.publish(
+                    FlydraError(FlydraError.MISSING_DATA, d)
+                )
+
     def _process_parsed_data(
         self,
         cam_idx,
@@ -712,21 +811,13 @@ class CoordinateProcessor(threading.Thread):
         n_pts,
         cam_id,
         raw_framenumber,
-        new_data_framenumbers,
+        new_data_slots,
         points_in_pluecker_coords_meters,
-        points_distorted,
-        points_undistorted,
-        deferred_2d_data,
+        pt_array,
     ):
         # Note: this must be called with self.all_data_lock acquired.
 
-        timestamp_check_dict = self.timestamp_check_dict
-        convert_format = flydra_kalman_utils.convert_format  # shorthand
-        realtime_coord_dict = self.realtime_coord_dict
-        oldest_timestamp_by_corrected_framenumber = (
-            self.oldest_timestamp_by_corrected_framenumber
-        )
-        realtime_kalman_coord_dict = self.realtime_kalman_coord_dict
+        frame_assembler = self.frame_assembler
 
         if 1:
             if 1:
@@ -751,120 +842,142 @@ class CoordinateProcessor(threading.Thread):
                             self.OnSynchronize(
                                 cam_idx, cam_id, raw_framenumber, trigger_timestamp
                             )
-                            new_data_framenumbers.clear()
+                            new_data_slots.clear()
 
                         self.last_timestamps[cam_idx] = trigger_timestamp
                         self.last_framenumbers_delay[cam_idx] = raw_framenumber
                         self.main_brain.framenumber = corrected_framenumber
 
-                        if self.main_brain.is_saving_data():
-                            for point_tuple in points_distorted:
-                                # Save 2D data (even when no point found) to allow
-                                # temporal correlation of movie frames to 2D data.
-                                frame_pt_idx = point_tuple[PT_TUPLE_IDX_FRAME_PT_IDX]
-                                cur_val = point_tuple[PT_TUPLE_IDX_CUR_VAL_IDX]
-                                mean_val = point_tuple[PT_TUPLE_IDX_MEAN_VAL_IDX]
-                                sumsqf_val = point_tuple[PT_TUPLE_IDX_SUMSQF_VAL_IDX]
-                                if corrected_framenumber is None:
-                                    # don't bother saving if we don't know when it was from
-                                    continue
-                                deferred_2d_data.append(
-                                    (
-                                        absolute_cam_no,  # defer saving to later
-                                        corrected_framenumber,
-                                        trigger_timestamp,
-                                        camn_received_time,
-                                    )
-                                    + point_tuple[:5]
-                                    + (frame_pt_idx, cur_val, mean_val, sumsqf_val)
-                                )
-                        # save new frame data
-
-                        if corrected_framenumber not in realtime_coord_dict:
-                            realtime_coord_dict[corrected_framenumber] = {}
-                            timestamp_check_dict[corrected_framenumber] = {}
-
-                        # For hypothesis testing: attempt 3D reconstruction of 1st point from each 2D view
-                        realtime_coord_dict[corrected_framenumber][
-                            cam_id
-                        ] = points_undistorted[0]
-                        # timestamp_check_dict[corrected_framenumber][cam_id]= camn_received_time
-                        timestamp_check_dict[corrected_framenumber][
-                            cam_id
-                        ] = trigger_timestamp
-
-                        if len(points_in_pluecker_coords_meters):
-                            # save all 3D Pluecker coordinates for Kalman filtering
-                            realtime_kalman_coord_dict[corrected_framenumber][
-                                absolute_cam_no
-                            ] = points_in_pluecker_coords_meters
-
-                        if n_pts:
-                            inc_val = 1
-                        else:
-                            inc_val = 0
-
+                        # (don't bother saving if we don't know when it was from)
                         if (
-                            corrected_framenumber
-                            in oldest_timestamp_by_corrected_framenumber
+                            self.main_brain.is_saving_data()
+                            and corrected_framenumber is not None
                         ):
-                            (
-                                orig_timestamp,
-                                n,
-                            ) = oldest_timestamp_by_corrected_framenumber[
-                                corrected_framenumber
-                            ]
-                            if orig_timestamp is None:
-                                oldest = trigger_timestamp  # this may also be None, but eventually won't be
-                            else:
-                                oldest = min(trigger_timestamp, orig_timestamp)
-                            oldest_timestamp_by_corrected_framenumber[
-                                corrected_framenumber
-                            ] = (oldest, n + inc_val)
-                            del oldest, n, orig_timestamp
-                        else:
-                            oldest_timestamp_by_corrected_framenumber[
-                                corrected_framenumber
-                            ] = (trigger_timestamp, inc_val)
+                            self._stage_2d_data(
+                                absolute_cam_no,
+                                corrected_framenumber,
+                                trigger_timestamp,
+                                camn_received_time,
+                                pt_array,
+                            )
+                        # save new frame data (all 3D Pluecker
+                        # coordinates for Kalman filtering)
+                        slot = frame_assembler.add(
+                            corrected_framenumber,
+                            cam_idx,
+                            trigger_timestamp,
+                            n_pts=n_pts,
+                            camn=absolute_cam_no,
+                            pluecker_coords=points_in_pluecker_coords_meters,
+                        )
 
-                        new_data_framenumbers.add(
-                            corrected_framenumber
-                        )  # insert into set
+                        if frame_assembler.last_evicted is not None:
+                            # An older frame never got the data of all
+                            # cameras. This is only expected when
+                            # multiple cameras are not synchronized,
+                            # (When camera-camera frame correspondences
+                            # are unknown.)
+                            self._warn_incomplete_frame(
+                                *frame_assembler.last_evicted
+                            )
 
-                finished_corrected_framenumbers = []  # for quick deletion
+                        if slot is not None:
+                            new_data_slots.add(slot)  # insert into set
+
+    def _stage_2d_data(
+        self,
+        absolute_cam_no,
+        corrected_framenumber,
+        trigger_timestamp,
+        camn_received_time,
+        pt_array,
+    ):
+        """fill the staging buffer of the 2D data table writer by column"""
+        n_pts = len(pt_array)
+        if n_pts:
+            # nan cannot get sent across network in platform-independent way
+            slope = pt_array["slope"].copy()
+            slope[slope == near_inf] = inf
+            slope[pt_array["slope_found"] == 0] = nan
+            eccentricity = pt_array["eccentricity"].copy()
+            eccentricity[eccentricity == near_inf] = inf
+            columns = {
+                "x": pt_array["x_distorted"],
+                "y": pt_array["y_distorted"],
+                "area": pt_array["area"],
+                "slope": slope,
+                "eccentricity": eccentricity,
+                "frame_pt_idx": np.arange(n_pts),
+                "cur_val": pt_array["cur_val"],
+                "mean_val": pt_array["mean_val"],
+                "sumsqf_val": pt_array["sumsqf_val"],
+            }
+        else:
+            # Save 2D data (even when no point found) to allow
+            # temporal correlation of movie frames to 2D data.
+            n_pts = 1
+            columns = {
+                "x": nan,
+                "y": nan,
+                "area": nan,
+                "slope": nan,
+                "eccentricity": nan,
+                "frame_pt_idx": 0,
+                "cur_val": 0,
+                "mean_val": 0,
+                "sumsqf_val": 0,
+            }
+        columns["camn"] = absolute_cam_no
+        columns["frame"] = corrected_framenumber
+        columns["timestamp"] = trigger_timestamp
+        columns["cam_received_timestamp"] = camn_received_time
+        self.main_brain.data2d_writer.append_columns(n_pts, columns)
+
+    def _reconstruct_frames(self, new_data_slots):
+        convert_format = flydra_kalman_utils.convert_format  # shorthand
+        frame_assembler = self.frame_assembler
+
+        with self.all_data_lock:
+            if 1:
+                finished_slots = []  # for quick deletion
 
                 ########################################################################
 
                 # Now we've grabbed all data waiting on network. Now it's
-                # time to calculate 3D info.
-
-                # XXX could go for latest data first to minimize latency
-                # on that data.
+                # time to calculate 3D info. The completed frames are
+                # tracked in order, but only the newest gets the full work
+                # (see flydra_core.frame_scheduler).
 
                 ########################################################################
 
-                for corrected_framenumber in new_data_framenumbers:
-                    (
-                        oldest_camera_timestamp,
-                        n,
-                    ) = oldest_timestamp_by_corrected_framenumber[corrected_framenumber]
-                    if oldest_camera_timestamp is None:
-                        # LOG.info('no latency estimate available -- skipping 3D reconstruction')
-                        continue
-                    if (
-                        time.time() - oldest_camera_timestamp
-                    ) > self.max_reconstruction_latency_sec:
-                        # LOG.info('maximum reconstruction latency exceeded -- skipping 3D reconstruction')
-                        continue
-
-                    data_dict = realtime_coord_dict[corrected_framenumber]
-                    if len(data_dict) == len(self.cam_ids):  # all camera data arrived
+                completed_frames = []
+                for slot in new_data_slots:
+                    if frame_assembler.is_complete(slot):  # all camera data arrived
+                        oldest_ts, n = frame_assembler.get_oldest_timestamp(slot)
+                        completed_frames.append(
+                            (frame_assembler.get_framenumber(slot), oldest_ts, slot)
+                        )
+
+                for mode, slot in self.frame_scheduler.schedule(completed_frames):
+                    if 1:
+                        corrected_framenumber = frame_assembler.get_framenumber(slot)
+                        (
+                            oldest_camera_timestamp,
+                            n,
+                        ) = frame_assembler.get_oldest_timestamp(slot)
 
                         if self.debug_level.isSet():
-                            LOG.debug("frame %d" % (corrected_framenumber))
+                            LOG.debug("frame %d (%s)" % (corrected_framenumber, mode))
 
                         # mark for deletion out of data queue
-                        finished_corrected_framenumbers.append(corrected_framenumber)
+                        finished_slots.append(slot)
+
+                        if mode == PREDICT_ONLY:
+                            # no latency estimate available or maximum
+                            # reconstruction latency exceeded -- skipping 3D
+                            # reconstruction, the tracked objects predict
+                            # over this frame.
+                            continue
 
                         if self.reconstructor is None:
                             # can't do any 3D math without calibration information
@@ -884,9 +997,9 @@ class CoordinateProcessor(threading.Thread):
                                     self.main_brain.best_realtime_data = None
                                     continue
 
-                                pluecker_coords_by_camn = realtime_kalman_coord_dict[
-                                    corrected_framenumber
-                                ]
+                                pluecker_coords_by_camn = frame_assembler.get_pluecker_coords_by_camn(
+                                    slot
+                                )
 
                                 if self.save_profiling_data:
                                     dumps = pickle.dumps(pluecker_coords_by_camn)
@@ -936,14 +1049,16 @@ class CoordinateProcessor(threading.Thread):
                                         ("ntrack", self.tracker.how_many_are_living())
                                     )
 
+                                if mode == TRACK_ONLY:
+                                    # a newer frame is waiting
+                                    continue
+
                                 now = time.time()
                                 if self.show_overall_latency.isSet():
                                     (
                                         oldest_camera_timestamp,
                                         n,
-                                    ) = oldest_timestamp_by_corrected_framenumber[
-                                        corrected_framenumber
-                                    ]
+                                    ) = frame_assembler.get_oldest_timestamp(slot)
                                     if n > 0:
                                         if 0:
                                             LOG.info(
@@ -1013,7 +1128,7 @@ class CoordinateProcessor(threading.Thread):
                                             this_observation_Lcoords,
                                             cam_ids_used,
                                             min_mean_dist,
-                                        ) = ru.hypothesis_testing_algorithm__find_best_3d(
+                                        ) = self.find_best_3d(
                                             self.reconstructor,
                                             found_data_dict,
                                             max_error,
@@ -1086,18 +1201,16 @@ class CoordinateProcessor(threading.Thread):
                                             ),
                                             objects=ros_objects,
                                         )
-                                        self.realtime_ros_packets_pub.publish(
-                                            flydra_mainbrain_super_packet([ros_packet])
+                                        self._put_output(
+                                            self.realtime_ros_packets_pub.publish,
+                                            flydra_mainbrain_super_packet([ros_packet]),
                                         )
 
-                for finished in finished_corrected_framenumbers:
+                for finished in finished_slots:
                     # check that timestamps are in reasonable agreement (low priority)
-                    diff_from_start = []
-                    for cam_id, tmp_trigger_timestamp in timestamp_check_dict[
+                    timestamps_by_cam_id = frame_assembler.get_trigger_timestamps(
                         finished
-                    ].iteritems():
-                        diff_from_start.append(tmp_trigger_timestamp)
-                    timestamps_by_cam_id = numpy.array(diff_from_start)
+                    )
 
                     if self.show_sync_errors:
                         if len(timestamps_by_cam_id):
@@ -1114,64 +1227,4 @@ class CoordinateProcessor(threading.Thread):
                                     FlydraError(FlydraError.CAM_TIMESTAMPS_OFF, "")
                                 )
 
-                    del realtime_coord_dict[finished]
-                    del timestamp_check_dict[finished]
-                    try:
-                        del realtime_kalman_coord_dict[finished]
-                    except KeyError:
-                        pass
-
-                # Clean up old frame records to save RAM.
-                # This is only needed when multiple cameras are not
-                # synchronized, (When camera-camera frame
-                # correspondences are unknown.)
-                if len(realtime_coord_dict) > 100:
-                    # dont spam the console at startup (i.e. before a sync has been attemted)
-                    if self.ever_synchronized:
-                        LOG.warn(
-                            "Cameras not synchronized or network dropping packets -- unmatched 2D data accumulating"
-                        )
-                        self.main_brain.error_ros_msgs_pub.publish(
-                            FlydraError(FlydraError.NOT_SYNCHRONIZED, "")
-                        )
-
-                    k = realtime_coord_dict.keys()
-                    k.sort()
-
-                    # get one sample
-                    corrected_framenumber = k[0]
-                    data_dict = realtime_coord_dict[corrected_framenumber]
-                    this_cam_ids = data_dict.keys()
-                    missing_cam_id_guess = list(set(self.cam_ids) - set(this_cam_ids))
-                    if len(missing_cam_id_guess) and self.ever_synchronized:
-                        delta = list(set(self.cam_ids) - set(this_cam_ids))
-                        LOG.warn("a guess at missing cam_id(s): %r" % delta)
-                        for d in delta:
-                            self.main_brain.error_ros_msgs_pub.publish(
-                                FlydraError(FlydraError.MISSING_DATA, d)
-                            )
-
-                    for ki in k[:-50]:
-                        del realtime_coord_dict[ki]
-                        del timestamp_check_dict[ki]
-
-                if len(realtime_kalman_coord_dict) > 100:
-                    LOG.warn(
-                        "deleting unused 3D data (this should be a rare occurrance)"
-                    )
-                    self.main_brain.error_ros_msgs_pub.publish(
-                        FlydraError(FlydraError.UNUSED_3D_DATA, "")
-                    )
-                    k = realtime_kalman_coord_dict.keys()
-                    k.sort()
-                    for ki in k[:-50]:
-                        del realtime_kalman_coord_dict[ki]
-
-                if len(oldest_timestamp_by_corrected_framenumber) > 100:
-                    k = oldest_timestamp_by_corrected_framenumber.keys()
-                    k.sort()
-                    for ki in k[:-50]:
-                        del oldest_timestamp_by_corrected_framenumber[ki]
-
-                if len(deferred_2d_data):
-                    self.main_brain.queue_data2d.put(deferred_2d_data)
+                    frame_assembler.release(finished)
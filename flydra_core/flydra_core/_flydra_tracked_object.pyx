@@ -4,6 +4,7 @@ cimport numpy as np
 cimport _fastgeom
 cimport _mahalanobis
 cimport _pmat_jacobian
+from _reconstruct_utils cimport _intrinsics_t, _distort_pt
 
 import numpy
 import numpy as np
@@ -11,6 +12,8 @@ import time, sys
 import adskalman.adskalman as kalman
 
 import flydra_core.kalman.ekf as kalman_ekf
+import flydra_core.kalman.dynamic_models as dynamic_models
+from flydra_core._fused_ekf import FusedEKF
 #import flydra_core.geom as geom
 import _fastgeom as geom
 import flydra_core.geom
@@ -24,7 +27,7 @@ from pprint import pprint
 cdef double c_inf
 c_inf = np.inf
 
-__all__ = ['TrackedObject']
+__all__ = ['TrackedObject', 'CandidateGrid', 'History', 'RaggedHistory']
 
 PT_TUPLE_IDX_X = flydra_core.data_descriptions.PT_TUPLE_IDX_X
 PT_TUPLE_IDX_Y = flydra_core.data_descriptions.PT_TUPLE_IDX_Y
@@ -50,6 +53,12 @@ ctypedef int mybool
 
 cdef extern from "math.h":
     double sqrt(double)
+    double fabs(double)
+    double floor(double)
+
+# distorted pixel coordinates beyond this are not binned by CandidateGrid
+cdef double MAX_BINNED_COORD
+MAX_BINNED_COORD = 1e9
 
 cpdef evaluate_pmat_jacobian(object pmats_and_points_cov, np.ndarray[np.double_t, ndim=1] xhatminus):
     cdef int N
@@ -131,6 +140,219 @@ def obs2d_hashable( arr ):
     val = newarr.tostring()
     return val
 
+cdef class CandidateGrid:
+    """spatial index of the 2D candidate points of one frame
+
+    The candidate points of each camera are binned by their distorted
+    pixel coordinates into square cells. This allows a tracked object
+    to consider only the points near its predicted image location
+    rather than all points of the camera. The index is conservative:
+    it may return points slightly outside the requested radius, but
+    never omits one inside it.
+    """
+    cdef readonly double cell_size
+    cdef object cells_by_camn, unbinned_by_camn
+
+    def __init__(self, reconstructor, data_dict, camn2cam_id,
+                 double cell_size):
+        cdef int idx
+        cdef double xdi, ydi
+
+        if not cell_size > 0:
+            raise ValueError('cell_size must be positive')
+        self.cell_size = cell_size
+        self.cells_by_camn = {}
+        self.unbinned_by_camn = {}
+        helpers = reconstructor.get_reconstruct_helper_dict()
+        for camn, candidate_point_list in data_dict.iteritems():
+            helper = helpers[camn2cam_id[camn]]
+            xs = [pt[PT_TUPLE_IDX_X] for (pt, line) in candidate_point_list]
+            ys = [pt[PT_TUPLE_IDX_Y] for (pt, line) in candidate_point_list]
+            xd, yd = helper.distort_many(xs, ys)
+            cells = {}
+            unbinned = []
+            for idx in range(len(xs)):
+                xdi = xd[idx]
+                ydi = yd[idx]
+                if fabs(xdi) < MAX_BINNED_COORD and fabs(ydi) < MAX_BINNED_COORD:
+                    key = (<long>floor(xdi/cell_size), <long>floor(ydi/cell_size))
+                    cells.setdefault(key, []).append(idx)
+                else:
+                    # nan or far off the image -- always a candidate
+                    unbinned.append(idx)
+            self.cells_by_camn[camn] = cells
+            self.unbinned_by_camn[camn] = unbinned
+
+    def query(self, camn, double x, double y, double radius):
+        """get candidate points of camn possibly within radius of (x,y)
+
+        Returns a sorted list of indices into the candidate point list
+        of camn, or None if all points must be considered.
+        """
+        cdef long col, row, col0, col1, row0, row1
+
+        cells = self.cells_by_camn.get(camn, None)
+        if cells is None:
+            return None
+        if not (fabs(x) < MAX_BINNED_COORD and fabs(y) < MAX_BINNED_COORD and
+                radius < MAX_BINNED_COORD):
+            return None
+
+        # widen the search slightly to be safe from rounding errors
+        radius = radius*(1.0+1e-9) + 1e-9
+        col0 = <long>floor((x-radius)/self.cell_size)
+        col1 = <long>floor((x+radius)/self.cell_size)
+        row0 = <long>floor((y-radius)/self.cell_size)
+        row1 = <long>floor((y+radius)/self.cell_size)
+
+        result = list(self.unbinned_by_camn[camn])
+        if (col1-col0+1)*(row1-row0+1) > len(cells):
+            for (col, row), idxs in cells.iteritems():
+                if col0 <= col <= col1 and row0 <= row <= row1:
+                    result.extend(idxs)
+        else:
+            for col from col0 <= col <= col1:
+                for row from row0 <= row <= row1:
+                    idxs = cells.get((col, row), None)
+                    if idxs is not None:
+                        result.extend(idxs)
+        result.sort()
+        return result
+
+def _history_from_array(arr):
+    cdef History result
+    result = History(arr.shape[1:], arr.dtype, capacity=len(arr))
+    result.extend(arr)
+    return result
+
+cdef class History:
+    """a growable array of equally shaped items
+
+    The items are stored in one preallocated array whose capacity
+    doubles when it is full, so that append() and pop() are amortized
+    O(1) and numpy.asarray() of a History is a view without copying.
+    Indexing and iteration behave as for that array.
+    """
+    cdef object buf
+    cdef readonly Py_ssize_t n
+
+    def __init__(self, item_shape=(), dtype=numpy.float64, Py_ssize_t capacity=16):
+        if capacity < 1:
+            capacity = 1
+        self.buf = numpy.empty((capacity,) + tuple(item_shape), dtype=dtype)
+        self.n = 0
+
+    cdef _reserve(self, Py_ssize_t n):
+        cdef Py_ssize_t capacity
+        capacity = self.buf.shape[0]
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity = 2*capacity
+        new_buf = numpy.empty((capacity,) + self.buf.shape[1:], dtype=self.buf.dtype)
+        new_buf[:self.n] = self.buf[:self.n]
+        self.buf = new_buf
+
+    cpdef append(self, value):
+        self._reserve(self.n+1)
+        self.buf[self.n] = value
+        self.n += 1
+
+    cpdef extend(self, values):
+        cdef Py_ssize_t n_new
+        n_new = len(values)
+        self._reserve(self.n+n_new)
+        self.buf[self.n:self.n+n_new] = values
+        self.n += n_new
+
+    cpdef pop(self):
+        if self.n == 0:
+            raise IndexError('pop from empty History')
+        self.n -= 1
+        return self.buf[self.n].copy()
+
+    cpdef grow(self, Py_ssize_t n):
+        """append n uninitialized items and return them as an array"""
+        self._reserve(self.n+n)
+        self.n += n
+        return self.buf[self.n-n:self.n]
+
+    cpdef truncate(self, Py_ssize_t n):
+        """discard all but the first n items"""
+        if 0 <= n < self.n:
+            self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        return self.buf[:self.n][idx]
+
+    def __iter__(self):
+        return iter(self.buf[:self.n])
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.buf[:self.n]
+        return self.buf[:self.n].astype(dtype)
+
+    def __reduce__(self):
+        return (_history_from_array, (numpy.array(self),))
+
+def _ragged_history_from_arrays(values, ends):
+    cdef RaggedHistory result
+    result = RaggedHistory(values.dtype)
+    result.values.extend(values)
+    result.ends.extend(ends)
+    return result
+
+cdef class RaggedHistory:
+    """a growable sequence of 1D arrays of varying length
+
+    The arrays are stored back to back in the History values, and
+    the History ends holds the end offset of each array, as in a
+    compressed sparse row layout.
+    """
+    cdef readonly History values, ends
+
+    def __init__(self, dtype):
+        self.values = History((), dtype, capacity=64)
+        self.ends = History((), numpy.int64)
+
+    cdef Py_ssize_t _start(self, Py_ssize_t i):
+        if i == 0:
+            return 0
+        return self.ends.buf[i-1]
+
+    cpdef append(self, value):
+        self.values.extend(value)
+        self.ends.append(self.values.n)
+
+    cpdef pop(self):
+        result = self[-1]
+        self.ends.pop()
+        self.values.truncate(self._start(self.ends.n))
+        return result
+
+    def __len__(self):
+        return self.ends.n
+
+    def __getitem__(self, Py_ssize_t i):
+        if i < 0:
+            i += self.ends.n
+        if not 0 <= i < self.ends.n:
+            raise IndexError('RaggedHistory index out of range')
+        return self.values.buf[self._start(i):self.ends.buf[i]].copy()
+
+    def __iter__(self):
+        cdef Py_ssize_t i
+        for i in range(self.ends.n):
+            yield self[i]
+
+    def __reduce__(self):
+        return (_ragged_history_from_arrays,
+                (numpy.array(self.values), numpy.array(self.ends)))
+
 cdef class TrackedObject:
     """
     Track one object using a Kalman filter.
@@ -148,12 +370,24 @@ cdef class TrackedObject:
     cdef double max_variance
     cdef object ekf_observation_covariance_pixels
 
-    cdef readonly object frames, xhats, timestamps, Ps, MLE_position, MLE_Lcoords
+    cdef readonly object frames, timestamps, MLE_position, MLE_Lcoords
+    # estimates, exposed through the xhats and Ps properties
+    cdef object _xhats, _Ps
     cdef readonly object observations_frames, observations_2d
     cdef int disable_image_stat_gating, orientation_consensus
     cdef object fake_timestamp
     cdef readonly unsigned int obj_id
-    cdef object ekf_kalman_A, ekf_kalman_Q
+    # number of observations dropped because the update failed
+    cdef readonly long n_failed_updates
+    cdef object ekf_kalman_A, ekf_kalman_Q, ekf_pmats
+    # closed-form prediction over skipped frames
+    cdef object A_powers, Q_accumulated, skipped_rows
+
+    # per-camera geometry (see reconstruct.CameraGeometry)
+    cdef object cam_id2idx
+    cdef const double[:,:,::1] geom_pmat
+    cdef const double[:,::1] geom_intrinsics, geom_distortion
+    cdef mybool project_with_geometry, distort_with_geometry
 
     def __init__(self,
                  reconstructor, # the Reconstructor instance
@@ -188,6 +422,17 @@ cdef class TrackedObject:
         self.save_all_data = save_all_data
         self.kill_me = False
         self.reconstructor = reconstructor
+        geometry = reconstructor.geometry
+        self.cam_id2idx = geometry.cam_id2idx
+        self.geom_pmat = geometry.pmat
+        self.geom_intrinsics = geometry.intrinsics
+        self.geom_distortion = geometry.distortion
+        # skew is not supported by ReconstructHelper.distort() and
+        # CameraGeometry.distort(), so Reconstructor.distort() is used
+        self.distort_with_geometry = not numpy.any(geometry.intrinsics[:,4])
+        # refraction requires the full Reconstructor.find2d()
+        self.project_with_geometry = (self.distort_with_geometry and
+                                      reconstructor.wateri is None)
         self.distorted_pixel_euclidian_distance_accept=kalman_model.get('distorted_pixel_euclidian_distance_accept',None)
         self.disable_image_stat_gating = disable_image_stat_gating
         self.orientation_consensus = orientation_consensus
@@ -195,6 +440,7 @@ cdef class TrackedObject:
 
         self.current_frameno = frame
         self.last_frameno_with_data = frame
+        self.n_failed_updates = 0
         obs0_position = obs0_position
         if obs0_Lcoords is None:
             obs0_Lcoords = NO_LCOORDS
@@ -222,12 +468,22 @@ cdef class TrackedObject:
         if kalman_model.get( 'isEKF', False):
             self.ekf_kalman_A = kalman_model['A']
             self.ekf_kalman_Q = kalman_model['Q']
-            # EKF
-            self.my_kalman = kalman_ekf.EKF(
-                initial_x=initial_x,
-                initial_P=P_k1,
-                )
             self.ekf_observation_covariance_pixels = kalman_model['ekf_observation_covariance_pixels']
+            self.A_powers, self.Q_accumulated = dynamic_models.get_multistep_matrices(
+                kalman_model)
+            # EKF
+            if reconstructor.wateri is None:
+                # pinhole observation model, see _fused_ekf
+                self.ekf_pmats = geometry.pmat
+                self.my_kalman = FusedEKF(self.ekf_kalman_A,
+                                          self.ekf_kalman_Q,
+                                          self.ekf_observation_covariance_pixels,
+                                          initial_x, P_k1)
+            else:
+                self.my_kalman = kalman_ekf.EKF(
+                    initial_x=initial_x,
+                    initial_P=P_k1,
+                    )
         else:
             # non-EKF
             self.my_kalman = kalman.KalmanFilter(kalman_model['A'],
@@ -236,17 +492,26 @@ cdef class TrackedObject:
                                                  kalman_model['R'],
                                                  initial_x,
                                                  P_k1)
-        self.frames = [frame]
-        self.xhats = [initial_x]
+        # The histories are stored in growable arrays rather than
+        # lists of small arrays.
+        self.frames = History((), numpy.int64)
+        self._xhats = History((ss,))
+        self.timestamps = History()
+        self._Ps = History((ss,ss))
+        self.frames.append(frame)
+        self._xhats.append(initial_x)
         if self.fake_timestamp is None:
-            self.timestamps = [time.time()]
+            self.timestamps.append(time.time())
         else:
-            self.timestamps = [self.fake_timestamp]
-        self.Ps = [P_k1]
+            self.timestamps.append(self.fake_timestamp)
+        self._Ps.append(P_k1)
 
-        self.observations_frames = [frame]
-        self.MLE_position = [obs0_position]
-        self.MLE_Lcoords = [obs0_Lcoords]
+        self.observations_frames = History((), numpy.int64)
+        self.MLE_position = History((3,))
+        self.MLE_Lcoords = History((6,))
+        self.observations_frames.append(frame)
+        self.MLE_position.append(obs0_position)
+        self.MLE_Lcoords.append(obs0_Lcoords)
 
         first_observations_2d_pre = [[camn,idx] for camn,idx in zip(first_observation_camns,first_observation_idxs)]
         first_observations_2d = []
@@ -254,42 +519,93 @@ cdef class TrackedObject:
             first_observations_2d.extend( obs )
         first_observations_2d = numpy.array(first_observations_2d,dtype=numpy.uint16) # if saved as VLArray, should match with atom type
 
-        self.observations_2d = [first_observations_2d]
+        self.observations_2d = RaggedHistory(numpy.uint16)
+        self.observations_2d.append(first_observations_2d)
+
+        # (first row, number of rows) of skipped frames whose estimates
+        # are not computed yet, see _fill_skipped()
+        self.skipped_rows = []
 
         self.max_frames_skipped=kalman_model['max_frames_skipped']
 
         # Don't run kalman filter with initial data, as this would
         # cause error estimates to drop too low.
 
+    property xhats:
+        def __get__(self):
+            # the skipped rows are filled before they can be read
+            self._fill_skipped()
+            return self._xhats
+
+    property Ps:
+        def __get__(self):
+            self._fill_skipped()
+            return self._Ps
+
     def __repr__(self):
         return '<TRO frames[0]=%r observations_2d[0]=%r xhats[0]=%r>' % (
             self.frames[0], self.observations_2d[0], self.xhats[0])
 
     def debug_info(self,level=3):
+        self._fill_skipped()
         if level > 5:
             sys.stdout.write('%s\n'%self)
-            N_pts = len(self.xhats)
+            N_pts = len(self._xhats)
             start_idx = max( N_pts-10, 0 )
             for i in range(start_idx,N_pts):
-                this_Pmean = math.sqrt(self.Ps[i][0,0]**2 + self.Ps[i][1,1]**2 + self.Ps[i][2,2]**2)
-                sys.stdout.write( ' '.join(map(str,['  ',i,self.frames[i],self.xhats[i][:3],this_Pmean,])) )
-                if self.frames[i] in self.observations_frames:
-                    j =  self.observations_frames.index(  self.frames[i] )
-                    sys.stdout.write( '%s\n'%self.MLE_position[j] )
+                this_Pmean = math.sqrt(self._Ps[i][0,0]**2 + self._Ps[i][1,1]**2 + self._Ps[i][2,2]**2)
+                sys.stdout.write( ' '.join(map(str,['  ',i,self.frames[i],self._xhats[i][:3],this_Pmean,])) )
+                j = numpy.nonzero(numpy.asarray(self.observations_frames) == self.frames[i])[0]
+                if len(j):
+                    sys.stdout.write( '%s\n'%self.MLE_position[j[0]] )
                 else:
                     sys.stdout.write('\n')
             sys.stdout.write('\n')
         elif level > 2:
-            sys.stdout.write('%d observations, %d estimates for %s\n'%(len(self.xhats),len(self.MLE_position),self))
+            sys.stdout.write('%d observations, %d estimates for %s\n'%(len(self._xhats),len(self.MLE_position),self))
+
+    cdef void _distort(self, int cam_idx, double xl, double yl,
+                       double *xd, double *yd):
+        # same as ReconstructHelper.distort(), which ignores skew (see
+        # distort_with_geometry)
+        cdef const double[::1] intr = self.geom_intrinsics[cam_idx]
+        cdef const double[::1] dist = self.geom_distortion[cam_idx]
+        cdef _intrinsics_t c
+        c.fc1 = intr[0]
+        c.fc2 = intr[1]
+        c.cc1 = intr[2]
+        c.cc2 = intr[3]
+        c.alpha_c = intr[4]
+        c.fc1p = intr[5]
+        c.fc2p = intr[6]
+        c.cc1p = intr[7]
+        c.cc2p = intr[8]
+        c.k1 = dist[0]
+        c.k2 = dist[1]
+        c.p1 = dist[2]
+        c.p2 = dist[3]
+        c.k3 = dist[4]
+        _distort_pt(&c, xl, yl, xd, yd)
+
+    cdef void _find2d_distorted(self, int cam_idx, double X0, double X1, double X2,
+                                double *xd, double *yd):
+        # same as Reconstructor.find2d(cam_id, X, distorted=True) without water
+        cdef const double[:,::1] P = self.geom_pmat[cam_idx]
+        cdef double x, y, w
+        x = P[0,0]*X0 + P[0,1]*X1 + P[0,2]*X2 + P[0,3]
+        y = P[1,0]*X0 + P[1,1]*X1 + P[1,2]*X2 + P[1,3]
+        w = P[2,0]*X0 + P[2,1]*X1 + P[2,2]*X2 + P[2,3]
+        self._distort(cam_idx, x/w, y/w, xd, yd)
 
     def get_distance_and_nsigma( self, testx ):
-        xhat = self.xhats[-1][:3]
+        self._fill_skipped()
+        xhat = self._xhats[-1][:3]
 
         dist2 = numpy.sum((testx-xhat)**2) # distance squared
         dist = numpy.sqrt(dist2)
 
         # XXX This should be mahalanobis distance, probably.
-        P = self.Ps[-1]
+        P = self._Ps[-1]
         Pmean = numpy.sqrt(numpy.sum([P[i,i]**2 for i in range(3)])) # sigma squared
         sigma = numpy.sqrt(Pmean)
         return dist, (dist/sigma)
@@ -297,20 +613,50 @@ cdef class TrackedObject:
     def kill(self):
         # called when killed
         if self.save_all_data:
+            self._fill_skipped()
             return
 
         # find last data
         last_observation_frame = self.observations_frames[-1]
 
         # eliminate estimates past last observation
-        while 1:
-            if self.frames[-1] > last_observation_frame:
-                self.frames.pop()
-                self.xhats.pop()
-                self.timestamps.pop()
-                self.Ps.pop()
-            else:
-                break
+        n = numpy.searchsorted(numpy.asarray(self.frames), last_observation_frame,
+                               side='right')
+        self.frames.truncate(n)
+        self._xhats.truncate(n)
+        self.timestamps.truncate(n)
+        self._Ps.truncate(n)
+        self._fill_skipped()
+
+    cdef _step_closed_form(self, long n_steps):
+        A_k = self.A_powers[n_steps]
+        Q_k = self.Q_accumulated[n_steps]
+        if isinstance(self.my_kalman, FusedEKF):
+            self.my_kalman.step_closed_form(A_k, Q_k)
+        else:
+            xhat = self.my_kalman.xhat_k1
+            P = self.my_kalman.P_k1
+            self.my_kalman.xhat_k1 = numpy.dot(A_k, xhat)
+            self.my_kalman.P_k1 = numpy.dot(numpy.dot(A_k, P), A_k.T) + Q_k
+
+    cdef _fill_skipped(self):
+        """compute the estimates of the frames jumped over in closed form"""
+        cdef Py_ssize_t row, n
+        if not len(self.skipped_rows):
+            return
+        xhats = numpy.asarray(self._xhats)
+        Ps = numpy.asarray(self._Ps)
+        for row, n in self.skipped_rows:
+            # rows may have been truncated since
+            n = min(n, len(xhats)-row)
+            if n <= 0:
+                continue
+            A_k = self.A_powers[1:n+1]
+            xhats[row:row+n] = numpy.dot(A_k, xhats[row-1])
+            Ps[row:row+n] = numpy.matmul(numpy.matmul(A_k, Ps[row-1]),
+                                         A_k.transpose((0,2,1)))
+            Ps[row:row+n] += self.Q_accumulated[1:n+1]
+        self.skipped_rows = []
 
     cpdef calculate_a_posteriori_estimate(self,
                                         long frame,
@@ -320,7 +666,50 @@ cdef class TrackedObject:
                                         int skip_data_association=0,
                                         object original_camns_and_idxs=None,
                                         object original_cam_ids_and_points2d=None,
+                                        object candidate_grid=None,
                                         ):
+        cdef double Pmean
+        used_camns_and_idxs = []
+        all_close_camn_pt_idxs = []
+
+        # Step 1. Update Kalman state to a priori estimates for this frame.
+        prior = self.calculate_a_priori_estimate(frame, debug1=debug1)
+        if prior is None:
+            return (used_camns_and_idxs, None, c_inf, all_close_camn_pt_idxs)
+        xhatminus, Pminus = prior
+
+        # Step 2. Filter incoming 2D data to use informative points (data association)
+        if skip_data_association:
+            position_MLE = numpy.nan*numpy.ones( (3,)) # skip
+            Lcoords = None
+            used_camns_and_idxs = original_camns_and_idxs
+            cam_ids_and_points2d = original_cam_ids_and_points2d
+            all_close_camn_pt_idxs = [] # not important when skipping data association
+        else:
+            (position_MLE, Lcoords, used_camns_and_idxs,
+             cam_ids_and_points2d,
+             all_close_camn_pt_idxs) = self._filter_data(xhatminus, Pminus,
+                                                         data_dict,
+                                                         camn2cam_id,
+                                                         debug=debug1,
+                                                         candidate_grid=candidate_grid)
+        if debug1>2:
+            print 'position MLE, used_camns_and_idxs',position_MLE,used_camns_and_idxs
+            print 'Lcoords (3D body orientation) : %s'%str(Lcoords)
+
+        (used_camns_and_idxs, this_observations_2d_hash,
+         Pmean) = self.calculate_a_posteriori_from_observation(
+             frame, xhatminus, Pminus, position_MLE, Lcoords,
+             used_camns_and_idxs, cam_ids_and_points2d, debug1=debug1)
+        return (used_camns_and_idxs, this_observations_2d_hash,
+                Pmean, all_close_camn_pt_idxs)
+
+    cpdef calculate_a_priori_estimate(self, long frame, int debug1=0):
+        """step the Kalman filter up to frame
+
+        Returns the a priori estimate (xhatminus, Pminus) for frame, or
+        None if this object is to be killed.
+        """
         # Step 1. Update Kalman state to a priori estimates for this frame.
         # Step 1.A. Update Kalman state for each skipped frame.
 
@@ -330,14 +719,30 @@ cdef class TrackedObject:
         # Since we have no observation, the estimated error will
         # rise.
         cdef long i, frames_since_update
-        cdef long frames_skipped
-        cdef double Pmean
         frames_since_update = frame-self.current_frameno-1
 
         if debug1>2:
             print 'doing',self,'============--'
             print 'updating for %d frames since update'%(frames_since_update,)
 
+        if (self.A_powers is not None and
+            0 < frames_since_update < len(self.A_powers)):
+            # Jump over the skipped frames at once. Their estimates
+            # are only computed when needed.
+            self.frames.extend(numpy.arange(self.current_frameno+1, frame))
+            self.timestamps.extend(numpy.zeros((frames_since_update,)))
+            self.skipped_rows.append((len(self._xhats), frames_since_update))
+            self._xhats.grow(frames_since_update)
+            self._Ps.grow(frames_since_update)
+            self._step_closed_form(frames_since_update)
+            frames_since_update = 0
+        elif isinstance(self.my_kalman, FusedEKF):
+            if frames_since_update > 0:
+                self.frames.extend(numpy.arange(self.current_frameno+1, frame))
+                self.timestamps.extend(numpy.zeros((frames_since_update,)))
+                self.my_kalman.step_many(self._xhats.grow(frames_since_update),
+                                         self._Ps.grow(frames_since_update))
+            frames_since_update = 0
         for i in range(frames_since_update):
             if isinstance(self.my_kalman, kalman_ekf.EKF):
                 xhat, P = self.my_kalman.step(self.ekf_kalman_A,
@@ -346,118 +751,140 @@ cdef class TrackedObject:
                 xhat, P = self.my_kalman.step()
             ############ save outputs ###############
             self.frames.append( self.current_frameno + i + 1 )
-            self.xhats.append( xhat )
+            self._xhats.append( xhat )
             self.timestamps.append( 0.0 )
-            self.Ps.append( P )
+            self._Ps.append( P )
 
         self.current_frameno = frame
+        if self.kill_me:
+            return None
+        # Step 1.B. Update Kalman to provide a priori estimates for this frame
+        if isinstance(self.my_kalman, FusedEKF):
+            xhatminus, Pminus = self.my_kalman.calculate_a_priori()
+        elif isinstance(self.my_kalman, kalman_ekf.EKF):
+            xhatminus, Pminus = self.my_kalman.step1__calculate_a_priori(
+                self.ekf_kalman_A, self.ekf_kalman_Q)
+        else:
+            xhatminus, Pminus = self.my_kalman.step1__calculate_a_priori()
+        if debug1>2:
+            print 'xhatminus'
+            print xhatminus
+            print 'Pminus'
+            print Pminus
+            print
+        return xhatminus, Pminus
+
+    cpdef calculate_a_posteriori_from_observation(self, long frame,
+                                                  object xhatminus,
+                                                  object Pminus,
+                                                  object position_MLE,
+                                                  object Lcoords,
+                                                  object used_camns_and_idxs,
+                                                  object cam_ids_and_points2d,
+                                                  int debug1=0):
+        """update the Kalman filter with the observation made for frame
+
+        The a priori estimate must come from
+        calculate_a_priori_estimate() and the observation from
+        make_observation(). Returns (used_camns_and_idxs,
+        this_observations_2d_hash, Pmean).
+        """
+        cdef long frames_skipped
+        cdef double Pmean
         this_observations_2d_hash = None
-        used_camns_and_idxs = []
-        all_close_camn_pt_idxs = []
-        Pmean = c_inf
-        if not self.kill_me:
-            # Step 1.B. Update Kalman to provide a priori estimates for this frame
-            if isinstance(self.my_kalman, kalman_ekf.EKF):
-                xhatminus, Pminus = self.my_kalman.step1__calculate_a_priori(
-                    self.ekf_kalman_A, self.ekf_kalman_Q)
-            else:
-                xhatminus, Pminus = self.my_kalman.step1__calculate_a_priori()
-            if debug1>2:
-                print 'xhatminus'
-                print xhatminus
-                print 'Pminus'
-                print Pminus
-                print
-
-            # Step 2. Filter incoming 2D data to use informative points (data association)
-            if skip_data_association:
-                position_MLE = numpy.nan*numpy.ones( (3,)) # skip
-                Lcoords = None
-                used_camns_and_idxs = original_camns_and_idxs
-                cam_ids_and_points2d = original_cam_ids_and_points2d
-                all_close_camn_pt_idxs = [] # not important when skipping data association
-            else:
-                (position_MLE, Lcoords, used_camns_and_idxs,
-                 cam_ids_and_points2d,
-                 all_close_camn_pt_idxs) = self._filter_data(xhatminus, Pminus,
-                                                             data_dict,
-                                                             camn2cam_id,
-                                                             debug=debug1)
-            if debug1>2:
-                print 'position MLE, used_camns_and_idxs',position_MLE,used_camns_and_idxs
-                print 'Lcoords (3D body orientation) : %s'%str(Lcoords)
-
-            # Step 3. Incorporate observation to estimate a posteriori
-            if isinstance(self.my_kalman, kalman_ekf.EKF):
-                prediction_3d = xhatminus[:3]
-                pmats_and_points_cov = [ (
-                                          self.reconstructor.get_model_with_jacobian(cam_id),
-                                          value_tuple[:2],#just first 2 components (x,y) become xy2d_observed
-                                          self.ekf_observation_covariance_pixels)
-                                         for (cam_id,value_tuple) in cam_ids_and_points2d]
-                y,hx,C,R,missing_data = evaluate_pmat_jacobian(
-                    pmats_and_points_cov,xhatminus)
-                xhat, P = self.my_kalman.step2__calculate_a_posteriori(
-                    xhatminus, Pminus, y=y,hx=hx,
-                    C=C,R=R,missing_data=missing_data)
-            else:
-                xhat, P = self.my_kalman.step2__calculate_a_posteriori(
-                    xhatminus, Pminus,
-                    y=position_MLE)
-
-            # calculate mean variance of x y z position (assumes first three components of state vector are position)
-
-            # XXX should probably use trace/N (mean of variances) or determinant (volume of variance)
-            Pmean = numpy.sqrt(numpy.sum([P[i,i]**2 for i in range(3)]))
-
-            if debug1>2:
-                print 'xhat'
-                print xhat
-                print 'P'
-                print P
-                print 'Pmean',Pmean
-
-            # XXX Need to test if error for this object has grown beyond a
-            # threshold at which it should be terminated.
-            if Pmean > self.max_variance:
-                self.kill_me = True
-                if debug1>=1:
-                    print 'will kill next time because Pmean too large (%f > %f)'%(Pmean,self.max_variance)
 
-            frames_skipped = frame - self.last_frameno_with_data
-            if frames_skipped > self.max_frames_skipped:
-                self.kill_me = True
+        # Step 3. Incorporate observation to estimate a posteriori
+        if isinstance(self.my_kalman, FusedEKF):
+            cam_idxs = [self.cam_id2idx[cam_id]
+                        for (cam_id,value_tuple) in cam_ids_and_points2d]
+            y = numpy.array([value_tuple[:2]
+                             for (cam_id,value_tuple) in cam_ids_and_points2d],
+                            dtype=numpy.float64).reshape((len(cam_idxs),2))
+            posterior = self.my_kalman.calculate_a_posteriori(
+                xhatminus, Pminus, self.ekf_pmats[cam_idxs], y)
+            if posterior is None:
+                # innovation covariance not positive definite: keep
+                # the prior and treat this as a missed observation so
+                # that the 2D points are neither recorded nor gobbled
+                self.n_failed_updates += 1
                 if debug1>=1:
-                    print 'will kill next time because frames skipped (%ld > %ld, frame %ld)'%(
-                        frames_skipped, self.max_frames_skipped,frame)
+                    print 'a posteriori update failed for obj_id %d, frame %ld'%(
+                        self.obj_id, frame)
+                posterior = xhatminus, Pminus
+                self.my_kalman.xhat_k1 = xhatminus
+                self.my_kalman.P_k1 = Pminus
+                position_MLE = None
+                used_camns_and_idxs = []
+            xhat, P = posterior
+        elif isinstance(self.my_kalman, kalman_ekf.EKF):
+            prediction_3d = xhatminus[:3]
+            pmats_and_points_cov = [ (
+                                      self.reconstructor.get_model_with_jacobian(cam_id),
+                                      value_tuple[:2],#just first 2 components (x,y) become xy2d_observed
+                                      self.ekf_observation_covariance_pixels)
+                                     for (cam_id,value_tuple) in cam_ids_and_points2d]
+            y,hx,C,R,missing_data = evaluate_pmat_jacobian(
+                pmats_and_points_cov,xhatminus)
+            xhat, P = self.my_kalman.step2__calculate_a_posteriori(
+                xhatminus, Pminus, y=y,hx=hx,
+                C=C,R=R,missing_data=missing_data)
+        else:
+            xhat, P = self.my_kalman.step2__calculate_a_posteriori(
+                xhatminus, Pminus,
+                y=position_MLE)
 
-            ############ save outputs ###############
-            self.frames.append( frame )
-            self.xhats.append( xhat )
-            if self.fake_timestamp is None:
-                self.timestamps.append(time.time())
+        # calculate mean variance of x y z position (assumes first three components of state vector are position)
+
+        # XXX should probably use trace/N (mean of variances) or determinant (volume of variance)
+        Pmean = numpy.sqrt(numpy.sum([P[i,i]**2 for i in range(3)]))
+
+        if debug1>2:
+            print 'xhat'
+            print xhat
+            print 'P'
+            print P
+            print 'Pmean',Pmean
+
+        # XXX Need to test if error for this object has grown beyond a
+        # threshold at which it should be terminated.
+        if Pmean > self.max_variance:
+            self.kill_me = True
+            if debug1>=1:
+                print 'will kill next time because Pmean too large (%f > %f)'%(Pmean,self.max_variance)
+
+        frames_skipped = frame - self.last_frameno_with_data
+        if frames_skipped > self.max_frames_skipped:
+            self.kill_me = True
+            if debug1>=1:
+                print 'will kill next time because frames skipped (%ld > %ld, frame %ld)'%(
+                    frames_skipped, self.max_frames_skipped,frame)
+
+        ############ save outputs ###############
+        self.frames.append( frame )
+        self._xhats.append( xhat )
+        if self.fake_timestamp is None:
+            self.timestamps.append(time.time())
+        else:
+            self.timestamps.append(self.fake_timestamp)
+        self._Ps.append( P )
+
+        if position_MLE is not None:
+            self.last_frameno_with_data = frame
+            self.observations_frames.append( frame )
+            self.MLE_position.append( position_MLE )
+            if Lcoords is None:
+                self.MLE_Lcoords.append( NO_LCOORDS )
             else:
-                self.timestamps.append(self.fake_timestamp)
-            self.Ps.append( P )
-
-            if position_MLE is not None:
-                self.last_frameno_with_data = frame
-                self.observations_frames.append( frame )
-                self.MLE_position.append( position_MLE )
-                if Lcoords is None:
-                    self.MLE_Lcoords.append( NO_LCOORDS )
-                else:
-                    self.MLE_Lcoords.append( Lcoords )
-                this_observations_2d = []
-                for (camn, frame_pt_idx, dd_idx) in used_camns_and_idxs:
-                    this_observations_2d.extend( [camn,frame_pt_idx] )
-                this_observations_2d = numpy.array( this_observations_2d, dtype=numpy.uint16 ) # convert to numpy
-                self.observations_2d.append( this_observations_2d )
-                this_observations_2d_hash = obs2d_hashable( this_observations_2d )
-            if debug1>2:
-                print
-        return (used_camns_and_idxs, this_observations_2d_hash,
-                Pmean, all_close_camn_pt_idxs)
+                self.MLE_Lcoords.append( Lcoords )
+            this_observations_2d = []
+            for (camn, frame_pt_idx, dd_idx) in used_camns_and_idxs:
+                this_observations_2d.extend( [camn,frame_pt_idx] )
+            this_observations_2d = numpy.array( this_observations_2d, dtype=numpy.uint16 ) # convert to numpy
+            self.observations_2d.append( this_observations_2d )
+            this_observations_2d_hash = obs2d_hashable( this_observations_2d )
+        if debug1>2:
+            print
+        return (used_camns_and_idxs, this_observations_2d_hash, Pmean)
 
     def remove_previous_observation(self, int debug1=0):
 
@@ -468,13 +895,14 @@ cdef class TrackedObject:
         self.current_frameno -= 1
 
         # Remove most recent information
+        self._fill_skipped()
         frame = self.frames.pop()
         if debug1>2:
             sys.stdout.write( '%s removing previous observation (from frame %d)\n'%(self,frame,))
 
-        self.xhats.pop()
+        self._xhats.pop()
         self.timestamps.pop()
-        self.Ps.pop()
+        self._Ps.pop()
         if self.observations_frames[-1] == frame:
             self.observations_frames.pop()
             self.MLE_position.pop()
@@ -482,14 +910,14 @@ cdef class TrackedObject:
             self.observations_2d.pop()
 
         # reset self.my_kalman
-        self.my_kalman.xhat_k1 = self.xhats[-1]
-        self.my_kalman.P_k1 = self.Ps[-1]
+        self.my_kalman.xhat_k1 = self._xhats[-1].copy()
+        self.my_kalman.P_k1 = self._Ps[-1].copy()
 
         self.last_frameno_with_data = self.observations_frames[-1]
 
     cpdef _filter_data(self, object xhatminus, object Pminus,
                        object data_dict, object camn2cam_id,
-                       int debug=0):
+                       int debug=0, object candidate_grid=None):
         """given state estimate, select useful incoming data and make new observation
 
         This function 'solves' the data association problem. 2D
@@ -503,15 +931,59 @@ cdef class TrackedObject:
         plane. Note that a raw threshold for this is implemented with
         distorted_pixel_euclidian_distance_accept.)
 
+        If candidate_grid (a CandidateGrid of data_dict) is given, only
+        the points near the predicted image location are considered
+        for the distorted pixel distance test. The result is the same.
+        """
+        cdef double least_nll
+        (gated_by_camn,
+         all_close_camn_pt_idxs) = self.gate_data(xhatminus, Pminus,
+                                                  data_dict, camn2cam_id,
+                                                  debug=debug,
+                                                  candidate_grid=candidate_grid)
+
+        # For each camera, take the gated point with the least negative
+        # log likelihood.
+        chosen = []
+        for camn, gated in gated_by_camn:
+            least_nll = c_inf
+            closest_idx = None
+            for idx, nll_this_point in gated:
+                if nll_this_point < least_nll:
+                    least_nll = nll_this_point
+                    closest_idx = idx
+            if closest_idx is not None:
+                chosen.append( (camn, closest_idx) )
+
+        (position_MLE, Lcoords, used_camns_and_idxs,
+         cam_ids_and_points2d) = self.make_observation(chosen, data_dict,
+                                                       camn2cam_id,
+                                                       debug=debug)
+        return (position_MLE, Lcoords, used_camns_and_idxs,
+                cam_ids_and_points2d, all_close_camn_pt_idxs)
+
+    cpdef gate_data(self, object xhatminus, object Pminus,
+                    object data_dict, object camn2cam_id,
+                    int debug=0, object candidate_grid=None):
+        """find the incoming 2D points that could be this object
+
+        Returns (gated_by_camn, all_close_camn_pt_idxs). gated_by_camn
+        is a list of (camn, gated) in the order of data_dict, where
+        gated is a list of (idx, nll) for each acceptable point, with
+        idx the index of the point in data_dict[camn] and nll its
+        negative log likelihood given the a priori estimate.
+
+        See _filter_data() for the meaning of the arguments.
         """
         # For each camera, predict 2D image location and error distance
-        cdef double least_nll, nll_this_point
+        cdef double nll_this_point
         cdef double dist2, dist, p_y_x
         cdef int gated_in, pixel_dist_criterion_passed
 
-        cdef double pt_area, mean_val, sumsqf_val, area
+        cdef double pt_area, mean_val, sumsqf_val
         cdef int cur_val
-        cdef int camn, frame_pt_idx
+        cdef int camn, frame_pt_idx, cam_idx
+        cdef double pred_x_dist, pred_y_dist, pt_x_dist, pt_y_dist, pixel_dist
         cdef _fastgeom.PlueckerLine projected_line
         cdef _fastgeom.ThreeTuple best_3d_location
 
@@ -520,17 +992,32 @@ cdef class TrackedObject:
         prediction_3d = xhatminus[:3]
         cdef _fastgeom.ThreeTuple fast_prediction_3d = _fastgeom.ThreeTuple(xhatminus[:3])
         pixel_dist_cmp = self.distorted_pixel_euclidian_distance_accept
-        neg_predicted_3d = -geom.ThreeTuple( prediction_3d )
-        cam_ids_and_points2d = []
-
-        used_camns_and_idxs = []
+        gated_by_camn = []
         if debug>2:
-            print '_filter_data():'
+            print 'gate_data():'
+            candidate_grid = None # show all points
         for camn,candidate_point_list in data_dict.iteritems():
             cam_id = camn2cam_id[camn]
+            cam_idx = self.cam_id2idx[cam_id]
 
             if pixel_dist_cmp is not None:
-                predicted_2d_distorted = self.reconstructor.find2d(cam_id,prediction_3d,distorted=True)
+                if self.project_with_geometry:
+                    self._find2d_distorted(cam_idx, fast_prediction_3d.a,
+                                           fast_prediction_3d.b,
+                                           fast_prediction_3d.c,
+                                           &pred_x_dist, &pred_y_dist)
+                else:
+                    pred_x_dist, pred_y_dist = self.reconstructor.find2d(
+                        cam_id,prediction_3d,distorted=True)
+                if candidate_grid is not None:
+                    candidate_idxs = candidate_grid.query(
+                        camn, pred_x_dist, pred_y_dist, pixel_dist_cmp)
+                else:
+                    candidate_idxs = None
+            else:
+                candidate_idxs = None
+            if candidate_idxs is None:
+                candidate_idxs = range(len(candidate_point_list))
 
             if debug>2:
                 predicted_2d_undistorted = self.reconstructor.find2d(cam_id,prediction_3d,distorted=False)
@@ -554,13 +1041,13 @@ cdef class TrackedObject:
             # (nonlinear) perspective projection of a multivariante
             # normal.
 
-            least_nll = c_inf
-            closest_idx = None
+            gated = []
+            gated_by_camn.append( (camn, gated) )
 
             Pminus_inv = None # defer inverting Pminus until necessary.
 
-            for idx,(pt_undistorted,projected_line) in enumerate(
-                candidate_point_list):
+            for idx in candidate_idxs:
+                pt_undistorted,projected_line = candidate_point_list[idx]
 
                 # Iterate over each candidate point. Each point has:
                 #  * index 'idx'
@@ -578,8 +1065,12 @@ cdef class TrackedObject:
                     # XXX TODO: fixme: should just pass in distorted pixel coordinates, but saves reorganizing all this code.
                     pt_x_undist =  pt_undistorted[PT_TUPLE_IDX_X]
                     pt_y_undist =  pt_undistorted[PT_TUPLE_IDX_Y]
-                    pt_x_dist, pt_y_dist = self.reconstructor.distort( cam_id, (pt_x_undist, pt_y_undist) )
-                    pixel_dist = numpy.sqrt((predicted_2d_distorted[0] - pt_x_dist)**2 + (predicted_2d_distorted[1] - pt_y_dist)**2)
+                    if self.distort_with_geometry:
+                        self._distort(cam_idx, pt_x_undist, pt_y_undist,
+                                      &pt_x_dist, &pt_y_dist)
+                    else:
+                        pt_x_dist, pt_y_dist = self.reconstructor.distort( cam_id, (pt_x_undist, pt_y_undist) )
+                    pixel_dist = sqrt((pred_x_dist - pt_x_dist)**2 + (pred_y_dist - pt_y_dist)**2)
                     if pixel_dist > pixel_dist_cmp:
                         pixel_dist_criterion_passed = False
 
@@ -649,45 +1140,59 @@ cdef class TrackedObject:
                 if gated_in:
                     if debug>2:
                         print '       (acceptable)'
-                    if nll_this_point < least_nll:
-                        if debug>2:
-                            print '       (so far the best -- taking)'
-                        least_nll = nll_this_point
-                        closest_idx = idx
+                    gated.append( (idx, nll_this_point) )
                     all_close_camn_pt_idxs.append( (camn, frame_pt_idx) )
                 elif debug>2:
                     print '       (not acceptable)'
 
-            if closest_idx is not None:
-                pt_undistorted, projected_line = candidate_point_list[closest_idx]
-                area = pt_undistorted[PT_TUPLE_IDX_AREA]
-                if area >= self.area_threshold_for_orientation:
-                    # with orientation
-                    observed_2d = (pt_undistorted[PT_TUPLE_IDX_X],
-                                   pt_undistorted[PT_TUPLE_IDX_Y],
-                                   pt_undistorted[PT_TUPLE_IDX_AREA],
-                                   pt_undistorted[PT_TUPLE_IDX_SLOPE],
-                                   pt_undistorted[PT_TUPLE_IDX_ECCENTRICITY],
-                                   pt_undistorted[PT_TUPLE_IDX_P1],
-                                   pt_undistorted[PT_TUPLE_IDX_P2],
-                                   pt_undistorted[PT_TUPLE_IDX_P3],
-                                   pt_undistorted[PT_TUPLE_IDX_P4])
-                else:
-                    # with no orientation
-                    observed_2d = (pt_undistorted[PT_TUPLE_IDX_X],
-                                   pt_undistorted[PT_TUPLE_IDX_Y],
-                                   pt_undistorted[PT_TUPLE_IDX_AREA],
-                                   cnan,
-                                   cnan,
-                                   cnan,
-                                   cnan,
-                                   cnan,
-                                   cnan)
-                cam_ids_and_points2d.append( (cam_id,observed_2d) )
-                frame_pt_idx = pt_undistorted[PT_TUPLE_IDX_FRAME_PT_IDX]
-                used_camns_and_idxs.append( (camn, frame_pt_idx, closest_idx) )
-                if debug>2:
-                    print 'best match idx %d (%s)'%(closest_idx, str(pt_undistorted[:2]))
+        return gated_by_camn, all_close_camn_pt_idxs
+
+    cpdef make_observation(self, object chosen, object data_dict,
+                           object camn2cam_id, int debug=0):
+        """make new observation from the chosen incoming 2D points
+
+        chosen is a list of (camn, idx), with idx the index of the point
+        in data_dict[camn]. At most one point per camera may be given.
+
+        Returns (position_MLE, Lcoords, used_camns_and_idxs,
+        cam_ids_and_points2d).
+        """
+        cdef double area
+        cdef int camn, frame_pt_idx
+
+        cam_ids_and_points2d = []
+        used_camns_and_idxs = []
+        for camn, closest_idx in chosen:
+            cam_id = camn2cam_id[camn]
+            pt_undistorted, projected_line = data_dict[camn][closest_idx]
+            area = pt_undistorted[PT_TUPLE_IDX_AREA]
+            if area >= self.area_threshold_for_orientation:
+                # with orientation
+                observed_2d = (pt_undistorted[PT_TUPLE_IDX_X],
+                               pt_undistorted[PT_TUPLE_IDX_Y],
+                               pt_undistorted[PT_TUPLE_IDX_AREA],
+                               pt_undistorted[PT_TUPLE_IDX_SLOPE],
+                               pt_undistorted[PT_TUPLE_IDX_ECCENTRICITY],
+                               pt_undistorted[PT_TUPLE_IDX_P1],
+                               pt_undistorted[PT_TUPLE_IDX_P2],
+                               pt_undistorted[PT_TUPLE_IDX_P3],
+                               pt_undistorted[PT_TUPLE_IDX_P4])
+            else:
+                # with no orientation
+                observed_2d = (pt_undistorted[PT_TUPLE_IDX_X],
+                               pt_undistorted[PT_TUPLE_IDX_Y],
+                               pt_undistorted[PT_TUPLE_IDX_AREA],
+                               cnan,
+                               cnan,
+                               cnan,
+                               cnan,
+                               cnan,
+                               cnan)
+            cam_ids_and_points2d.append( (cam_id,observed_2d) )
+            frame_pt_idx = pt_undistorted[PT_TUPLE_IDX_FRAME_PT_IDX]
+            used_camns_and_idxs.append( (camn, frame_pt_idx, closest_idx) )
+            if debug>2:
+                print 'best match idx %d (%s)'%(closest_idx, str(pt_undistorted[:2]))
 
         Lcoords = None # default to no line coordinates
         # Now cam_ids_and_points2d has just the 2d points we'll use for this reconstruction
@@ -706,11 +1211,12 @@ cdef class TrackedObject:
         else:
             position_MLE = None
         return (position_MLE, Lcoords, used_camns_and_idxs,
-                cam_ids_and_points2d, all_close_camn_pt_idxs)
+                cam_ids_and_points2d)
 
     def get_most_recent_data(self):
-        if not len(self.xhats):
+        if not len(self._xhats):
             return
-        xhat = self.xhats[-1]
-        P = self.Ps[-1]
+        self._fill_skipped()
+        xhat = self._xhats[-1].copy()
+        P = self._Ps[-1].copy()
         return self.obj_id, xhat,P
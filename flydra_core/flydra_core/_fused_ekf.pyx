@@ -0,0 +1,313 @@
+#emacs, this is -*-Python-*- mode
+"""extended Kalman filter for pinhole cameras in fused, nogil loops
+
+This implements the same filter as flydra_core.kalman.ekf.EKF with the
+observation model of _pmat_jacobian.PinholeCameraModelWithJacobian,
+but each step is a single call working in place on preallocated
+buffers rather than a sequence of numpy calls on tiny matrices. The
+a posteriori error covariance is computed in Joseph form.
+"""
+import numpy
+cimport numpy as np
+
+cdef extern from "math.h":
+    double sqrt(double) nogil
+
+cdef void _predict(int ss, const double *A, const double *Q,
+                   double *x, double *P, double *xtmp, double *AP) nogil:
+    """x = A x, P = A P A^T + Q in place"""
+    cdef int i, j, k
+    cdef double acc
+    for i in range(ss):
+        acc = 0.0
+        for k in range(ss):
+            acc += A[i*ss+k]*x[k]
+        xtmp[i] = acc
+    for i in range(ss):
+        x[i] = xtmp[i]
+    for i in range(ss):
+        for j in range(ss):
+            acc = 0.0
+            for k in range(ss):
+                acc += A[i*ss+k]*P[k*ss+j]
+            AP[i*ss+j] = acc
+    for i in range(ss):
+        for j in range(ss):
+            acc = Q[i*ss+j]
+            for k in range(ss):
+                acc += AP[i*ss+k]*A[j*ss+k]
+            P[i*ss+j] = acc
+
+cdef int _cholesky(int m, double *S) nogil:
+    """lower Cholesky factor of S in place, returns 0 if not pos. def."""
+    cdef int i, j, k
+    cdef double acc
+    for j in range(m):
+        acc = S[j*m+j]
+        for k in range(j):
+            acc -= S[j*m+k]*S[j*m+k]
+        if not acc > 0.0:
+            return 0
+        S[j*m+j] = sqrt(acc)
+        for i in range(j+1, m):
+            acc = S[i*m+j]
+            for k in range(j):
+                acc -= S[i*m+k]*S[j*m+k]
+            S[i*m+j] = acc/S[j*m+j]
+    return 1
+
+cdef void _cholesky_solve(int m, const double *L, double *b) nogil:
+    """solve L L^T z = b in place"""
+    cdef int i, k
+    cdef double acc
+    for i in range(m):
+        acc = b[i]
+        for k in range(i):
+            acc -= L[i*m+k]*b[k]
+        b[i] = acc/L[i*m+i]
+    for i in range(m-1, -1, -1):
+        acc = b[i]
+        for k in range(i+1, m):
+            acc -= L[k*m+i]*b[k]
+        b[i] = acc/L[i*m+i]
+
+cdef int _update(int ss, int n_cams, const double *pmats, const double *y,
+                 const double *R2, double *x, double *P,
+                 double *C, double *PCt, double *S, double *K, double *e,
+                 double *IKC, double *tmp) nogil:
+    """incorporate n_cams 2D observations y into x and P in place
+
+    pmats holds the (3,4) camera matrices back to back and R2 the
+    (2,2) observation covariance of each camera. C is (m,3), PCt and K
+    are (ss,m), S is (m,m) and IKC and tmp are (ss,ss) with m =
+    2*n_cams. Returns 0, leaving x and P unchanged, if the innovation
+    covariance is not positive definite.
+    """
+    cdef int m = 2*n_cams
+    cdef int i, j, k, cam
+    cdef double X0, X1, X2, u, v, w, acc
+    cdef const double *pmat
+
+    # observation function h(x) and its jacobian C at x
+    X0 = x[0]
+    X1 = x[1]
+    X2 = x[2]
+    for cam in range(n_cams):
+        pmat = pmats + 12*cam
+        u = pmat[0]*X0 + pmat[1]*X1 + pmat[2]*X2 + pmat[3]
+        v = pmat[4]*X0 + pmat[5]*X1 + pmat[6]*X2 + pmat[7]
+        w = pmat[8]*X0 + pmat[9]*X1 + pmat[10]*X2 + pmat[11]
+        u = u/w
+        v = v/w
+        e[2*cam] = y[2*cam] - u
+        e[2*cam+1] = y[2*cam+1] - v
+        for j in range(3):
+            C[(2*cam)*3+j] = (pmat[j] - u*pmat[8+j])/w
+            C[(2*cam+1)*3+j] = (pmat[4+j] - v*pmat[8+j])/w
+
+    # PCt = P C^T (only the first 3 columns of the full C are non-zero)
+    for i in range(ss):
+        for j in range(m):
+            acc = 0.0
+            for k in range(3):
+                acc += P[i*ss+k]*C[j*3+k]
+            PCt[i*m+j] = acc
+
+    # S = C P C^T + R
+    for i in range(m):
+        for j in range(m):
+            acc = 0.0
+            for k in range(3):
+                acc += C[i*3+k]*PCt[k*m+j]
+            S[i*m+j] = acc
+    for cam in range(n_cams):
+        for i in range(2):
+            for j in range(2):
+                S[(2*cam+i)*m+2*cam+j] += R2[i*2+j]
+    if not _cholesky(m, S):
+        return 0
+
+    # K = P C^T S^-1, row by row as S is symmetric
+    for i in range(ss):
+        for j in range(m):
+            K[i*m+j] = PCt[i*m+j]
+        _cholesky_solve(m, S, K+i*m)
+
+    # x = x + K (y - h(x))
+    for i in range(ss):
+        acc = 0.0
+        for j in range(m):
+            acc += K[i*m+j]*e[j]
+        x[i] += acc
+
+    # P = (I - K C) P (I - K C)^T + K R K^T
+    for i in range(ss):
+        for j in range(ss):
+            acc = 0.0
+            if j < 3:
+                for k in range(m):
+                    acc -= K[i*m+k]*C[k*3+j]
+            if i == j:
+                acc += 1.0
+            IKC[i*ss+j] = acc
+    for i in range(ss):
+        for j in range(ss):
+            acc = 0.0
+            for k in range(ss):
+                acc += IKC[i*ss+k]*P[k*ss+j]
+            tmp[i*ss+j] = acc
+    for i in range(ss):
+        for j in range(ss):
+            acc = 0.0
+            for k in range(ss):
+                acc += tmp[i*ss+k]*IKC[j*ss+k]
+            for cam in range(n_cams):
+                for k in range(2):
+                    acc += K[i*m+2*cam+k]*(
+                        R2[k*2]*K[j*m+2*cam] + R2[k*2+1]*K[j*m+2*cam+1])
+            P[i*ss+j] = acc
+    return 1
+
+cdef class FusedEKF:
+    """Extended Kalman filter for observations by pinhole cameras
+
+    This has the state attributes xhat_k1 and P_k1 of
+    flydra_core.kalman.ekf.EKF, with A, Q and the 2D observation
+    covariance R fixed at construction.
+    """
+    cdef readonly int ss
+    cdef double[:,::1] A, Q, R2
+    cdef double[::1] x, xtmp
+    cdef double[:,::1] P, AP, IKC, tmp
+    # buffers which depend on the number of observations
+    cdef int max_cams
+    cdef double[:,::1] C, PCt, S, K
+    cdef double[::1] e
+
+    def __init__(self, A, Q, R, initial_x, initial_P):
+        self.ss = len(initial_x)
+        self.A = numpy.array(A, dtype=numpy.float64)
+        self.Q = numpy.array(Q, dtype=numpy.float64)
+        self.R2 = numpy.array(R, dtype=numpy.float64)
+        assert self.A.shape[0] == self.ss and self.A.shape[1] == self.ss
+        assert self.Q.shape[0] == self.ss and self.Q.shape[1] == self.ss
+        assert self.R2.shape[0] == 2 and self.R2.shape[1] == 2
+        self.x = numpy.array(initial_x, dtype=numpy.float64)
+        self.P = numpy.array(initial_P, dtype=numpy.float64)
+        self.xtmp = numpy.empty((self.ss,))
+        self.AP = numpy.empty((self.ss, self.ss))
+        self.IKC = numpy.empty((self.ss, self.ss))
+        self.tmp = numpy.empty((self.ss, self.ss))
+        self.max_cams = 0
+        self._reserve(4)
+
+    cdef _reserve(self, int n_cams):
+        cdef int m
+        if n_cams <= self.max_cams:
+            return
+        m = 2*n_cams
+        self.C = numpy.empty((m, 3))
+        self.PCt = numpy.empty((self.ss, m))
+        self.S = numpy.empty((m, m))
+        self.K = numpy.empty((self.ss, m))
+        self.e = numpy.empty((m,))
+        self.max_cams = n_cams
+
+    property xhat_k1:
+        def __get__(self):
+            return numpy.array(self.x)
+        def __set__(self, value):
+            cdef double[::1] xv = numpy.asarray(value, dtype=numpy.float64)
+            self.x[:] = xv
+
+    property P_k1:
+        def __get__(self):
+            return numpy.array(self.P)
+        def __set__(self, value):
+            cdef double[:,::1] Pv = numpy.ascontiguousarray(value, dtype=numpy.float64)
+            self.P[:,:] = Pv
+
+    def calculate_a_priori(self):
+        """get the a priori estimate (xhatminus, Pminus) of the next step
+
+        The state is not changed.
+        """
+        xhatminus = numpy.array(self.x)
+        Pminus = numpy.array(self.P)
+        cdef double[::1] xv = xhatminus
+        cdef double[:,::1] Pv = Pminus
+        with nogil:
+            _predict(self.ss, &self.A[0,0], &self.Q[0,0], &xv[0], &Pv[0,0],
+                     &self.xtmp[0], &self.AP[0,0])
+        return xhatminus, Pminus
+
+    def step_many(self, double[:,::1] xhats_out, double[:,:,::1] Ps_out):
+        """step without observations once per row of xhats_out
+
+        The estimate after each step is written to xhats_out and
+        Ps_out, and the state is left at the last one.
+        """
+        cdef int i, j, k, n, ss
+        n = xhats_out.shape[0]
+        ss = self.ss
+        if n == 0:
+            return
+        assert xhats_out.shape[1] == ss
+        assert Ps_out.shape[0] == n and Ps_out.shape[1] == ss and Ps_out.shape[2] == ss
+        with nogil:
+            for i in range(n):
+                _predict(ss, &self.A[0,0], &self.Q[0,0], &self.x[0], &self.P[0,0],
+                         &self.xtmp[0], &self.AP[0,0])
+                for j in range(ss):
+                    xhats_out[i,j] = self.x[j]
+                    for k in range(ss):
+                        Ps_out[i,j,k] = self.P[j,k]
+
+    def step_closed_form(self, const double[:,::1] A_k, const double[:,::1] Q_k):
+        """step k times without observations at once
+
+        A_k is A**k and Q_k the process covariance accumulated over the
+        k steps, see dynamic_models.get_multistep_matrices().
+        """
+        assert A_k.shape[0] == self.ss and A_k.shape[1] == self.ss
+        assert Q_k.shape[0] == self.ss and Q_k.shape[1] == self.ss
+        with nogil:
+            _predict(self.ss, &A_k[0,0], &Q_k[0,0], &self.x[0], &self.P[0,0],
+                     &self.xtmp[0], &self.AP[0,0])
+
+    def calculate_a_posteriori(self, xhatminus, Pminus,
+                               const double[:,:,::1] pmats,
+                               const double[:,::1] y):
+        """incorporate the observations y of the cameras with pmats
+
+        pmats has shape (N,3,4) and y shape (N,2). The a posteriori
+        estimate becomes the state and is returned as (xhat, P), or
+        None if the update is numerically impossible, in which case
+        the state is not changed.
+        """
+        cdef int n_cams, ok, ss
+        cdef double[::1] x
+        cdef double[:,::1] P
+        n_cams = pmats.shape[0]
+        ss = self.ss
+        assert y.shape[0] == n_cams and y.shape[1] == 2
+        assert pmats.shape[1] == 3 and pmats.shape[2] == 4
+        xhat = numpy.array(xhatminus, dtype=numpy.float64)
+        P_out = numpy.array(Pminus, dtype=numpy.float64)
+        x = xhat
+        P = P_out
+        if n_cams == 0:
+            self.x[:] = x
+            self.P[:,:] = P
+            return xhat, P_out
+        self._reserve(n_cams)
+        with nogil:
+            ok = _update(ss, n_cams, &pmats[0,0,0], &y[0,0], &self.R2[0,0],
+                         &x[0], &P[0,0], &self.C[0,0], &self.PCt[0,0],
+                         &self.S[0,0], &self.K[0,0], &self.e[0],
+                         &self.IKC[0,0], &self.tmp[0,0])
+        if not ok:
+            return None
+        self.x[:] = x
+        self.P[:,:] = P
+        return xhat, P_out
@@ -0,0 +1,58 @@
+cdef extern from "math.h":
+    double fabs(double) nogil
+
+# The lens distortion model of ReconstructHelper, for use from C.
+
+ctypedef struct _intrinsics_t:
+    double fc1, fc2, cc1, cc2
+    double fc1p, fc2p, cc1p, cc2p
+    double k1, k2, k3, p1, p2
+    double alpha_c
+
+cdef inline void _undistort_pt(_intrinsics_t *c, double x_kk, double y_kk,
+                               int n_iterations, double tolerance,
+                               double *xl, double *yl) nogil:
+    # Same as ReconstructHelper.undistort(). If tolerance is positive,
+    # stop once an iteration moves the point less than tolerance.
+    cdef double xd, yd, x, y, x_new, y_new
+    cdef double r_2, k_radial, delta_x, delta_y
+    cdef int i
+
+    xd = ( x_kk - c.cc1 ) / c.fc1
+    yd = ( y_kk - c.cc2 ) / c.fc2
+
+    xd = xd - c.alpha_c * yd
+
+    x = xd
+    y = yd
+
+    for i from 0<=i<n_iterations:
+        r_2 = x*x + y*y
+        k_radial = 1.0 + r_2*(c.k1 + r_2*(c.k2 + r_2*c.k3))
+        delta_x = 2.0 * (c.p1)*x*y + (c.p2)*(r_2 + 2.0*x*x)
+        delta_y = (c.p1) * (r_2 + 2.0*y*y)+2.0*(c.p2)*x*y
+        x_new = (xd-delta_x)/k_radial
+        y_new = (yd-delta_y)/k_radial
+        if tolerance > 0.0 and fabs(x_new-x) < tolerance and fabs(y_new-y) < tolerance:
+            x = x_new
+            y = y_new
+            break
+        x = x_new
+        y = y_new
+
+    xl[0] = (c.fc1p)*x + (c.fc1p*c.alpha_c)*y + (c.cc1p)
+    yl[0] = (c.fc2p)*y + (c.cc2p)
+
+cdef inline void _distort_pt(_intrinsics_t *c, double xl, double yl,
+                             double *xd, double *yd) nogil:
+    # Same as ReconstructHelper.distort().
+    cdef double x, y, r_2, term1
+
+    x = ( xl - c.cc1p ) / c.fc1p
+    y = ( yl - c.cc2p ) / c.fc2p
+
+    r_2 = x*x + y*y
+    term1 = c.k1*r_2 + c.k2*r_2*r_2 + c.k3*r_2*r_2*r_2
+
+    xd[0] = (c.fc1)*(x + x*term1 + (2*c.p1*x*y + c.p2*(r_2+2*x*x))) + (c.cc1)
+    yd[0] = (c.fc2)*(y + y*term1 + (c.p1*(r_2+2*y*y) + 2*c.p2*x*y)) + (c.cc2)
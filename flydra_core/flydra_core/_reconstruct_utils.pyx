@@ -24,6 +24,7 @@ class NoAcceptablePointFound(Exception):
 
 cdef extern from "math.h":
     double sqrt(double)
+    double floor(double) nogil
     int isnan(double x)
     int isinf(double x)
 
@@ -246,6 +247,92 @@ cdef class ReconstructHelper:
         yl = (self.fc2p)*y + (self.cc2p)
         return (xl, yl)
 
+    cdef _intrinsics_t _get_intrinsics(self):
+        cdef _intrinsics_t c
+        c.fc1 = self.fc1
+        c.fc2 = self.fc2
+        c.cc1 = self.cc1
+        c.cc2 = self.cc2
+        c.fc1p = self.fc1p
+        c.fc2p = self.fc2p
+        c.cc1p = self.cc1p
+        c.cc2p = self.cc2p
+        c.k1 = self.k1
+        c.k2 = self.k2
+        c.k3 = self.k3
+        c.p1 = self.p1
+        c.p2 = self.p2
+        c.alpha_c = self.alpha_c
+        return c
+
+    def undistort_many(self, x_kk, y_kk, int n_iterations=5, tolerance=None,
+                       lut=None):
+        """undistort arrays of 2D coordinates
+
+        Same as undistort(), but operating on whole arrays at once.
+        Returns (xl, yl) as arrays of float64 with the shape of x_kk.
+
+        If tolerance is given, n_iterations is the maximum number of
+        iterations and the iteration for a point stops as soon as it
+        moves the point by less than tolerance (in normalized
+        coordinates).
+
+        If lut is given (see make_undistort_lut()), points with
+        integer coordinates within the table are looked up rather than
+        computed.
+        """
+        cdef _intrinsics_t c = self._get_intrinsics()
+        cdef double tol = 0.0
+        cdef const double[::1] xv, yv
+        cdef double[::1] xlv, ylv
+        cdef const double[:,::1] lut_x, lut_y
+        cdef Py_ssize_t i, n, col, row, width=0, height=0
+        cdef double xi, yi
+
+        if tolerance is not None:
+            tol = tolerance
+        if lut is not None:
+            lut_x, lut_y = lut
+            height = lut_x.shape[0]
+            width = lut_x.shape[1]
+
+        x_kk = numpy.asarray(x_kk,dtype=numpy.float64)
+        shape = x_kk.shape
+        xv = numpy.ascontiguousarray(x_kk).ravel()
+        yv = numpy.ascontiguousarray(y_kk,dtype=numpy.float64).ravel()
+        n = xv.shape[0]
+        assert yv.shape[0]==n
+        xl = numpy.empty((n,),dtype=numpy.float64)
+        yl = numpy.empty((n,),dtype=numpy.float64)
+        xlv = xl
+        ylv = yl
+
+        with nogil:
+            for i in range(n):
+                xi = xv[i]
+                yi = yv[i]
+                if (width > 0 and xi == floor(xi) and yi == floor(yi) and
+                    0 <= xi < width and 0 <= yi < height):
+                    col = <Py_ssize_t>xi
+                    row = <Py_ssize_t>yi
+                    xlv[i] = lut_x[row,col]
+                    ylv[i] = lut_y[row,col]
+                else:
+                    _undistort_pt(&c, xi, yi, n_iterations, tol, &xlv[i], &ylv[i])
+        return (xl.reshape(shape), yl.reshape(shape))
+
+    def make_undistort_lut(self, int width, int height, int n_iterations=5,
+                           tolerance=None):
+        """precompute undistorted coordinates of every pixel
+
+        Returns (xl, yl), each of shape (height,width), suitable for
+        the lut argument of undistort_many().
+        """
+        x, y = numpy.meshgrid(numpy.arange(width,dtype=numpy.float64),
+                              numpy.arange(height,dtype=numpy.float64))
+        return self.undistort_many(x, y, n_iterations=n_iterations,
+                                   tolerance=tolerance)
+
     def distort(self, double xl, double yl):
         """distort 2D coordinate pair"""
 
@@ -277,6 +364,35 @@ cdef class ReconstructHelper:
 
         return (xd, yd)
 
+    def distort_many(self, xl, yl):
+        """distort arrays of 2D coordinates
+
+        Same as distort(), but operating on whole arrays at once.
+        Returns (xd, yd) as arrays of float64 with the shape of xl.
+        """
+        cdef _intrinsics_t c = self._get_intrinsics()
+        cdef const double[::1] xv, yv
+        cdef double[::1] xdv, ydv
+        cdef Py_ssize_t i, n
+
+        assert self.alpha_c==0 # see distort()
+
+        xl = numpy.asarray(xl,dtype=numpy.float64)
+        shape = xl.shape
+        xv = numpy.ascontiguousarray(xl).ravel()
+        yv = numpy.ascontiguousarray(yl,dtype=numpy.float64).ravel()
+        n = xv.shape[0]
+        assert yv.shape[0]==n
+        xd = numpy.empty((n,),dtype=numpy.float64)
+        yd = numpy.empty((n,),dtype=numpy.float64)
+        xdv = xd
+        ydv = yd
+
+        with nogil:
+            for i in range(n):
+                _distort_pt(&c, xv[i], yv[i], &xdv[i], &ydv[i])
+        return (xd.reshape(shape), yd.reshape(shape))
+
     def undistort_image(self, numpy_image ):
         assert len(numpy_image.shape)==2
         assert numpy_image.dtype == numpy.uint8
@@ -295,6 +411,68 @@ cdef class ReconstructHelper:
 cdef int gave_water_warning
 gave_water_warning = 0
 
+def _check_water_hypothesis_test():
+    global gave_water_warning
+    if STRICT_WATER:
+        raise NotImplementedError('water and hypothesis testing not yet implemented')
+    if not gave_water_warning:
+        warnings.warn('_reconstruct_utils: Hypothesis test intersection done '
+                      'without refraction correction. Result will be wrong. '
+                      'Set environment variable STRICT_WATER_HYPOTHESIS_TEST '
+                      'to raise an error rather than give this warning.')
+        gave_water_warning = 1
+
+def _finish_best_3d(object recon, object found_data_dict, object cam_ids_used,
+                    object X, int with_water):
+    """compute final 3D point and line for the winning camera combination"""
+    if with_water:
+        # Even though (for speed reasons) we did not use proper
+        # refraction-correct code in the hypothesis test, we now
+        # recompute X using refraction.
+        cam_ids_and_points2d = []
+        for cam_id in cam_ids_used:
+            xy = found_data_dict[cam_id][:2]
+            cam_ids_and_points2d.append(( cam_id, xy ))
+
+        X = recon.find3d(cam_ids_and_points2d,
+                         undistort=False, # points are already undistorted
+                         return_line_coords = False,
+                         )
+
+    # calculate line3d
+    P = []
+    for cam_id in cam_ids_used:
+        x,y,area,slope,eccentricity, p1,p2,p3,p4 = found_data_dict[cam_id]
+        if eccentricity > MINIMUM_ECCENTRICITY and not numpy.isnan(p1):
+                P.append( (p1,p2,p3,p4) )
+    if len(P) < 2:
+        Lcoords = None
+    else:
+        P = numpy.array(P)
+        try:
+            u,d,vt=numpy.dual.svd(P,full_matrices=True)
+        except numpy.linalg.LinAlgError, err:
+            print 'SVD error, P=',repr(P)
+            Lcoords = None
+        except:
+            print 'Error on P'
+            print P
+            raise
+        else:
+            P = vt[0,:] # P,Q are planes (take row because this is transpose(V))
+            Q = vt[1,:]
+
+            # directly to Pluecker line coordinates
+            Lcoords = ( -(P[3]*Q[2]) + P[2]*Q[3],
+                          P[3]*Q[1]  - P[1]*Q[3],
+                        -(P[2]*Q[1]) + P[1]*Q[2],
+                        -(P[3]*Q[0]) + P[0]*Q[3],
+                        -(P[2]*Q[0]) + P[0]*Q[2],
+                        -(P[1]*Q[0]) + P[0]*Q[1] )
+            if isnan(Lcoords[0]):
+                Lcoords = None
+    return X, Lcoords
+
 def hypothesis_testing_algorithm__find_best_3d( object recon, object found_data_dict,
                                                 double ACCEPTABLE_DISTANCE_PIXELS,
                                                 int debug=0, Py_ssize_t max_n_cams=5,
@@ -327,23 +505,13 @@ def hypothesis_testing_algorithm__find_best_3d( object recon, object found_data_
     least_err_by_n_cameras = [cinf]*(max_n_cams+1) # allow 0-based indexing to last camera
     allA = numpy.zeros( (2*(len(cam_ids)+1),4), dtype=numpy.float64)
     bad_cam_ids = []
-    cam_id2idx = {}
+    cam_id2idx = recon.geometry.cam_id2idx
     all2d = {}
-    Pmat_fastnx = recon.Pmat # shorthand
+    Pmats = recon.geometry.pmat # shorthand
 
-    global gave_water_warning
     if with_water:
-        if STRICT_WATER:
-            raise NotImplementedError('water and hypothesis testing not yet implemented')
-        if not gave_water_warning:
-            warnings.warn('_reconstruct_utils: Hypothesis test intersection done '
-                          'without refraction correction. Result will be wrong. '
-                          'Set environment variable STRICT_WATER_HYPOTHESIS_TEST '
-                          'to raise an error rather than give this warning.')
-            gave_water_warning = 1
+        _check_water_hypothesis_test()
     for i,cam_id in enumerate(cam_ids):
-        cam_id2idx[cam_id] = i
-
         # do we have incoming data?
         try:
             value_tuple = found_data_dict[cam_id]
@@ -360,7 +528,7 @@ def hypothesis_testing_algorithm__find_best_3d( object recon, object found_data_
 
         # Similar to code in reconstruct.Reconstructor.find3d()
 
-        Pmat = Pmat_fastnx[cam_id] # Pmat is 3 rows x 4 columns
+        Pmat = Pmats[i] # Pmat is 3 rows x 4 columns
         row3 = Pmat[2,:]
         allA[ i*2, : ] = x*row3 - Pmat[0,:]
         allA[ i*2+1, :]= y*row3 - Pmat[1,:]
@@ -413,7 +581,7 @@ def hypothesis_testing_algorithm__find_best_3d( object recon, object found_data_
             mean_dist = 0.0
             for cam_id in cam_ids_used:
                 orig_x,orig_y = all2d[cam_id]
-                Pmat = Pmat_fastnx[cam_id]
+                Pmat = Pmats[cam_id2idx[cam_id]]
                 new_xyw = numpy.dot( Pmat, X ) # reproject 3d to 2d
                 new_x, new_y = new_xyw[0:2]/new_xyw[2]
 
@@ -449,58 +617,138 @@ def hypothesis_testing_algorithm__find_best_3d( object recon, object found_data_
 
     # now calculate final values
     cam_ids_used = cam_ids_for_least_err[best_n_cams]
-    if with_water:
-        # Even though (for speed reasons) we did not use proper
-        # refraction-correct code above, we now recompute X using
-        # refraction.
-        cam_ids_and_points2d = []
-        for cam_id in cam_ids_used:
-            xy = found_data_dict[cam_id][:2]
-            cam_ids_and_points2d.append(( cam_id, xy ))
+    X, Lcoords = _finish_best_3d(recon, found_data_dict, cam_ids_used,
+                                 X_for_least_err[best_n_cams], with_water)
+    return X, Lcoords, cam_ids_used, mean_dist
 
-        X = recon.find3d(cam_ids_and_points2d,
-                         undistort=False, # points are already undistorted
-                         return_line_coords = False,
-                         )
-    else:
-        X = X_for_least_err[best_n_cams]
-    del X_for_least_err
+def hypothesis_testing_algorithm__find_best_3d_vectorized(
+    object recon, object found_data_dict,
+    double ACCEPTABLE_DISTANCE_PIXELS,
+    int debug=0, Py_ssize_t max_n_cams=5,
+    int with_water = 0):
+    """Use hypothesis testing algorithm to find best 3D point (vectorized)
 
-    # calculate line3d
-    P = []
-    for cam_id in cam_ids_used:
-        x,y,area,slope,eccentricity, p1,p2,p3,p4 = found_data_dict[cam_id]
-        if eccentricity > MINIMUM_ECCENTRICITY and not numpy.isnan(p1):
-                P.append( (p1,p2,p3,p4) )
-    if len(P) < 2:
-        Lcoords = None
-    else:
-        P = numpy.array(P)
+    Gives the same result as hypothesis_testing_algorithm__find_best_3d(),
+    but rather than solving each camera combination with its own SVD,
+    the linear systems of all combinations of a given size are stacked
+    and solved by a single batched SVD. Reprojection error for all
+    combinations is likewise computed in a single pass.
+
+    """
+    cdef int n_cams, best_n_cams, n_all_cams, i
+    cdef double x, y, least_err, mean_dist
+
+    cam_ids = recon.cam_ids # shorthand
+    n_all_cams = len(cam_ids)
+    max_n_cams = min(n_all_cams, max_n_cams)
+
+    if with_water:
+        _check_water_hypothesis_test()
+
+    Pmats = recon.geometry.pmat # shape (n_all_cams,3,4)
+    have_data = numpy.zeros( (n_all_cams,), dtype=numpy.bool_ )
+    all2d = numpy.zeros( (n_all_cams,2), dtype=numpy.float64 )
+    for i,cam_id in enumerate(cam_ids):
+        # do we have incoming data?
         try:
-            u,d,vt=svd(P,full_matrices=True)
-        except numpy.linalg.LinAlgError, err:
-            print 'SVD error, P=',repr(P)
-            Lcoords = None
-        except:
-            print 'Error on P'
-            print P
-            raise
-        else:
-            P = vt[0,:] # P,Q are planes (take row because this is transpose(V))
-            Q = vt[1,:]
+            value_tuple = found_data_dict[cam_id]
+        except KeyError:
+            continue
+        # was a 2d point found?
+        x,y = value_tuple[:2]
+        if isnan(x):
+            continue
+        have_data[i] = True
+        all2d[i,0] = x
+        all2d[i,1] = y
 
-            # directly to Pluecker line coordinates
-            Lcoords = ( -(P[3]*Q[2]) + P[2]*Q[3],
-                          P[3]*Q[1]  - P[1]*Q[3],
-                        -(P[2]*Q[1]) + P[1]*Q[2],
-                        -(P[3]*Q[0]) + P[0]*Q[3],
-                        -(P[2]*Q[0]) + P[0]*Q[2],
-                        -(P[1]*Q[0]) + P[0]*Q[1] )
-            if isnan(Lcoords[0]):
-                Lcoords = None
-    ## c_lib.free(least_err_by_n_cameras)
+    # Per-camera rows of the linear system (as in the loop version).
+    allA = numpy.empty( (n_all_cams,2,4), dtype=numpy.float64)
+    allA[:,0,:] = all2d[:,0,numpy.newaxis]*Pmats[:,2,:] - Pmats[:,0,:]
+    allA[:,1,:] = all2d[:,1,numpy.newaxis]*Pmats[:,2,:] - Pmats[:,1,:]
+
+    least_err_by_n_cameras = [cinf]*(max_n_cams+1)
+    cam_ids_for_least_err = {}
+    X_for_least_err = {}
+    for n_cams from 2<=n_cams<=max_n_cams:
+        # Can we short-circuit the rest of these computations?
+        if not isinf(least_err_by_n_cameras[n_cams-1]):
+            if least_err_by_n_cameras[n_cams-1] > ACCEPTABLE_DISTANCE_PIXELS:
+                if debug>5:
+                    print 'HYPOTHESIS TEST -    shorting for n_cams %d (this=%f, ACCEPTABLE_DISTANCE_PIXELS=%f)'%(
+                        n_cams,least_err_by_n_cameras[n_cams-1],ACCEPTABLE_DISTANCE_PIXELS)
+                break
+
+        combo_idxs = recon.cam_combination_idxs_by_size[n_cams]
+        valid = numpy.all(have_data[combo_idxs],axis=1)
+        orig_combo_nums = numpy.nonzero(valid)[0]
+        if not len(orig_combo_nums):
+            continue
+        combo_idxs = combo_idxs[orig_combo_nums] # shape (K,n_cams)
+
+        # find 3D points (the SVD of A, not an eigendecomposition of
+        # A^T A, which would square the condition number)
+        A = allA[combo_idxs].reshape((len(combo_idxs),2*n_cams,4))
+        u,d,vt = numpy.linalg.svd(A)
+        X = vt[:,-1,:]/vt[:,-1,3,numpy.newaxis] # normalize, shape (K,4)
+
+        # calculate reprojection error
+        new_xyw = numpy.einsum('knij,kj->kni', Pmats[combo_idxs], X)
+        new_xy = new_xyw[:,:,:2]/new_xyw[:,:,2,numpy.newaxis]
+        dists = numpy.sqrt(numpy.sum((all2d[combo_idxs]-new_xy)**2,axis=2))
+        mean_dists = numpy.mean(dists,axis=1)
+        if debug>5:
+            for k in range(len(orig_combo_nums)):
+                print 'HYPOTHESIS TEST - mean_dist = %f for cam_ids_used = %s (always pt 0)'%(
+                    mean_dists[k],str(recon.cam_combinations_by_size[n_cams][orig_combo_nums[k]]))
+
+        # first combination with lowest error (nan never wins)
+        mean_dists[numpy.isnan(mean_dists)] = cinf
+        k = numpy.argmin(mean_dists)
+        mean_dist = mean_dists[k]
+        if mean_dist < least_err_by_n_cameras[n_cams]:
+            least_err_by_n_cameras[n_cams] = mean_dist
+            cam_ids_for_least_err[n_cams] = recon.cam_combinations_by_size[n_cams][orig_combo_nums[k]]
+            X_for_least_err[n_cams] = X[k,:3]
+
+    # now we have the best estimate for 2 views, 3 views, ...
+    best_n_cams = 2
+    least_err = least_err_by_n_cameras[2]
+    if debug>5:
+        print 'HYPOTHESIS TEST - least_err, ACCEPTABLE_DISTANCE_PIXELS: %f, %f'%(least_err,ACCEPTABLE_DISTANCE_PIXELS)
+    mean_dist = least_err
+    if not (least_err < ACCEPTABLE_DISTANCE_PIXELS):
+        raise NoAcceptablePointFound('least error was %f'%least_err)
+
+    for n_cams from 3 <= n_cams <= max_n_cams:
+        least_err = least_err_by_n_cameras[n_cams]
+        if debug>5:
+            print 'HYPOTHESIS TEST - n_cams %d: %f'%(n_cams,least_err)
+        if isinf(least_err):
+            break # if we don't have e.g. 4 cameras, we won't have 5
+        if least_err < ACCEPTABLE_DISTANCE_PIXELS:
+            mean_dist = least_err
+            best_n_cams = n_cams
+
+    # now calculate final values
+    cam_ids_used = cam_ids_for_least_err[best_n_cams]
+    X, Lcoords = _finish_best_3d(recon, found_data_dict, cam_ids_used,
+                                 X_for_least_err[best_n_cams], with_water)
     return X, Lcoords, cam_ids_used, mean_dist
 
+HYPOTHESIS_TEST_ENGINES = {
+    'loop':hypothesis_testing_algorithm__find_best_3d,
+    'vectorized':hypothesis_testing_algorithm__find_best_3d_vectorized,
+    }
+
+def get_hypothesis_test_engine(name):
+    """return the hypothesis testing function for engine name"""
+    try:
+        return HYPOTHESIS_TEST_ENGINES[name]
+    except KeyError:
+        raise ValueError('unknown hypothesis test engine %r (choose from %s)'%(
+            name, ', '.join(sorted(HYPOTHESIS_TEST_ENGINES.keys()))))
+
 ## def undistort_image( char* src, int srcstep,
 ##                      char* dst, int dststep,
 ##                      int width, int height,
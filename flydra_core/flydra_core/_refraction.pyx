@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 cimport _Roots3And4
 import _Roots3And4
+import numpy
 
 """
 This code calculates rays according to [Fermat's principle of least
@@ -63,3 +64,23 @@ cpdef double find_fastest_path_fermat(double n1,double n2,double z1,double h,dou
 
     result = _Roots3And4.real_nonnegative_root_less_than(a,b,c,d,e,h, eps)
     return result
+
+def find_fastest_path_fermat_many(double n1,double n2,double z1,h,z2,double eps):
+    """find_fastest_path_fermat() for arrays of h and z2
+
+    Returns an array of float64 with the shape of h.
+    """
+    cdef double[:] hv, z2v, resultv
+    cdef Py_ssize_t i
+
+    h = numpy.ascontiguousarray(h,dtype=numpy.float64)
+    shape = h.shape
+    hv = h.ravel()
+    z2v = numpy.ascontiguousarray(z2,dtype=numpy.float64).ravel()
+    assert z2v.shape[0]==hv.shape[0]
+    result = numpy.empty((hv.shape[0],),dtype=numpy.float64)
+    resultv = result
+
+    for i in range(hv.shape[0]):
+        resultv[i] = find_fastest_path_fermat(n1,n2,z1,hv[i],z2v[i],eps)
+    return result.reshape(shape)
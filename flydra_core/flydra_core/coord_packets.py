@@ -0,0 +1,103 @@
+"""encoding and decoding of the 2D point packets sent by the cameras
+
+A packet is a header (see common_variables.recv_pt_header_fmt)
+followed by n_pts points (see common_variables.recv_pt_fmt). The
+points are kept in arrays of recv_pt_dtype, which has the same memory
+layout as a packed point, so they are copied to and from the packet
+buffer in one step.
+"""
+from __future__ import absolute_import
+import struct
+
+import numpy as np
+
+from flydra_core.common_variables import recv_pt_fmt, recv_pt_header_fmt
+
+recv_pt_header_struct = struct.Struct(recv_pt_header_fmt)
+recv_pt_struct = struct.Struct(recv_pt_fmt)
+
+# see recv_pt_fmt
+recv_pt_dtype = np.dtype(
+    [
+        ("x_distorted", "<f8"),
+        ("y_distorted", "<f8"),
+        ("area", "<f8"),
+        ("slope", "<f8"),
+        ("eccentricity", "<f8"),
+        ("slope_found", "u1"),
+        ("cur_val", "u1"),
+        ("mean_val", "<f8"),
+        ("sumsqf_val", "<f8"),
+    ]
+)
+assert recv_pt_dtype.itemsize == recv_pt_struct.size
+
+
+class PointPacketEncoder:
+    """encode the points of one camera into a reused buffer
+
+    Parameters
+    ----------
+    cam_id : str
+      The camera sending the packets
+    max_num_points : int
+      The number of points for which the buffer is initially allocated
+    """
+
+    def __init__(self, cam_id, max_num_points=10):
+        self._cam_id = cam_id
+        self._alloc(max_num_points)
+
+    def _alloc(self, max_num_points):
+        self._max_num_points = max_num_points
+        self._buf = bytearray(
+            recv_pt_header_struct.size + max_num_points * recv_pt_struct.size
+        )
+        self._view = memoryview(self._buf)
+        self._points = np.frombuffer(
+            self._buf,
+            dtype=recv_pt_dtype,
+            count=max_num_points,
+            offset=recv_pt_header_struct.size,
+        )
+
+    def encode(
+        self, timestamp, cam_received_time, framenumber, points, n_frames_skipped
+    ):
+        """encode a packet, returning a view of the buffer
+
+        points is an array of recv_pt_dtype (or a sequence of tuples in
+        recv_pt_fmt order). The returned view is only valid until the
+        next call.
+        """
+        n_pts = len(points)
+        if n_pts > self._max_num_points:
+            self._alloc(max(n_pts, 2 * self._max_num_points))
+        recv_pt_header_struct.pack_into(
+            self._buf,
+            0,
+            self._cam_id,
+            timestamp,
+            cam_received_time,
+            framenumber,
+            n_pts,
+            n_frames_skipped,
+        )
+        if n_pts:
+            self._points[:n_pts] = points
+        return self._view[: recv_pt_header_struct.size + n_pts * recv_pt_struct.size]
+
+
+def decode_point_packet(buf):
+    """decode a packet into its header tuple and array of recv_pt_dtype
+
+    The points are a read-only view of buf.
+    """
+    header = recv_pt_header_struct.unpack_from(buf)
+    n_pts = header[4]
+    if len(buf) != recv_pt_header_struct.size + n_pts * recv_pt_struct.size:
+        raise ValueError("packet length does not match number of points")
+    points = np.frombuffer(
+        buf, dtype=recv_pt_dtype, count=n_pts, offset=recv_pt_header_struct.size
+    )
+    return header, points
@@ -0,0 +1,343 @@
+"""crash-safe, append-only journal of the 2D data
+
+Instead of writing data2d_distorted straight into the .h5 file, the
+MainBrain can append the 2D data to a journal, which is converted
+("compacted") to the data2d_distorted table once saving stops. A crash
+while saving may leave a broken .h5 file, but never loses the 2D data
+in the journal.
+
+A journal is a directory of segment files named data2d.NNNNNN.journal.
+Each segment starts with a header::
+
+  8 bytes   magic "FLY2DJNL"
+  uint32    format version
+  uint32    length of the JSON of the row dtype
+  ...       JSON of the row dtype (the fields of Info2D)
+
+followed by records::
+
+  uint32    length of the payload
+  uint32    CRC-32 of the payload
+  ...       payload: the rows as a packed array of the row dtype
+
+All integers are little-endian. A record which is incomplete or has
+the wrong checksum (e.g. the last one before a power loss) ends the
+segment on reading.
+"""
+from __future__ import absolute_import
+import glob
+import json
+import os
+import shutil
+import struct
+import threading
+import warnings
+import zlib
+
+import numpy as np
+import tables
+
+import flydra_core.data_descriptions
+
+MAGIC = b"FLY2DJNL"
+VERSION = 1
+SEGMENT_PATTERN = "data2d.%06d.journal"
+
+_SEGMENT_HEADER_FMT = "<8sII"
+_SEGMENT_HEADER_SIZE = struct.calcsize(_SEGMENT_HEADER_FMT)
+_RECORD_HEADER_FMT = "<II"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER_FMT)
+
+Info2D = flydra_core.data_descriptions.Info2D
+INFO2D_DTYPE = np.dtype(
+    tables.Description(Info2D().columns)._v_nested_descr
+).newbyteorder("<")
+
+
+def get_journal_dirname(h5filename):
+    """get the journal directory used when saving h5filename"""
+    return os.path.splitext(h5filename)[0] + ".data2d-journal"
+
+
+def list_segments(dirname):
+    """get the filenames of the segments of a journal, in order"""
+    return sorted(glob.glob(os.path.join(dirname, "data2d.*.journal")))
+
+
+def _dtype_to_json(dtype):
+    return json.dumps([[name, dtype.fields[name][0].str] for name in dtype.names])
+
+
+def _dtype_from_json(buf):
+    return np.dtype([(str(name), str(typestr)) for name, typestr in json.loads(buf)])
+
+
+def _crc32(buf):
+    return zlib.crc32(buf) & 0xFFFFFFFF
+
+
+class Data2dJournalWriter:
+    """append 2D data to a journal
+
+    Parameters
+    ----------
+    dirname : str
+      The directory of the journal, created if needed
+    segment_max_bytes : int
+      A new segment is started once a segment is this large
+    fsync : bool
+      Whether flush() waits until the data is on disk
+
+    append() and flush() behave like those of a PyTables table, so
+    the journal can replace the table of a BatchedTableWriter.
+    """
+
+    def __init__(self, dirname, segment_max_bytes=256 * 1024 * 1024, fsync=True):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.dirname = dirname
+        self.dtype = INFO2D_DTYPE
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        existing = list_segments(dirname)
+        if len(existing):
+            last = os.path.basename(existing[-1])
+            self._segment_number = int(last.split(".")[1]) + 1
+        else:
+            self._segment_number = 0
+        self._fd = None
+        self._segment_bytes = 0
+        self.n_rows = 0
+
+    def _open_segment(self):
+        filename = os.path.join(
+            self.dirname, SEGMENT_PATTERN % (self._segment_number,)
+        )
+        self._segment_number += 1
+        dtype_json = _dtype_to_json(self.dtype).encode("ascii")
+        self._fd = open(filename, mode="wb")
+        self._fd.write(
+            struct.pack(_SEGMENT_HEADER_FMT, MAGIC, VERSION, len(dtype_json))
+        )
+        self._fd.write(dtype_json)
+        self._segment_bytes = _SEGMENT_HEADER_SIZE + len(dtype_json)
+
+    def append(self, rows):
+        """append rows (a structured array or a sequence of tuples)"""
+        rows = np.asarray(rows, dtype=self.dtype)
+        if not len(rows):
+            return
+        if self._fd is None or self._segment_bytes >= self.segment_max_bytes:
+            self.close()
+            self._open_segment()
+        payload = rows.tobytes()
+        self._fd.write(struct.pack(_RECORD_HEADER_FMT, len(payload), _crc32(payload)))
+        self._fd.write(payload)
+        self._segment_bytes += _RECORD_HEADER_SIZE + len(payload)
+        self.n_rows += len(rows)
+
+    def flush(self):
+        if self._fd is None:
+            return
+        self._fd.flush()
+        if self.fsync:
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        if self._fd is None:
+            return
+        self.flush()
+        self._fd.close()
+        self._fd = None
+
+
+def _scan_segment(filename):
+    """check the records of a segment
+
+    Returns (dtype, records), where records is a list of (offset,
+    n_rows) of the payload of each valid record.
+    """
+    records = []
+    file_size = os.path.getsize(filename)
+    with open(filename, mode="rb") as fd:
+        buf = fd.read(_SEGMENT_HEADER_SIZE)
+        if len(buf) < _SEGMENT_HEADER_SIZE:
+            warnings.warn("%s: incomplete journal segment header, ignored" % filename)
+            return None, records
+        magic, version, dtype_len = struct.unpack(_SEGMENT_HEADER_FMT, buf)
+        if magic != MAGIC:
+            raise ValueError("%s is not a 2D data journal segment" % filename)
+        if version != VERSION:
+            raise ValueError(
+                "%s: unsupported journal format version %d" % (filename, version)
+            )
+        dtype_json = fd.read(dtype_len)
+        if len(dtype_json) < dtype_len:
+            warnings.warn("%s: incomplete journal segment header, ignored" % filename)
+            return None, records
+        dtype = _dtype_from_json(dtype_json.decode("ascii"))
+        offset = _SEGMENT_HEADER_SIZE + dtype_len
+        while True:
+            buf = fd.read(_RECORD_HEADER_SIZE)
+            if not len(buf):
+                break
+            if len(buf) == _RECORD_HEADER_SIZE:
+                payload_len, crc = struct.unpack(_RECORD_HEADER_FMT, buf)
+                if payload_len > file_size - offset - _RECORD_HEADER_SIZE:
+                    payload = b""  # torn, or a corrupt length
+                else:
+                    payload = fd.read(payload_len)
+                if (
+                    len(payload) == payload_len
+                    and payload_len % dtype.itemsize == 0
+                    and _crc32(payload) == crc
+                ):
+                    offset += _RECORD_HEADER_SIZE
+                    records.append((offset, payload_len // dtype.itemsize))
+                    offset += payload_len
+                    continue
+            # a torn or corrupt record
+            warnings.warn(
+                "%s: ignoring %d bytes after the last valid journal record"
+                % (filename, file_size - offset)
+            )
+            break
+    return dtype, records
+
+
+class Data2dJournalReader:
+    """read the 2D data of a journal like a data2d_distorted table
+
+    Only the rows of valid records are read. The records are checked
+    once when the journal is opened. The segments are memory mapped
+    and the records are viewed in place, so reading a field only
+    copies the values of that field.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.dtype = None
+        self._records = []  # (filename, offset, n_rows)
+        self._segment_maps = {}  # filename: memory map of the segment
+        for filename in list_segments(dirname):
+            dtype, records = _scan_segment(filename)
+            if dtype is None:
+                continue
+            if self.dtype is None:
+                self.dtype = dtype
+            elif dtype != self.dtype:
+                raise ValueError("%s: journal segments differ in dtype" % filename)
+            for offset, n_rows in records:
+                self._records.append((filename, offset, n_rows))
+        if self.dtype is None:
+            self.dtype = INFO2D_DTYPE
+        self.colnames = list(self.dtype.names)
+        n_rows = [record[2] for record in self._records]
+        self._record_stops = np.cumsum(n_rows, dtype=np.int64)
+        self.nrows = int(self._record_stops[-1]) if len(n_rows) else 0
+
+    def __len__(self):
+        return self.nrows
+
+    def iter_records(self):
+        """iterate over the rows of each record"""
+        for filename, offset, n_rows in self._records:
+            yield self._read_record(filename, offset, n_rows)
+
+    def _read_record(self, filename, offset, n_rows):
+        """get a read-only view of the rows of a record"""
+        segment_map = self._segment_maps.get(filename)
+        if segment_map is None:
+            segment_map = np.memmap(filename, dtype=np.uint8, mode="r")
+            self._segment_maps[filename] = segment_map
+        return np.frombuffer(segment_map, dtype=self.dtype, count=n_rows, offset=offset)
+
+    def read(self, start=None, stop=None, field=None):
+        """read rows start to stop, optionally of a single field"""
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        parts = []
+        if stop > start:
+            first = np.searchsorted(self._record_stops, start, side="right")
+            last = np.searchsorted(self._record_stops, stop - 1, side="right")
+            for i in range(first, last + 1):
+                filename, offset, n_rows = self._records[i]
+                record_start = int(self._record_stops[i]) - n_rows
+                rows = self._read_record(filename, offset, n_rows)
+                if field is not None:
+                    rows = rows[field]  # a strided view
+                parts.append(rows[max(start - record_start, 0) : stop - record_start])
+        if len(parts):
+            return np.concatenate(parts)
+        if field is not None:
+            return np.zeros((0,), dtype=self.dtype[field])
+        return np.zeros((0,), dtype=self.dtype)
+
+    def close(self):
+        """drop the memory maps of the segments"""
+        self._segment_maps = {}
+
+
+def compact_journal(dirname, h5filename, remove=False, rows_per_append=1000000):
+    """save the 2D data of a journal as the data2d_distorted table
+
+    Any existing data2d_distorted table of h5filename (e.g. from an
+    interrupted compaction) is replaced. If remove is True, the
+    journal is removed afterwards. Returns the number of rows saved.
+    """
+    reader = Data2dJournalReader(dirname)
+    with tables.open_file(h5filename, mode="a") as h5file:
+        root = h5file.root
+        if hasattr(root, "data2d_distorted"):
+            h5file.remove_node(root, "data2d_distorted")
+        table = h5file.create_table(
+            root,
+            "data2d_distorted",
+            Info2D,
+            "2d data",
+            expectedrows=max(reader.nrows, 1),
+            chunkshape=flydra_core.data_descriptions.TABLE_CHUNKSHAPES[
+                "data2d_distorted"
+            ],
+        )
+        staged = []
+        n_staged = 0
+        for rows in reader.iter_records():
+            staged.append(rows)
+            n_staged += len(rows)
+            if n_staged >= rows_per_append:
+                table.append(np.concatenate(staged))
+                staged = []
+                n_staged = 0
+        if len(staged):
+            table.append(np.concatenate(staged))
+        table.flush()
+        flydra_core.data_descriptions.create_table_indexes(h5file)
+    reader.close()
+    if remove:
+        shutil.rmtree(dirname)
+    return reader.nrows
+
+
+class JournalCompactor(threading.Thread):
+    """compact a journal in the background
+
+    The thread is not a daemon, so the process does not exit before
+    the compaction is done. PyTables must not be used by several
+    threads at once, so lock (if given) is held while compacting.
+    """
+
+    def __init__(self, dirname, h5filename, remove=True, lock=None):
+        threading.Thread.__init__(self, name="JournalCompactor")
+        self.dirname = dirname
+        self.h5filename = h5filename
+        self.remove = remove
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+        self.n_rows = None
+
+    def run(self):
+        with self.lock:
+            self.n_rows = compact_journal(
+                self.dirname, self.h5filename, remove=self.remove
+            )
@@ -82,3 +82,41 @@ class MovieInfo(PT.IsDescription):
 
 class ExperimentInfo(PT.IsDescription):
     uuid = PT.StringCol(32, pos=0)
+
+
+# Chunk shapes (in rows) of the large tables, which are read either
+# in long runs of frames or all rows of one obj_id. Each chunk is a
+# few hundred KB.
+TABLE_CHUNKSHAPES = {
+    "data2d_distorted": (4096,),
+    "kalman_estimates": (1024,),
+    "ML_estimates": (4096,),
+}
+
+# Columns of the large tables which get a completely sorted index.
+TABLE_INDEXED_COLUMNS = {
+    "data2d_distorted": ("frame", "camn"),
+    "kalman_estimates": ("obj_id", "frame"),
+    "ML_estimates": ("obj_id", "frame"),
+}
+
+
+def create_table_indexes(h5file):
+    """create completely sorted indexes on the large tables of h5file
+
+    This should be called once all rows are written, as building the
+    indexes at once is much faster than updating them on each append.
+    Existing indexes are left alone, and the uint64 columns of some
+    older files, which PyTables cannot index, are skipped.
+    """
+    for table_name, colnames in TABLE_INDEXED_COLUMNS.items():
+        if not hasattr(h5file.root, table_name):
+            continue
+        table = getattr(h5file.root, table_name)
+        for colname in colnames:
+            if table.coltypes[colname] == "uint64":
+                continue
+            col = table.colinstances[colname]
+            if col.index is None:
+                col.create_csindex()
+    h5file.flush()
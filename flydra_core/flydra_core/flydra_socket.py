@@ -1,6 +1,19 @@
 import socket
 import struct
 import math
+import errno
+import os
+import time
+import ctypes
+import ctypes.util
+
+import numpy as np
+
+from flydra_core.shm_ring import (
+    SharedMemoryRingReceiver,
+    SharedMemoryRingSender,
+    get_default_shm_dir,
+)
 
 # -----------------------------------------------------------------------
 
@@ -66,10 +79,320 @@ def get_dummy_sender():
     return DummySender()
 
 
+# -----------------------------------------------------------------------
+
+# Batched transport. Many datagrams are sent or received with one
+# system call (sendmmsg/recvmmsg on Linux, called with ctypes). Where
+# these are not available, a loop of send() or non-blocking recv()
+# calls is used instead.
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+_MSG_WAITFORONE = 0x10000
+
+
+def _get_libc_mmsg_functions():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+    recvmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_mmsghdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_mmsghdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_libc_recvmmsg, _libc_sendmmsg = _get_libc_mmsg_functions()
+
+
+def _make_mmsghdrs(bufs):
+    """make an array of mmsghdr with one iovec for each row of bufs"""
+    n_msgs, buf_size = bufs.shape
+    iovecs = (_iovec * n_msgs)()
+    msgs = (_mmsghdr * n_msgs)()
+    for i in range(n_msgs):
+        iovecs[i].iov_base = bufs.ctypes.data + i * buf_size
+        iovecs[i].iov_len = buf_size
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return iovecs, msgs
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+class FlydraBatchSender(FlydraTransportSender):
+    """send datagrams, coalescing them to send many per system call
+
+    Datagrams are copied into a preallocated buffer and sent when
+    max_batch_size of them are pending or when the oldest of them has
+    waited max_latency_seconds. As the latency is only checked on
+    calls to send() and flush_if_due(), the caller must call one of
+    them regularly (or flush()).
+
+    Each datagram is still delivered as one datagram.
+
+    Parameters
+    ----------
+    destination_addr : AddrInfoBase
+      The address to send to
+    max_batch_size : int
+      The maximum number of datagrams sent with one system call
+    max_latency_seconds : float
+      The maximum duration a datagram is held back
+    buf_size : int
+      The maximum size of a datagram
+    use_sendmmsg : bool, optional
+      Whether to use the sendmmsg() system call. By default, it is
+      used if available.
+    """
+
+    def __init__(
+        self,
+        destination_addr,
+        max_batch_size=16,
+        max_latency_seconds=0.001,
+        buf_size=max_datagram_size,
+        use_sendmmsg=None,
+    ):
+        FlydraTransportSender.__init__(self, destination_addr)
+        # connect, so that messages need no address
+        self._sockobj.connect(self._sockaddr)
+        if use_sendmmsg is None:
+            use_sendmmsg = _libc_sendmmsg is not None
+        elif use_sendmmsg and _libc_sendmmsg is None:
+            raise ValueError("sendmmsg() is not available")
+        self._max_batch_size = max_batch_size
+        self._max_latency_seconds = max_latency_seconds
+        self._bufs = np.empty((max_batch_size, buf_size), dtype=np.uint8)
+        self._lens = [0] * max_batch_size
+        self._n_pending = 0
+        self._first_pending_time = None
+        if use_sendmmsg:
+            self._iovecs, self._msgs = _make_mmsghdrs(self._bufs)
+        else:
+            self._msgs = None
+
+    def send(self, data):
+        n_bytes = len(data)
+        assert n_bytes <= self._bufs.shape[1]
+        i = self._n_pending
+        memoryview(self._bufs[i])[:n_bytes] = data
+        self._lens[i] = n_bytes
+        self._n_pending += 1
+        if i == 0:
+            self._first_pending_time = time.time()
+        if self._n_pending == self._max_batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """send the pending datagrams if the oldest has waited too long"""
+        if self._n_pending == 0:
+            return
+        if time.time() - self._first_pending_time >= self._max_latency_seconds:
+            self.flush()
+
+    def flush(self):
+        """send all pending datagrams"""
+        n_pending = self._n_pending
+        self._n_pending = 0
+        if self._msgs is None:
+            for i in range(n_pending):
+                self._sockobj.send(self._bufs[i, : self._lens[i]])
+            return
+        for i in range(n_pending):
+            self._iovecs[i].iov_len = self._lens[i]
+        n_sent = 0
+        while n_sent < n_pending:
+            n = _libc_sendmmsg(
+                self._sockobj.fileno(),
+                ctypes.byref(self._msgs[n_sent]),
+                n_pending - n_sent,
+                0,
+            )
+            if n < 0:
+                _raise_errno()
+            n_sent += n
+
+    def close(self):
+        self.flush()
+        self._sockobj.close()
+
+
+class FlydraBatchReceiver(FlydraTransportReceiver):
+    """receive many datagrams per system call
+
+    Datagrams are received into a preallocated buffer and returned
+    without copying.
+
+    Parameters
+    ----------
+    addr : AddrInfoBase
+      The address to listen at
+    socket_timeout_seconds : float, optional
+      The maximum duration to wait for the first datagram of a batch
+    max_batch_size : int
+      The maximum number of datagrams returned by recv_batch()
+    buf_size : int
+      The maximum size of a datagram
+    use_recvmmsg : bool, optional
+      Whether to use the recvmmsg() system call. By default, it is
+      used if available.
+    """
+
+    def __init__(
+        self,
+        addr,
+        socket_timeout_seconds=None,
+        max_batch_size=64,
+        buf_size=max_datagram_size,
+        use_recvmmsg=None,
+    ):
+        FlydraTransportReceiver.__init__(
+            self, addr, socket_timeout_seconds=socket_timeout_seconds
+        )
+        if use_recvmmsg is None:
+            use_recvmmsg = _libc_recvmmsg is not None
+        elif use_recvmmsg and _libc_recvmmsg is None:
+            raise ValueError("recvmmsg() is not available")
+        self._max_batch_size = max_batch_size
+        self._bufs = np.empty((max_batch_size, buf_size), dtype=np.uint8)
+        if use_recvmmsg:
+            self._iovecs, self._msgs = _make_mmsghdrs(self._bufs)
+        else:
+            self._msgs = None
+
+    def recv_batch(self):
+        """wait for a datagram and return it with all others already waiting
+
+        Returns a list of up to max_batch_size arrays of uint8. These
+        are views of the receive buffer and are only valid until the
+        next call.
+        """
+        if self._msgs is not None:
+            n = _libc_recvmmsg(
+                self._sockobj.fileno(),
+                self._msgs,
+                self._max_batch_size,
+                _MSG_WAITFORONE,
+                None,
+            )
+            if n < 0:
+                _raise_errno()
+            return [self._bufs[i, : self._msgs[i].msg_len] for i in range(n)]
+
+        batch = []
+        flags = 0  # block (up to the socket timeout) for the first datagram
+        while len(batch) < self._max_batch_size:
+            buf = self._bufs[len(batch)]
+            try:
+                n_bytes = self._sockobj.recv_into(buf, len(buf), flags)
+            except socket.error as err:
+                if batch and err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            batch.append(buf[:n_bytes])
+            flags = socket.MSG_DONTWAIT
+        return batch
+
+
+class SharedMemoryTransportReceiver:
+    """receive from senders on the same host through shared memory rings
+
+    Has the interface of FlydraBatchReceiver.
+    """
+
+    def __init__(self, addr, socket_timeout_seconds=None, max_batch_size=64):
+        assert addr.is_shared_memory()
+        self._addr = addr
+        self._max_batch_size = max_batch_size
+        self._receiver = SharedMemoryRingReceiver(
+            addr.dirname, timeout_seconds=socket_timeout_seconds
+        )
+
+    def get_listen_addrinfo(self):
+        return self._addr
+
+    def recv(self):
+        return self._receiver.recv()
+
+    def recv_batch(self):
+        return self._receiver.recv_batch(max_count=self._max_batch_size)
+
+    def get_n_lost(self):
+        """get the number of messages dropped by the senders"""
+        return self._receiver.n_lost
+
+    def close(self):
+        self._receiver.close()
+
+
+# -----------------------------------------------------------------------
+
+
+def make_sender(destination_addr):
+    """return a sender of datagrams for destination_addr"""
+    if destination_addr.is_shared_memory():
+        return SharedMemoryRingSender(destination_addr.dirname)
+    return FlydraTransportSender(destination_addr)
+
+
+def make_receiver(addr, socket_timeout_seconds=None):
+    """return a receiver of datagram batches listening at addr"""
+    if addr.is_shared_memory():
+        return SharedMemoryTransportReceiver(
+            addr, socket_timeout_seconds=socket_timeout_seconds
+        )
+    return FlydraBatchReceiver(addr, socket_timeout_seconds=socket_timeout_seconds)
+
+
 # --------------------------------------------------------
 
-# These classes represent addresses of either a unix domain socket or
-# an IP address.
+# These classes represent addresses of either a unix domain socket,
+# an IP address or a shared memory directory.
 
 
 class AddrInfoBase:
@@ -79,6 +402,9 @@ class AddrInfoBase:
     def is_ip_socket(self):
         return self.family in [socket.AF_INET, socket.AF_INET6]
 
+    def is_shared_memory(self):
+        return False
+
     def to_dict(self):
         """return dict to copy self when calling make_address(**result)"""
         raise NotImplementedError("derived class must override this method")
@@ -108,6 +434,33 @@ class AddrInfoUnixDomainSocket(AddrInfoBase):
         return True
 
 
+class AddrInfoSharedMemory(AddrInfoBase):
+    """the directory of a SharedMemoryRingReceiver
+
+    Only senders on the same host can use this address.
+    """
+
+    def __init__(self, shm_name):
+        self.shm_name = shm_name
+        self.dirname = os.path.join(get_default_shm_dir(), shm_name)
+        self.family = None
+
+    def is_shared_memory(self):
+        return True
+
+    def to_dict(self):
+        return {
+            "shm_name": self.shm_name,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, AddrInfoSharedMemory):
+            return False
+        if self.shm_name != other.shm_name:
+            return False
+        return True
+
+
 class AddrInfoIP(AddrInfoBase):
     def __init__(self, host, port):
         self.host = host
@@ -162,11 +515,17 @@ def does_host_require_DNS(host, port=None, family=0):
 
 
 def make_addrinfo(
-    host=None, port=None, filename=None,
+    host=None, port=None, filename=None, shm_name=None,
 ):
     """factory function to return and instance of AddrInfoBase"""
 
-    if filename is not None:
+    if shm_name is not None:
+        # shared memory rings
+        assert host is None
+        assert port is None
+        assert filename is None
+        return AddrInfoSharedMemory(shm_name=shm_name)
+    elif filename is not None:
         # unix domain socket
         assert host is None
         assert port is None
@@ -213,6 +572,105 @@ def test_flydra_unix_domain_sockets():
     assert addr_info2 == addr_info
 
 
+def test_flydra_batch_transport():
+    import tempfile
+    import shutil
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for addr in [
+            make_addrinfo(filename=os.path.join(tmpdir, "sock")),
+            make_addrinfo(host="127.0.0.1", port=0),
+        ]:
+            for use_mmsg in [False, True]:
+                if use_mmsg and _libc_recvmmsg is None:
+                    continue
+                yield check_batch_transport, addr, use_mmsg
+                if addr.is_unix_domain_socket():
+                    os.unlink(addr.sockaddr)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def check_batch_transport(addr, use_mmsg):
+    receiver = FlydraBatchReceiver(
+        addr, socket_timeout_seconds=0.1, max_batch_size=4, use_recvmmsg=use_mmsg
+    )
+    listen_addr = receiver.get_listen_addrinfo()
+    sender = FlydraBatchSender(
+        listen_addr, max_batch_size=3, max_latency_seconds=60.0, use_sendmmsg=use_mmsg
+    )
+    msgs = [("message %d" % i).encode("ascii") * (i + 1) for i in range(7)]
+    for msg in msgs:
+        sender.send(memoryview(bytearray(msg)))
+    # The last datagram is still held back.
+    sender.flush()
+
+    received = []
+    while len(received) < len(msgs):
+        batch = receiver.recv_batch()
+        assert 1 <= len(batch) <= 4
+        received.extend(buf.tobytes() for buf in batch)
+    assert received == msgs
+
+    # Nothing more is waiting.
+    try:
+        receiver.recv_batch()
+    except socket.error as err:
+        assert err.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+    else:
+        raise AssertionError("expected timeout")
+    sender.close()
+
+
+def test_flydra_shared_memory_transport():
+    addr = make_addrinfo(shm_name="test_flydra_socket.%d" % os.getpid())
+    addr2 = make_addrinfo(**addr.to_dict())
+    assert addr2 == addr
+
+    receiver = make_receiver(addr, socket_timeout_seconds=0.1)
+    try:
+        assert receiver.get_listen_addrinfo() == addr
+        senders = [make_sender(addr) for i in range(2)]
+        for i in range(600):
+            senders[i % 2].send(("message %d" % i).encode("ascii"))
+
+        # each ring holds 256 messages, so some were dropped
+        received = []
+        while 1:
+            try:
+                batch = receiver.recv_batch()
+            except socket.error as err:
+                assert err.errno == errno.EAGAIN
+                break
+            received.extend(buf.tobytes() for buf in batch)
+        assert len(received) == 512
+        assert [sender.n_dropped for sender in senders] == [44, 44]
+
+        # there is room again, and the messages of one sender keep
+        # their order
+        for i in range(3):
+            senders[0].send(memoryview(bytearray(("again %d" % i).encode("ascii"))))
+        assert [receiver.recv() for i in range(3)] == [
+            b"again 0",
+            b"again 1",
+            b"again 2",
+        ]
+        # the loss is detected once a later message arrives
+        assert receiver.get_n_lost() == 44
+        for sender in senders:
+            sender.close()
+        try:
+            receiver.recv_batch()
+        except socket.error as err:
+            assert err.errno == errno.EAGAIN
+        # closed rings are removed once read
+        assert os.listdir(addr.dirname) == ["wakeup"]
+    finally:
+        receiver.close()
+    assert not os.path.exists(addr.dirname)
+
+
 if __name__ == "__main__":
     test_flydra_unix_domain_sockets()
     test_flydra_ip_sockets()
@@ -0,0 +1,135 @@
+"""collect the 2D data of all cameras for each frame
+
+The data of a frame is kept in the slot framenumber % capacity of a
+ring, so finding, completing and discarding frames takes constant
+time and nothing is allocated per frame. Which cameras have sent
+data for a frame is kept as a bitmask of camera indexes.
+
+A frame which is still incomplete when its slot is needed for a newer
+frame is evicted. A complete frame which was not released yet, because
+it was never processed, is overwritten. Data arriving for a frame older
+than the one in its slot is dropped.
+"""
+from __future__ import absolute_import
+import numpy as np
+
+
+class FrameAssembler:
+    """a ring of the frames for which 2D data is being collected
+
+    Parameters
+    ----------
+    n_cams : int
+      The number of cameras, which are given by index 0..n_cams-1
+    capacity : int
+      The number of frames kept
+    """
+
+    def __init__(self, n_cams, capacity=128):
+        self.capacity = capacity
+        self.n_evicted = 0
+        self.n_overwritten = 0
+        self.n_dropped = 0
+        self.last_evicted = None
+        self.reset(n_cams)
+
+    def reset(self, n_cams=None):
+        """discard all frames, optionally changing the number of cameras"""
+        if n_cams is not None:
+            self.n_cams = n_cams
+            self.all_arrived_mask = (1 << n_cams) - 1
+            self._trigger_timestamps = np.empty((self.capacity, n_cams))
+            self._pluecker_coords = [[None] * n_cams for i in range(self.capacity)]
+        self._framenumbers = [None] * self.capacity
+        self._arrived_masks = [0] * self.capacity
+        self._oldest_timestamps = [None] * self.capacity
+        self._n_with_points = [0] * self.capacity
+
+    def add(
+        self,
+        framenumber,
+        cam_idx,
+        trigger_timestamp,
+        n_pts=0,
+        camn=None,
+        pluecker_coords=None,
+    ):
+        """add the data of one camera for a frame
+
+        pluecker_coords is the list of (pt_undistorted, pluecker line)
+        of the points with a valid ray, which is only kept if not empty.
+
+        Returns the slot of the frame, or None if the data was dropped
+        because the frame is too old. If the slot held an incomplete
+        older frame, it is evicted and returned as (framenumber,
+        arrived_mask) in self.last_evicted. If it held a complete older
+        frame, that frame is counted in self.n_overwritten.
+        """
+        slot = framenumber % self.capacity
+        slot_framenumber = self._framenumbers[slot]
+        self.last_evicted = None
+        if slot_framenumber != framenumber:
+            if slot_framenumber is not None:
+                if slot_framenumber > framenumber:
+                    self.n_dropped += 1
+                    return None
+                if not self.is_complete(slot):
+                    self.n_evicted += 1
+                    self.last_evicted = (slot_framenumber, self._arrived_masks[slot])
+                else:
+                    self.n_overwritten += 1
+                self.release(slot)
+            self._framenumbers[slot] = framenumber
+            self._oldest_timestamps[slot] = trigger_timestamp
+        else:
+            oldest = self._oldest_timestamps[slot]
+            if oldest is None:
+                # this may also be None, but eventually won't be
+                self._oldest_timestamps[slot] = trigger_timestamp
+            elif trigger_timestamp is not None:
+                self._oldest_timestamps[slot] = min(trigger_timestamp, oldest)
+
+        self._arrived_masks[slot] |= 1 << cam_idx
+        self._trigger_timestamps[slot, cam_idx] = (
+            np.nan if trigger_timestamp is None else trigger_timestamp
+        )
+        if n_pts:
+            self._n_with_points[slot] += 1
+        if pluecker_coords:
+            self._pluecker_coords[slot][cam_idx] = (camn, pluecker_coords)
+        return slot
+
+    def get_framenumber(self, slot):
+        return self._framenumbers[slot]
+
+    def is_complete(self, slot):
+        """whether all cameras have sent data for the frame"""
+        return self._arrived_masks[slot] == self.all_arrived_mask
+
+    def get_missing_cam_idxs(self, arrived_mask):
+        return [i for i in range(self.n_cams) if not (arrived_mask >> i) & 1]
+
+    def get_oldest_timestamp(self, slot):
+        """get the oldest trigger timestamp and number of cameras with points"""
+        return self._oldest_timestamps[slot], self._n_with_points[slot]
+
+    def get_trigger_timestamps(self, slot):
+        """get the trigger timestamps of the cameras which sent data"""
+        arrived = [
+            i for i in range(self.n_cams) if (self._arrived_masks[slot] >> i) & 1
+        ]
+        return self._trigger_timestamps[slot, arrived]
+
+    def get_pluecker_coords_by_camn(self, slot):
+        """get a dict of the pluecker_coords by camn, as used by the tracker"""
+        return dict(item for item in self._pluecker_coords[slot] if item is not None)
+
+    def release(self, slot):
+        """discard a frame, making its slot available"""
+        self._framenumbers[slot] = None
+        self._arrived_masks[slot] = 0
+        self._oldest_timestamps[slot] = None
+        self._n_with_points[slot] = 0
+        pluecker_coords = self._pluecker_coords[slot]
+        for i in range(self.n_cams):
+            pluecker_coords[i] = None
@@ -0,0 +1,80 @@
+"""decide how much work each completed frame gets in realtime tracking
+
+Completed frames are always processed in order, but when tracking
+falls behind, only the newest frame gets the full work (tracking,
+hypothesis testing for new objects and publishing). Older frames
+within the latency bound only update the tracked objects. Frames
+beyond the latency bound are skipped, so the tracked objects predict
+over them without data association when the next frame is tracked.
+
+As a tracked object is killed when it has no data for more than
+max_frames_skipped frames, no more than max_consecutive_skipped
+frames in a row are skipped.
+"""
+from __future__ import absolute_import
+import time
+
+FULL = "full"
+TRACK_ONLY = "track_only"
+PREDICT_ONLY = "predict_only"
+FRAME_MODES = (FULL, TRACK_ONLY, PREDICT_ONLY)
+
+
+class FrameScheduler:
+    """schedule completed frames with a bound on their latency
+
+    Parameters
+    ----------
+    max_latency_sec : float
+      Frames whose oldest camera timestamp is older are skipped
+    max_consecutive_skipped : int, optional
+      The maximum number of frames skipped in a row, unlimited if None
+    """
+
+    def __init__(self, max_latency_sec, max_consecutive_skipped=None):
+        self.max_latency_sec = max_latency_sec
+        self.max_consecutive_skipped = max_consecutive_skipped
+        self.n_frames = dict((mode, 0) for mode in FRAME_MODES)
+        self.max_backlog = 0
+        self._n_consecutive_skipped = 0
+
+    def schedule(self, frames, now=None):
+        """schedule a list of (framenumber, oldest_timestamp, item)
+
+        Returns a list of (mode, item), in order of framenumber. A
+        frame without oldest_timestamp has no latency estimate and is
+        skipped.
+        """
+        if now is None:
+            now = time.time()
+        frames = sorted(frames, key=lambda frame: frame[0])
+        self.max_backlog = max(self.max_backlog, len(frames))
+        result = []
+        for i, (framenumber, oldest_timestamp, item) in enumerate(frames):
+            if oldest_timestamp is None:
+                mode = PREDICT_ONLY
+            elif now - oldest_timestamp > self.max_latency_sec:
+                if (
+                    self.max_consecutive_skipped is not None
+                    and self._n_consecutive_skipped >= self.max_consecutive_skipped
+                ):
+                    # keep the tracked objects alive
+                    mode = TRACK_ONLY
+                else:
+                    mode = PREDICT_ONLY
+            elif i == len(frames) - 1:
+                mode = FULL
+            else:
+                mode = TRACK_ONLY
+
+            if mode == PREDICT_ONLY:
+                self._n_consecutive_skipped += 1
+            else:
+                self._n_consecutive_skipped = 0
+            self.n_frames[mode] += 1
+            result.append((mode, item))
+        return result
+
+    def get_n_degraded(self):
+        """get the number of frames which did not get the full work"""
+        return self.n_frames[TRACK_ONLY] + self.n_frames[PREDICT_ONLY]
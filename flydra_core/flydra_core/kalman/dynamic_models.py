@@ -313,6 +313,43 @@ def create_dynamic_model_dict(dt=None, disable_warning=False):
     return dynamic_models
 
 
+_multistep_cache = {}
+
+
+def get_multistep_matrices(kalman_model):
+    """get the matrices to step a Kalman model several times at once
+
+    Returns the arrays A_powers and Q_accumulated of shape (N+1,ss,ss),
+    where N is one more than max_frames_skipped. Stepping the Kalman
+    filter k times without observations maps the estimate (xhat, P)
+    to (A_powers[k] xhat, A_powers[k] P A_powers[k].T +
+    Q_accumulated[k]), with A_powers[k] = A**k and Q_accumulated[k] the
+    sum of A**i Q (A**i).T for i < k.
+
+    The arrays are not stored in kalman_model, which is saved with the
+    data, but cached here.
+    """
+    A = numpy.asarray(kalman_model["A"], dtype=numpy.float64)
+    Q = numpy.asarray(kalman_model["Q"], dtype=numpy.float64)
+    n_steps = kalman_model["max_frames_skipped"] + 1
+    key = (A.tostring(), Q.tostring(), A.shape, n_steps)
+    result = _multistep_cache.get(key, None)
+    if result is None:
+        ss = A.shape[0]
+        A_powers = numpy.empty((n_steps + 1, ss, ss))
+        Q_accumulated = numpy.empty((n_steps + 1, ss, ss))
+        A_powers[0] = numpy.eye(ss)
+        Q_accumulated[0] = 0.0
+        for k in range(1, n_steps + 1):
+            A_powers[k] = numpy.dot(A, A_powers[k - 1])
+            Q_accumulated[k] = numpy.dot(numpy.dot(A, Q_accumulated[k - 1]), A.T) + Q
+        A_powers.setflags(write=False)
+        Q_accumulated.setflags(write=False)
+        result = A_powers, Q_accumulated
+        _multistep_cache[key] = result
+    return result
+
+
 class EKFAllParams(dict):
     """abstract base class hold all parameters for data association and EK filtering"""
 
@@ -207,7 +207,7 @@ class FilteredObservations(
     x = PT.Float32Col(pos=2)
     y = PT.Float32Col(pos=3)
     z = PT.Float32Col(pos=4)
-    obs_2d_idx = PT.UInt64Col(pos=5)  # index into VLArray 'ML_estimates_2d_idxs'
+    obs_2d_idx = PT.UInt64Col(pos=5)  # row of MLEstimates2dIdxs
     hz_line0 = PT.Float32Col(pos=6)
     hz_line1 = PT.Float32Col(pos=7)
     hz_line2 = PT.Float32Col(pos=8)
@@ -217,6 +217,158 @@ class FilteredObservations(
 
 
 ML_estimates_2d_idxs_type = PT.UInt16Atom
+ML_estimates_2d_idxs_offsets_type = PT.UInt64Atom
+
+# The camns and idxs of the 2D data used for each ML estimate are saved
+# in compressed sparse row layout: row obs_2d_idx of ML_estimates is
+# ML_estimates_2d_idxs_data[offsets[obs_2d_idx]:offsets[obs_2d_idx+1]],
+# with offsets = ML_estimates_2d_idxs_offsets. Older files have one
+# VLArray 'ML_estimates_2d_idxs' (or 'kalman_observations_2d_idxs').
+ML_ESTIMATES_2D_IDXS_DATA = "ML_estimates_2d_idxs_data"
+ML_ESTIMATES_2D_IDXS_OFFSETS = "ML_estimates_2d_idxs_offsets"
+ML_ESTIMATES_2D_IDXS_VLARRAY_NAMES = (
+    "ML_estimates_2d_idxs",
+    "kalman_observations_2d_idxs",
+)
+
+
+class MLEstimates2dIdxs(object):
+    """the camns and idxs of the 2D data used for each ML estimate
+
+    Indexing with obs_2d_idx returns the camns and idxs interleaved
+    (camn0, idx0, camn1, idx1, ...) as a view into data, which may be
+    an array in memory or a PyTables node.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, obs_2d_idx):
+        obs_2d_idx = int(obs_2d_idx)
+        if obs_2d_idx < 0:
+            obs_2d_idx += len(self)
+        if not 0 <= obs_2d_idx < len(self):
+            raise IndexError("obs_2d_idx out of range")
+        start, stop = self.offsets[obs_2d_idx : obs_2d_idx + 2]
+        return self.data[int(start) : int(stop)]
+
+    def __iter__(self):
+        for obs_2d_idx in range(len(self)):
+            yield self[obs_2d_idx]
+
+    def get_range(self, start, stop):
+        """get the rows start to stop (exclusive) at once
+
+        Returns (data, offsets) with data holding the rows back to back
+        and row i being data[offsets[i-start]:offsets[i-start+1]].
+        """
+        offsets = np.asarray(self.offsets[start : stop + 1], dtype=np.uint64)
+        data = self.data[int(offsets[0]) : int(offsets[-1])]
+        return data, offsets - offsets[0]
+
+
+class MLEstimates2dIdxsWriter(object):
+    """append the camns and idxs of ML estimates to a file"""
+
+    def __init__(self, h5file, where=None, filters=None):
+        if where is None:
+            where = h5file.root
+        self.data = h5file.create_earray(
+            where,
+            ML_ESTIMATES_2D_IDXS_DATA,
+            ML_estimates_2d_idxs_type(),
+            (0,),
+            "camns and idxs",
+            filters=filters,
+        )
+        self.offsets = h5file.create_earray(
+            where,
+            ML_ESTIMATES_2D_IDXS_OFFSETS,
+            ML_estimates_2d_idxs_offsets_type(),
+            (0,),
+            "offsets of the camns and idxs of each ML estimate",
+            filters=filters,
+        )
+        self.offsets.append(np.zeros((1,), dtype=np.uint64))
+        self.nrows = 0
+        self.nvalues = 0
+
+    def append(self, values, ends):
+        """append rows given back to back in values
+
+        ends holds the end offset of each row within values. Returns
+        the obs_2d_idx of the appended rows.
+        """
+        values = np.asarray(values, dtype=np.uint16)
+        ends = np.asarray(ends, dtype=np.uint64)
+        obs_2d_idxs = np.arange(self.nrows, self.nrows + len(ends), dtype=np.uint64)
+        if len(values):
+            self.data.append(values)
+        if len(ends):
+            self.offsets.append(ends + np.uint64(self.nvalues))
+        self.nrows += len(ends)
+        self.nvalues += len(values)
+        return obs_2d_idxs
+
+    def append_rows(self, rows):
+        """append a sequence of rows, returns their obs_2d_idx"""
+        rows = [np.asarray(row, dtype=np.uint16) for row in rows]
+        ends = np.cumsum([len(row) for row in rows], dtype=np.uint64)
+        if len(rows):
+            values = np.concatenate(rows)
+        else:
+            values = np.zeros((0,), dtype=np.uint16)
+        return self.append(values, ends)
+
+    def flush(self):
+        self.data.flush()
+        self.offsets.flush()
+
+
+def read_ML_estimates_2d_idxs(where, load=True):
+    """get the camns and idxs of ML estimates saved in the group where
+
+    With load True, everything is read into memory at once. Otherwise
+    rows are read from the file as they are accessed. Files saved with
+    the older VLArray layout are converted on load.
+    """
+    if hasattr(where, ML_ESTIMATES_2D_IDXS_OFFSETS):
+        data = getattr(where, ML_ESTIMATES_2D_IDXS_DATA)
+        offsets = getattr(where, ML_ESTIMATES_2D_IDXS_OFFSETS)
+        if load:
+            data = data[:]
+            offsets = offsets[:]
+        return MLEstimates2dIdxs(data, offsets)
+    for name in ML_ESTIMATES_2D_IDXS_VLARRAY_NAMES:
+        if hasattr(where, name):
+            vlarray = getattr(where, name)
+            break
+    else:
+        raise PT.NoSuchNodeError(
+            "no %r or %r node" % (ML_ESTIMATES_2D_IDXS_OFFSETS, "ML_estimates_2d_idxs")
+        )
+    if not load:
+        return vlarray
+    rows = vlarray[:]
+    offsets = np.zeros((len(rows) + 1,), dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(row) for row in rows])
+    if len(rows):
+        data = np.concatenate(rows).astype(np.uint16)
+    else:
+        data = np.zeros((0,), dtype=np.uint16)
+    return MLEstimates2dIdxs(data, offsets)
+
+
+def is_ML_estimates_2d_idxs_node(name):
+    """True if name is a node holding camns and idxs of ML estimates"""
+    return name in (
+        (ML_ESTIMATES_2D_IDXS_DATA, ML_ESTIMATES_2D_IDXS_OFFSETS)
+        + ML_ESTIMATES_2D_IDXS_VLARRAY_NAMES
+    )
 
 
 def convert_format(current_data, camn2cam_id, area_threshold=0.0, only_likely=False):
@@ -1,10 +1,44 @@
 from __future__ import print_function
 import flydra_core.data_descriptions as data_descriptions
 import collections
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
-from flydra_core._flydra_tracked_object import TrackedObject
+from flydra_core._flydra_tracked_object import TrackedObject, CandidateGrid
+from flydra_core.kalman.tracker_pool import TrackedObjectPool
 
-__all__ = ["TrackedObject", "Tracker"]
+__all__ = ["TrackedObject", "Tracker", "ASSOCIATION_MODES"]
+
+# 'greedy': earlier objects take their best points first, conflicts
+#           are resolved by rewinding the worse object.
+# 'hungarian': per camera, points are assigned to objects by minimum
+#           total cost.
+ASSOCIATION_MODES = ("greedy", "hungarian")
+
+
+def _assign_by_min_cost(cost):
+    """assign points to objects by minimum total cost
+
+    cost is an (n_objects, n_points) array, inf where an object may not
+    use a point. As many points as possible are assigned, each to at
+    most one object. Returns a list of (object index, point index).
+    """
+    allowed = np.isfinite(cost)
+    obj_idxs = np.nonzero(np.any(allowed, axis=1))[0]
+    if not len(obj_idxs):
+        return []
+    cost = cost[obj_idxs]
+    allowed = allowed[obj_idxs]
+    # Disallowed pairs cost more than any set of allowed pairs,
+    # so that as many points as possible are assigned.
+    disallowed_cost = 1.0 + 2 * np.sum(np.abs(cost[allowed]))
+    cost[~allowed] = disallowed_cost
+    rows, cols = linear_sum_assignment(cost)
+    return [
+        (int(obj_idxs[row]), int(col))
+        for row, col in zip(rows, cols)
+        if allowed[row, col]
+    ]
 
 
 class Tracker:
@@ -27,6 +61,8 @@ class Tracker:
         disable_image_stat_gating=False,
         orientation_consensus=0,
         fake_timestamp=None,
+        association_mode="greedy",
+        n_workers=0,
     ):
         """
 
@@ -35,8 +71,16 @@ class Tracker:
         reconstructor - reconstructor instance
         kalman_model - dictionary of Kalman filter parameters
         area_threshold - minimum area to consider for tracking use
+        association_mode - one of ASSOCIATION_MODES
+        n_workers - if > 0, hold the tracked objects in this many worker
+                    processes and update them in parallel
 
         """
+        if association_mode not in ASSOCIATION_MODES:
+            raise ValueError("unknown association mode: %r" % (association_mode,))
+        if n_workers > 0 and association_mode != "greedy":
+            raise ValueError("worker processes require greedy association")
+        self.association_mode = association_mode
         self.area_threshold = area_threshold
         self.area_threshold_for_orientation = area_threshold_for_orientation
         self.save_all_data = save_all_data
@@ -54,12 +98,46 @@ class Tracker:
             raise ValueError("must specify kalman_model")
         self.kalman_model = kalman_model
 
+        self.tracked_object_pool = None
+        if n_workers > 0:
+            self.tracked_object_pool = TrackedObjectPool(
+                reconstructor, n_workers, self._get_tracked_object_kwargs()
+            )
+
+    def _get_tracked_object_kwargs(self):
+        return dict(
+            kalman_model=self.kalman_model,
+            save_all_data=self.save_all_data,
+            area_threshold=self.area_threshold,
+            area_threshold_for_orientation=self.area_threshold_for_orientation,
+            disable_image_stat_gating=self.disable_image_stat_gating,
+            orientation_consensus=self.orientation_consensus,
+            fake_timestamp=self.fake_timestamp,
+        )
+
+    def close(self):
+        """stop the worker processes, if any"""
+        if self.tracked_object_pool is not None:
+            self.tracked_object_pool.close()
+            self.tracked_object_pool = None
+
     def how_many_are_living(self):
         # XXX should we check .kill_me attribute on them?
         return len(self.live_tracked_objects)
 
+    def _call_live(self, method_name, *args, **kwargs):
+        """call a method on all live tracked objects, return the results"""
+        if self.tracked_object_pool is not None:
+            return self.tracked_object_pool.call(
+                self.live_tracked_objects, method_name, *args, **kwargs
+            )
+        return [
+            getattr(tro, method_name)(*args, **kwargs)
+            for tro in self.live_tracked_objects
+        ]
+
     def get_most_recent_data(self):
-        results = [tro.get_most_recent_data() for tro in self.live_tracked_objects]
+        results = self._call_live("get_most_recent_data")
         return results
 
     def debug_info(level):
@@ -79,7 +157,7 @@ class Tracker:
         min_dist_to_believe_new_nsigma = self.kalman_model[
             "min_dist_to_believe_new_sigma"
         ]
-        results = [tro.get_distance_and_nsigma(X) for tro in self.live_tracked_objects]
+        results = self._call_live("get_distance_and_nsigma", X)
         for (dist_meters, dist_nsigma) in results:
             if debug > 5:
                 print("distance in meters, nsigma:", dist_meters, dist_nsigma)
@@ -123,14 +201,49 @@ class Tracker:
         all_to_gobble = []
         best_by_hash = {}
         to_rewind = []
-        # I could parallelize this========================================
-        # this is map:
-        results = [
-            tro.calculate_a_posteriori_estimate(
-                frame, data_dict, camn2cam_id, debug1=debug2
+
+        # Bin the 2D points once for all objects, so that each object
+        # only considers the points near its predicted image location.
+        candidate_grid = None
+        pixel_dist_accept = self.kalman_model.get(
+            "distorted_pixel_euclidian_distance_accept", None
+        )
+        if (
+            pixel_dist_accept is not None
+            and len(self.live_tracked_objects)
+            and self.tracked_object_pool is None
+        ):
+            candidate_grid = CandidateGrid(
+                self.reconstructor, data_dict, camn2cam_id, pixel_dist_accept
             )
-            for tro in self.live_tracked_objects
-        ]
+
+        if self.association_mode == "hungarian":
+            results = self._calculate_a_posteriori_estimates_by_assignment(
+                frame, data_dict, camn2cam_id, candidate_grid, debug2=debug2
+            )
+        elif self.tracked_object_pool is not None:
+            # this is map, run in the worker processes, which build
+            # their own candidate grids:
+            results = self.tracked_object_pool.calculate_a_posteriori_estimates(
+                self.live_tracked_objects,
+                frame,
+                data_dict,
+                camn2cam_id,
+                grid_cell_size=pixel_dist_accept,
+                debug=debug2,
+            )
+        else:
+            # this is map:
+            results = [
+                tro.calculate_a_posteriori_estimate(
+                    frame,
+                    data_dict,
+                    camn2cam_id,
+                    debug1=debug2,
+                    candidate_grid=candidate_grid,
+                )
+                for tro in self.live_tracked_objects
+            ]
 
         # this is reduce:
         all_close_camn_pt_idxs = []
@@ -201,11 +314,88 @@ class Tracker:
         kill_idxs.sort()
         kill_idxs.reverse()
         newly_dead = [self.live_tracked_objects.pop(i) for i in kill_idxs]
-        _ = [tro.kill() for tro in newly_dead]
-        self.dead_tracked_objects.extend(newly_dead)
+        self.dead_tracked_objects.extend(self._kill_tracked_objects(newly_dead))
         self._flush_dead_queue()
         return data_dict
 
+    def _calculate_a_posteriori_estimates_by_assignment(
+        self, frame, data_dict, camn2cam_id, candidate_grid, debug2=0
+    ):
+        """update all live objects using a global data association
+
+        For each camera, the cost of assigning each 2D point to each
+        object is its negative log likelihood as computed by
+        TrackedObject.gate_data(). The points are assigned by solving
+        the linear assignment problem, so that no point is used by
+        more than one object, and each object is then updated exactly
+        once. Returns results in the form of
+        TrackedObject.calculate_a_posteriori_estimate().
+        """
+        live = self.live_tracked_objects
+        priors = [
+            tro.calculate_a_priori_estimate(frame, debug1=debug2) for tro in live
+        ]
+
+        gated_by_obj = []
+        close_by_obj = []
+        for tro, prior in zip(live, priors):
+            if prior is None:
+                gated_by_obj.append({})
+                close_by_obj.append([])
+                continue
+            xhatminus, Pminus = prior
+            gated_by_camn, close_camn_pt_idxs = tro.gate_data(
+                xhatminus,
+                Pminus,
+                data_dict,
+                camn2cam_id,
+                debug=debug2,
+                candidate_grid=candidate_grid,
+            )
+            gated_by_obj.append(dict(gated_by_camn))
+            close_by_obj.append(close_camn_pt_idxs)
+
+        chosen_by_obj = [[] for tro in live]
+        for camn, candidate_point_list in data_dict.iteritems():
+            cost = np.empty((len(live), len(candidate_point_list)))
+            cost.fill(np.inf)
+            for obj_idx, gated_by_camn in enumerate(gated_by_obj):
+                for idx, nll in gated_by_camn.get(camn, []):
+                    cost[obj_idx, idx] = nll
+            for obj_idx, idx in _assign_by_min_cost(cost):
+                chosen_by_obj[obj_idx].append((camn, idx))
+
+        results = []
+        for tro, prior, chosen, close_camn_pt_idxs in zip(
+            live, priors, chosen_by_obj, close_by_obj
+        ):
+            if prior is None:
+                results.append(([], None, np.inf, []))
+                continue
+            xhatminus, Pminus = prior
+            (
+                position_MLE,
+                Lcoords,
+                used_camns_and_idxs,
+                cam_ids_and_points2d,
+            ) = tro.make_observation(chosen, data_dict, camn2cam_id, debug=debug2)
+            (
+                used_camns_and_idxs,
+                obs2d_hash,
+                Pmean,
+            ) = tro.calculate_a_posteriori_from_observation(
+                frame,
+                xhatminus,
+                Pminus,
+                position_MLE,
+                Lcoords,
+                used_camns_and_idxs,
+                cam_ids_and_points2d,
+                debug1=debug2,
+            )
+            results.append((used_camns_and_idxs, obs2d_hash, Pmean, close_camn_pt_idxs))
+        return results
+
     def join_new_obj(
         self,
         frame,
@@ -218,28 +408,32 @@ class Tracker:
         obj_id = self.cur_obj_id
         self.cur_obj_id += 1
 
-        tro = TrackedObject(
-            self.reconstructor,
-            obj_id,
+        args = (
             frame,
             first_observation_orig_units,
             first_observation_Lcoords_orig_units,
             first_observation_camns,
             first_observation_idxs,
-            kalman_model=self.kalman_model,
-            save_all_data=self.save_all_data,
-            area_threshold=self.area_threshold,
-            area_threshold_for_orientation=self.area_threshold_for_orientation,
-            disable_image_stat_gating=self.disable_image_stat_gating,
-            orientation_consensus=self.orientation_consensus,
-            fake_timestamp=self.fake_timestamp,
         )
+        if self.tracked_object_pool is not None:
+            tro = self.tracked_object_pool.join(obj_id, *args)
+        else:
+            tro = TrackedObject(
+                self.reconstructor, obj_id, *args, **self._get_tracked_object_kwargs()
+            )
         self.live_tracked_objects.append(tro)
 
+    def _kill_tracked_objects(self, tros):
+        """kill tros, return the objects to pass to killed tracker callbacks"""
+        if self.tracked_object_pool is not None:
+            return self.tracked_object_pool.kill(tros)
+        _ = [tro.kill() for tro in tros]
+        return tros
+
     def kill_all_trackers(self):
-        _ = [tro.kill() for tro in self.live_tracked_objects]
-        while len(self.live_tracked_objects):
-            self.dead_tracked_objects.append(self.live_tracked_objects.pop())
+        newly_dead = self.live_tracked_objects[::-1]
+        self.live_tracked_objects = []
+        self.dead_tracked_objects.extend(self._kill_tracked_objects(newly_dead))
         self._flush_dead_queue()
 
     def set_killed_tracker_callback(self, callback):
@@ -0,0 +1,246 @@
+"""hold tracked objects in worker processes
+
+The Tracker can keep its TrackedObject instances in a pool of
+persistent worker processes rather than in its own process. The Kalman
+state never leaves the workers while an object is alive: each frame,
+only the candidate 2D data are sent to the workers and only the small
+result tuples of TrackedObject.calculate_a_posteriori_estimate() are
+sent back. Once an object is killed, its history is returned as a
+KilledTrackedObject.
+
+The workers are started with fork, so the Reconstructor (which need
+not be picklable) is inherited rather than sent.
+"""
+from __future__ import print_function
+import multiprocessing
+import sys
+import traceback
+
+from flydra_core._flydra_tracked_object import TrackedObject, CandidateGrid
+
+__all__ = ["TrackedObjectPool", "TrackedObjectProxy", "KilledTrackedObject"]
+
+
+class KilledTrackedObject:
+    """the saved history of a killed TrackedObject
+
+    This has the attributes of TrackedObject needed to save its data.
+    """
+
+    _attrs = (
+        "obj_id",
+        "current_frameno",
+        "frames",
+        "xhats",
+        "Ps",
+        "timestamps",
+        "observations_frames",
+        "MLE_position",
+        "observations_2d",
+        "MLE_Lcoords",
+    )
+
+    def __init__(self, tro):
+        for name in self._attrs:
+            setattr(self, name, getattr(tro, name))
+
+
+class TrackedObjectProxy:
+    """stand-in for a TrackedObject held by a TrackedObjectPool"""
+
+    def __init__(self, pool, worker_idx, obj_id):
+        self.pool = pool
+        self.worker_idx = worker_idx
+        self.obj_id = obj_id
+        self.kill_me = False
+
+    def __repr__(self):
+        return "<TrackedObjectProxy obj_id %d in worker %d>" % (
+            self.obj_id,
+            self.worker_idx,
+        )
+
+    def _call(self, method_name, *args, **kwargs):
+        return self.pool.call([self], method_name, *args, **kwargs)[0]
+
+    def remove_previous_observation(self, debug1=0):
+        return self._call("remove_previous_observation", debug1=debug1)
+
+    def get_distance_and_nsigma(self, testx):
+        return self._call("get_distance_and_nsigma", testx)
+
+    def get_most_recent_data(self):
+        return self._call("get_most_recent_data")
+
+    def debug_info(self, level=3):
+        return self._call("debug_info", level=level)
+
+
+def _worker_main(conn, reconstructor, tracked_object_kwargs):
+    tros = {}
+    while True:
+        msg = conn.recv()
+        cmd = msg[0]
+        if cmd == "close":
+            conn.close()
+            return
+        try:
+            if cmd == "join":
+                obj_id, args = msg[1:]
+                tros[obj_id] = TrackedObject(
+                    reconstructor, obj_id, *args, **tracked_object_kwargs
+                )
+                result = None
+            elif cmd == "update":
+                obj_ids, frame, data_dict, camn2cam_id, grid_cell_size, debug = msg[1:]
+                candidate_grid = None
+                if grid_cell_size is not None:
+                    candidate_grid = CandidateGrid(
+                        reconstructor, data_dict, camn2cam_id, grid_cell_size
+                    )
+                result = []
+                for obj_id in obj_ids:
+                    tro = tros[obj_id]
+                    tro_result = tro.calculate_a_posteriori_estimate(
+                        frame,
+                        data_dict,
+                        camn2cam_id,
+                        debug1=debug,
+                        candidate_grid=candidate_grid,
+                    )
+                    result.append((tro_result, tro.kill_me))
+            elif cmd == "kill":
+                obj_ids = msg[1]
+                result = []
+                for obj_id in obj_ids:
+                    tro = tros.pop(obj_id)
+                    tro.kill()
+                    result.append(KilledTrackedObject(tro))
+            elif cmd == "call":
+                obj_ids, method_name, args, kwargs = msg[1:]
+                result = [
+                    getattr(tros[obj_id], method_name)(*args, **kwargs)
+                    for obj_id in obj_ids
+                ]
+            else:
+                raise ValueError("unknown command %r" % (cmd,))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+        else:
+            sys.stdout.flush()
+            conn.send(("ok", result))
+
+
+class TrackedObjectPool:
+    """a pool of worker processes holding TrackedObject instances
+
+    arguments
+    =========
+    reconstructor - reconstructor instance
+    n_workers - number of worker processes
+    tracked_object_kwargs - keyword arguments for TrackedObject
+    """
+
+    def __init__(self, reconstructor, n_workers, tracked_object_kwargs):
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least 1")
+        self.conns = []
+        self.workers = []
+        self.n_live = []
+        for i in range(n_workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_worker_main,
+                args=(child_conn, reconstructor, tracked_object_kwargs),
+            )
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+            self.n_live.append(0)
+
+    def _send(self, worker_idx, msg):
+        self.conns[worker_idx].send(msg)
+
+    def _recv(self, worker_idx):
+        status, result = self.conns[worker_idx].recv()
+        if status == "error":
+            raise RuntimeError(
+                "error in tracked object worker %d:\n%s" % (worker_idx, result)
+            )
+        return result
+
+    def _by_worker(self, tros):
+        obj_ids_by_worker = {}
+        for tro in tros:
+            obj_ids_by_worker.setdefault(tro.worker_idx, []).append(tro.obj_id)
+        return obj_ids_by_worker
+
+    def _scatter_gather(self, tros, make_msg):
+        """send one message per worker, gather results in order of tros"""
+        obj_ids_by_worker = self._by_worker(tros)
+        for worker_idx, obj_ids in obj_ids_by_worker.items():
+            self._send(worker_idx, make_msg(obj_ids))
+        result_by_obj_id = {}
+        for worker_idx, obj_ids in obj_ids_by_worker.items():
+            results = self._recv(worker_idx)
+            result_by_obj_id.update(zip(obj_ids, results))
+        return [result_by_obj_id[tro.obj_id] for tro in tros]
+
+    def join(self, obj_id, *args):
+        """create a new TrackedObject in the least loaded worker
+
+        The arguments are those of TrackedObject following
+        reconstructor and obj_id. Returns a TrackedObjectProxy.
+        """
+        worker_idx = self.n_live.index(min(self.n_live))
+        self._send(worker_idx, ("join", obj_id, args))
+        self._recv(worker_idx)
+        self.n_live[worker_idx] += 1
+        return TrackedObjectProxy(self, worker_idx, obj_id)
+
+    def calculate_a_posteriori_estimates(
+        self, tros, frame, data_dict, camn2cam_id, grid_cell_size=None, debug=0
+    ):
+        """run calculate_a_posteriori_estimate() for all tros in parallel
+
+        If grid_cell_size is not None, each worker indexes data_dict
+        with a CandidateGrid of that cell size.
+        """
+        data_dict = dict(data_dict)  # a plain dict pickles quickly
+        results = self._scatter_gather(
+            tros,
+            lambda obj_ids: (
+                "update",
+                obj_ids,
+                frame,
+                data_dict,
+                camn2cam_id,
+                grid_cell_size,
+                debug,
+            ),
+        )
+        for tro, (tro_result, kill_me) in zip(tros, results):
+            tro.kill_me = kill_me
+        return [tro_result for (tro_result, kill_me) in results]
+
+    def kill(self, tros):
+        """kill tros and return their KilledTrackedObject instances"""
+        killed = self._scatter_gather(tros, lambda obj_ids: ("kill", obj_ids))
+        for tro in tros:
+            self.n_live[tro.worker_idx] -= 1
+        return killed
+
+    def call(self, tros, method_name, *args, **kwargs):
+        """call a TrackedObject method on tros, return the results"""
+        return self._scatter_gather(
+            tros, lambda obj_ids: ("call", obj_ids, method_name, args, kwargs)
+        )
+
+    def close(self):
+        for worker_idx, worker in enumerate(self.workers):
+            self._send(worker_idx, ("close",))
+            worker.join()
+        self.conns = []
+        self.workers = []
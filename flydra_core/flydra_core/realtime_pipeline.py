@@ -0,0 +1,238 @@
+"""stages of the realtime 3D reconstruction pipeline
+
+Each stage runs in its own thread and passes items to the next stage
+through a bounded StageQueue, so a slow stage does not stall the ones
+before it. The receive stage drains the socket as fast as possible:
+once its queue is full, the oldest packets are dropped and counted,
+instead of being lost silently in the kernel buffer.
+"""
+from __future__ import absolute_import
+import collections
+import errno
+import logging
+import socket
+import threading
+import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+LOG = logging.getLogger(__name__)
+
+
+class StageQueue:
+    """a bounded queue between two stages, with depth and drop metrics
+
+    Parameters
+    ----------
+    name : str
+      The name used in the metrics
+    maxsize : int
+      The maximum number of items waiting
+    drop_oldest : bool
+      When the queue is full, whether put() drops the oldest item
+      (the default) or blocks until an item is taken.
+    """
+
+    def __init__(self, name, maxsize, drop_oldest=True):
+        self.name = name
+        self._maxsize = maxsize
+        self._drop_oldest = drop_oldest
+        self._cond = threading.Condition()
+        # start: vars access controlled by self._cond
+        self._items = collections.deque()
+        self.n_put = 0
+        self.n_dropped = 0
+        self.max_depth = 0
+        #   end: vars access controlled by self._cond
+
+    def put(self, item):
+        with self._cond:
+            while len(self._items) >= self._maxsize:
+                if self._drop_oldest:
+                    self._items.popleft()
+                    self.n_dropped += 1
+                else:
+                    self._cond.wait()
+            self._items.append(item)
+            self.n_put += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """take the oldest item, raising Queue.Empty on timeout"""
+        with self._cond:
+            if timeout is not None:
+                stop_time = time.time() + timeout
+            while not len(self._items):
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = stop_time - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty()
+                    self._cond.wait(remaining)
+            item = self._items.popleft()
+            self._cond.notify_all()
+        return item
+
+    def get_all_nowait(self, max_items=None):
+        """take all waiting items, or only the oldest max_items of them"""
+        with self._cond:
+            if max_items is None or max_items >= len(self._items):
+                items = list(self._items)
+                self._items.clear()
+            else:
+                items = [self._items.popleft() for i in range(max_items)]
+            self._cond.notify_all()
+        return items
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items)
+
+    def get_metrics(self):
+        with self._cond:
+            return {
+                "name": self.name,
+                "depth": len(self._items),
+                "max_depth": self.max_depth,
+                "n_put": self.n_put,
+                "n_dropped": self.n_dropped,
+            }
+
+
+class ReceiveStage(threading.Thread):
+    """drain a receiver into a StageQueue of packets
+
+    Parameters
+    ----------
+    receiver : FlydraBatchReceiver
+      A receiver as returned by flydra_socket.make_receiver(), with a
+      timeout so the quit_event is checked regularly
+    queue : StageQueue
+      The queue of received packets, as bytes
+    quit_event : threading.Event
+      Set to stop the thread
+    """
+
+    def __init__(self, receiver, queue, quit_event):
+        threading.Thread.__init__(self, name="ReceiveStage")
+        self.daemon = True
+        self._receiver = receiver
+        self._queue = queue
+        self._quit_event = quit_event
+
+    def run(self):
+        while not self._quit_event.isSet():
+            try:
+                # all packets waiting, received with one system call
+                batch = self._receiver.recv_batch()
+            except socket.error as err:
+                if err.errno == errno.EAGAIN:
+                    # no data ready. try again (after checking if we should quit).
+                    continue
+                raise
+            for buf in batch:
+                # the batch is only valid until the next call
+                self._queue.put(buf.tobytes())
+
+
+class ConsumerStage(threading.Thread):
+    """call a function with each item of a StageQueue
+
+    Parameters
+    ----------
+    name : str
+      The name of the thread
+    queue : StageQueue
+      The queue of items to handle
+    handle_item : callable
+      Called with each item. An exception is logged and counted in
+      n_errors, and the thread goes on with the next item.
+    quit_event : threading.Event
+      Set to stop the thread once the queue is empty
+    """
+
+    def __init__(self, name, queue, handle_item, quit_event):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._queue = queue
+        self._handle_item = handle_item
+        self._quit_event = quit_event
+        self.n_errors = 0
+
+    def run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self._quit_event.isSet():
+                    break
+                continue
+            try:
+                self._handle_item(item)
+            except Exception:
+                # a dead thread would block the producers of a queue
+                # which does not drop items forever
+                self.n_errors += 1
+                LOG.exception("%s: error handling item" % self.name)
+
+
+class OutputStage:
+    """call functions with a value in a ConsumerStage thread
+
+    Parameters
+    ----------
+    name : str
+      The name of the queue and of the thread
+    maxsize : int
+      The maximum number of outputs waiting. put() blocks once the
+      queue is full.
+
+    put() calls the function immediately until start() is called and
+    after finish() returned.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = StageQueue(name, maxsize, drop_oldest=False)
+        self._quit_event = threading.Event()
+        self._stage = None
+        self.n_errors = 0
+
+    def start(self):
+        self._quit_event.clear()
+        self._stage = ConsumerStage(
+            "OutputStage", self.queue, self._handle_output, self._quit_event
+        )
+        self._stage.start()
+
+    def put(self, func, value):
+        """call func(value) in the output stage"""
+        if self._stage is None:
+            func(value)
+        else:
+            self.queue.put((func, value))
+
+    def _handle_output(self, item):
+        func, value = item
+        func(value)
+
+    def finish(self):
+        """wait until all waiting outputs are done and stop the thread"""
+        if self._stage is None:
+            return
+        self._quit_event.set()
+        self._stage.join()
+        self.n_errors += self._stage.n_errors
+        self._stage = None
+
+    def get_metrics(self):
+        result = self.queue.get_metrics()
+        result["n_errors"] = self.n_errors
+        if self._stage is not None:
+            result["n_errors"] += self._stage.n_errors
+        return result
@@ -393,6 +393,59 @@ def do_3d_operations_on_2d_point(
     return (p1, p2, p3, p4, ray0, ray1, ray2, ray3, ray4, ray5)
 
 
+def do_3d_operations_on_2d_points(
+    helper,
+    x0u,
+    y0u,  # undistorted coords
+    pmat_inv,
+    camera_center,
+    x0_abs,
+    y0_abs,  # distorted coords
+    rise,
+    run,
+):
+    """vectorized version of do_3d_operations_on_2d_point()
+
+    All 2D arguments are arrays of length N from a single camera.
+    Returns (planes, rays) with shapes (N,4) and (N,6).
+    """
+    x0u = numpy.asarray(x0u, dtype=numpy.float64)
+    y0u = numpy.asarray(y0u, dtype=numpy.float64)
+    rise = numpy.asarray(rise, dtype=numpy.float64)
+    run = numpy.asarray(run, dtype=numpy.float64)
+    N = len(x0u)
+
+    found_point_image_plane = numpy.array([x0u, y0u, numpy.ones((N,))])
+    X0 = numpy.dot(pmat_inv, found_point_image_plane).T  # shape (N,4)
+
+    planes = numpy.empty((N, 4))
+    planes.fill(numpy.nan)
+    has_line = ~(numpy.isnan(rise) | numpy.isnan(run))
+    if numpy.any(has_line):
+        # convert the slope in distorted coords to slope in undistorted coords
+        norm = numpy.sqrt(run[has_line] ** 2 + rise[has_line] ** 2)
+        dx = run[has_line] / norm * 0.1
+        dy = rise[has_line] / norm * 0.1
+        x1u, y1u = helper.undistort_many(
+            numpy.asarray(x0_abs)[has_line] + dx, numpy.asarray(y0_abs)[has_line] + dy
+        )
+        X1 = numpy.dot(pmat_inv, [x1u, y1u, numpy.ones(x1u.shape)]).T
+        A = numpy.empty((len(X1), 3, 4))  # 3 points define plane
+        A[:, 0, :] = X0[has_line]
+        A[:, 1, :] = X1
+        A[:, 2, :] = camera_center
+        u, d, vt = numpy.linalg.svd(A, full_matrices=True)
+        planes[has_line] = vt[:, 3, :]  # plane parameters
+
+    # calculate pluecker coords of 3D ray from camera center to point
+    X0 = X0 / X0[:, 3, numpy.newaxis]
+    B = numpy.asarray(camera_center, dtype=numpy.float64)
+    if len(B) == 3:
+        B = numpy.array([B[0], B[1], B[2], 1.0])
+    rays = X0[:, L_i] * B[L_j] - B[L_i] * X0[:, L_j]
+    return planes, rays
+
+
 def angles_near(a, b, eps=None, mod_pi=False, debug=False):
     """compare if angles a and b are within eps of each other. assumes radians"""
 
@@ -1066,6 +1119,113 @@ def Reconstructor_from_xml(elem):
     return r
 
 
+class CameraGeometry(object):
+    """Immutable per-camera geometry of a :class:`Reconstructor`.
+
+    All values are stored in contiguous, read-only float64 arrays
+    whose first axis is the camera index, i.e. the position of the
+    camera in ``cam_ids``.
+
+    Attributes
+    ----------
+    cam_ids : tuple of strings
+    cam_id2idx : dict
+      maps cam_id to camera index
+    pmat : ndarray (N,3,4)
+      camera calibration matrices
+    pmat_inv : ndarray (N,4,3)
+      pseudo-inverse of the camera calibration matrices
+    camera_center : ndarray (N,4)
+      homogeneous camera centers
+    intrinsics : ndarray (N,9)
+      fc1, fc2, cc1, cc2, alpha_c, fc1p, fc2p, cc1p, cc2p
+    distortion : ndarray (N,5)
+      k1, k2, p1, p2, k3 (the order of ``get_nlparams()``)
+    """
+
+    def __init__(self, cam_ids, Pmat, pmat_inv, helpers):
+        cam_ids = tuple(cam_ids)
+        d = self.__dict__  # bypass __setattr__
+        d["cam_ids"] = cam_ids
+        d["cam_id2idx"] = dict((cam_id, i) for i, cam_id in enumerate(cam_ids))
+
+        pmat = [Pmat[cam_id] for cam_id in cam_ids]
+        centers = [pmat2cam_center(P)[:, 0] for P in pmat]
+        intrinsics = []
+        distortion = []
+        for cam_id in cam_ids:
+            h = helpers[cam_id]
+            intrinsics.append(
+                (
+                    h.fc1,
+                    h.fc2,
+                    h.cc1,
+                    h.cc2,
+                    h.alpha_c,
+                    h.fc1p,
+                    h.fc2p,
+                    h.cc1p,
+                    h.cc2p,
+                )
+            )
+            distortion.append(h.get_nlparams())
+        arrays = dict(
+            pmat=(pmat, (3, 4)),
+            pmat_inv=([pmat_inv[cam_id] for cam_id in cam_ids], (4, 3)),
+            camera_center=([(c[0], c[1], c[2], 1.0) for c in centers], (4,)),
+            intrinsics=(intrinsics, (9,)),
+            distortion=(distortion, (5,)),
+        )
+        for name, (value, shape) in arrays.items():
+            arr = numpy.ascontiguousarray(
+                numpy.reshape(numpy.array(value, dtype=numpy.float64), (-1,) + shape)
+            )
+            arr.flags.writeable = False
+            d[name] = arr
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CameraGeometry is immutable")
+
+    def __len__(self):
+        return len(self.cam_ids)
+
+    def distort(self, x):
+        """distort undistorted 2D points of all cameras at once
+
+        x : (M,2,N) array of undistorted pixel coordinates, M being the
+          number of cameras
+        returns (M,2,N) array of distorted pixel coordinates
+
+        This is the math of ReconstructHelper.distort() broadcast over
+        all cameras and points.
+        """
+        intrinsics = self.intrinsics[:, :, np.newaxis]
+        fc1, fc2, cc1, cc2, alpha_c, fc1p, fc2p, cc1p, cc2p = [
+            intrinsics[:, i] for i in range(9)
+        ]
+        if np.any(alpha_c != 0):
+            raise NotImplementedError("distortion with skew (alpha_c != 0)")
+        distortion = self.distortion[:, :, np.newaxis]
+        k1, k2, p1, p2, k3 = [distortion[:, i] for i in range(5)]
+
+        x = np.asarray(x, dtype=np.float64)
+        assert x.shape[:2] == (len(self), 2)
+        xn = (x[:, 0, :] - cc1p) / fc1p
+        yn = (x[:, 1, :] - cc2p) / fc2p
+
+        r_2 = xn * xn + yn * yn
+        term1 = r_2 * (k1 + r_2 * (k2 + r_2 * k3))
+
+        result = np.empty_like(x)
+        result[:, 0, :] = (
+            xn + xn * term1 + (2 * p1 * xn * yn + p2 * (r_2 + 2 * xn * xn))
+        ) * fc1 + cc1
+        result[:, 1, :] = (
+            yn + yn * term1 + (p1 * (r_2 + 2 * yn * yn) + 2 * p2 * xn * yn)
+        ) * fc2 + cc2
+        return result
+
+
 class Reconstructor:
     """A complete calibration for all cameras in a flydra setup
 
@@ -1320,6 +1480,9 @@ class Reconstructor:
             self.pmat_inv[cam_id] = numpy.linalg.pinv(self.Pmat[cam_id])
 
         self.cam_ids = cam_ids
+        self.geometry = CameraGeometry(
+            self.cam_ids, self.Pmat, self.pmat_inv, self._helper
+        )
 
         self.add_water(wateri)
 
@@ -1340,6 +1503,15 @@ class Reconstructor:
         self.cam_combinations_by_size = {}
         for cc in self.cam_combinations:
             self.cam_combinations_by_size.setdefault(len(cc), []).append(cc)
+        # Same combinations, as stacked arrays of indices into
+        # self.cam_ids, for the vectorized hypothesis test.
+        cam_id2idx = dict((cam_id, i) for i, cam_id in enumerate(self.cam_ids))
+        self.cam_combination_idxs_by_size = {}
+        for n_cams, combos in self.cam_combinations_by_size.items():
+            self.cam_combination_idxs_by_size[n_cams] = numpy.array(
+                [[cam_id2idx[cam_id] for cam_id in cc] for cc in combos],
+                dtype=numpy.intp,
+            )
         # fill self._cam_centers_cache
         self._cam_centers_cache = {}
         for cam_id in self.cam_ids:
@@ -1975,12 +2147,11 @@ class Reconstructor:
                     x_nowater[0] = xd
                     x_nowater[1] = yd
                 else:
-                    N_pts = x_nowater.shape[1]
-                    for i in range(N_pts):
-                        xpt = x_nowater[:, i]
-                        xd, yd = self.distort(cam_id, xpt)
-                        x_nowater[0, i] = xd
-                        x_nowater[1, i] = yd
+                    xd, yd = self._helper[cam_id].distort_many(
+                        x_nowater[0], x_nowater[1]
+                    )
+                    x_nowater[0] = xd
+                    x_nowater[1] = yd
 
         if underwater_cond is not None:
             x = np.empty((2, N_points), dtype=np.float64)
@@ -2022,6 +2193,39 @@ class Reconstructor:
             else:
                 return x
 
+    def find2d_all(self, X, distorted=False, bypass_refraction=False):
+        """find projection of 3D points in X onto the image planes of all cameras
+
+        X : (N,3) array of points or (N,4) array of homogeneous points
+          (or a single point of shape (3,) or (4,))
+        returns shape==(M,2,N) projection, where M is the number of
+          cameras, in the order of self.cam_ids
+        """
+        X = np.array(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[np.newaxis, :]
+        if X.shape[1] == 3:
+            X = np.hstack((X, np.ones((X.shape[0], 1))))
+        assert X.shape[1] == 4
+
+        geometry = self.geometry
+        x = np.einsum("mij,nj->min", geometry.pmat, X)  # shape (M,3,N)
+        x = x[:, 0:2, :] / x[:, 2:3, :]  # normalize
+        if distorted:
+            x = geometry.distort(x)
+
+        if self.wateri is not None and not bypass_refraction:
+            w = X[:, 3]
+            assert np.allclose(w, np.ones_like(w))
+            underwater_cond = X[:, 2] < 0
+            if np.any(underwater_cond):
+                underwater_pts = X[underwater_cond, :3]
+                for cam_idx, cam_id in enumerate(geometry.cam_ids):
+                    x[cam_idx][:, underwater_cond] = water.view_points_in_water(
+                        self, cam_id, underwater_pts, self.wateri, distorted=distorted
+                    )
+        return x
+
     def find3d_single_cam(self, cam_id, x):
         """see also SingleCameraCalibration.get_example_3d_point_creating_image_point()"""
         return nx.dot(self.pmat_inv[cam_id], as_column(x))
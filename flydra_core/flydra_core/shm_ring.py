@@ -0,0 +1,289 @@
+"""shared memory ring buffers for messages between processes on one host
+
+A receiver owns a directory (by default in /dev/shm) holding a FIFO
+used for wakeups. Each sender creates its own ring file in that
+directory, so every ring has a single producer and a single consumer
+and needs no locks.
+
+A ring file is a header followed by fixed size slots. The header
+holds (as uint64) the number of slots, the slot size, the number of
+slots written (head) and read (tail), whether the receiver is waiting
+for data and whether the sender has closed the ring. Each slot starts
+with the sequence number of its message and the message length.
+
+A sender drops messages while the ring is full, as a socket would.
+The receiver detects this from the gaps in the sequence numbers.
+
+The head and tail are published after the slot contents are written,
+which relies on stores not being reordered (as on x86).
+
+The wakeup handshake (the sender stores the head and then loads the
+waiting flag, the receiver stores the waiting flag and then loads the
+head) would need a full memory barrier, as even x86 may reorder a load
+before an earlier store, and Python cannot issue one. Therefore the
+sender also wakes the receiver whenever the ring was empty, and the
+receiver never sleeps longer than wakeup_poll_seconds before checking
+the rings again, which bounds the delay of a lost wakeup.
+"""
+from __future__ import absolute_import
+import errno
+import mmap
+import os
+import select
+import shutil
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 16
+WAKEUP_FILENAME = "wakeup"
+RING_SUFFIX = ".ring"
+
+_N_SLOTS, _SLOT_SIZE, _HEAD, _TAIL, _WAITING, _CLOSED = range(6)
+
+
+def get_default_shm_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _get_slot_stride(slot_size):
+    # keep slots 64 byte aligned
+    return -(-(SLOT_HEADER_SIZE + slot_size) // 64) * 64
+
+
+class _Ring:
+    """a memory mapped ring file"""
+
+    def __init__(self, fd, size):
+        self.mm = mmap.mmap(fd, size)
+        arr = np.frombuffer(self.mm, dtype=np.uint8)
+        self.header = arr[:HEADER_SIZE].view(np.uint64)
+        self.arr = arr
+
+    def init_slots(self):
+        self.n_slots = int(self.header[_N_SLOTS])
+        self.slot_size = int(self.header[_SLOT_SIZE])
+        stride = _get_slot_stride(self.slot_size)
+        slots = self.arr[HEADER_SIZE : HEADER_SIZE + self.n_slots * stride]
+        slots = slots.reshape((self.n_slots, stride))
+        self.slot_headers = np.ndarray(
+            (self.n_slots, 2),
+            dtype=np.uint64,
+            buffer=self.mm,
+            offset=HEADER_SIZE,
+            strides=(stride, 8),
+        )
+        self.payloads = slots[:, SLOT_HEADER_SIZE : SLOT_HEADER_SIZE + self.slot_size]
+
+    def close(self):
+        # The mmap is closed once no more arrays view it.
+        self.header = self.arr = self.slot_headers = self.payloads = None
+        self.mm = None
+
+
+class SharedMemoryRingSender:
+    """send messages to a SharedMemoryRingReceiver
+
+    Parameters
+    ----------
+    dirname : str
+      The directory of the receiver
+    n_slots : int
+      The number of messages the ring holds
+    slot_size : int
+      The maximum size of a message
+    """
+
+    def __init__(self, dirname, n_slots=256, slot_size=4096):
+        size = HEADER_SIZE + n_slots * _get_slot_stride(slot_size)
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix="ring-")
+        try:
+            os.ftruncate(fd, size)
+            self._ring = _Ring(fd, size)
+        finally:
+            os.close(fd)
+        self._ring.header[_N_SLOTS] = n_slots
+        self._ring.header[_SLOT_SIZE] = slot_size
+        self._ring.init_slots()
+        self._seq = 0
+        self.n_dropped = 0
+
+        # the receiver only opens complete ring files
+        self._filename = tmp_filename + RING_SUFFIX
+        os.rename(tmp_filename, self._filename)
+        self._wakeup_fd = os.open(
+            os.path.join(dirname, WAKEUP_FILENAME), os.O_WRONLY | os.O_NONBLOCK
+        )
+        self._wakeup()  # let the receiver find the new ring
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_fd, b"\0")
+        except OSError as err:
+            # the FIFO is full, so the receiver will wake up anyway
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def send(self, data):
+        ring = self._ring
+        n_bytes = len(data)
+        assert n_bytes <= ring.slot_size
+        seq = self._seq
+        self._seq += 1
+        head = int(ring.header[_HEAD])
+        tail = int(ring.header[_TAIL])
+        if head - tail >= ring.n_slots:
+            # full, drop the message
+            self.n_dropped += 1
+            return
+        i = head % ring.n_slots
+        memoryview(ring.payloads[i])[:n_bytes] = data
+        ring.slot_headers[i, 0] = seq
+        ring.slot_headers[i, 1] = n_bytes
+        ring.header[_HEAD] = head + 1
+        if head == tail or ring.header[_WAITING]:
+            self._wakeup()
+
+    def close(self):
+        """close the ring; the receiver removes it once it is read"""
+        self._ring.header[_CLOSED] = 1
+        self._wakeup()
+        self._ring.close()
+        os.close(self._wakeup_fd)
+
+
+class SharedMemoryRingReceiver:
+    """receive messages from the SharedMemoryRingSender instances of a directory
+
+    Parameters
+    ----------
+    dirname : str
+      The directory to create. It must not exist.
+    timeout_seconds : float, optional
+      The maximum duration to wait for a message
+    wakeup_poll_seconds : float
+      The maximum duration to sleep before checking the rings again,
+      in case a wakeup was lost
+    """
+
+    def __init__(self, dirname, timeout_seconds=None, wakeup_poll_seconds=0.005):
+        os.mkdir(dirname)
+        self._dirname = dirname
+        self._timeout_seconds = timeout_seconds
+        self._wakeup_poll_seconds = wakeup_poll_seconds
+        wakeup_filename = os.path.join(dirname, WAKEUP_FILENAME)
+        os.mkfifo(wakeup_filename)
+        self._wakeup_fd = os.open(wakeup_filename, os.O_RDONLY | os.O_NONBLOCK)
+        # keep a writer open, so the FIFO never signals end of file
+        self._wakeup_keep_fd = os.open(wakeup_filename, os.O_WRONLY | os.O_NONBLOCK)
+        self._rings = {}  # by filename
+        self._expected_seqs = {}
+        self._to_release = []
+        self.n_lost = 0
+
+    def _scan(self):
+        """open the rings of new senders"""
+        for name in os.listdir(self._dirname):
+            if not name.endswith(RING_SUFFIX) or name in self._rings:
+                continue
+            filename = os.path.join(self._dirname, name)
+            fd = os.open(filename, os.O_RDWR)
+            try:
+                ring = _Ring(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            ring.init_slots()
+            self._rings[name] = ring
+            self._expected_seqs[name] = 0
+
+    def _release(self):
+        """let the senders reuse the slots returned by the last call"""
+        for ring, tail in self._to_release:
+            ring.header[_TAIL] = tail
+        self._to_release = []
+
+    def _poll(self, max_count):
+        batch = []
+        for name in list(self._rings.keys()):
+            ring = self._rings[name]
+            tail = int(ring.header[_TAIL])
+            closed = ring.header[_CLOSED]
+            head = int(ring.header[_HEAD])
+            stop = min(head, tail + max_count - len(batch))
+            for j in range(tail, stop):
+                i = j % ring.n_slots
+                seq = int(ring.slot_headers[i, 0])
+                self.n_lost += seq - self._expected_seqs[name]
+                self._expected_seqs[name] = seq + 1
+                batch.append(ring.payloads[i, : int(ring.slot_headers[i, 1])])
+            if stop > tail:
+                self._to_release.append((ring, stop))
+            elif closed:
+                # closed and completely read
+                ring.close()
+                del self._rings[name]
+                del self._expected_seqs[name]
+                os.unlink(os.path.join(self._dirname, name))
+            if len(batch) == max_count:
+                break
+        return batch
+
+    def _set_waiting(self, value):
+        for ring in self._rings.values():
+            ring.header[_WAITING] = value
+
+    def recv_batch(self, max_count=64):
+        """wait for a message and return it with all others already waiting
+
+        Returns a list of up to max_count arrays of uint8. These are
+        views of the rings and are only valid until the next call.
+        Raises socket.error with errno EAGAIN on timeout.
+        """
+        self._release()
+        if self._timeout_seconds is not None:
+            stop_time = time.time() + self._timeout_seconds
+        while True:
+            batch = self._poll(max_count)
+            if batch:
+                return batch
+            self._scan()
+            self._set_waiting(1)
+            batch = self._poll(max_count)
+            if batch:
+                self._set_waiting(0)
+                return batch
+            wait = self._wakeup_poll_seconds
+            if self._timeout_seconds is not None:
+                wait = min(wait, stop_time - time.time())
+            if wait > 0:
+                select.select([self._wakeup_fd], [], [], wait)
+            self._set_waiting(0)
+            try:
+                while os.read(self._wakeup_fd, 4096):
+                    pass
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+            if self._timeout_seconds is not None and time.time() >= stop_time:
+                batch = self._poll(max_count)
+                if batch:
+                    return batch
+                raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+
+    def recv(self):
+        """wait for one message and return a copy of it"""
+        return self.recv_batch(max_count=1)[0].tobytes()
+
+    def close(self):
+        self._release()
+        for ring in self._rings.values():
+            ring.close()
+        self._rings = {}
+        os.close(self._wakeup_fd)
+        os.close(self._wakeup_keep_fd)
+        shutil.rmtree(self._dirname)
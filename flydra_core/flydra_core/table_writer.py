@@ -0,0 +1,248 @@
+"""batched writing of rows to PyTables tables from a dedicated thread
+
+The threads producing data fill a preallocated structured array (a
+staging buffer) in place. A writer thread swaps it for a spare buffer
+and appends all staged rows to the table with a single call, either
+when enough rows are staged or when enough time has passed. Producers
+only ever wait for the buffer swap, never for HDF5.
+"""
+from __future__ import absolute_import
+import threading
+import time
+
+import numpy as np
+
+
+class StagingBuffer:
+    """a preallocated structured array filled in place
+
+    The capacity doubles when the buffer is full, so rows are never
+    dropped.
+    """
+
+    def __init__(self, dtype, capacity):
+        self.data = np.empty((capacity,), dtype=dtype)
+        self.n_rows = 0
+
+    def _reserve(self, n_rows):
+        needed = self.n_rows + n_rows
+        capacity = len(self.data)
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            data = np.empty((capacity,), dtype=self.data.dtype)
+            data[: self.n_rows] = self.data[: self.n_rows]
+            self.data = data
+        start = self.n_rows
+        self.n_rows = needed
+        return self.data[start:needed]
+
+    def append_row(self, row):
+        """append one row, given as a tuple in the order of the fields"""
+        self._reserve(1)[0] = row
+
+    def append_rows(self, rows):
+        """append a sequence of rows, either tuples or a structured array"""
+        if len(rows):
+            self._reserve(len(rows))[:] = rows
+
+    def append_columns(self, n_rows, columns):
+        """append n_rows, filled in place by column
+
+        columns is a dict of field name to a value or an array of
+        n_rows values. Fields not given are left uninitialized.
+        """
+        rows = self._reserve(n_rows)
+        for name, values in columns.items():
+            rows[name] = values
+
+    def get_rows(self):
+        """get a view of the staged rows"""
+        return self.data[: self.n_rows]
+
+    def clear(self):
+        self.n_rows = 0
+
+
+class BatchedTableWriter:
+    """stage rows for a table and append them in batches
+
+    Parameters
+    ----------
+    name : str
+      The name used in the counters
+    dtype : numpy dtype
+      The dtype of the rows, in the column order of the table
+    capacity : int
+      The initial number of rows of each staging buffer
+    flush_rows : int, optional
+      Flush once this many rows are staged (default: capacity)
+    flush_interval_sec : float
+      Flush staged rows at least this often
+
+    The append methods may be called from any thread, flush() is only
+    called from a single thread at a time (see TableWriterThread).
+    Rows staged while no table is set are discarded at the next flush.
+    """
+
+    def __init__(
+        self, name, dtype, capacity=10000, flush_rows=None, flush_interval_sec=1.0
+    ):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        if flush_rows is None:
+            flush_rows = capacity
+        self.flush_rows = flush_rows
+        self.flush_interval_sec = flush_interval_sec
+        self.table = None
+        self.wake_event = None  # set when flush_rows are staged
+        self._lock = threading.Lock()
+        # start: vars access controlled by self._lock
+        self._filling = StagingBuffer(self.dtype, capacity)
+        self.n_rows_staged = 0
+        #   end: vars access controlled by self._lock
+        self._spare = StagingBuffer(self.dtype, capacity)
+        self._last_flush_time = time.time()
+        self.n_rows_written = 0
+        self.n_rows_discarded = 0
+        self.n_bytes_written = 0
+        self.n_flushes = 0
+        self.max_rows_per_flush = 0
+        self.write_time_sec = 0.0
+
+    def set_table(self, table):
+        """set the table to append to, or None to discard rows"""
+        self.table = table
+
+    def append_row(self, row):
+        with self._lock:
+            self._filling.append_row(row)
+            self.n_rows_staged += 1
+            n_rows = self._filling.n_rows
+        self._check_wake(n_rows)
+
+    def append_rows(self, rows):
+        with self._lock:
+            self._filling.append_rows(rows)
+            self.n_rows_staged += len(rows)
+            n_rows = self._filling.n_rows
+        self._check_wake(n_rows)
+
+    def append_columns(self, n_rows, columns):
+        with self._lock:
+            self._filling.append_columns(n_rows, columns)
+            self.n_rows_staged += n_rows
+            n_rows = self._filling.n_rows
+        self._check_wake(n_rows)
+
+    def _check_wake(self, n_rows):
+        if n_rows >= self.flush_rows and self.wake_event is not None:
+            self.wake_event.set()
+
+    def get_n_rows_pending(self):
+        with self._lock:
+            return self._filling.n_rows
+
+    def needs_flush(self, now=None):
+        if now is None:
+            now = time.time()
+        if now - self._last_flush_time >= self.flush_interval_sec:
+            return True
+        return self.get_n_rows_pending() >= self.flush_rows
+
+    def flush(self):
+        """append all staged rows to the table, returns the number of rows"""
+        self._last_flush_time = time.time()
+        with self._lock:
+            self._filling, self._spare = self._spare, self._filling
+        staged = self._spare
+        rows = staged.get_rows()
+        n_rows = len(rows)
+        table = self.table
+        if n_rows and table is None:
+            self.n_rows_discarded += n_rows
+        elif n_rows:
+            t0 = time.time()
+            table.append(rows)
+            table.flush()
+            self.write_time_sec += time.time() - t0
+            self.n_rows_written += n_rows
+            self.n_bytes_written += rows.nbytes
+            self.n_flushes += 1
+            self.max_rows_per_flush = max(self.max_rows_per_flush, n_rows)
+        staged.clear()
+        return n_rows
+
+    def get_counters(self):
+        """get the write throughput counters"""
+        if self.write_time_sec > 0:
+            rows_per_sec = self.n_rows_written / self.write_time_sec
+            bytes_per_sec = self.n_bytes_written / self.write_time_sec
+        else:
+            rows_per_sec = bytes_per_sec = None
+        return {
+            "name": self.name,
+            "n_rows_staged": self.n_rows_staged,
+            "n_rows_pending": self.get_n_rows_pending(),
+            "n_rows_written": self.n_rows_written,
+            "n_rows_discarded": self.n_rows_discarded,
+            "n_bytes_written": self.n_bytes_written,
+            "n_flushes": self.n_flushes,
+            "max_rows_per_flush": self.max_rows_per_flush,
+            "write_time_sec": self.write_time_sec,
+            # the rate HDF5 could sustain, not the rate of the data
+            "write_rows_per_sec": rows_per_sec,
+            "write_bytes_per_sec": bytes_per_sec,
+        }
+
+
+class TableWriterThread(threading.Thread):
+    """flush BatchedTableWriters when they need it
+
+    Parameters
+    ----------
+    writers : list of BatchedTableWriter
+      The writers to flush
+    lock : threading.Lock, optional
+      Held while flushing, to serialize all access to the HDF5 file
+    poll_interval_sec : float
+      The longest time between checks of the flush policies
+    """
+
+    def __init__(self, writers, lock=None, poll_interval_sec=0.1):
+        threading.Thread.__init__(self, name="TableWriterThread")
+        self.daemon = True
+        self.writers = list(writers)
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+        self.poll_interval_sec = poll_interval_sec
+        self._wake_event = threading.Event()
+        self._quit_event = threading.Event()
+        for writer in self.writers:
+            writer.wake_event = self._wake_event
+
+    def run(self):
+        while not self._quit_event.isSet():
+            self._wake_event.wait(self.poll_interval_sec)
+            self._wake_event.clear()
+            now = time.time()
+            for writer in self.writers:
+                if writer.needs_flush(now):
+                    with self.lock:
+                        writer.flush()
+
+    def flush_all(self):
+        """flush all writers now, must be called with self.lock acquired"""
+        for writer in self.writers:
+            writer.flush()
+
+    def quit(self):
+        self._quit_event.set()
+        self._wake_event.set()
+        self.join()
+        with self.lock:
+            self.flush_all()
+
+    def get_counters(self):
+        return [writer.get_counters() for writer in self.writers]
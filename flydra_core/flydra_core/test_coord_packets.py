@@ -0,0 +1,33 @@
+import struct
+
+import numpy as np
+
+from flydra_core.common_variables import recv_pt_fmt, recv_pt_header_fmt
+from flydra_core.coord_packets import (
+    PointPacketEncoder,
+    decode_point_packet,
+    recv_pt_dtype,
+)
+
+
+def test_coord_packets():
+    cam_id = b"cam1"
+    encoder = PointPacketEncoder(cam_id, max_num_points=2)
+    for n_pts in [0, 1, 2, 5, 3]:
+        pts = [
+            (i + 0.5, 2.0 * i, 3.0, -1.5, 2.5, i % 2, 100 + i, 20.25, 30.5)
+            for i in range(n_pts)
+        ]
+        header = (cam_id, 12.5, 13.5, 1234 + n_pts, n_pts, 7)
+
+        # the encoded packet is identical to one packed with struct
+        expected = struct.pack(recv_pt_header_fmt, *header)
+        for pt in pts:
+            expected += struct.pack(recv_pt_fmt, *pt)
+        points = np.array(pts, dtype=recv_pt_dtype)
+        buf = encoder.encode(12.5, 13.5, 1234 + n_pts, points, 7)
+        assert buf.tobytes() == expected
+
+        decoded_header, decoded_points = decode_point_packet(expected)
+        assert decoded_header == header
+        assert decoded_points.tolist() == pts
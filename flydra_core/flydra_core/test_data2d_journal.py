@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+
+import numpy as np
+import tables
+
+from flydra_core.data2d_journal import (
+    Data2dJournalWriter,
+    Data2dJournalReader,
+    JournalCompactor,
+    compact_journal,
+    list_segments,
+    INFO2D_DTYPE,
+)
+
+
+def _make_rows(start, stop):
+    rows = np.zeros((stop - start,), dtype=INFO2D_DTYPE)
+    rows["camn"] = 1
+    rows["frame"] = np.arange(start, stop)
+    rows["x"] = np.arange(start, stop) * 0.5
+    return rows
+
+
+def test_data2d_journal():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dirname = os.path.join(tmpdir, "journal")
+        writer = Data2dJournalWriter(dirname, segment_max_bytes=1000)
+        for start in range(0, 100, 10):
+            writer.append(_make_rows(start, start + 10))
+        writer.append([tuple(row) for row in _make_rows(100, 102)])
+        writer.close()
+        segments = list_segments(dirname)
+        assert len(segments) > 1
+
+        reader = Data2dJournalReader(dirname)
+        assert len(reader) == 102
+        assert np.all(reader.read(field="frame") == np.arange(102))
+        rows = reader.read(start=15, stop=35)
+        assert np.all(rows["frame"] == np.arange(15, 35))
+        assert np.allclose(rows["x"], np.arange(15, 35) * 0.5)
+        assert len(reader.read(start=50, stop=50)) == 0
+        x = reader.read(start=95, field="x")
+        assert x.dtype == INFO2D_DTYPE["x"]
+        assert np.allclose(x, np.arange(95, 102) * 0.5)
+        assert reader.read(start=50, stop=50, field="x").dtype == x.dtype
+
+        # a torn record at the end of a segment (e.g. after a power loss)
+        with open(segments[0], mode="ab") as fd:
+            fd.write(b"\x50\x00\x00\x00\x00")
+        # a corrupt record in the last segment
+        with open(segments[-1], mode="r+b") as fd:
+            fd.seek(-1, os.SEEK_END)
+            fd.write(b"\xff")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            reader = Data2dJournalReader(dirname)
+        assert len(caught) == 2
+        assert len(reader) == 100
+        assert np.all(reader.read(field="frame") == np.arange(100))
+
+        # appending continues with a new segment
+        writer = Data2dJournalWriter(dirname)
+        writer.append(_make_rows(102, 110))
+        writer.close()
+        assert len(list_segments(dirname)) == len(segments) + 1
+
+        h5filename = os.path.join(tmpdir, "data.h5")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            assert compact_journal(dirname, h5filename) == 108
+            # an interrupted compaction is redone, in the background
+            # once the lock serializing the HDF5 access is released
+            lock = threading.Lock()
+            with lock:
+                compactor = JournalCompactor(dirname, h5filename, lock=lock)
+                compactor.start()
+                compactor.join(0.1)
+                assert compactor.n_rows is None
+            compactor.join()
+            assert compactor.n_rows == 108
+        assert not os.path.exists(dirname)
+        with tables.open_file(h5filename, mode="r") as h5file:
+            data2d = h5file.root.data2d_distorted[:]
+        assert np.all(data2d["frame"][-8:] == np.arange(102, 110))
+        assert len(data2d) == 108
+    finally:
+        shutil.rmtree(tmpdir)
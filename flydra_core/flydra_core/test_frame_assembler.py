@@ -0,0 +1,74 @@
+import numpy as np
+
+from flydra_core.frame_assembler import FrameAssembler
+from flydra_core.realtime_pipeline import StageQueue
+
+
+def test_frame_assembler():
+    fa = FrameAssembler(n_cams=3, capacity=8)
+
+    slot = fa.add(100, 0, 10.0, n_pts=1, camn=5, pluecker_coords=["a"])
+    assert fa.get_framenumber(slot) == 100
+    assert not fa.is_complete(slot)
+    assert fa.add(100, 2, 9.5, n_pts=0, camn=7, pluecker_coords=[]) == slot
+    assert fa.add(100, 1, 10.5, n_pts=2, camn=6, pluecker_coords=["b", "c"]) == slot
+    assert fa.is_complete(slot)
+    assert fa.get_oldest_timestamp(slot) == (9.5, 2)
+    assert fa.get_pluecker_coords_by_camn(slot) == {5: ["a"], 6: ["b", "c"]}
+    assert np.allclose(fa.get_trigger_timestamps(slot), [10.0, 10.5, 9.5])
+    fa.release(slot)
+
+    # frames sharing a slot
+    slot = fa.add(101, 1, None)
+    assert fa.get_oldest_timestamp(slot) == (None, 0)
+    fa.add(101, 0, 11.0)
+    assert fa.get_oldest_timestamp(slot) == (11.0, 0)
+    timestamps = fa.get_trigger_timestamps(slot)
+    assert timestamps[0] == 11.0 and np.isnan(timestamps[1])
+    assert fa.add(101 - 8, 2, 1.0) is None  # older, dropped
+    assert fa.n_dropped == 1
+    assert fa.last_evicted is None
+    assert fa.add(101 + 8, 2, 12.0) == slot  # newer, evicts frame 101
+    assert fa.n_evicted == 1
+    assert fa.last_evicted[0] == 101
+    assert fa.get_missing_cam_idxs(fa.last_evicted[1]) == [2]
+    assert fa.get_framenumber(slot) == 109
+    assert fa.get_pluecker_coords_by_camn(slot) == {}
+
+    # changing the cameras discards all frames
+    fa.reset(n_cams=2)
+    assert fa.get_framenumber(slot) is None
+    slot = fa.add(200, 0, 20.0)
+    fa.add(200, 1, 20.0)
+    assert fa.is_complete(slot)
+
+
+def test_frame_assembler_backlog():
+    # a backlog of completed frames larger than the capacity
+    fa = FrameAssembler(n_cams=1, capacity=8)
+    for framenumber in range(12):
+        fa.add(framenumber, 0, float(framenumber))
+    # frames 0..3 were never released, but they are counted
+    assert fa.n_evicted == 0
+    assert fa.n_overwritten == 4
+    framenumbers = [fa.get_framenumber(slot) for slot in range(8)]
+    assert framenumbers == [8, 9, 10, 11, 4, 5, 6, 7]
+
+    # taking the backlog in batches of at most capacity * n_cams
+    # packets, like CoordinateProcessor.run(), loses no frame
+    fa = FrameAssembler(n_cams=2, capacity=8)
+    queue = StageQueue("receive", 1000)
+    for framenumber in range(30):
+        for cam_idx in range(2):
+            queue.put((framenumber, cam_idx))
+    processed = []
+    while queue.qsize():
+        slots = set()
+        for framenumber, cam_idx in queue.get_all_nowait(fa.capacity * fa.n_cams):
+            slots.add(fa.add(framenumber, cam_idx, None))
+        for slot in slots:
+            assert fa.is_complete(slot)
+            processed.append(fa.get_framenumber(slot))
+            fa.release(slot)
+    assert sorted(processed) == list(range(30))
+    assert fa.n_overwritten == 0
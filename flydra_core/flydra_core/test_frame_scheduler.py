@@ -0,0 +1,40 @@
+from flydra_core.frame_scheduler import (
+    FrameScheduler,
+    FULL,
+    TRACK_ONLY,
+    PREDICT_ONLY,
+)
+
+
+def test_frame_scheduler():
+    scheduler = FrameScheduler(max_latency_sec=0.1, max_consecutive_skipped=2)
+    now = 100.0
+
+    # no backlog
+    assert scheduler.schedule([(10, 99.95, "a")], now=now) == [(FULL, "a")]
+
+    # backlog, in order of framenumber with the newest getting the full work
+    frames = [(13, 99.97, "d"), (11, 99.95, "b"), (12, 99.96, "c")]
+    assert scheduler.schedule(frames, now=now) == [
+        (TRACK_ONLY, "b"),
+        (TRACK_ONLY, "c"),
+        (FULL, "d"),
+    ]
+    assert scheduler.max_backlog == 3
+
+    # stale frames are skipped, but not too many in a row
+    frames = [(i, 99.0, i) for i in range(20, 25)] + [(25, 99.99, 25)]
+    assert scheduler.schedule(frames, now=now) == [
+        (PREDICT_ONLY, 20),
+        (PREDICT_ONLY, 21),
+        (TRACK_ONLY, 22),
+        (PREDICT_ONLY, 23),
+        (PREDICT_ONLY, 24),
+        (FULL, 25),
+    ]
+
+    # without latency estimate
+    assert scheduler.schedule([(30, None, "x")], now=now) == [(PREDICT_ONLY, "x")]
+
+    assert scheduler.n_frames == {FULL: 3, TRACK_ONLY: 3, PREDICT_ONLY: 5}
+    assert scheduler.get_n_degraded() == 8
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from flydra_core.realtime_pipeline import StageQueue, ConsumerStage, OutputStage
+
+
+def test_consumer_stage_errors():
+    queue = StageQueue("test", 2, drop_oldest=False)
+    quit_event = threading.Event()
+    handled = []
+
+    def handle_item(item):
+        if item % 3 == 0:
+            raise ValueError("bad item %d" % item)
+        handled.append(item)
+
+    stage = ConsumerStage("TestStage", queue, handle_item, quit_event)
+    stage.start()
+    # with a dead thread, put() would block once the queue is full
+    for i in range(10):
+        queue.put(i)
+    quit_event.set()
+    stage.join(5.0)
+    assert not stage.is_alive()
+    assert handled == [1, 2, 4, 5, 7, 8]
+    assert stage.n_errors == 4
+
+
+def test_output_stage():
+    stage = OutputStage("output", 5)
+    thread_names = []
+
+    def output(value):
+        thread_names.append((value, threading.current_thread().name))
+
+    # before start(), outputs are handled immediately
+    stage.put(output, 0)
+    assert thread_names == [(0, threading.current_thread().name)]
+
+    stage.start()
+
+    def slow_output(value):
+        time.sleep(0.01)
+        output(value)
+
+    def bad_output(value):
+        raise ValueError("bad output")
+
+    for i in range(1, 20):
+        if i == 10:
+            stage.put(bad_output, i)
+        else:
+            stage.put(slow_output, i)
+    # like CoordinateProcessor.finish_processing(): the outputs of
+    # the killed trackers are put just before the stage is finished
+    stage.put(output, 20)
+    stage.finish()
+    assert [value for value, name in thread_names] == [
+        i for i in range(21) if i != 10
+    ]
+    assert set(name for value, name in thread_names[1:]) == set(["OutputStage"])
+    metrics = stage.get_metrics()
+    assert metrics["n_put"] == 20
+    assert metrics["n_dropped"] == 0
+    assert metrics["n_errors"] == 1
+
+    # after finish(), outputs are handled immediately again
+    stage.put(output, 21)
+    assert thread_names[-1] == (21, threading.current_thread().name)
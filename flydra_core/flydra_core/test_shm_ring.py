@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from flydra_core.shm_ring import SharedMemoryRingSender, SharedMemoryRingReceiver
+
+
+def test_shm_ring():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dirname = os.path.join(tmpdir, "ring")
+        receiver = SharedMemoryRingReceiver(dirname, timeout_seconds=5.0)
+        sender = SharedMemoryRingSender(dirname, n_slots=4, slot_size=16)
+
+        # full rings drop messages, which the receiver counts as lost
+        for i in range(6):
+            sender.send(b"msg%d" % i)
+        assert sender.n_dropped == 2
+        batch = receiver.recv_batch()
+        assert [buf.tobytes() for buf in batch] == [b"msg0", b"msg1", b"msg2", b"msg3"]
+
+        # a sender writing to an empty ring wakes a waiting receiver
+        def send_later():
+            for i in range(6, 26):
+                time.sleep(0.01)
+                sender.send(b"msg%d" % i)
+
+        thread = threading.Thread(target=send_later)
+        thread.start()
+        max_latency = 0.0
+        for i in range(6, 26):
+            t0 = time.time()
+            assert receiver.recv() == b"msg%d" % i
+            max_latency = max(max_latency, time.time() - t0)
+        thread.join()
+        assert max_latency < 0.1
+        assert receiver.n_lost == 2
+        sender.close()
+        receiver.close()
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import tables
+
+from flydra_core.table_writer import BatchedTableWriter, TableWriterThread
+
+
+class Row(tables.IsDescription):
+    frame = tables.UInt64Col(pos=0)
+    x = tables.Float32Col(pos=1)
+
+
+def test_batched_table_writer():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "test.h5")
+        with tables.open_file(fname, mode="w") as h5file:
+            table = h5file.create_table(h5file.root, "rows", Row)
+            writer = BatchedTableWriter(
+                "rows", table.dtype, capacity=4, flush_rows=4, flush_interval_sec=60
+            )
+
+            # without table, rows are discarded
+            writer.append_row((0, 0.0))
+            assert writer.flush() == 1
+
+            writer.set_table(table)
+            writer.append_row((1, 1.0))
+            writer.append_rows([(i, i * 2.0) for i in range(2, 12)])  # grows
+            assert writer.get_n_rows_pending() == 11
+            assert writer.needs_flush()
+
+            lock = threading.Lock()
+            writer_thread = TableWriterThread([writer], lock=lock)
+            writer_thread.start()
+            writer.append_rows(np.array([(12, 24.0)], dtype=table.dtype))
+            writer.append_columns(
+                3, {"frame": np.arange(13, 16), "x": np.array([26.0, 28.0, 30.0])}
+            )
+            writer.append_columns(1, {"frame": 16, "x": np.nan})
+            writer_thread.quit()
+
+            assert np.all(table.cols.frame[:] == np.arange(1, 17))
+            assert np.all(table.cols.x[-5:-1] == [24.0, 26.0, 28.0, 30.0])
+            assert np.isnan(table.cols.x[-1])
+            counters = writer_thread.get_counters()[0]
+            assert counters["n_rows_staged"] == 17
+            assert counters["n_rows_discarded"] == 1
+            assert counters["n_rows_written"] == 16
+            assert counters["n_rows_pending"] == 0
+            assert counters["n_bytes_written"] == 16 * table.dtype.itemsize
+    finally:
+        shutil.rmtree(tmpdir)
@@ -46,16 +46,10 @@ def view_points_in_water(reconstructor, cam_id, pts3d, water, distorted=True):
 
     shifted_water_surface_pts = np.zeros_like(pts3d)
 
-    r0 = []
-    for i in range(len(shifted_pts)):
-        assert depth[i] >= 0
-        r0.append(
-            _refraction.find_fastest_path_fermat(
-                water.n1, water.n2, height, r[i], depth[i], water.water_roots_eps
-            )
-        )
-
-    r0 = np.array(r0)
+    assert np.all(depth >= 0)
+    r0 = _refraction.find_fastest_path_fermat_many(
+        water.n1, water.n2, height, r, depth, water.water_roots_eps
+    )
     shifted_water_surface_pts[:, 0] = r0 * np.cos(theta)
     shifted_water_surface_pts[:, 1] = r0 * np.sin(theta)
 
@@ -57,6 +57,14 @@ ext_modules.append(
     )
 )
 
+ext_modules.append(
+    Extension(
+        name="flydra_core._fused_ekf",
+        sources=["flydra_core/_fused_ekf.pyx"],
+        include_dirs=[np.get_include()],
+    )
+)
+
 ext_modules.append(
     Extension(name="flydra_core._mahalanobis", sources=["flydra_core/_mahalanobis.pyx"])
 )